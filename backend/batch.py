@@ -0,0 +1,381 @@
+"""
+Upscale por lotes para rIA
+Agrupa las imágenes por (modelo, escala, tile, motor), ejecuta una sola invocación
+del motor por grupo y emite los resultados como NDJSON a medida que el motor
+avisa de cada salida escrita. Un fallo en una imagen no hace fallar el lote
+completo.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from functools import partial
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+from config import BATCH_GROUP_SIZE, MAX_IMAGE_SIZE, SUPPORTED_FORMATS, TEMP_DIR
+from image_io import prepare_input_file, read_image_size, write_json_response
+from progress import current_reporter, reporting, reporting_outputs
+from scheduler import Priority, QueueFullError
+from upscale_service import RealESRGANService
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BatchItem:
+    """Imagen individual dentro de un lote"""
+    index: int
+    filename: str
+    model: str
+    scale: int
+    tile_size: int
+    engine: str = "auto"
+    input_path: Optional[Path] = None
+    content_hash: Optional[str] = None
+    cache_key: Optional[str] = None
+    output_path: Optional[Path] = None
+    error: Optional[str] = None
+    cached: bool = False
+    reported: bool = False
+
+
+@dataclass
+class BatchGroup:
+    """Imágenes que comparten parámetros y se procesan en una invocación"""
+    model: str
+    scale: int
+    tile_size: int
+    engine: str
+    directory: Path
+    items: list = field(default_factory=list)
+    future: Optional[Future] = None
+
+    @property
+    def input_dir(self) -> Path:
+        return self.directory / "in"
+
+    @property
+    def output_dir(self) -> Path:
+        return self.directory / "out"
+
+
+class BatchRun:
+    """Orquesta un lote: preparación, agrupación, ejecución y streaming"""
+
+    def __init__(self, service: RealESRGANService, client_id: str):
+        self.service = service
+        self.client_id = client_id
+        self.batch_dir = TEMP_DIR / f"batch-{uuid.uuid4()}"
+        self.staging_dir = self.batch_dir / "staging"
+        self.staging_dir.mkdir(parents=True)
+        self.items: list[BatchItem] = []
+        self.cancel_event = threading.Event()
+        self.start_time = time.time()
+        # El avance del lote es el de imágenes emitidas (cada grupo informaría del suyo)
+        self.reporter = current_reporter()
+        self.reported = 0
+        # Salidas escritas por el motor ((grupo, Path)) y avisos de futures
+        # terminados (None), desde los hilos del planificador; los crea stream()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._events: Optional[asyncio.Queue] = None
+
+    async def add_item(
+        self,
+        filename: str,
+        path: Path,
+        content_hash: str,
+        model: str,
+        scale: int,
+        tile_size: int,
+        engine: str = "auto"
+    ):
+        """Registra una imagen ya volcada a disco y la valida (en CodecPool)"""
+        item = BatchItem(len(self.items), filename, model, scale, tile_size, engine, content_hash=content_hash)
+        self.items.append(item)
+
+        extension = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+        if extension not in SUPPORTED_FORMATS:
+            item.error = f"Formato no soportado. Usa: {', '.join(SUPPORTED_FORMATS)}"
+            path.unlink(missing_ok=True)
+            return
+
+        try:
+            # El lote ya fue admitido: sus imágenes no cuentan contra el límite del pool
+            item.input_path, _ = await self.service.codec.run(
+                prepare_input_file, path, MAX_IMAGE_SIZE, admit=False
+            )
+        except ValueError as e:
+            item.error = str(e)
+            path.unlink(missing_ok=True)
+
+    async def add_archive(self, archive_path: Path, max_items: int, **params):
+        """Extrae las imágenes de un ZIP al área de preparación (en un hilo)"""
+        with zipfile.ZipFile(archive_path) as archive:
+            members = [m for m in archive.infolist() if not m.is_dir()]
+            for member in members:
+                if len(self.items) >= max_items:
+                    raise ValueError(f"El lote supera el máximo de {max_items} imágenes")
+                if member.file_size > MAX_IMAGE_SIZE * MAX_IMAGE_SIZE * 4:
+                    # Evita descomprimir entradas desproporcionadas (zip bomb)
+                    self.items.append(BatchItem(
+                        len(self.items), member.filename, error="Archivo demasiado grande", **params
+                    ))
+                    continue
+
+                path = self.staging_dir / f"{uuid.uuid4()}.upload"
+                digest = await asyncio.to_thread(_extract_and_hash, archive, member, path)
+                await self.add_item(Path(member.filename).name, path, digest, **params)
+
+    def _lookup_cache(self):
+        cache = self.service.cache
+        if cache is None:
+            return
+        for item in self.items:
+            if item.error is not None:
+                continue
+            item.cache_key = self.service.cache_key(
+                item.content_hash, item.model, item.scale, item.tile_size, item.engine
+            )
+            cached_path = cache.get(item.cache_key)
+            if cached_path is not None:
+                item.output_path = cached_path
+                item.cached = True
+
+    def _build_groups(self) -> list:
+        """Agrupa por parámetros y divide en grupos de BATCH_GROUP_SIZE"""
+        by_params: dict = {}
+        for item in self.items:
+            if item.error is None and not item.cached:
+                by_params.setdefault((item.model, item.scale, item.tile_size, item.engine), []).append(item)
+
+        groups = []
+        for (model, scale, tile_size, engine), items in by_params.items():
+            for start in range(0, len(items), BATCH_GROUP_SIZE):
+                group = BatchGroup(
+                    model, scale, tile_size, engine, self.batch_dir / f"group-{len(groups)}"
+                )
+                group.input_dir.mkdir(parents=True)
+                for item in items[start:start + BATCH_GROUP_SIZE]:
+                    # Nombres por índice: evita colisiones y permite localizar la salida
+                    target = group.input_dir / f"{item.index:05d}{item.input_path.suffix}"
+                    item.input_path.rename(target)
+                    item.input_path = target
+                    group.items.append(item)
+                groups.append(group)
+        return groups
+
+    async def _item_line(self, item: BatchItem) -> bytes:
+        """
+        Serializa el resultado de una imagen como línea NDJSON. El base64 de
+        la imagen se escribe en CodecPool, como la respuesta de /api/upscale
+        """
+        item.reported = True
+        self.reported += 1
+        if self.reporter is not None:
+            total = len(self.items)
+            self.reporter(
+                {"percent": round(100 * self.reported / total, 2), "images_done": self.reported, "images": total},
+                force=self.reported == total
+            )
+        if item.error is not None:
+            line = {"index": item.index, "filename": item.filename, "status": "error", "error": item.error}
+            return (json.dumps(line) + "\n").encode()
+
+        width, height = read_image_size(item.output_path)
+        fields = {
+            "index": item.index,
+            "filename": item.filename,
+            "status": "ok",
+            "width": width,
+            "height": height,
+            "cached": item.cached,
+            "engine": item.engine
+        }
+        line_path = self.batch_dir / f"line-{item.index:05d}.json"
+        try:
+            await self.service.codec.run(
+                write_json_response, item.output_path, "image/png", fields, line_path, True, admit=False
+            )
+            return await asyncio.to_thread(line_path.read_bytes)
+        finally:
+            line_path.unlink(missing_ok=True)
+
+    def _finish_item(self, item: BatchItem, output_path: Path):
+        """Guarda en caché (si procede) la salida de una imagen terminada"""
+        cache = self.service.cache
+        if item.cache_key is not None and cache is not None:
+            output_path = cache.put(item.cache_key, output_path)
+        item.output_path = output_path
+
+    def _take_output(self, item: BatchItem, output_path: Path):
+        """
+        Aparta la salida de un grupo antes de guardarla: si el motor repite el
+        grupo con un tile menor (OOM) escribe un archivo nuevo y no pisa el
+        enlace que conserva la caché
+        """
+        result_path = self.batch_dir / f"result-{item.index:05d}.png"
+        os.replace(output_path, result_path)
+        self._finish_item(item, result_path)
+
+    def _notify(self, event: Optional[tuple]):
+        """Encola un evento para stream() desde cualquier hilo"""
+        try:
+            self._loop.call_soon_threadsafe(self._events.put_nowait, event)
+        except RuntimeError:
+            # Event loop cerrado: ya no hay nadie leyendo el lote
+            pass
+
+    def _on_output(self, group: BatchGroup, output_path: Path):
+        """Oyente de salidas del grupo (se llama desde el hilo del motor)"""
+        self._notify((group, output_path))
+
+    def _output_item(self, group: BatchGroup, output_path: Path) -> Optional[BatchItem]:
+        """Imagen pendiente del grupo a la que corresponde una salida del motor (<índice>.png)"""
+        try:
+            item = self.items[int(output_path.stem)]
+        except (ValueError, IndexError):
+            return None
+        if item not in group.items or item.reported or item.output_path is not None:
+            return None
+        return item
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        """Ejecuta el lote y emite una línea NDJSON por imagen y un resumen final"""
+        retries: dict = {}
+        self._loop = asyncio.get_running_loop()
+        self._events = asyncio.Queue()
+        self.service.janitor.pin(self.batch_dir)
+        try:
+            self._lookup_cache()
+
+            # Errores de validación y aciertos de caché se emiten de inmediato
+            for item in self.items:
+                if item.error is not None or item.cached:
+                    yield await self._item_line(item)
+
+            pending = []
+            for group in self._build_groups():
+                try:
+                    with reporting(None), reporting_outputs(partial(self._on_output, group)):
+                        group.future = self.service.upscale_batch(
+                            group.input_dir,
+                            group.output_dir,
+                            scale=group.scale,
+                            model=group.model,
+                            tile_size=group.tile_size,
+                            cancel_event=self.cancel_event,
+                            priority=Priority.BATCH,
+                            client_id=self.client_id,
+                            engine=group.engine
+                        )
+                except QueueFullError as e:
+                    for item in group.items:
+                        item.error = str(e)
+                        yield await self._item_line(item)
+                    continue
+                group.future.add_done_callback(lambda _: self._notify(None))
+                pending.append(group)
+
+            while pending or retries:
+                event = await self._events.get()
+                if event is not None:
+                    group, output_path = event
+                    item = self._output_item(group, output_path)
+                    if item is not None:
+                        self._take_output(item, group.output_dir / output_path.name)
+                        yield await self._item_line(item)
+                    continue
+
+                for group in list(pending):
+                    if not group.future.done():
+                        continue
+                    pending.remove(group)
+
+                    if group.future.cancelled():
+                        # exception() lanzaría CancelledError y cortaría el stream
+                        for item in group.items:
+                            if item.reported or item.output_path is not None:
+                                continue
+                            item.error = "Tarea cancelada antes de procesarse"
+                            yield await self._item_line(item)
+                        continue
+
+                    group_error = group.future.exception()
+                    for item in group.items:
+                        if item.reported or item.output_path is not None:
+                            continue
+                        output_path = group.output_dir / f"{item.index:05d}.png"
+                        if group_error is None and output_path.exists():
+                            self._take_output(item, output_path)
+                            yield await self._item_line(item)
+                            continue
+
+                        # Reintento individual: aísla la imagen que hizo fallar al grupo
+                        try:
+                            with reporting(None):
+                                retries[item.index] = self.service.upscale(
+                                    input_path=item.input_path,
+                                    scale=item.scale,
+                                    model=item.model,
+                                    tile_size=item.tile_size,
+                                    cancel_event=self.cancel_event,
+                                    priority=Priority.BATCH,
+                                    client_id=self.client_id,
+                                    engine=item.engine
+                                )
+                        except QueueFullError as e:
+                            item.error = str(e)
+                            yield await self._item_line(item)
+                            continue
+                        retries[item.index].add_done_callback(lambda _: self._notify(None))
+
+                for index, future in list(retries.items()):
+                    if not future.done():
+                        continue
+                    del retries[index]
+                    item = self.items[index]
+                    if future.cancelled():
+                        item.error = "Tarea cancelada antes de procesarse"
+                    elif future.exception() is not None:
+                        item.error = str(future.exception())
+                    else:
+                        self._finish_item(item, future.result())
+                    yield await self._item_line(item)
+
+            failed = sum(1 for item in self.items if item.error is not None)
+            yield json.dumps({
+                "done": True,
+                "total": len(self.items),
+                "succeeded": len(self.items) - failed,
+                "failed": failed,
+                "processing_time": time.time() - self.start_time
+            }).encode() + b"\n"
+        finally:
+            # Cliente desconectado o lote terminado: detener trabajo y limpiar
+            self.cancel_event.set()
+            for item in self.items:
+                cache = self.service.cache
+                if item.output_path is not None and not (cache is not None and cache.owns(item.output_path)):
+                    item.output_path.unlink(missing_ok=True)
+            shutil.rmtree(self.batch_dir, ignore_errors=True)
+            self.service.janitor.unpin(self.batch_dir)
+
+
+def _extract_and_hash(archive: zipfile.ZipFile, member: zipfile.ZipInfo, path: Path) -> str:
+    """Extrae una entrada del ZIP por bloques calculando su hash SHA-256"""
+    digest = hashlib.sha256()
+    with archive.open(member) as source, open(path, "wb") as target:
+        for chunk in iter(lambda: source.read(1024 * 1024), b""):
+            digest.update(chunk)
+            target.write(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,118 @@
+"""
+Benchmark de los formatos de salida
+Codifica un resultado del tamaño que produce el motor en cada formato y
+calidad (encoder.encode_image, la misma función que ejecuta el pool de
+ImageEncoder) y mide:
+
+- bytes del archivo y de la data URL en base64 (respuesta JSON)
+- latencia de la codificación (mediana de --repeat)
+- relación de tamaño frente a PNG
+
+Las filas marcadas con "motor" son las que realesrgan-ncnn-vulkan escribe
+directamente con -f (WebP sin pérdida y JPEG calidad 100): en producción
+no pasan por el pool, su coste lo paga el binario.
+
+Sin --image se usa una imagen sintética con degradados y algo de ruido,
+que comprime como una foto; --scale la amplía antes de medir, como haría
+el motor.
+
+Uso:
+    python benchmarks/bench_formats.py [--sizes 1024 2048 4096] [--image foto.jpg --scale 4]
+                                       [--qualities 75 90] [--repeat 3] [--json salida.json]
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import tempfile
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+from PIL import Image  # noqa: E402
+
+from encoder import PNG, OutputFormat, available_formats, encode_image  # noqa: E402
+from engines import SubprocessEngine  # noqa: E402
+
+
+def make_image(size: int) -> Image.Image:
+    """Imagen sintética: degradados y un fractal con ruido suave"""
+    gradient = Image.linear_gradient("L").resize((size, size))
+    radial = Image.radial_gradient("L").resize((size, size))
+    fractal = Image.effect_mandelbrot((size, size), (-2.0, -1.25, 0.75, 1.25), 64)
+    image = Image.merge("RGB", (gradient, radial, fractal))
+    noise = Image.effect_noise((size, size), 24).convert("RGB")
+    return Image.blend(image, noise, 0.15)
+
+
+def formats_to_measure(qualities: list) -> list:
+    """PNG, las variantes que escribe el motor y cada formato con pérdida por calidad"""
+    available = available_formats()
+    formats = [PNG, OutputFormat("webp", 100, True), OutputFormat("jpg", 100, False)]
+    for name in ("jpg", "webp", "avif"):
+        if name in available:
+            formats.extend(OutputFormat(name, quality, False) for quality in qualities)
+    return formats
+
+
+def measure(source: Path, directory: Path, output_format: OutputFormat, repeat: int) -> dict:
+    destination = directory / f"out.{output_format.extension}"
+    seconds = [encode_image(str(source), str(destination), output_format) for _ in range(repeat)]
+    size = destination.stat().st_size
+    return {
+        "format": output_format.key,
+        "engine": output_format.key in SubprocessEngine.native_formats,
+        "bytes": size,
+        # Data URL: 4 caracteres por cada 3 bytes más el prefijo
+        "base64_bytes": 4 * ((size + 2) // 3) + len(f"data:{output_format.media_type};base64,"),
+        "encode_seconds": statistics.median(seconds)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de los formatos de salida")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 2048, 4096],
+                        help="Lado del resultado sintético (px)")
+    parser.add_argument("--image", type=Path, help="Imagen de entrada en lugar de la sintética")
+    parser.add_argument("--scale", type=int, default=4, help="Ampliación de --image antes de medir")
+    parser.add_argument("--qualities", type=int, nargs="+", default=[75, 90])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", type=Path, help="Guardar resultados en un archivo JSON")
+    args = parser.parse_args()
+
+    if args.image:
+        with Image.open(args.image) as image:
+            sources = [(f"{args.image.name} x{args.scale}", image.convert("RGB").resize(
+                (image.width * args.scale, image.height * args.scale), Image.Resampling.LANCZOS
+            ))]
+    else:
+        sources = [(f"{size}x{size}", make_image(size)) for size in args.sizes]
+
+    results = []
+    print(f"{'imagen':<18} {'formato':<23} {'bytes':>12} {'base64':>12} {'vs PNG':>7} {'codificar':>10}")
+    for label, image in sources:
+        with tempfile.TemporaryDirectory() as tmp:
+            directory = Path(tmp)
+            # El PNG de entrada es lo que escribiría el motor
+            source = directory / "engine.png"
+            image.save(source, "PNG", compress_level=1)
+            png_bytes = None
+            for output_format in formats_to_measure(args.qualities):
+                result = {"image": label, **measure(source, directory, output_format, args.repeat)}
+                png_bytes = png_bytes or result["bytes"]
+                results.append(result)
+                name = output_format.key + (" (motor)" if result["engine"] else "")
+                print(
+                    f"{label:<18} {name:<23} {result['bytes']:>12,} {result['base64_bytes']:>12,} "
+                    f"{result['bytes'] / png_bytes:>6.0%} {result['encode_seconds'] * 1000:>8.1f}ms"
+                )
+
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2))
+        print(f"Resultados guardados en {args.json}")
+
+
+if __name__ == "__main__":
+    main()
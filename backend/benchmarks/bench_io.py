@@ -0,0 +1,185 @@
+"""
+Benchmark del pipeline de E/S de /api/upscale
+Compara el camino anterior (re-guardar la entrada como PNG, re-abrir y
+re-codificar la salida) con el actual (bytes originales y lectura de
+cabecera), midiendo el tiempo por etapa y el pico de memoria (RSS).
+
+El motor no se ejecuta: su salida se simula con un PNG reescalado que se
+genera antes de medir, así solo se mide el coste de E/S de la API.
+
+Uso:
+    python benchmarks/bench_io.py [--sizes 512 1024 2048] [--format JPEG] [--json salida.json]
+"""
+
+import argparse
+import base64
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+from PIL import Image  # noqa: E402
+
+from image_io import read_image_size, write_input_image  # noqa: E402
+
+
+def make_payload(size: int, image_format: str) -> str:
+    """Imagen sintética con ruido (comprime como una foto real) en base64"""
+    image = Image.effect_noise((size, size), 64).convert("RGB")
+    buffer = BytesIO()
+    image.save(buffer, image_format)
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def make_engine_output(payload: str, scale: int, directory: Path) -> Path:
+    """Simula el PNG que escribiría Real-ESRGAN"""
+    with Image.open(BytesIO(base64.b64decode(payload))) as image:
+        output = image.convert("RGB").resize((image.width * scale, image.height * scale))
+    path = directory / "engine_output.png"
+    output.save(path, "PNG")
+    return path
+
+
+def run_legacy(payload: str, engine_output: Path, directory: Path) -> dict:
+    """Pipeline anterior: PIL re-guarda la entrada y re-codifica la salida"""
+    stages = {}
+
+    t = time.perf_counter()
+    image_bytes = base64.b64decode(payload)
+    stages["b64_decode"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    image = Image.open(BytesIO(image_bytes))
+    _ = image.size
+    stages["open_input"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    image.save(directory / "legacy_input.png", "PNG")
+    stages["write_input"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    with Image.open(engine_output) as result_img:
+        _ = result_img.size
+        buffered = BytesIO()
+        result_img.save(buffered, format="PNG")
+        output_bytes = buffered.getvalue()
+    stages["read_output"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    base64.b64encode(output_bytes).decode()
+    stages["b64_encode"] = time.perf_counter() - t
+
+    return stages
+
+
+def run_current(payload: str, engine_output: Path, directory: Path) -> dict:
+    """Pipeline actual: bytes originales y tamaño leído de la cabecera"""
+    stages = {}
+
+    t = time.perf_counter()
+    image_bytes = base64.b64decode(payload)
+    stages["b64_decode"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    image = Image.open(BytesIO(image_bytes))
+    _ = image.size
+    stages["open_input"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    write_input_image(image_bytes, image, directory)
+    stages["write_input"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    read_image_size(engine_output)
+    output_bytes = engine_output.read_bytes()
+    stages["read_output"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    base64.b64encode(output_bytes).decode()
+    stages["b64_encode"] = time.perf_counter() - t
+
+    return stages
+
+
+def child_main(mode: str, payload_path: Path, engine_output: Path, repeat: int):
+    """Ejecuta un modo en un proceso aislado para medir su pico de RSS"""
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        payload = payload_path.read_text()
+        baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        runner = run_legacy if mode == "legacy" else run_current
+        totals: dict = {}
+        for _ in range(repeat):
+            for stage, elapsed in runner(payload, engine_output, directory).items():
+                totals[stage] = totals.get(stage, 0.0) + elapsed
+
+    stages = {stage: elapsed / repeat for stage, elapsed in totals.items()}
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({
+        "mode": mode,
+        "stages": stages,
+        "total": sum(stages.values()),
+        # ru_maxrss está en KB en Linux
+        "peak_rss_mb": peak_rss / 1024,
+        "pipeline_rss_mb": (peak_rss - baseline_rss) / 1024
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de E/S de /api/upscale")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 1024, 2048])
+    parser.add_argument("--format", default="JPEG", choices=["JPEG", "PNG", "WEBP", "BMP"])
+    parser.add_argument("--scale", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", type=Path, help="Guardar resultados en un archivo JSON")
+    parser.add_argument("--child", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        mode, payload_path, engine_output = args.child
+        child_main(mode, Path(payload_path), Path(engine_output), args.repeat)
+        return
+
+    results = []
+    print(f"{'modo':<8} {'tamaño':>7} {'decode':>8} {'abrir':>8} {'entrada':>8} "
+          f"{'salida':>8} {'b64':>8} {'total':>8} {'RSS MB':>8}")
+    for size in args.sizes:
+        # Las entradas se preparan aquí para que no cuenten en el RSS del hijo
+        with tempfile.TemporaryDirectory() as tmp:
+            directory = Path(tmp)
+            payload = make_payload(size, args.format)
+            payload_path = directory / "payload.b64"
+            payload_path.write_text(payload)
+            engine_output = make_engine_output(payload, args.scale, directory)
+
+            for mode in ("legacy", "current"):
+                output = subprocess.run(
+                    [sys.executable, __file__, "--child", mode, str(payload_path),
+                     str(engine_output), "--repeat", str(args.repeat)],
+                    capture_output=True, text=True, check=True
+                ).stdout
+                result = {"size": size, "format": args.format, **json.loads(output)}
+                results.append(result)
+                stages = result["stages"]
+                print(
+                    f"{mode:<8} {size:>7} {stages['b64_decode'] * 1000:>7.1f}ms "
+                    f"{stages['open_input'] * 1000:>6.1f}ms {stages['write_input'] * 1000:>6.1f}ms "
+                    f"{stages['read_output'] * 1000:>6.1f}ms {stages['b64_encode'] * 1000:>6.1f}ms "
+                    f"{result['total'] * 1000:>6.1f}ms {result['pipeline_rss_mb']:>8.1f}"
+                )
+
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2))
+        print(f"\nResultados guardados en {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""
+Benchmark del retraso del event loop bajo carga
+Lanza upscales JSON concurrentes de imágenes grandes (el caso que más CPU
+gasta en la API: base64 de la entrada y de la respuesta) mientras un hilo
+sonda GET /health cada --probe-interval segundos. /health no hace trabajo:
+su latencia es el tiempo que espera a que el event loop quede libre.
+
+Para cada valor de --codec-workers (CODEC_WORKERS del servidor; 0 = hilos)
+arranca un uvicorn nuevo con el sustituto benchmarks/fake_realesrgan.py y
+mide:
+
+- latencia de la sonda p50/p99/máx
+- ria_event_loop_lag_seconds durante la carga (media y p99 por buckets)
+- throughput y latencia p50/p99 de los upscales
+
+Requiere Linux o macOS (como bench_upscale.py, cuyo servidor reutiliza).
+
+Uso:
+    python benchmarks/bench_loop_lag.py [--size 2048] [--concurrency 8] [--requests 32]
+                                        [--codec-workers 0 2] [--json salida.json]
+"""
+
+import argparse
+import base64
+import http.client
+import json
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from bench_upscale import (
+    BACKEND_DIR, bench_env, free_port, make_image, make_models, percentile, request, run_clients,
+    wait_until_ready
+)
+
+LAG_PATTERN = re.compile(r'^ria_event_loop_lag_seconds_(bucket|sum|count)(?:\{le="([^"]+)"\})? (\S+)$')
+
+
+def scrape_lag(port: int) -> dict:
+    """Buckets acumulados, suma y cuenta de ria_event_loop_lag_seconds"""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    _, body = request(conn, "GET", "/metrics")
+    conn.close()
+    lag = {"buckets": {}, "sum": 0.0, "count": 0.0}
+    for line in body.decode().splitlines():
+        match = LAG_PATTERN.match(line)
+        if not match:
+            continue
+        kind, bound, value = match.groups()
+        if kind == "bucket":
+            lag["buckets"][float(bound)] = float(value)
+        else:
+            lag[kind] = float(value)
+    return lag
+
+
+def lag_delta(before: dict, after: dict) -> dict:
+    """Media y p99 (límite superior de su bucket) entre dos lecturas, en ms"""
+    count = after["count"] - before["count"]
+    if count <= 0:
+        return {"samples": 0, "mean_ms": 0.0, "p99_ms": 0.0}
+    p99 = float("inf")
+    for bound in sorted(after["buckets"]):
+        if after["buckets"][bound] - before["buckets"].get(bound, 0.0) >= 0.99 * count:
+            p99 = bound
+            break
+    return {
+        "samples": int(count),
+        "mean_ms": (after["sum"] - before["sum"]) / count * 1000,
+        "p99_ms": p99 * 1000
+    }
+
+
+class Probe(threading.Thread):
+    """Sonda de /health a intervalo fijo sobre una conexión keep-alive"""
+
+    def __init__(self, port: int, interval: float):
+        super().__init__(daemon=True)
+        self.port = port
+        self.interval = interval
+        self.latencies: list = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+        while not self.stopped.wait(self.interval):
+            start = time.perf_counter()
+            try:
+                request(conn, "GET", "/health")
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                continue
+            self.latencies.append(time.perf_counter() - start)
+        conn.close()
+
+
+def upscale_call(port: int, body: bytes):
+    """Función de cliente: un upscale JSON por llamada"""
+    headers = {"Content-Type": "application/json"}
+
+    def call(state: dict) -> bool:
+        conn = state.get("conn")
+        if conn is None:
+            conn = state["conn"] = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+        try:
+            status, _ = request(conn, "POST", "/api/upscale", body, headers)
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            state.pop("conn")
+            raise
+        return status == 200
+
+    return call
+
+
+def run_scenario(codec_workers: int, body: bytes, args, work_dir: Path) -> dict:
+    env = {
+        **bench_env(work_dir, argparse.Namespace(
+            latency=args.latency, latency_per_mp=0.0, workers=args.workers, concurrency=[args.concurrency]
+        )),
+        "CODEC_WORKERS": str(codec_workers),
+        "LOOP_LAG_INTERVAL": str(args.lag_interval)
+    }
+    port = free_port()
+    log_path = work_dir / "server.log"
+    with log_path.open("wb") as log_file:
+        server = subprocess.Popen(
+            [sys.executable, str(BACKEND_DIR / "benchmarks" / "bench_upscale.py"), "--serve", str(port),
+             str(work_dir / "server_stats.json")],
+            cwd=BACKEND_DIR, env=env, stdout=log_file, stderr=subprocess.STDOUT
+        )
+        try:
+            wait_until_ready(port, server)
+            call = upscale_call(port, body)
+            warmup_state: dict = {}
+            for _ in range(args.warmup):
+                call(warmup_state)
+            if "conn" in warmup_state:
+                warmup_state["conn"].close()
+
+            # Referencia sin carga
+            idle = Probe(port, args.probe_interval)
+            idle.start()
+            time.sleep(1.0)
+            idle.stopped.set()
+            idle.join()
+
+            lag_before = scrape_lag(port)
+            probe = Probe(port, args.probe_interval)
+            probe.start()
+            latencies, errors, elapsed = run_clients(call, args.requests, args.concurrency)
+            probe.stopped.set()
+            probe.join()
+            lag = lag_delta(lag_before, scrape_lag(port))
+        except Exception:
+            print(log_path.read_text(errors="replace")[-4000:], file=sys.stderr)
+            raise
+        finally:
+            server.terminate()
+            server.wait(timeout=60)
+
+    probes = sorted(probe.latencies)
+    latencies = sorted(latencies)
+    return {
+        "codec_workers": codec_workers,
+        "upscales": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "upscale_p50_ms": percentile(latencies, 0.50) * 1000,
+        "upscale_p99_ms": percentile(latencies, 0.99) * 1000,
+        "probe_idle_p50_ms": percentile(sorted(idle.latencies), 0.50) * 1000,
+        "probes": len(probes),
+        "probe_p50_ms": percentile(probes, 0.50) * 1000,
+        "probe_p99_ms": percentile(probes, 0.99) * 1000,
+        "probe_max_ms": (probes[-1] if probes else 0.0) * 1000,
+        "lag": lag
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del retraso del event loop bajo carga")
+    parser.add_argument("--size", type=int, default=2048, help="Lado de la imagen de entrada (px)")
+    parser.add_argument("--format", default="PNG", choices=["JPEG", "PNG", "WEBP"])
+    parser.add_argument("--scale", type=int, default=2, choices=[2, 3, 4])
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=32, help="Upscales medidos por escenario")
+    parser.add_argument("--warmup", type=int, default=1, help="Upscales previos sin medir")
+    parser.add_argument("--codec-workers", type=int, nargs="+", default=[0, 2],
+                        help="CODEC_WORKERS de cada escenario (0 = hilos)")
+    parser.add_argument("--workers", type=int, default=4, help="MAX_WORKERS del servicio")
+    parser.add_argument("--latency", type=float, default=0.05, help="Segundos del motor por imagen")
+    parser.add_argument("--probe-interval", type=float, default=0.01, help="Segundos entre sondas de /health")
+    parser.add_argument("--lag-interval", type=float, default=0.02, help="LOOP_LAG_INTERVAL del servidor")
+    parser.add_argument("--json", type=Path, help="Guardar resultados en un archivo JSON")
+    args = parser.parse_args()
+
+    image_bytes = make_image(args.size, args.format)
+    body = json.dumps({"image": base64.b64encode(image_bytes).decode(), "scale": args.scale}).encode()
+    print(f"Entrada {args.size}x{args.size} {args.format}: petición de {len(body) / 1e6:.1f} MB, "
+          f"x{args.scale}, {args.concurrency} concurrentes")
+    print(f"{'codec':>6} {'req/s':>7} {'p50':>9} {'p99':>9} {'sonda':>8} {'p50':>8} {'p99':>8} {'máx':>8} "
+          f"{'lag media':>10} {'lag p99':>9} {'errores':>8}")
+
+    results = []
+    for codec_workers in args.codec_workers:
+        with tempfile.TemporaryDirectory() as tmp:
+            work_dir = Path(tmp)
+            make_models(work_dir / "models")
+            result = run_scenario(codec_workers, body, args, work_dir)
+        results.append(result)
+        print(
+            f"{codec_workers:>6} {result['throughput']:>7.2f} {result['upscale_p50_ms']:>7.0f}ms "
+            f"{result['upscale_p99_ms']:>7.0f}ms {result['probe_idle_p50_ms']:>6.1f}ms "
+            f"{result['probe_p50_ms']:>6.1f}ms {result['probe_p99_ms']:>6.1f}ms {result['probe_max_ms']:>6.1f}ms "
+            f"{result['lag']['mean_ms']:>8.2f}ms {result['lag']['p99_ms']:>7.1f}ms {result['errors']:>8}"
+        )
+    print("(sonda: p50 de /health sin carga; p50/p99/máx durante la carga)")
+
+    if args.json:
+        args.json.write_text(json.dumps({
+            "config": {
+                "size": args.size,
+                "format": args.format,
+                "scale": args.scale,
+                "concurrency": args.concurrency,
+                "requests": args.requests,
+                "latency": args.latency
+            },
+            "results": results
+        }, indent=2))
+        print(f"Resultados guardados en {args.json}")
+
+
+if __name__ == "__main__":
+    main()
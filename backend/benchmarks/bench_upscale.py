@@ -0,0 +1,496 @@
+"""
+Benchmark de extremo a extremo del servicio de upscale
+Mide POST /api/upscale (JSON y binario), POST /api/upscale/file y
+RealESRGANService.upscale llamado directamente, con el sustituto
+benchmarks/fake_realesrgan.py en lugar del binario real: la latencia del
+motor es fija y configurable, así las diferencias entre ejecuciones vienen
+del código de la API y del servicio, no de la GPU.
+
+Cada escenario (modo, tamaño, concurrencia) usa un proceso nuevo (uvicorn
+para los modos HTTP) con directorios temporales, caché de resultados y
+calentamiento desactivados, y mide:
+
+- throughput y latencia p50/p95/p99 de las peticiones
+- pico de RSS del proceso del servidor
+- CPU del servidor (api) y de los procesos del motor (engine) durante la carga
+- tiempo medio por etapa (ria_upscale_stage_duration_seconds)
+
+Con --compare se comparan los resultados con un JSON anterior y el script
+termina con código 1 si algún escenario empeora más de --threshold %.
+Requiere Linux o macOS (resource, SIGUSR1 y el shebang del sustituto).
+
+Uso:
+    python benchmarks/bench_upscale.py [--modes json raw file service] [--sizes 256 512 1024]
+                                       [--concurrency 1 4] [--requests 20] [--latency 0.05]
+                                       [--json salida.json] [--compare base.json]
+"""
+
+import argparse
+import base64
+import http.client
+import json
+import os
+import re
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+from PIL import Image  # noqa: E402
+
+from config import MODELS  # noqa: E402
+
+FAKE_BINARY = Path(__file__).resolve().parent / "fake_realesrgan.py"
+MODES = ["json", "raw", "file", "service"]
+STAGE_PATTERN = re.compile(r'^ria_upscale_stage_duration_seconds_(sum|count)\{stage="([^"]+)"\} (\S+)$')
+
+
+def make_image(size: int, image_format: str) -> bytes:
+    """Imagen sintética con ruido (comprime como una foto real)"""
+    image = Image.effect_noise((size, size), 64).convert("RGB")
+    buffer = BytesIO()
+    image.save(buffer, image_format)
+    return buffer.getvalue()
+
+
+def make_models(models_dir: Path):
+    """Modelos de mentira que pasan la validación del registro (cabecera ncnn)"""
+    models_dir.mkdir(parents=True, exist_ok=True)
+    for info in MODELS.values():
+        (models_dir / info["param_filename"]).write_text("7767517\n")
+        (models_dir / info["filename"]).write_bytes(b"\0")
+
+
+def bench_env(work_dir: Path, args) -> dict:
+    return {
+        **os.environ,
+        "REALESRGAN_BINARY": str(FAKE_BINARY),
+        "FAKE_REALESRGAN_LATENCY": str(args.latency),
+        "FAKE_REALESRGAN_LATENCY_PER_MP": str(args.latency_per_mp),
+        "MODELS_DIR": str(work_dir / "models"),
+        "SCRATCH_DIR": str(work_dir),
+        "TILE_TUNING_FILE": str(work_dir / "tile_tuning.json"),
+        "ENGINE_BACKEND": "subprocess",
+        "ENGINE_FALLBACK": "none",
+        "VULKAN_DEVICES": "0",
+        "MAX_WORKERS": str(args.workers),
+        "MAX_QUEUE_SIZE": str(max(64, max(args.concurrency) * 2)),
+        "RESULT_CACHE_ENABLED": "false",
+        "WARMUP_ENABLED": "false",
+        "MODELS_WATCH_INTERVAL": "0",
+        "MIN_FREE_DISK_MB": "0",
+        "JOB_STORE": "memory",
+        "PYTHONDONTWRITEBYTECODE": "1"
+    }
+
+
+def percentile(values: list, fraction: float) -> float:
+    return values[int(fraction * (len(values) - 1))] if values else 0.0
+
+
+def parse_stages(text: str) -> dict:
+    """Suma y cuenta por etapa de la exposición de /metrics"""
+    stages: dict = {}
+    for line in text.splitlines():
+        match = STAGE_PATTERN.match(line)
+        if match:
+            kind, stage, value = match.groups()
+            stages.setdefault(stage, {"sum": 0.0, "count": 0.0})[kind] = float(value)
+    return stages
+
+
+def stage_delta(before: dict, after: dict) -> dict:
+    """Tiempo medio (ms) y total (s) de cada etapa entre dos lecturas"""
+    result = {}
+    for stage, values in after.items():
+        previous = before.get(stage, {"sum": 0.0, "count": 0.0})
+        count = values["count"] - previous["count"]
+        if count > 0:
+            total = values["sum"] - previous["sum"]
+            result[stage] = {"count": int(count), "mean_ms": total / count * 1000, "total_s": total}
+    return result
+
+
+def usage_snapshot() -> dict:
+    """CPU propia y de los hijos ya terminados (motor) y pico de RSS en MB"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss está en KB en Linux y en bytes en macOS
+    rss_unit = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "api_cpu": own.ru_utime + own.ru_stime,
+        "engine_cpu": children.ru_utime + children.ru_stime,
+        "peak_rss_mb": own.ru_maxrss / rss_unit
+    }
+
+
+def summarize(latencies: list, errors: int, elapsed: float, usage_before: dict, usage_after: dict,
+              stages: dict) -> dict:
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        "requests": count,
+        "errors": errors,
+        "throughput": count / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "peak_rss_mb": usage_after["peak_rss_mb"],
+        "idle_rss_mb": usage_before["peak_rss_mb"],
+        "cpu_s": {
+            "api": usage_after["api_cpu"] - usage_before["api_cpu"],
+            "engine": usage_after["engine_cpu"] - usage_before["engine_cpu"]
+        },
+        "stages": stages
+    }
+
+
+def run_clients(call, requests: int, concurrency: int) -> tuple:
+    """
+    Reparte 'requests' llamadas entre 'concurrency' hilos
+
+    Returns:
+        tuple: (latencias de las correctas, errores, segundos de reloj)
+    """
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    remaining = iter(range(requests))
+
+    def worker():
+        nonlocal errors
+        state = {}
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    break
+            start = time.perf_counter()
+            try:
+                ok = call(state)
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors += 1
+        if "conn" in state:
+            state["conn"].close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    return latencies, errors, time.perf_counter() - start
+
+
+# ---------------------------------------------------------------------------
+# Modo service: RealESRGANService.upscale en el propio proceso
+# ---------------------------------------------------------------------------
+
+def child_service(image_path: Path, concurrency: int, args):
+    """Proceso aislado que llama al servicio directamente e imprime el resultado"""
+    from config import TEMP_DIR  # noqa: E402
+    from metrics import REGISTRY  # noqa: E402
+    from upscale_service import get_upscale_service  # noqa: E402
+
+    service = get_upscale_service()
+    image_bytes = image_path.read_bytes()
+    suffix = image_path.suffix
+
+    def call(_state) -> bool:
+        input_path = TEMP_DIR / f"{uuid.uuid4()}{suffix}"
+        input_path.write_bytes(image_bytes)
+        try:
+            output_path = service.upscale(input_path, scale=args.scale).result()
+            output_path.unlink()
+            return True
+        finally:
+            input_path.unlink(missing_ok=True)
+
+    for _ in range(args.warmup):
+        call({})
+    usage_before = usage_snapshot()
+    stages_before = parse_stages(REGISTRY.render())
+    latencies, errors, elapsed = run_clients(call, args.requests, concurrency)
+    stages = stage_delta(stages_before, parse_stages(REGISTRY.render()))
+    usage_after = usage_snapshot()
+    service.shutdown()
+    print(json.dumps(summarize(latencies, errors, elapsed, usage_before, usage_after, stages)))
+
+
+def run_service(image_path: Path, concurrency: int, args, env: dict) -> dict:
+    output = subprocess.run(
+        [sys.executable, __file__, "--child", str(image_path), str(concurrency),
+         *child_args(args)],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True
+    )
+    if output.returncode != 0:
+        raise RuntimeError(f"El proceso del benchmark falló:\n{output.stderr[-4000:]}")
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def child_args(args) -> list:
+    return ["--scale", str(args.scale), "--requests", str(args.requests), "--warmup", str(args.warmup)]
+
+
+# ---------------------------------------------------------------------------
+# Modos HTTP: uvicorn en un proceso aparte
+# ---------------------------------------------------------------------------
+
+def serve(port: int, stats_path: Path):
+    """
+    Servidor del benchmark: con SIGUSR1 escribe en stats_path el uso de
+    CPU y memoria del proceso, para medir solo el intervalo de la carga
+    """
+    import uvicorn  # noqa: E402
+
+    def write_stats(*_):
+        tmp_path = stats_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(usage_snapshot()))
+        os.replace(tmp_path, stats_path)
+
+    signal.signal(signal.SIGUSR1, write_stats)
+    uvicorn.Server(uvicorn.Config("main:app", host="127.0.0.1", port=port, log_level="warning")).run()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def request(conn: http.client.HTTPConnection, method: str, path: str, body=None, headers=None):
+    conn.request(method, path, body=body, headers=headers or {})
+    response = conn.getresponse()
+    return response.status, response.read()
+
+
+def wait_until_ready(port: int, server: subprocess.Popen, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("El servidor terminó al arrancar")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            status, _ = request(conn, "GET", "/health/ready")
+            conn.close()
+            if status == 200:
+                return
+        except (OSError, http.client.HTTPException):
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"El servidor no arrancó en {timeout:.0f}s")
+
+
+def server_stats(server: subprocess.Popen, stats_path: Path, timeout: float = 10.0) -> dict:
+    stats_path.unlink(missing_ok=True)
+    server.send_signal(signal.SIGUSR1)
+    deadline = time.monotonic() + timeout
+    while not stats_path.exists():
+        if time.monotonic() > deadline:
+            raise RuntimeError("El servidor no respondió a SIGUSR1")
+        time.sleep(0.02)
+    return json.loads(stats_path.read_text())
+
+
+def scrape_stages(port: int) -> dict:
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    _, body = request(conn, "GET", "/metrics")
+    conn.close()
+    return parse_stages(body.decode())
+
+
+def http_call(mode: str, port: int, image_bytes: bytes, image_format: str, scale: int):
+    """Función de cliente para un modo HTTP (una conexión keep-alive por hilo)"""
+    content_type = f"image/{image_format.lower()}"
+    if mode == "json":
+        path = "/api/upscale"
+        body = json.dumps({"image": base64.b64encode(image_bytes).decode(), "scale": scale})
+        headers = {"Content-Type": "application/json"}
+    elif mode == "raw":
+        path = f"/api/upscale?scale={scale}"
+        body = image_bytes
+        headers = {"Content-Type": content_type, "Accept": "image/png"}
+    else:
+        boundary = uuid.uuid4().hex
+        path = f"/api/upscale/file?scale={scale}"
+        body = (
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; "
+            f"filename=\"bench.{image_format.lower()}\"\r\nContent-Type: {content_type}\r\n\r\n"
+        ).encode() + image_bytes + f"\r\n--{boundary}--\r\n".encode()
+        headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+    def call(state: dict) -> bool:
+        conn = state.get("conn")
+        if conn is None:
+            conn = state["conn"] = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+        try:
+            status, _ = request(conn, "POST", path, body, headers)
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            state.pop("conn")
+            raise
+        return status == 200
+
+    return call
+
+
+def run_http(mode: str, image_path: Path, concurrency: int, args, env: dict, work_dir: Path) -> dict:
+    image_bytes = image_path.read_bytes()
+    port = free_port()
+    stats_path = work_dir / "server_stats.json"
+    log_path = work_dir / "server.log"
+    with log_path.open("wb") as log_file:
+        server = subprocess.Popen(
+            [sys.executable, __file__, "--serve", str(port), str(stats_path)],
+            cwd=BACKEND_DIR, env=env, stdout=log_file, stderr=subprocess.STDOUT
+        )
+        try:
+            wait_until_ready(port, server)
+            call = http_call(mode, port, image_bytes, args.format, args.scale)
+            warmup_state: dict = {}
+            for _ in range(args.warmup):
+                call(warmup_state)
+            if "conn" in warmup_state:
+                warmup_state["conn"].close()
+
+            stages_before = scrape_stages(port)
+            usage_before = server_stats(server, stats_path)
+            latencies, errors, elapsed = run_clients(call, args.requests, concurrency)
+            usage_after = server_stats(server, stats_path)
+            stages = stage_delta(stages_before, scrape_stages(port))
+        except Exception:
+            print(log_path.read_text(errors="replace")[-4000:], file=sys.stderr)
+            raise
+        finally:
+            server.terminate()
+            server.wait(timeout=60)
+    return summarize(latencies, errors, elapsed, usage_before, usage_after, stages)
+
+
+# ---------------------------------------------------------------------------
+# Comparación con una ejecución anterior
+# ---------------------------------------------------------------------------
+
+def scenario_key(result: dict) -> tuple:
+    return result["mode"], result["size"], result["concurrency"]
+
+
+def compare(results: list, baseline_path: Path, threshold: float) -> bool:
+    """
+    Imprime la variación de throughput y p95 frente a baseline_path
+
+    Returns:
+        bool: True si algún escenario empeora más de 'threshold' %
+    """
+    baseline = {scenario_key(r): r for r in json.loads(baseline_path.read_text())["results"]}
+    regressed = False
+    print(f"\nComparación con {baseline_path} (umbral {threshold:.0f}%)")
+    print(f"{'modo':<8} {'tamaño':>7} {'conc':>5} {'req/s':>9} {'p95':>9}")
+    for result in results:
+        previous = baseline.get(scenario_key(result))
+        if previous is None:
+            continue
+        throughput = (result["throughput"] / previous["throughput"] - 1) * 100 if previous["throughput"] else 0.0
+        p95 = (result["p95_ms"] / previous["p95_ms"] - 1) * 100 if previous["p95_ms"] else 0.0
+        worse = throughput < -threshold or p95 > threshold
+        regressed = regressed or worse
+        print(
+            f"{result['mode']:<8} {result['size']:>7} {result['concurrency']:>5} "
+            f"{throughput:>+8.1f}% {p95:>+8.1f}%{'  REGRESIÓN' if worse else ''}"
+        )
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de extremo a extremo del servicio de upscale")
+    parser.add_argument("--modes", nargs="+", default=MODES, choices=MODES)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[256, 512, 1024])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--requests", type=int, default=20, help="Peticiones medidas por escenario")
+    parser.add_argument("--warmup", type=int, default=2, help="Peticiones previas sin medir")
+    parser.add_argument("--scale", type=int, default=2, choices=[2, 3, 4])
+    parser.add_argument("--format", default="JPEG", choices=["JPEG", "PNG", "WEBP"])
+    parser.add_argument("--latency", type=float, default=0.05, help="Segundos del motor por imagen")
+    parser.add_argument("--latency-per-mp", type=float, default=0.0,
+                        help="Segundos extra del motor por megapíxel de salida")
+    parser.add_argument("--workers", type=int, default=2, help="MAX_WORKERS del servicio")
+    parser.add_argument("--json", type=Path, help="Guardar resultados en un archivo JSON")
+    parser.add_argument("--compare", type=Path, help="JSON de una ejecución anterior")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Empeoramiento tolerado (%%)")
+    parser.add_argument("--child", nargs=2, help=argparse.SUPPRESS)
+    parser.add_argument("--serve", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(int(args.serve[0]), Path(args.serve[1]))
+        return
+    if args.child:
+        image_path, concurrency = args.child
+        child_service(Path(image_path), int(concurrency), args)
+        return
+
+    results = []
+    print(f"CPUs disponibles: {os.cpu_count()}; motor simulado: {args.latency * 1000:.0f}ms por imagen")
+    print(f"{'modo':<8} {'tamaño':>7} {'conc':>5} {'req/s':>8} {'p50':>9} {'p95':>9} {'p99':>9} "
+          f"{'RSS MB':>7} {'CPU api':>8} {'CPU mot':>8} {'errores':>8}")
+    for size in args.sizes:
+        for mode in args.modes:
+            for concurrency in args.concurrency:
+                with tempfile.TemporaryDirectory() as tmp:
+                    work_dir = Path(tmp)
+                    env = bench_env(work_dir, args)
+                    make_models(work_dir / "models")
+                    image_path = work_dir / f"input.{args.format.lower()}"
+                    image_path.write_bytes(make_image(size, args.format))
+
+                    if mode == "service":
+                        result = run_service(image_path, concurrency, args, env)
+                    else:
+                        result = run_http(mode, image_path, concurrency, args, env, work_dir)
+
+                result = {"mode": mode, "size": size, "concurrency": concurrency, **result}
+                results.append(result)
+                print(
+                    f"{mode:<8} {size:>7} {concurrency:>5} {result['throughput']:>8.2f} "
+                    f"{result['p50_ms']:>7.1f}ms {result['p95_ms']:>7.1f}ms {result['p99_ms']:>7.1f}ms "
+                    f"{result['peak_rss_mb']:>7.1f} {result['cpu_s']['api']:>7.2f}s "
+                    f"{result['cpu_s']['engine']:>7.2f}s {result['errors']:>8}"
+                )
+                stages = ", ".join(f"{name} {value['mean_ms']:.1f}ms" for name, value in result["stages"].items())
+                print(f"{'':>8} etapas: {stages}")
+
+    if args.json:
+        args.json.write_text(json.dumps({
+            "config": {
+                "latency": args.latency,
+                "latency_per_mp": args.latency_per_mp,
+                "scale": args.scale,
+                "format": args.format,
+                "workers": args.workers,
+                "requests": args.requests,
+                "cpus": os.cpu_count()
+            },
+            "results": results
+        }, indent=2))
+        print(f"\nResultados guardados en {args.json}")
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Sustituto de realesrgan-ncnn-vulkan para benchmarks
+Acepta los mismos argumentos (-i, -o, -s, -n, -t, -g, -f), espera una
+latencia configurable en lugar de ejecutar la red y escribe la imagen
+ampliada con vecino más cercano. Con -i directorio procesa cada imagen
+como el binario real (lotes y video).
+
+La espera es sleep, no cálculo: simula el tiempo de GPU, durante el cual
+la CPU del servidor queda libre.
+
+Variables de entorno:
+    FAKE_REALESRGAN_LATENCY: Segundos por imagen (por defecto 0.05)
+    FAKE_REALESRGAN_LATENCY_PER_MP: Segundos extra por megapíxel de salida
+
+Uso:
+    REALESRGAN_BINARY=benchmarks/fake_realesrgan.py python main.py
+"""
+
+import os
+import sys
+import time
+from pathlib import Path
+
+from PIL import Image
+
+
+def arg(argv: list, flag: str, default: str = None) -> str:
+    return argv[argv.index(flag) + 1] if flag in argv else default
+
+
+# Opciones con las que el binario real codifica cada formato de -f
+SAVE_OPTIONS = {"png": {}, "webp": {"lossless": True}, "jpg": {"quality": 100}}
+
+
+def upscale(src: Path, dst: Path, scale: int, latency: float, latency_per_mp: float, output_format: str):
+    with Image.open(src) as image:
+        size = (image.width * scale, image.height * scale)
+        # Progreso en stderr con el mismo formato que el binario real
+        wait = latency + latency_per_mp * size[0] * size[1] / 1e6
+        for percent in (0, 25, 50, 75, 100):
+            sys.stderr.write(f"{percent:.2f}%\n")
+            sys.stderr.flush()
+            time.sleep(wait / 5)
+        image.convert("RGB").resize(size, Image.NEAREST).save(
+            dst, "JPEG" if output_format == "jpg" else output_format.upper(), **SAVE_OPTIONS[output_format]
+        )
+
+
+def main():
+    argv = sys.argv[1:]
+    src, dst = Path(arg(argv, "-i")), Path(arg(argv, "-o"))
+    scale = int(arg(argv, "-s", "4"))
+    output_format = arg(argv, "-f", "png")
+    latency = float(os.getenv("FAKE_REALESRGAN_LATENCY", 0.05))
+    latency_per_mp = float(os.getenv("FAKE_REALESRGAN_LATENCY_PER_MP", 0))
+
+    if src.is_dir():
+        dst.mkdir(parents=True, exist_ok=True)
+        for path in sorted(src.iterdir()):
+            upscale(path, dst / f"{path.stem}.{output_format}", scale, latency, latency_per_mp, output_format)
+    else:
+        upscale(src, dst, scale, latency, latency_per_mp, output_format)
+
+
+if __name__ == "__main__":
+    main()
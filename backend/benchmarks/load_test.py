@@ -0,0 +1,209 @@
+"""
+Prueba de carga de la capa HTTP con varios procesos de la API
+Arranca uvicorn con 1, 2, 4... workers compartiendo la cola y el registro
+de trabajos (JOB_STORE=sqlite) y mide peticiones por segundo contra dos
+caminos que no dependen de la GPU:
+
+- status: GET /api/jobs/{id} de un trabajo creado por otro proceso
+- cached: POST /api/upscale de una imagen ya reescalada (acierto de caché)
+
+Así se mide el escalado de la API en sí; la GPU es un recurso compartido
+que no crece con el número de procesos. En una máquina con menos núcleos
+que workers (servidor + clientes) el escalado queda limitado por la CPU.
+
+Uso:
+    python benchmarks/load_test.py [--workers 1 2 4] [--clients 16] [--duration 10]
+                                   [--endpoints status cached] [--json salida.json]
+"""
+
+import argparse
+import base64
+import http.client
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+def make_payload() -> str:
+    """Imagen pequeña en base64: el coste del motor no debe dominar"""
+    buffer = BytesIO()
+    Image.effect_noise((64, 64), 64).convert("RGB").save(buffer, "PNG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def request(conn: http.client.HTTPConnection, method: str, path: str, body=None, headers=None):
+    conn.request(method, path, body=body, headers=headers or {})
+    response = conn.getresponse()
+    return response.status, response.read()
+
+
+def wait_until_ready(port: int, workers: int, timeout: float = 120.0):
+    """Espera a que respondan /health y los N procesos hayan registrado su latido"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            status, body = request(conn, "GET", "/api/queue")
+            conn.close()
+            if status == 200 and json.loads(body).get("cluster", {}).get("processes", 0) >= workers:
+                return
+        except (OSError, http.client.HTTPException):
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"El servidor con {workers} workers no arrancó en {timeout:.0f}s")
+
+
+def start_server(workers: int, port: int, state_dir: Path, log_file) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "JOB_STORE": "sqlite",
+        "SHARED_STATE_DIR": str(state_dir),
+        "ENGINE_BACKEND": os.environ.get("ENGINE_BACKEND", "persistent"),
+        "PERSISTENT_ENGINE_IMPL": os.environ.get("PERSISTENT_ENGINE_IMPL", "stub"),
+        "PROCESS_HEARTBEAT_TIMEOUT": "6"
+    }
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+         "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env, stdout=log_file, stderr=subprocess.STDOUT
+    )
+
+
+def prepare(port: int, payload: str) -> str:
+    """Crea un trabajo y espera a que termine; también deja el resultado en caché"""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    body = json.dumps({"image": payload, "scale": 2})
+    status, data = request(conn, "POST", "/api/jobs", body, {"Content-Type": "application/json"})
+    if status != 202:
+        raise RuntimeError(f"No se pudo crear el trabajo: {status} {data[:200]!r}")
+    job_id = json.loads(data)["job_id"]
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        job = json.loads(request(conn, "GET", f"/api/jobs/{job_id}")[1])
+        if job["state"] == "completed":
+            conn.close()
+            return job_id
+        if job["state"] in ("failed", "cancelled"):
+            raise RuntimeError(f"El trabajo de preparación terminó en {job['state']}: {job['error']}")
+        time.sleep(0.2)
+    raise RuntimeError("El trabajo de preparación no terminó a tiempo")
+
+
+def client(args) -> dict:
+    """Proceso cliente: repite la petición con una conexión keep-alive hasta el plazo"""
+    port, endpoint, job_id, payload, start_at, deadline = args
+    if endpoint == "status":
+        method, path, body, headers = "GET", f"/api/jobs/{job_id}", None, {}
+    else:
+        method, path = "POST", "/api/upscale"
+        body = json.dumps({"image": payload, "scale": 2})
+        headers = {"Content-Type": "application/json", "Accept": "image/png"}
+
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    latencies = []
+    errors = 0
+    time.sleep(max(0.0, start_at - time.monotonic()))
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            status, _ = request(conn, method, path, body, headers)
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            continue
+        if status == 200:
+            latencies.append(time.perf_counter() - start)
+        else:
+            errors += 1
+    conn.close()
+    return {"latencies": latencies, "errors": errors}
+
+
+def run_load(port: int, endpoint: str, job_id: str, payload: str, clients: int, duration: float) -> dict:
+    # Los clientes empiezan a la vez (tras arrancar el pool) y paran en el mismo instante
+    start_at = time.monotonic() + 1.0
+    deadline = start_at + duration
+    with multiprocessing.Pool(clients) as pool:
+        results = pool.map(client, [(port, endpoint, job_id, payload, start_at, deadline)] * clients)
+
+    latencies = sorted(lat for result in results for lat in result["latencies"])
+    errors = sum(result["errors"] for result in results)
+    count = len(latencies)
+    return {
+        "requests": count,
+        "errors": errors,
+        "rps": count / duration,
+        "p50_ms": latencies[count // 2] * 1000 if count else 0.0,
+        "p95_ms": latencies[int(0.95 * (count - 1))] * 1000 if count else 0.0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga con varios procesos de la API")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=16, help="Procesos cliente concurrentes")
+    parser.add_argument("--duration", type=float, default=10.0, help="Segundos de carga por escenario")
+    parser.add_argument("--endpoints", nargs="+", default=["status", "cached"], choices=["status", "cached"])
+    parser.add_argument("--json", type=Path, help="Guardar resultados en un archivo JSON")
+    args = parser.parse_args()
+
+    payload = make_payload()
+    results = []
+    baseline = {}
+    print(f"CPUs disponibles: {os.cpu_count()}")
+    print(f"{'endpoint':<8} {'workers':>7} {'req/s':>9} {'p50':>9} {'p95':>9} {'errores':>8} {'escalado':>9}")
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as state_dir:
+            port = free_port()
+            log_path = Path(state_dir) / "server.log"
+            log_file = log_path.open("wb")
+            server = start_server(workers, port, Path(state_dir), log_file)
+            try:
+                wait_until_ready(port, workers)
+                job_id = prepare(port, payload)
+                for endpoint in args.endpoints:
+                    result = {
+                        "endpoint": endpoint,
+                        "workers": workers,
+                        **run_load(port, endpoint, job_id, payload, args.clients, args.duration)
+                    }
+                    baseline.setdefault(endpoint, result["rps"])
+                    result["speedup"] = result["rps"] / baseline[endpoint] if baseline[endpoint] else 0.0
+                    results.append(result)
+                    print(
+                        f"{endpoint:<8} {workers:>7} {result['rps']:>9.1f} {result['p50_ms']:>7.1f}ms "
+                        f"{result['p95_ms']:>7.1f}ms {result['errors']:>8} {result['speedup']:>8.2f}x"
+                    )
+            except Exception:
+                print(log_path.read_text(errors="replace")[-4000:], file=sys.stderr)
+                raise
+            finally:
+                server.terminate()
+                server.wait(timeout=60)
+                log_file.close()
+
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2))
+        print(f"\nResultados guardados en {args.json}")
+
+
+if __name__ == "__main__":
+    main()
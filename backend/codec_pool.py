@@ -0,0 +1,128 @@
+"""
+Decodificación y codificación de las peticiones fuera del event loop
+El event loop atiende a todos los clientes: el CPU que gasta una petición lo
+esperan también /health y los eventos SSE. Decodificar el base64 de una foto
+4K, abrirla con PIL, calcular su hash y escribirla, o pasar a base64 un
+resultado de decenas de MB, son decenas o cientos de milisegundos.
+
+CodecPool ejecuta ese trabajo en un pool de procesos propio, separado del
+planificador del motor y de ImageEncoder (una re-codificación de varios
+segundos no retrasa la admisión de peticiones). Como en encoder.py, son
+procesos y no hilos: base64 y el parseo del JSON retienen el GIL. Los
+cuerpos JSON (decode_json_payload) sí van enteros por el pipe del pool hacia
+el worker, con su base64; las subidas binarias y multipart se vuelcan antes a
+TEMP_DIR y solo viaja su ruta. De vuelta, el resultado queda en disco
+(TEMP_DIR, OUTPUT_DIR): al proceso de la API solo vuelven rutas y metadatos.
+
+Las tareas pendientes están acotadas: por encima de CODEC_QUEUE_SIZE la
+petición se rechaza con QueueFullError (429) en lugar de acumular memoria.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional
+
+from config import CODEC_NICE, CODEC_QUEUE_SIZE, CODEC_WORKERS
+from scheduler import QueueFullError
+
+logger = logging.getLogger(__name__)
+
+# Segundos que se sugieren al cliente cuando el pool está saturado
+CODEC_RETRY_AFTER = 1.0
+
+
+def _lower_priority():
+    """
+    Baja la prioridad de los procesos del pool: con pocos núcleos compiten
+    por la CPU con el de la API, y el sistema debe preferir el event loop
+    """
+    try:
+        os.nice(CODEC_NICE)
+    except (AttributeError, OSError):
+        pass
+
+
+class CodecPool:
+    """Pool acotado para el trabajo de CPU de las peticiones"""
+
+    def __init__(self, workers: int = CODEC_WORKERS, max_pending: int = CODEC_QUEUE_SIZE):
+        """
+        Args:
+            workers: Procesos del pool (0 = hilos, p. ej. si no se pueden crear procesos)
+            max_pending: Tareas en cola o en ejecución antes de rechazar
+        """
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor: Optional[Executor] = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.rejected = 0
+
+    def _pool(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                if self.workers > 0:
+                    # spawn: fork copiaría a medias los hilos del proceso de la API
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                        initializer=_lower_priority
+                    )
+                else:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=max(1, min(4, (os.cpu_count() or 2) // 2)), thread_name_prefix="codec"
+                    )
+            return self._executor
+
+    def start(self):
+        """Arranca los procesos antes de la primera petición (importar PIL en cada uno tarda)"""
+        pool = self._pool()
+        for _ in range(max(1, self.workers)):
+            pool.submit(os.getpid)
+
+    async def run(self, fn: Callable, *args, admit: bool = True):
+        """
+        Ejecuta fn(*args) en el pool sin bloquear el event loop
+
+        Args:
+            admit: Aplicar el límite de pendientes. Con False la tarea se
+                   acepta siempre (la respuesta de un upscale ya hecho)
+
+        Raises:
+            QueueFullError: Si hay max_pending tareas pendientes
+        """
+        with self._lock:
+            if admit and self._pending >= self.max_pending:
+                self.rejected += 1
+                raise QueueFullError(CODEC_RETRY_AFTER)
+            self._pending += 1
+        executor = None
+        try:
+            executor = self._pool()
+            return await asyncio.wrap_future(executor.submit(fn, *args))
+        except BrokenProcessPool:
+            # Murió un proceso (p. ej. sin memoria): el pool roto rechazaría
+            # todo lo demás, la siguiente petición crea uno nuevo
+            logger.warning("Pool de decodificación roto; se recreará")
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"workers": self.workers, "pending": self._pending, "rejected": self.rejected}
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
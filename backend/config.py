@@ -9,17 +9,24 @@ from pathlib import Path
 # Directorio base del backend
 BASE_DIR = Path(__file__).resolve().parent
 
+# Directorio para archivos intermedios (entradas y salidas del motor).
+# Apuntarlo a un tmpfs (p. ej. SCRATCH_DIR=/dev/shm/ria) evita que las
+# imágenes intermedias pasen por el disco.
+SCRATCH_DIR = Path(os.getenv("SCRATCH_DIR", str(BASE_DIR)))
+
 # Directorios de trabajo
-TEMP_DIR = BASE_DIR / "temp"
-MODELS_DIR = BASE_DIR / "models"
+TEMP_DIR = SCRATCH_DIR / "temp"
+MODELS_DIR = Path(os.getenv("MODELS_DIR", str(BASE_DIR / "models")))
 BINARIES_DIR = BASE_DIR / "binaries"
-OUTPUT_DIR = BASE_DIR / "output"
+OUTPUT_DIR = SCRATCH_DIR / "output"
+CACHE_DIR = BASE_DIR / "cache"
 
 # Crear directorios si no existen
-TEMP_DIR.mkdir(exist_ok=True)
-MODELS_DIR.mkdir(exist_ok=True)
+TEMP_DIR.mkdir(parents=True, exist_ok=True)
+MODELS_DIR.mkdir(parents=True, exist_ok=True)
 BINARIES_DIR.mkdir(exist_ok=True)
-OUTPUT_DIR.mkdir(exist_ok=True)
+OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+CACHE_DIR.mkdir(exist_ok=True)
 
 # Configuración de Real-ESRGAN
 # URLs de descarga para los binarios
@@ -36,6 +43,10 @@ REALESRGAN_EXECUTABLE = {
     "macos": "realesrgan-ncnn-vulkan"
 }
 
+# Ruta explícita al ejecutable (p. ej. el sustituto de benchmarks/fake_realesrgan.py);
+# vacío = BINARIES_DIR / REALESRGAN_EXECUTABLE
+REALESRGAN_BINARY = os.getenv("REALESRGAN_BINARY", "")
+
 # Modelos disponibles de Real-ESRGAN
 # Estos nombres corresponden a los modelos incluidos en el binario ncnn-vulkan
 MODELS = {
@@ -80,13 +91,147 @@ MODELS = {
 API_HOST = os.getenv("API_HOST", "0.0.0.0")
 API_PORT = int(os.getenv("API_PORT", 8000))
 API_RELOAD = os.getenv("API_RELOAD", "true").lower() == "true"
+API_WORKERS = int(os.getenv("API_WORKERS", 1))  # Procesos de uvicorn (>1 desactiva el reload)
 
 # Configuración de procesamiento
-MAX_IMAGE_SIZE = 4096  # Tamaño máximo en píxeles por lado
+MAX_IMAGE_SIZE = 4096  # Tamaño máximo en píxeles por lado que procesa el motor de una vez
 SUPPORTED_FORMATS = ["png", "jpg", "jpeg", "webp", "bmp"]
 
+# Formato del resultado (parámetros format, quality y lossless). Si el motor
+# no escribe el formato pedido, su PNG se re-codifica en un pool de procesos
+OUTPUT_QUALITY = int(os.getenv("OUTPUT_QUALITY", 90))  # Calidad por defecto de JPEG, WebP y AVIF
+ENCODER_WORKERS = int(os.getenv("ENCODER_WORKERS", max(1, min(4, (os.cpu_count() or 2) // 2))))  # 0 = hilos
+
+# Decodificación y validación de las peticiones (base64, PIL, hash) y
+# codificación de las respuestas JSON, fuera del event loop y del motor
+CODEC_WORKERS = int(os.getenv("CODEC_WORKERS", max(1, min(4, (os.cpu_count() or 2) // 2))))  # 0 = hilos
+CODEC_QUEUE_SIZE = int(os.getenv("CODEC_QUEUE_SIZE", 64))  # Tareas pendientes antes de responder 429
+CODEC_NICE = int(os.getenv("CODEC_NICE", 5))  # Prioridad de sus procesos respecto a la API (os.nice)
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", 0.1))  # Segundos entre mediciones del retraso del event loop (0 = desactivado)
+
+# Imágenes grandes: con un lado mayor que MAX_IMAGE_SIZE se trocean en tiles
+# solapados y el resultado se cose en un buffer en disco (memoria acotada)
+LARGE_IMAGE_MAX_SIZE = int(os.getenv("LARGE_IMAGE_MAX_SIZE", 32768))  # Máximo por lado
+LARGE_IMAGE_TILE_SIZE = int(os.getenv("LARGE_IMAGE_TILE_SIZE", 1024))  # Lado de cada tile (px de entrada)
+LARGE_IMAGE_TILE_OVERLAP = int(os.getenv("LARGE_IMAGE_TILE_OVERLAP", 32))  # Contexto por lado (px)
+LARGE_IMAGE_TILES_IN_FLIGHT = int(os.getenv("LARGE_IMAGE_TILES_IN_FLIGHT", 4))  # Tiles encolados a la vez
+LARGE_IMAGE_MAX_CONCURRENT = int(os.getenv("LARGE_IMAGE_MAX_CONCURRENT", 1))  # Imágenes grandes a la vez
+LARGE_IMAGE_QUEUE_SIZE = int(os.getenv("LARGE_IMAGE_QUEUE_SIZE", 4))  # Imágenes grandes en espera antes de responder 429
+
 # Tiempo máximo de procesamiento (segundos)
 PROCESSING_TIMEOUT = 900
 
+# Plazo por defecto de las peticiones síncronas (segundos). El cliente puede
+# acortarlo con la cabecera X-Request-Timeout; al vencer se descarta la tarea
+# en cola o se termina el proceso del motor y se responde 504.
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", PROCESSING_TIMEOUT))
+
+# Planificador de tareas (valores por dispositivo)
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", 2))  # Procesos de Real-ESRGAN simultáneos
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", 32))  # Tareas en espera antes de responder 429
+
+# Vista previa (preview=true en /api/upscale): se reescala una versión reducida
+# o una región de la imagen en un carril rápido con workers y cola propios
+PREVIEW_MAX_SIDE = int(os.getenv("PREVIEW_MAX_SIDE", 256))  # Lado mayor (px) que llega al motor
+PREVIEW_PADDING = int(os.getenv("PREVIEW_PADDING", 16))  # Contexto alrededor de la región (evita bordes)
+PREVIEW_WORKERS = int(os.getenv("PREVIEW_WORKERS", 1))  # Workers reservados por dispositivo
+PREVIEW_QUEUE_SIZE = int(os.getenv("PREVIEW_QUEUE_SIZE", 8))  # Vistas previas en espera por dispositivo
+PREVIEW_TTL = int(os.getenv("PREVIEW_TTL", 600))  # Segundos que se puede promover a trabajo completo
+PREVIEW_DIR = TEMP_DIR / "previews"
+
+# Procesamiento por lotes
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 500))  # Imágenes máximas por petición
+BATCH_GROUP_SIZE = int(os.getenv("BATCH_GROUP_SIZE", 32))  # Imágenes por invocación del motor
+
+# Tiempo que se conservan los resultados de trabajos asíncronos (segundos)
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", 3600))
+
+# Almacén de trabajos
+# - memory: cada proceso guarda sus trabajos en memoria (un solo proceso)
+# - sqlite: cola y registro de trabajos compartidos entre procesos de la API
+JOB_STORE = os.getenv("JOB_STORE", "memory").lower()
+SHARED_STATE_DIR = Path(os.getenv("SHARED_STATE_DIR", str(SCRATCH_DIR / "shared")))
+JOB_DB_PATH = SHARED_STATE_DIR / "jobs.sqlite3"
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 0.1))  # Segundos entre consultas de la cola
+PROCESS_HEARTBEAT_TIMEOUT = int(os.getenv("PROCESS_HEARTBEAT_TIMEOUT", 30))  # Proceso sin latido = caído
+
 # Configuración de Vulkan
 VULKAN_DEVICE_ID = int(os.getenv("VULKAN_DEVICE_ID", 0))  # ID de GPU a usar
+
+# Dispositivos de cómputo: lista de IDs ("0,1", "-1" para CPU) o "auto" para
+# detectarlos. Cada dispositivo tiene sus propios workers (MAX_WORKERS) y cola.
+VULKAN_DEVICES = os.getenv("VULKAN_DEVICES", str(VULKAN_DEVICE_ID))
+DEVICE_MAX_FAILURES = int(os.getenv("DEVICE_MAX_FAILURES", 3))  # Fallos seguidos antes de apartarlo
+DEVICE_RETRY_AFTER = int(os.getenv("DEVICE_RETRY_AFTER", 60))  # Segundos fuera de servicio
+
+# Selección automática del tamaño de tile (cuando la petición usa tile_size=0)
+TILE_AUTO_TUNE = os.getenv("TILE_AUTO_TUNE", "true").lower() == "true"
+GPU_MEMORY_MB = int(os.getenv("GPU_MEMORY_MB", 0))  # Memoria disponible para el motor (0 = detectar)
+TILE_MEMORY_FRACTION = float(os.getenv("TILE_MEMORY_FRACTION", 0.7))  # Fracción usable por los tiles
+TILE_TUNING_FILE = Path(os.getenv("TILE_TUNING_FILE", str(BASE_DIR / "tile_tuning.json")))
+
+# Motor de inferencia
+# - subprocess: un proceso realesrgan-ncnn-vulkan por imagen
+# - persistent: workers de larga duración que cargan el modelo una sola vez
+# - cpu: redimensionado LANCZOS con Pillow (sin GPU ni modelos)
+ENGINE_BACKEND = os.getenv("ENGINE_BACKEND", "subprocess")
+# Motor que se usa si el configurado no está disponible al arrancar (cpu o none)
+ENGINE_FALLBACK = os.getenv("ENGINE_FALLBACK", "cpu")
+PERSISTENT_ENGINE_IMPL = os.getenv("PERSISTENT_ENGINE_IMPL", "ncnn")  # ncnn o stub
+PERSISTENT_ENGINE_MAX_MODELS = int(os.getenv("PERSISTENT_ENGINE_MAX_MODELS", 2))  # Modelos cargados por worker
+# Motor stub (pruebas sin GPU). La latencia admite un valor por dispositivo ("0.1,0.5")
+STUB_ENGINE_LATENCY = [float(v) for v in os.getenv("STUB_ENGINE_LATENCY", "0").split(",")]
+STUB_ENGINE_DEVICES = int(os.getenv("STUB_ENGINE_DEVICES", 1))  # Dispositivos simulados con "auto"
+STUB_ENGINE_FAILING_DEVICES = [
+    int(v) for v in os.getenv("STUB_ENGINE_FAILING_DEVICES", "").split(",") if v.strip()
+]  # Dispositivos simulados que fallan siempre
+
+# Calentamiento al arrancar: una inferencia mínima por modelo y dispositivo
+# antes de declararse listo (/health/ready)
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+# Segundos entre revisiones de MODELS_DIR para detectar modelos nuevos o cambiados (0 = no vigilar)
+MODELS_WATCH_INTERVAL = float(os.getenv("MODELS_WATCH_INTERVAL", 5.0))
+
+# Readiness (/health/ready): fuera de servicio con la cola casi llena o poco disco
+READY_QUEUE_SATURATION = float(os.getenv("READY_QUEUE_SATURATION", 0.9))  # Fracción de la cola ocupada
+MIN_FREE_DISK_MB = int(os.getenv("MIN_FREE_DISK_MB", 1024))  # Espacio libre mínimo en temp/ y output/
+
+# Caché de resultados (direccionada por contenido, expulsión LRU)
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", 1024))  # Tamaño máximo en disco
+# Upscales idénticos en curso comparten una ejecución (misma clave que la caché)
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "true").lower() == "true"
+
+# Limpieza de temp/ y output/ en segundo plano (por tandas, sin bloquear la API)
+JANITOR_INTERVAL = float(os.getenv("JANITOR_INTERVAL", 60))  # Segundos entre pasadas
+JANITOR_BATCH_SIZE = int(os.getenv("JANITOR_BATCH_SIZE", 256))  # Entradas revisadas por tanda
+JANITOR_MAX_AGE_HOURS = float(os.getenv("JANITOR_MAX_AGE_HOURS", 24))  # Edad a partir de la que se borra
+JANITOR_QUOTA_MB = int(os.getenv("JANITOR_QUOTA_MB", 4096))  # Ocupación máxima de temp/ + output/ (0 = sin cuota)
+# Lo más reciente puede ser de una petición en curso: no se borra antes de que venza su plazo
+JANITOR_MIN_AGE = float(os.getenv("JANITOR_MIN_AGE", REQUEST_TIMEOUT + 60))
+
+# Progreso en tiempo real (SSE): /api/progress/{request_id} y /api/jobs/{id}/events
+PROGRESS_MIN_INTERVAL = float(os.getenv("PROGRESS_MIN_INTERVAL", 0.25))  # Segundos mínimos entre actualizaciones
+PROGRESS_HEARTBEAT = float(os.getenv("PROGRESS_HEARTBEAT", 15))  # Comentario SSE para mantener viva la conexión
+PROGRESS_RETENTION = float(os.getenv("PROGRESS_RETENTION", 60))  # Segundos que se conserva el estado final
+
+# Trazas por petición: una línea OTLP/JSON por petición (vacío = no se escriben)
+TRACE_LOG_FILE = os.getenv("TRACE_LOG_FILE", str(BASE_DIR / "logs" / "traces.jsonl"))
+TRACE_LOG_MAX_MB = int(os.getenv("TRACE_LOG_MAX_MB", 50))  # Tamaño antes de rotar el archivo
+TRACE_LOG_BACKUPS = int(os.getenv("TRACE_LOG_BACKUPS", 3))  # Archivos rotados que se conservan
+TRACE_EXCLUDE_ROUTES = [  # Rutas sin traza en el log (siguen recibiendo X-Request-ID)
+    route.strip()
+    for route in os.getenv(
+        "TRACE_EXCLUDE_ROUTES",
+        "/health,/health/live,/health/ready,/metrics,/api/progress/{request_id},/api/jobs/{job_id}/events"
+    ).split(",")
+    if route.strip()
+]
+
+# Video (ffmpeg decodifica/codifica; los frames se reescalan por bloques)
+FFMPEG_BINARY = os.getenv("FFMPEG_BINARY", "ffmpeg")
+FFPROBE_BINARY = os.getenv("FFPROBE_BINARY", "ffprobe")
+VIDEO_CHUNK_FRAMES = int(os.getenv("VIDEO_CHUNK_FRAMES", 48))  # Frames por invocación del motor
+VIDEO_MAX_CHUNKS_ON_DISK = int(os.getenv("VIDEO_MAX_CHUNKS_ON_DISK", 3))  # Acota el uso de disco
+VIDEO_MAX_CONCURRENT = int(os.getenv("VIDEO_MAX_CONCURRENT", 1))  # Videos procesándose a la vez
+VIDEO_CRF = int(os.getenv("VIDEO_CRF", 18))  # Calidad de libx264 (menor = mejor)
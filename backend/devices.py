@@ -0,0 +1,513 @@
+"""
+Pool de dispositivos de cómputo para rIA
+Reparte las tareas de upscale entre varias GPUs (o la CPU con -g -1). Cada
+dispositivo tiene su propio motor y su propio PriorityScheduler; las tareas
+se asignan al dispositivo que terminaría antes según el coste estimado y la
+carga pendiente, y los dispositivos que fallan repetidamente se apartan
+temporalmente.
+"""
+
+import logging
+import re
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import CancelledError, Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+from config import STUB_ENGINE_DEVICES, VULKAN_DEVICE_ID
+from engines import DeadlineExceeded, UpscaleCancelled, UpscaleEngine
+from metrics import TASKS_DROPPED
+from scheduler import EMA_ALPHA, Priority, PriorityScheduler, QueueFullError
+
+logger = logging.getLogger(__name__)
+
+# ID que usa realesrgan-ncnn-vulkan para ejecutar en CPU
+CPU_DEVICE_ID = -1
+
+# Segundos por unidad de coste asumidos antes de medir un dispositivo
+DEFAULT_SECONDS_PER_COST = 1.0
+
+
+def discover_devices(setting: str, backend: str, impl: str) -> list:
+    """
+    Resuelve la lista de dispositivos a usar
+
+    Args:
+        setting: Valor de VULKAN_DEVICES ("auto" o IDs separados por comas)
+        backend: ENGINE_BACKEND configurado
+        impl: PERSISTENT_ENGINE_IMPL configurado
+
+    Returns:
+        list[int]: IDs de dispositivo (al menos uno)
+    """
+    if backend == "cpu":
+        return [CPU_DEVICE_ID]
+
+    if setting.strip().lower() != "auto":
+        devices = [int(value) for value in setting.split(",") if value.strip()]
+        return devices or [VULKAN_DEVICE_ID]
+
+    if backend == "persistent" and impl == "stub":
+        return list(range(max(1, STUB_ENGINE_DEVICES)))
+
+    vulkaninfo = shutil.which("vulkaninfo")
+    if vulkaninfo:
+        try:
+            result = subprocess.run(
+                [vulkaninfo, "--summary"], capture_output=True, text=True, timeout=10
+            )
+            # Líneas "GPU0:", "GPU1:", ... de la sección Devices
+            ids = sorted({int(match) for match in re.findall(r"^GPU(\d+):", result.stdout, re.MULTILINE)})
+            if ids:
+                logger.info(f"Dispositivos Vulkan detectados: {ids}")
+                return ids
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+
+    logger.warning(f"No se pudieron detectar dispositivos Vulkan; usando {VULKAN_DEVICE_ID}")
+    return [VULKAN_DEVICE_ID]
+
+
+@dataclass
+class Device:
+    """Dispositivo de cómputo con su motor, cola y estado de salud"""
+    id: int
+    engine: UpscaleEngine
+    scheduler: PriorityScheduler
+    # Coste de las tareas en cola o en ejecución
+    backlog_cost: float = 0.0
+    # Segundos por unidad de coste (media móvil); None hasta la primera medición
+    seconds_per_cost: Optional[float] = None
+    consecutive_failures: int = 0
+    failures: int = 0
+    unhealthy_until: float = 0.0
+    futures: set = field(default_factory=set)
+
+    @property
+    def name(self) -> str:
+        return "cpu" if self.id == CPU_DEVICE_ID else f"gpu{self.id}"
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.unhealthy_until
+
+
+# Resultado de una tarea que se movió a otro dispositivo (RoutedFuture lo ignora)
+REROUTED = object()
+
+
+class RoutedFuture(Future):
+    """
+    Future que retorna DevicePool. Sigue a la tarea encolada en un
+    dispositivo ('upstream') y, si esta se mueve a otro, a la nueva.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.upstream: Optional[Future] = None
+
+    def follow(self, upstream: Future):
+        self.upstream = upstream
+        upstream.add_done_callback(self._settle)
+
+    def _settle(self, upstream: Future):
+        if upstream is not self.upstream:
+            return
+        if upstream.cancelled():
+            super().cancel()
+            return
+        error = upstream.exception()
+        if error is not None:
+            self.set_exception(error)
+        elif upstream.result() is not REROUTED:
+            self.set_result(upstream.result())
+
+    def cancel(self) -> bool:
+        # Solo se cancela si la tarea seguía en cola; en ejecución la detiene su cancel_event
+        if self.upstream is not None and self.upstream.cancel():
+            return super().cancel()
+        return False
+
+
+class DevicePool:
+    """
+    Reparte tareas entre dispositivos. Expone la misma interfaz que
+    PriorityScheduler (submit, idle_workers, check_capacity, queue_position,
+    stats, shutdown), de modo que el resto del backend no distingue entre uno y
+    varios dispositivos.
+    """
+
+    def __init__(
+        self,
+        engines: dict,
+        workers_per_device: int,
+        max_queue_size: int,
+        max_failures: int = 3,
+        retry_after: float = 60.0,
+        preview_workers: int = 0,
+        preview_queue_size: int = 0
+    ):
+        """
+        Args:
+            engines: ID de dispositivo -> motor configurado para ese dispositivo
+            workers_per_device: Tareas simultáneas por dispositivo
+            max_queue_size: Tareas en espera por dispositivo
+            max_failures: Fallos seguidos que apartan al dispositivo
+            retry_after: Segundos que el dispositivo queda fuera de servicio
+            preview_workers: Workers reservados para vistas previas por dispositivo
+            preview_queue_size: Vistas previas en espera por dispositivo
+        """
+        self.max_failures = max_failures
+        self.retry_after = retry_after
+        self.devices = [
+            Device(
+                device_id,
+                engine,
+                PriorityScheduler(workers_per_device, max_queue_size, preview_workers, preview_queue_size)
+            )
+            for device_id, engine in engines.items()
+        ]
+        self.max_workers = workers_per_device * len(self.devices)
+        self.max_queue_size = max_queue_size * len(self.devices)
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def _candidates_locked(self) -> list:
+        """Dispositivos sanos; si ninguno lo está se usan todos (modo degradado)"""
+        now = time.monotonic()
+        healthy = [device for device in self.devices if device.healthy(now)]
+        return healthy or list(self.devices)
+
+    def _seconds_per_cost_locked(self, device: Device) -> float:
+        if device.seconds_per_cost is not None:
+            return device.seconds_per_cost
+        # Sin mediciones propias se asume la media de los demás dispositivos
+        measured = [d.seconds_per_cost for d in self.devices if d.seconds_per_cost is not None]
+        return sum(measured) / len(measured) if measured else DEFAULT_SECONDS_PER_COST
+
+    def _estimated_finish_locked(self, device: Device, cost: float) -> float:
+        """Segundos hasta que terminaría en este dispositivo una tarea de coste dado"""
+        workers = device.scheduler.max_workers
+        return (device.backlog_cost + cost) * self._seconds_per_cost_locked(device) / workers
+
+    def _choose_locked(self, cost: float, priority: Priority) -> Device:
+        candidates = [d for d in self._candidates_locked() if d.scheduler.has_capacity(priority)]
+        if not candidates:
+            self.rejected += 1
+            raise QueueFullError(self._estimate_wait_locked())
+        return min(candidates, key=lambda device: self._estimated_finish_locked(device, cost))
+
+    def estimate_wait(self, extra: int = 0) -> float:
+        """Estimación del tiempo hasta que una tarea nueva empiece (segundos)"""
+        with self._lock:
+            return self._estimate_wait_locked(extra)
+
+    def _estimate_wait_locked(self, extra: int = 0) -> float:
+        return min(device.scheduler.estimate_wait(extra) for device in self._candidates_locked())
+
+    def idle_workers(self) -> int:
+        """Workers libres en los dispositivos sanos"""
+        with self._lock:
+            return sum(device.scheduler.idle_workers() for device in self._candidates_locked())
+
+    def has_capacity(self, priority: Priority = Priority.INTERACTIVE) -> bool:
+        """Indica si algún dispositivo admite otra tarea de esa prioridad (sin contar un rechazo)"""
+        with self._lock:
+            return any(device.scheduler.has_capacity(priority) for device in self._candidates_locked())
+
+    def estimate(self, cost: float, priority: Priority = Priority.INTERACTIVE) -> dict:
+        """
+        Estimación para una tarea de coste dado, sin encolarla
+
+        Returns:
+            dict: {"accepted", "device", "queue_wait", "processing_time",
+                   "estimated_time", "measured"}; los tiempos en segundos.
+                   Si no se admitiría, "queue_wait" es la espera hasta que
+                   conviene reintentar y los demás tiempos son None.
+        """
+        with self._lock:
+            candidates = [d for d in self._candidates_locked() if d.scheduler.has_capacity(priority)]
+            if not candidates:
+                return {
+                    "accepted": False,
+                    "device": None,
+                    "queue_wait": self._estimate_wait_locked(),
+                    "processing_time": None,
+                    "estimated_time": None,
+                    "measured": False
+                }
+
+            def times(device: Device) -> tuple:
+                seconds_per_cost = self._seconds_per_cost_locked(device)
+                queue_wait = device.backlog_cost * seconds_per_cost / device.scheduler.max_workers
+                return queue_wait, cost * seconds_per_cost
+
+            device = min(candidates, key=lambda d: sum(times(d)))
+            queue_wait, processing_time = times(device)
+            return {
+                "accepted": True,
+                "device": device.name,
+                "queue_wait": queue_wait,
+                "processing_time": processing_time,
+                "estimated_time": queue_wait + processing_time,
+                # False mientras se usa la velocidad supuesta (sin mediciones)
+                "measured": device.seconds_per_cost is not None
+            }
+
+    def check_capacity(self, priority: Priority = Priority.INTERACTIVE):
+        """Lanza QueueFullError si ningún dispositivo admite más tareas de esa prioridad"""
+        with self._lock:
+            if not any(device.scheduler.has_capacity(priority) for device in self._candidates_locked()):
+                self.rejected += 1
+                raise QueueFullError(self._estimate_wait_locked())
+
+    def submit(
+        self,
+        fn: Callable,
+        *args: Any,
+        priority: Priority = Priority.INTERACTIVE,
+        client_id: str = "anonymous",
+        cost: float = 1.0,
+        deadline: Optional[float] = None,
+        **kwargs: Any
+    ) -> Future:
+        """
+        Encola una tarea en el dispositivo que la terminaría antes.
+        fn recibe el dispositivo asignado como argumento 'device'.
+
+        Args:
+            fn: Función a ejecutar
+            priority: Clase de prioridad de la tarea
+            client_id: Identificador del cliente para el reparto justo
+            cost: Coste relativo estimado (p. ej. megapíxeles de salida)
+            deadline: Instante (time.monotonic) límite; si al salir de la cola
+                ya no se puede cumplir, la tarea se descarta sin ejecutarse
+
+        Raises:
+            QueueFullError: Si ningún dispositivo admite más tareas
+        """
+        with self._lock:
+            device = self._choose_locked(cost, priority)
+            return self._submit_locked(device, fn, args, kwargs, priority, client_id, cost, deadline)
+
+    def submit_to(
+        self,
+        device: Device,
+        fn: Callable,
+        *args: Any,
+        priority: Priority = Priority.INTERACTIVE,
+        client_id: str = "anonymous",
+        cost: float = 1.0,
+        **kwargs: Any
+    ) -> Future:
+        """
+        Encola una tarea en un dispositivo concreto (p. ej. para calentarlo).
+        fn recibe el dispositivo como argumento 'device'.
+
+        Raises:
+            QueueFullError: Si la cola del dispositivo está llena
+        """
+        with self._lock:
+            return self._submit_locked(device, fn, args, kwargs, priority, client_id, cost, None)
+
+    def _submit_locked(
+        self,
+        device: Device,
+        fn: Callable,
+        args: tuple,
+        kwargs: dict,
+        priority: Priority,
+        client_id: str,
+        cost: float,
+        deadline: Optional[float],
+        routed: Optional[RoutedFuture] = None
+    ) -> RoutedFuture:
+        """
+        Encola la tarea en 'device'. Con 'routed' (una tarea que se mueve de
+        dispositivo) se reutiliza el Future que ya tiene quien la encoló
+        """
+        rerouted = routed is not None
+        if routed is None:
+            routed = RoutedFuture()
+        future = device.scheduler.submit(
+            self._run_on_device,
+            device,
+            cost,
+            fn,
+            args,
+            kwargs,
+            priority,
+            client_id,
+            deadline,
+            routed,
+            rerouted,
+            priority=priority,
+            client_id=client_id
+        )
+        device.backlog_cost += cost
+        device.futures.add(future)
+        # También se ejecuta si la tarea se cancela en cola
+        future.add_done_callback(lambda done: self._release(device, cost, done))
+        routed.follow(future)
+        return routed
+
+    def _reroute(self, device: Device, cost: float, priority: Priority) -> Optional[Device]:
+        """Dispositivo sano alternativo para una tarea encolada en uno averiado"""
+        with self._lock:
+            now = time.monotonic()
+            if device.healthy(now):
+                return None
+            others = [
+                d for d in self.devices
+                if d is not device and d.healthy(now) and d.scheduler.has_capacity(priority)
+            ]
+            if not others:
+                return None
+            return min(others, key=lambda other: self._estimated_finish_locked(other, cost))
+
+    def _run_on_device(
+        self,
+        device: Device,
+        cost: float,
+        fn: Callable,
+        args: tuple,
+        kwargs: dict,
+        priority: Priority,
+        client_id: str,
+        deadline: Optional[float],
+        routed: RoutedFuture,
+        rerouted: bool
+    ):
+        if deadline is not None:
+            with self._lock:
+                expected = cost * (device.seconds_per_cost or 0.0)
+            if time.monotonic() + expected > deadline:
+                # El cliente ya no esperará el resultado: no gastar el motor
+                TASKS_DROPPED.inc(reason="deadline")
+                raise DeadlineExceeded("El plazo de la petición no se puede cumplir")
+
+        # El dispositivo se apartó mientras la tarea esperaba: moverla a otro sano.
+        # El Future de quien la encoló pasa a seguir a la nueva tarea y este
+        # worker queda libre. Una tarea solo se mueve una vez.
+        alternative = None if rerouted else self._reroute(device, cost, priority)
+        if alternative is not None:
+            try:
+                with self._lock:
+                    self._submit_locked(alternative, fn, args, kwargs, priority, client_id, cost, deadline, routed)
+            except QueueFullError:
+                # Se llenó entre la elección y el encolado: se ejecuta aquí
+                pass
+            else:
+                logger.info(f"Tarea movida de {device.name} (no disponible) a {alternative.name}")
+                return REROUTED
+
+        start = time.monotonic()
+        try:
+            result = fn(*args, device=device, **kwargs)
+        except (UpscaleCancelled, CancelledError, ValueError):
+            # Cancelaciones y entradas inválidas no dicen nada del dispositivo
+            raise
+        except Exception as e:
+            self._record_failure(device, e)
+            raise
+        self._record_success(device, cost, time.monotonic() - start)
+        return result
+
+    def _release(self, device: Device, cost: float, future: Future):
+        with self._lock:
+            device.backlog_cost = max(0.0, device.backlog_cost - cost)
+            device.futures.discard(future)
+
+    def _record_success(self, device: Device, cost: float, elapsed: float):
+        with self._lock:
+            # Las tareas sin coste (calentamiento) no son representativas del rendimiento
+            if cost > 0:
+                sample = elapsed / max(cost, 1e-3)
+                if device.seconds_per_cost is None:
+                    device.seconds_per_cost = sample
+                else:
+                    device.seconds_per_cost += EMA_ALPHA * (sample - device.seconds_per_cost)
+            if device.consecutive_failures >= self.max_failures:
+                logger.info(f"Dispositivo {device.name} recuperado")
+            device.consecutive_failures = 0
+            device.unhealthy_until = 0.0
+
+    def _record_failure(self, device: Device, error: Exception):
+        with self._lock:
+            now = time.monotonic()
+            was_healthy = device.healthy(now)
+            device.failures += 1
+            device.consecutive_failures += 1
+            if device.consecutive_failures >= self.max_failures:
+                device.unhealthy_until = now + self.retry_after
+            if device.consecutive_failures >= self.max_failures and was_healthy:
+                logger.warning(
+                    f"Dispositivo {device.name} marcado como no disponible durante "
+                    f"{self.retry_after:.0f}s tras {device.consecutive_failures} fallos seguidos: {error}"
+                )
+
+    def queue_position(self, future: Future) -> Optional[int]:
+        """Número aproximado de tareas que se ejecutarán antes que esta en su dispositivo"""
+        # Un resultado que se re-codifica (encoder.EncodedFuture) o una petición
+        # agrupada (singleflight.CoalescedFuture) espera a la tarea del motor
+        while getattr(future, "upstream", None) is not None:
+            future = future.upstream
+        with self._lock:
+            device = next((d for d in self.devices if future in d.futures), None)
+        if device is None:
+            return None
+        return device.scheduler.queue_position(future)
+
+    def stats(self) -> dict:
+        """Agregado de todos los dispositivos más el detalle de cada uno"""
+        now = time.monotonic()
+        per_device = []
+        with self._lock:
+            for device in self.devices:
+                stats = device.scheduler.stats()
+                per_device.append({
+                    "id": device.id,
+                    "name": device.name,
+                    "healthy": device.healthy(now),
+                    "consecutive_failures": device.consecutive_failures,
+                    "failures": device.failures,
+                    "backlog_cost": device.backlog_cost,
+                    "seconds_per_cost": device.seconds_per_cost,
+                    **stats
+                })
+            estimated_wait = self._estimate_wait_locked()
+            rejected = self.rejected
+
+        completed = sum(d["completed"] for d in per_device)
+        return {
+            "workers": sum(d["workers"] for d in per_device),
+            "active_workers": sum(d["active_workers"] for d in per_device),
+            "preview_workers": sum(d["preview_workers"] for d in per_device),
+            "active_preview_workers": sum(d["active_preview_workers"] for d in per_device),
+            "queue_depth": sum(d["queue_depth"] for d in per_device),
+            "queue_depth_by_priority": {
+                priority.name.lower(): sum(d["queue_depth_by_priority"][priority.name.lower()] for d in per_device)
+                for priority in Priority
+            },
+            "max_queue_size": self.max_queue_size,
+            "submitted": sum(d["submitted"] for d in per_device),
+            "completed": completed,
+            "rejected": rejected,
+            "avg_wait_time": (
+                sum(d["avg_wait_time"] * d["completed"] for d in per_device) / completed if completed else 0.0
+            ),
+            "p95_wait_time": max(d["p95_wait_time"] for d in per_device),
+            "max_wait_time": max(d["max_wait_time"] for d in per_device),
+            "avg_run_time": sum(d["avg_run_time"] for d in per_device) / len(per_device),
+            "estimated_wait": estimated_wait,
+            "devices": per_device
+        }
+
+    def shutdown(self, wait: bool = True):
+        """Detiene los planificadores y libera los motores de cada dispositivo"""
+        for device in self.devices:
+            device.scheduler.shutdown(wait=wait)
+        for device in self.devices:
+            device.engine.close()
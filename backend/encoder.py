@@ -0,0 +1,293 @@
+"""
+Formato de salida de los upscales
+La petición elige el formato del resultado (png, webp, jpg o avif), su
+calidad y, en WebP, la compresión sin pérdida. Hay dos caminos:
+
+- El motor escribe el formato pedido si lo sabe codificar exactamente así
+  (UpscaleEngine.native_formats; p. ej. el -f de realesrgan-ncnn-vulkan):
+  no hay una segunda codificación.
+- Si no, el motor escribe PNG y ImageEncoder lo re-codifica con Pillow en un
+  pool de procesos (ENCODER_WORKERS). Codificar decenas de megapíxeles tarda
+  segundos y, en un hilo, competiría por el GIL con el event loop de la API.
+  La codificación se encadena al Future del planificador: el dispositivo
+  queda libre para la siguiente tarea mientras tanto.
+"""
+
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextvars import copy_context
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from PIL import Image
+
+try:
+    # Registra AVIF en las versiones de Pillow que no lo traen (< 11.2)
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+from config import ENCODER_WORKERS, OUTPUT_QUALITY
+from tracing import observe_stage
+
+logger = logging.getLogger(__name__)
+
+# Formato -> (formato de Pillow, tipo MIME, lado máximo en píxeles o None)
+FORMATS = {
+    "png": ("PNG", "image/png", None),
+    "webp": ("WEBP", "image/webp", 16383),
+    "jpg": ("JPEG", "image/jpeg", 65535),
+    "avif": ("AVIF", "image/avif", None)
+}
+ALIASES = {"jpeg": "jpg"}
+# Formatos que admiten lossless=true
+LOSSLESS_FORMATS = ("png", "webp")
+
+MEDIA_TYPES = {f".{name}": media_type for name, (_, media_type, _) in FORMATS.items()}
+
+
+def media_type_for(path: Path) -> str:
+    """Tipo MIME de un resultado según su extensión"""
+    return MEDIA_TYPES.get(Path(path).suffix.lower(), "application/octet-stream")
+
+
+def available_formats() -> list:
+    """Formatos que el Pillow instalado sabe escribir (AVIF es opcional)"""
+    Image.init()
+    return [name for name, (pil_format, _, _) in FORMATS.items() if pil_format in Image.SAVE]
+
+
+@dataclass(frozen=True)
+class OutputFormat:
+    """Formato pedido para el resultado"""
+    name: str = "png"
+    quality: int = 100
+    lossless: bool = True
+
+    @property
+    def extension(self) -> str:
+        return self.name
+
+    @property
+    def media_type(self) -> str:
+        return FORMATS[self.name][1]
+
+    @property
+    def key(self) -> str:
+        """Identificador con sus opciones ("png", "webp-lossless", "jpg-q85")"""
+        if self.lossless:
+            return self.name if self.name == "png" else f"{self.name}-lossless"
+        return f"{self.name}-q{self.quality}"
+
+    def check_size(self, width: int, height: int):
+        """
+        Raises:
+            ValueError: Si el formato no admite una imagen de ese tamaño
+        """
+        max_side = FORMATS[self.name][2]
+        if max_side is not None and max(width, height) > max_side:
+            raise ValueError(
+                f"{self.name.upper()} admite como máximo {max_side}px por lado "
+                f"y el resultado tendría {width}x{height}"
+            )
+
+    def save_options(self) -> dict:
+        """Argumentos de Image.save"""
+        if self.name == "png":
+            # Como CpuEngine: prima la velocidad sobre el tamaño
+            return {"compress_level": 1}
+        if self.lossless:
+            return {"lossless": True}
+        return {"quality": self.quality}
+
+
+PNG = OutputFormat()
+
+
+def parse_output_format(
+    name: Optional[str] = "png",
+    quality: Optional[int] = None,
+    lossless: bool = False
+) -> OutputFormat:
+    """
+    Valida el formato pedido
+
+    Args:
+        name: png, webp, jpg (o jpeg) o avif
+        quality: Calidad 1-100 de los formatos con pérdida (por defecto OUTPUT_QUALITY)
+        lossless: Compresión sin pérdida (PNG siempre lo es)
+
+    Raises:
+        ValueError: Si el formato o sus opciones no son válidos
+    """
+    name = (name or "png").lower()
+    name = ALIASES.get(name, name)
+    if name not in FORMATS:
+        raise ValueError(f"Formato de salida no válido: {name} ({', '.join(FORMATS)})")
+    if name not in available_formats():
+        raise ValueError(f"El formato {name} no está disponible en este servidor")
+    if quality is not None and not 1 <= quality <= 100:
+        raise ValueError("La calidad debe estar entre 1 y 100")
+    if lossless and name not in LOSSLESS_FORMATS:
+        raise ValueError(f"Solo {' y '.join(LOSSLESS_FORMATS)} admiten lossless")
+    if name == "png":
+        return PNG
+    return OutputFormat(name, quality if quality is not None else OUTPUT_QUALITY, lossless)
+
+
+def _allow_large_outputs():
+    """
+    Inicializa los procesos del pool. No importan image_io, que alinea la
+    protección de PIL contra "bombas de descompresión" con las entradas
+    grandes; aquí se abren resultados del motor (hasta x4 de esas entradas),
+    no archivos del cliente, y el límite por defecto (89 Mpx) rechazaría
+    p. ej. un 4096x4096 a x4
+    """
+    Image.MAX_IMAGE_PIXELS = None
+
+
+def encode_image(source: str, destination: str, output_format: OutputFormat) -> float:
+    """
+    Re-codifica 'source' en 'destination' (se ejecuta en los procesos del pool)
+
+    Returns:
+        float: Segundos que tardó
+    """
+    start = time.perf_counter()
+    with Image.open(source) as image:
+        if output_format.name == "jpg" and image.mode != "RGB":
+            # JPEG no tiene canal alfa: lo transparente queda sobre blanco
+            rgba = image.convert("RGBA")
+            image = Image.new("RGB", rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.getchannel("A"))
+        image.save(destination, FORMATS[output_format.name][0], **output_format.save_options())
+    return time.perf_counter() - start
+
+
+class EncodedFuture(Future):
+    """
+    Resultado de una tarea del motor re-codificado en otro formato.
+    'upstream' es el Future del planificador.
+    """
+
+    def __init__(self, upstream: Future):
+        super().__init__()
+        self.upstream = upstream
+
+    def cancel(self) -> bool:
+        # Solo se cancela si la tarea del motor seguía en cola; en ejecución
+        # la detiene el cancel_event y una codificación en curso termina sola
+        if self.upstream.cancel():
+            return super().cancel()
+        return False
+
+
+class ImageEncoder:
+    """Pool de procesos que re-codifica los PNG del motor"""
+
+    def __init__(self, workers: int = ENCODER_WORKERS):
+        """
+        Args:
+            workers: Procesos del pool (0 = un hilo, p. ej. si no se pueden crear procesos)
+        """
+        self.workers = workers
+        self._executor: Optional[Executor] = None
+        self._lock = threading.Lock()
+
+    def _pool(self) -> Executor:
+        # Los procesos se crean con la primera codificación, no al arrancar
+        with self._lock:
+            if self._executor is None:
+                if self.workers > 0:
+                    # spawn: fork copiaría a medias los hilos del proceso de la API
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                        initializer=_allow_large_outputs
+                    )
+                else:
+                    # En hilos rige el límite del proceso de la API (image_io)
+                    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="encoder")
+            return self._executor
+
+    def _discard(self, executor: Executor):
+        """
+        Descarta un pool roto: tras morir un proceso (p. ej. sin memoria)
+        rechazaría todas las codificaciones; la siguiente crea uno nuevo
+        """
+        logger.warning("Pool de codificación roto; se recreará")
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, *args) -> tuple:
+        """Encola encode_image(*args); retorna (pool, Future)"""
+        executor = self._pool()
+        try:
+            return executor, executor.submit(encode_image, *args)
+        except BrokenProcessPool:
+            # Roto por una codificación anterior: se reintenta en uno nuevo
+            self._discard(executor)
+            executor = self._pool()
+            return executor, executor.submit(encode_image, *args)
+
+    def chain(self, upstream: Future, output_format: OutputFormat) -> EncodedFuture:
+        """
+        Future que se resuelve con el resultado de 'upstream' (un PNG)
+        re-codificado en 'output_format'. El PNG intermedio se borra.
+        """
+        future = EncodedFuture(upstream)
+        # Contexto de quien encola: la etapa format_encode va a su traza
+        context = copy_context()
+
+        def on_engine_done(done: Future):
+            if done.cancelled():
+                future.cancel()
+                return
+            error = done.exception()
+            if error is not None:
+                future.set_exception(error)
+                return
+            source = Path(done.result())
+            destination = source.with_suffix(f".{output_format.extension}")
+            if not future.set_running_or_notify_cancel():
+                source.unlink(missing_ok=True)
+                return
+            try:
+                executor, encoding = self._submit(str(source), str(destination), output_format)
+            except Exception as e:
+                # Pool cerrado (el servicio se está apagando)
+                source.unlink(missing_ok=True)
+                future.set_exception(e)
+                return
+            encoding.add_done_callback(lambda encoded: on_encoded(encoded, source, destination, executor))
+
+        def on_encoded(encoded: Future, source: Path, destination: Path, executor: Executor):
+            source.unlink(missing_ok=True)
+            try:
+                seconds = encoded.result()
+            except BaseException as e:
+                if isinstance(e, BrokenProcessPool):
+                    self._discard(executor)
+                destination.unlink(missing_ok=True)
+                logger.error(f"Error al codificar {output_format.key}: {e}")
+                future.set_exception(
+                    RuntimeError(f"No se pudo codificar el resultado en {output_format.name}: {e}")
+                )
+                return
+            context.run(observe_stage, "format_encode", seconds)
+            future.set_result(destination)
+
+        upstream.add_done_callback(on_engine_done)
+        return future
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
@@ -0,0 +1,164 @@
+"""
+Worker persistente de inferencia para rIA
+Carga un modelo de Real-ESRGAN una sola vez y procesa imágenes a demanda.
+
+Protocolo (una línea JSON por mensaje):
+- Al arrancar escribe {"ready": true} en stdout (o {"ready": false, "error": ...})
+- Por cada línea recibida en stdin {"input", "output", "scale", "tile_size"}
+  responde {"ok": true} o {"ok": false, "error": ...}
+- Termina al cerrarse stdin
+
+Implementaciones:
+- ncnn: usa los bindings de Python de ncnn (pip install ncnn)
+- stub: reescalado LANCZOS con PIL, para pruebas en máquinas sin GPU
+"""
+
+import argparse
+import json
+import sys
+import time
+
+from PIL import Image
+
+# Margen alrededor de cada tile para evitar costuras (igual que realesrgan-ncnn-vulkan)
+TILE_PAD = 10
+# Tamaño de tile cuando no se especifica uno
+DEFAULT_TILE_SIZE = 200
+
+
+class StubModel:
+    """Modelo falso: reescala con PIL y simula una latencia fija (o un dispositivo averiado)"""
+
+    def __init__(self, model_scale: int, latency: float, fail: bool = False):
+        self.model_scale = model_scale
+        self.latency = latency
+        self.fail = fail
+
+    def upscale(self, image: Image.Image, tile_size: int) -> Image.Image:
+        if self.latency:
+            time.sleep(self.latency)
+        if self.fail:
+            raise RuntimeError("vkQueueSubmit failed -4 (dispositivo simulado averiado)")
+        return image.resize(
+            (image.width * self.model_scale, image.height * self.model_scale),
+            Image.Resampling.LANCZOS
+        )
+
+
+class NcnnModel:
+    """Modelo Real-ESRGAN cargado con los bindings de Python de ncnn"""
+
+    def __init__(self, param_path: str, bin_path: str, model_scale: int, gpu: int):
+        import ncnn
+        import numpy as np
+
+        self.np = np
+        self.ncnn = ncnn
+        self.model_scale = model_scale
+
+        self.net = ncnn.Net()
+        if gpu >= 0 and ncnn.get_gpu_count() > gpu:
+            self.net.opt.use_vulkan_compute = True
+            self.net.set_vulkan_device(gpu)
+        self.net.load_param(param_path)
+        self.net.load_model(bin_path)
+
+    def _infer(self, tile):
+        """Inferencia de un tile RGB uint8 (H, W, 3) -> (H*s, W*s, 3)"""
+        np = self.np
+        height, width = tile.shape[:2]
+        mat = self.ncnn.Mat.from_pixels(
+            np.ascontiguousarray(tile), self.ncnn.Mat.PixelType.PIXEL_RGB, width, height
+        )
+        mat.substract_mean_normalize([], [1 / 255.0] * 3)
+
+        extractor = self.net.create_extractor()
+        extractor.input("data", mat)
+        _, out = extractor.extract("output")
+
+        result = np.array(out).transpose(1, 2, 0)
+        return (result.clip(0, 1) * 255.0).round().astype(np.uint8)
+
+    def upscale(self, image: Image.Image, tile_size: int) -> Image.Image:
+        np = self.np
+        pixels = np.asarray(image.convert("RGB"))
+        height, width = pixels.shape[:2]
+        scale = self.model_scale
+        tile_size = tile_size or DEFAULT_TILE_SIZE
+
+        output = np.empty((height * scale, width * scale, 3), dtype=np.uint8)
+        for y in range(0, height, tile_size):
+            for x in range(0, width, tile_size):
+                # Tile con margen para que el modelo vea contexto en los bordes
+                y0, x0 = max(y - TILE_PAD, 0), max(x - TILE_PAD, 0)
+                y1 = min(y + tile_size + TILE_PAD, height)
+                x1 = min(x + tile_size + TILE_PAD, width)
+                result = self._infer(pixels[y0:y1, x0:x1])
+
+                # Recortar el margen en el resultado
+                top, left = (y - y0) * scale, (x - x0) * scale
+                tile_h = (min(y + tile_size, height) - y) * scale
+                tile_w = (min(x + tile_size, width) - x) * scale
+                output[y * scale:y * scale + tile_h, x * scale:x * scale + tile_w] = \
+                    result[top:top + tile_h, left:left + tile_w]
+
+        return Image.fromarray(output)
+
+
+def process(model, request: dict):
+    """Procesa una petición del protocolo"""
+    with Image.open(request["input"]) as image:
+        image = image.convert("RGB")
+        result = model.upscale(image, int(request.get("tile_size", 0)))
+
+    # El modelo trabaja a su escala nativa; ajustar si se pidió otra
+    scale = int(request.get("scale", model.model_scale))
+    if scale != model.model_scale:
+        result = result.resize(
+            (image.width * scale, image.height * scale),
+            Image.Resampling.LANCZOS
+        )
+    result.save(request["output"], "PNG")
+
+
+def send(message: dict):
+    sys.stdout.write(json.dumps(message) + "\n")
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker persistente de Real-ESRGAN")
+    parser.add_argument("--impl", choices=["ncnn", "stub"], default="ncnn")
+    parser.add_argument("--param", required=True)
+    parser.add_argument("--bin", required=True)
+    parser.add_argument("--model-scale", type=int, default=4)
+    parser.add_argument("--gpu", type=int, default=0)
+    parser.add_argument("--stub-latency", type=float, default=0.0)
+    parser.add_argument("--stub-fail", action="store_true")
+    args = parser.parse_args()
+
+    try:
+        if args.impl == "stub":
+            model = StubModel(args.model_scale, args.stub_latency, args.stub_fail)
+        else:
+            model = NcnnModel(args.param, args.bin, args.model_scale, args.gpu)
+    except Exception as e:
+        send({"ready": False, "error": str(e)})
+        return 1
+
+    send({"ready": True})
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            process(model, json.loads(line))
+            send({"ok": True})
+        except Exception as e:
+            send({"ok": False, "error": str(e)})
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
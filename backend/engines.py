@@ -0,0 +1,667 @@
+"""
+Motores de inferencia de Real-ESRGAN
+Define la interfaz común de los backends y sus implementaciones:
+- SubprocessEngine: un proceso realesrgan-ncnn-vulkan por imagen (comportamiento original)
+- PersistentEngine: procesos hijo de larga duración que cargan el modelo una
+  sola vez y atienden muchas imágenes por stdin/stdout (ver engine_worker.py)
+- CpuEngine: redimensionado LANCZOS con Pillow, sin GPU ni modelos; sirve de
+  alternativa en máquinas sin Vulkan
+"""
+
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Tuple
+
+import PIL
+from PIL import Image
+
+from config import (
+    BASE_DIR,
+    MODELS,
+    MODELS_DIR,
+    PROCESSING_TIMEOUT,
+    PERSISTENT_ENGINE_IMPL,
+    PERSISTENT_ENGINE_MAX_MODELS,
+    STUB_ENGINE_LATENCY,
+    STUB_ENGINE_FAILING_DEVICES
+)
+from metrics import ENGINE_PROCESS_CPU
+from progress import EngineProgress, current_output_listener, current_reporter, parse_output_done, parse_progress
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Intervalo de sondeo del proceso hijo para detectar cancelaciones (segundos)
+CANCEL_POLL_INTERVAL = 0.25
+# Segundos que se espera tras SIGTERM antes de matar el grupo con SIGKILL
+KILL_GRACE_PERIOD = 2.0
+
+# Mensajes con los que ncnn/Vulkan reportan falta de memoria (en minúsculas)
+OUT_OF_MEMORY_MARKERS = (
+    "out of memory",
+    "out_of_device_memory",
+    "out_of_host_memory",
+    "vkallocatememory failed",
+    "bad_alloc"
+)
+
+
+class UpscaleCancelled(Exception):
+    """La tarea de upscale fue cancelada antes de terminar"""
+
+
+class DeadlineExceeded(UpscaleCancelled):
+    """La tarea no puede terminar antes del plazo de la petición"""
+
+
+class EngineError(RuntimeError):
+    """Fallo del motor de inferencia al procesar una imagen"""
+
+
+class EngineOutOfMemory(EngineError):
+    """El motor se quedó sin memoria; puede reintentarse con un tile menor"""
+
+
+def remaining_time(deadline: Optional[float], limit: float = PROCESSING_TIMEOUT) -> float:
+    """
+    Segundos disponibles hasta el plazo (reloj monotónico), acotados por limit
+
+    Raises:
+        DeadlineExceeded: Si el plazo ya pasó
+    """
+    if deadline is None:
+        return limit
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded("Plazo de la petición agotado")
+    return min(limit, remaining)
+
+
+def popen_group_kwargs() -> dict:
+    """Argumentos de Popen para lanzar el hijo en su propio grupo de procesos"""
+    if os.name == "posix":
+        return {"start_new_session": True}
+    return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+
+
+def kill_process_group(process: subprocess.Popen):
+    """
+    Termina el proceso y todos sus descendientes: SIGTERM al grupo, y SIGKILL
+    si no han salido tras KILL_GRACE_PERIOD. En Windows se mata el proceso.
+    """
+    if process.poll() is not None:
+        return
+    if os.name != "posix":
+        process.kill()
+        return
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=KILL_GRACE_PERIOD)
+    except subprocess.TimeoutExpired:
+        pass
+    except ProcessLookupError:
+        return
+    try:
+        # También alcanza a los nietos que sigan vivos aunque el líder haya salido
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def engine_error(message: str) -> EngineError:
+    """Construye el error adecuado según el mensaje del motor"""
+    lowered = message.lower()
+    if any(marker in lowered for marker in OUT_OF_MEMORY_MARKERS):
+        return EngineOutOfMemory(message)
+    return EngineError(message)
+
+
+class UpscaleEngine:
+    """Interfaz base de los motores de inferencia"""
+
+    name = "base"
+    # Si necesita los archivos .bin/.param de MODELS_DIR para procesar
+    requires_model_files = True
+    # Formatos (OutputFormat.key) que escribe según la extensión de output_path
+    native_formats = ("png",)
+
+    def is_available(self) -> bool:
+        """Indica si el motor puede usarse en esta máquina"""
+        raise NotImplementedError
+
+    def version(self) -> str:
+        """Huella del motor; forma parte de la clave de la caché de resultados"""
+        raise NotImplementedError
+
+    def run(
+        self,
+        input_path: Path,
+        output_path: Path,
+        model: str,
+        scale: int,
+        tile_size: int,
+        cancel_event: Optional[threading.Event] = None,
+        deadline: Optional[float] = None
+    ):
+        """
+        Reescala input_path y escribe el resultado en output_path (PNG, o
+        uno de native_formats según su extensión)
+
+        Args:
+            cancel_event: Al activarse se termina el proceso del motor
+            deadline: Instante (time.monotonic) a partir del cual el resultado ya no sirve
+
+        Raises:
+            UpscaleCancelled: Si cancel_event se activa durante el proceso
+            DeadlineExceeded: Si se alcanza el plazo antes de terminar
+            EngineError: Si el motor falla
+            subprocess.TimeoutExpired: Si se supera PROCESSING_TIMEOUT
+        """
+        raise NotImplementedError
+
+    def run_batch(
+        self,
+        input_dir: Path,
+        output_dir: Path,
+        model: str,
+        scale: int,
+        tile_size: int,
+        cancel_event: Optional[threading.Event] = None,
+        deadline: Optional[float] = None
+    ):
+        """
+        Reescala todas las imágenes de input_dir en output_dir (<nombre>.png).
+        La implementación por defecto procesa los archivos uno a uno; los
+        fallos individuales no detienen el resto y se reportan al final.
+        Cada salida escrita se notifica al oyente de reporting_outputs().
+
+        Raises:
+            UpscaleCancelled: Si cancel_event se activa durante el proceso
+            EngineError: Si alguna imagen falló
+        """
+        listener = current_output_listener()
+        failed = []
+        for input_path in sorted(input_dir.iterdir()):
+            output_path = output_dir / f"{input_path.stem}.png"
+            try:
+                self.run(input_path, output_path, model, scale, tile_size, cancel_event, deadline)
+            except (UpscaleCancelled, EngineOutOfMemory, subprocess.TimeoutExpired):
+                raise
+            except Exception as e:
+                logger.warning(f"Fallo en lote para {input_path.name}: {e}")
+                failed.append(input_path.name)
+                continue
+            if listener is not None:
+                listener(output_path)
+
+        if failed:
+            raise EngineError(f"Fallaron {len(failed)} imágenes del lote: {', '.join(failed)}")
+
+    def close(self):
+        """Libera procesos o recursos del motor"""
+
+
+class SubprocessEngine(UpscaleEngine):
+    """Ejecuta el binario realesrgan-ncnn-vulkan una vez por imagen"""
+
+    name = "subprocess"
+    # El binario codifica WebP sin pérdida y JPEG con calidad 100
+    native_formats = ("png", "webp-lossless", "jpg-q100")
+
+    def __init__(self, executable: Path, device_id: int):
+        self.executable = executable
+        self.device_id = device_id
+        self._version: Optional[str] = None
+
+    def is_available(self) -> bool:
+        return self.executable.exists()
+
+    def version(self) -> str:
+        if self._version is None:
+            digest = hashlib.sha256()
+            with open(self.executable, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            self._version = digest.hexdigest()[:16]
+        return self._version
+
+    def build_command(
+        self,
+        input_path: Path,
+        output_path: Path,
+        model: str,
+        scale: int,
+        tile_size: int,
+        output_format: str = "png"
+    ) -> list:
+        """Construye la línea de comandos para Real-ESRGAN"""
+        cmd = [
+            str(self.executable),
+            "-i", str(input_path),
+            "-o", str(output_path),
+            "-n", MODELS[model]["name"],
+            "-s", str(scale),
+            "-g", str(self.device_id),  # GPU ID
+            "-f", output_format  # Formato de salida (png, webp o jpg)
+        ]
+
+        # Añadir parámetros opcionales
+        if tile_size > 0:
+            cmd.extend(["-t", str(tile_size)])
+
+        # NOTA: El binario ncnn-vulkan de Real-ESRGAN NO soporta el parámetro -d (denoise)
+        # El denoise está integrado en cada modelo y no se puede ajustar en runtime
+        return cmd
+
+    def run(self, input_path, output_path, model, scale, tile_size, cancel_event=None, deadline=None):
+        cmd = self.build_command(
+            input_path, output_path, model, scale, tile_size, output_path.suffix.lstrip(".") or "png"
+        )
+        logger.info(f"Ejecutando comando: {' '.join(cmd)}")
+
+        returncode, stderr = run_process(cmd, cancel_event, deadline=deadline)
+        if returncode != 0:
+            stderr = stderr.strip() or f"código de salida {returncode}"
+            logger.error(f"Error de Real-ESRGAN: {stderr}")
+            raise engine_error(f"Real-ESRGAN falló: {stderr}")
+
+    def run_batch(self, input_dir, output_dir, model, scale, tile_size, cancel_event=None, deadline=None):
+        # El binario admite directorios (-i dir -o dir): una sola invocación
+        # carga el modelo e inicializa Vulkan una vez para todo el grupo
+        count = sum(1 for _ in input_dir.iterdir())
+        # -v: el binario anuncia cada salida escrita ("entrada -> salida done")
+        cmd = self.build_command(input_dir, output_dir, model, scale, tile_size) + ["-v"]
+        logger.info(f"Ejecutando lote de {count} imágenes: {' '.join(cmd)}")
+
+        returncode, stderr = run_process(
+            cmd, cancel_event, timeout=PROCESSING_TIMEOUT * max(count, 1), deadline=deadline, images=count
+        )
+        if returncode != 0:
+            stderr = stderr.strip() or f"código de salida {returncode}"
+            logger.error(f"Error de Real-ESRGAN en lote: {stderr}")
+            raise engine_error(f"Real-ESRGAN falló: {stderr}")
+
+
+class _WorkerProcess:
+    """Proceso hijo persistente que habla el protocolo JSON de engine_worker.py"""
+
+    def __init__(self, cmd: list):
+        self.process = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+            **popen_group_kwargs()
+        )
+        # Hilo lector: permite esperar respuestas con timeout en cualquier SO
+        self._responses: queue.Queue = queue.Queue()
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    def _read_loop(self):
+        for line in self.process.stdout:
+            self._responses.put(line)
+        self._responses.put(None)  # EOF: el proceso terminó
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def wait_ready(self, timeout: float):
+        """Espera el mensaje inicial que confirma la carga del modelo"""
+        response = self._responses.get(timeout=timeout)
+        if response is None:
+            raise EngineError("El worker persistente terminó al cargar el modelo")
+        message = json.loads(response)
+        if not message.get("ready"):
+            raise EngineError(f"El worker no pudo cargar el modelo: {message.get('error')}")
+
+    def request(
+        self,
+        payload: dict,
+        cancel_event: Optional[threading.Event],
+        deadline: Optional[float] = None
+    ) -> dict:
+        """Envía una petición y espera la respuesta vigilando cancelación, plazo y timeout"""
+        timeout = remaining_time(deadline)
+        self.process.stdin.write(json.dumps(payload) + "\n")
+        self.process.stdin.flush()
+
+        limit = time.monotonic() + timeout
+        while True:
+            try:
+                response = self._responses.get(timeout=CANCEL_POLL_INTERVAL)
+            except queue.Empty:
+                if cancel_event is not None and cancel_event.is_set():
+                    self.kill()
+                    raise UpscaleCancelled("Tarea cancelada durante el procesamiento")
+                if time.monotonic() > limit:
+                    self.kill()
+                    if timeout < PROCESSING_TIMEOUT:
+                        raise DeadlineExceeded("Plazo de la petición agotado durante el procesamiento")
+                    raise subprocess.TimeoutExpired(self.process.args, PROCESSING_TIMEOUT)
+                continue
+
+            if response is None:
+                raise EngineError("El worker persistente terminó inesperadamente")
+            return json.loads(response)
+
+    def kill(self):
+        kill_process_group(self.process)
+        self.process.wait()
+
+    def close(self):
+        """Termina el proceso (o recoge uno ya muerto) y libera sus pipes"""
+        if self.alive():
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                self.kill()
+        else:
+            self.process.wait()
+        # El lector acaba con el EOF; cerrar stdout antes lo rompería a mitad de lectura
+        self._reader.join(timeout=5)
+        for stream in (self.process.stdin, self.process.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+
+class PersistentEngine(UpscaleEngine):
+    """
+    Mantiene procesos worker de larga duración que cargan cada modelo una vez.
+    Cada hilo del planificador tiene sus propios procesos, de modo que no hay
+    contención entre workers; se conservan como máximo max_models por hilo.
+    """
+
+    name = "persistent"
+
+    def __init__(self, impl: str, device_id: int, max_models: int = 2):
+        self.impl = impl
+        self.device_id = device_id
+        self.max_models = max_models
+        self._local = threading.local()
+        self._all_workers: list = []
+        self._lock = threading.Lock()
+
+    def is_available(self) -> bool:
+        if self.impl == "stub":
+            return True
+        return importlib.util.find_spec("ncnn") is not None
+
+    def version(self) -> str:
+        if self.impl == "stub":
+            return "persistent-stub"
+        import ncnn
+        return f"persistent-ncnn-{getattr(ncnn, '__version__', 'unknown')}"
+
+    def _workers(self) -> "OrderedDict[tuple, _WorkerProcess]":
+        workers = getattr(self._local, "workers", None)
+        if workers is None:
+            workers = self._local.workers = OrderedDict()
+        return workers
+
+    def _get_worker(self, model: str, scale: int) -> _WorkerProcess:
+        workers = self._workers()
+        key = (model, scale)
+        worker = workers.get(key)
+        if worker is not None:
+            if worker.alive():
+                workers.move_to_end(key)
+                return worker
+            # Murió (o se mató al cancelar): se reemplaza
+            del workers[key]
+            self._retire(worker)
+
+        # Liberar el modelo usado hace más tiempo si se alcanza el límite
+        while len(workers) >= self.max_models:
+            _, old_worker = workers.popitem(last=False)
+            self._retire(old_worker)
+
+        model_info = MODELS[model]
+        # Latencia simulada del stub: un valor por dispositivo (se repite si hay menos)
+        stub_latency = STUB_ENGINE_LATENCY[self.device_id % len(STUB_ENGINE_LATENCY)]
+        cmd = [
+            sys.executable, str(BASE_DIR / "engine_worker.py"),
+            "--impl", self.impl,
+            "--param", str(MODELS_DIR / model_info["param_filename"]),
+            "--bin", str(MODELS_DIR / model_info["filename"]),
+            "--model-scale", str(model_info["scale"]),
+            "--gpu", str(self.device_id),
+            "--stub-latency", str(stub_latency)
+        ]
+        if self.impl == "stub" and self.device_id in STUB_ENGINE_FAILING_DEVICES:
+            cmd.append("--stub-fail")
+        logger.info(f"Iniciando worker persistente: {model} (x{scale})")
+        worker = _WorkerProcess(cmd)
+        try:
+            worker.wait_ready(timeout=PROCESSING_TIMEOUT)
+        except Exception:
+            worker.kill()
+            worker.close()
+            raise
+
+        workers[key] = worker
+        with self._lock:
+            self._all_workers.append(worker)
+        return worker
+
+    def _retire(self, worker: _WorkerProcess):
+        """Cierra un worker reemplazado o expulsado y lo quita del registro"""
+        worker.close()
+        with self._lock:
+            # close() del motor puede haberlo retirado ya
+            if worker in self._all_workers:
+                self._all_workers.remove(worker)
+
+    def run(self, input_path, output_path, model, scale, tile_size, cancel_event=None, deadline=None):
+        worker = self._get_worker(model, scale)
+        response = worker.request(
+            {
+                "input": str(input_path),
+                "output": str(output_path),
+                "scale": scale,
+                "tile_size": tile_size
+            },
+            cancel_event,
+            deadline
+        )
+        if not response.get("ok"):
+            raise engine_error(f"Worker persistente falló: {response.get('error')}")
+
+    def close(self):
+        with self._lock:
+            workers, self._all_workers = self._all_workers, []
+        for worker in workers:
+            worker.close()
+
+
+class CpuEngine(UpscaleEngine):
+    """
+    Redimensionado LANCZOS con Pillow (como backend-example/main.py). No usa
+    la red neuronal: la calidad es la de un reescalado clásico, pero funciona
+    en cualquier máquina y no necesita GPU, Vulkan ni modelos descargados.
+    """
+
+    name = "cpu"
+    requires_model_files = False
+
+    def is_available(self) -> bool:
+        return True
+
+    def version(self) -> str:
+        return f"cpu-lanczos-{PIL.__version__}"
+
+    def run(self, input_path, output_path, model, scale, tile_size, cancel_event=None, deadline=None):
+        # El redimensionado no se puede interrumpir: se comprueba antes y después
+        remaining_time(deadline)
+        if cancel_event is not None and cancel_event.is_set():
+            raise UpscaleCancelled("Tarea cancelada durante el procesamiento")
+        try:
+            with Image.open(input_path) as image:
+                if image.mode not in ("RGB", "RGBA"):
+                    image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+                upscaled = image.resize(
+                    (image.width * scale, image.height * scale), Image.Resampling.LANCZOS
+                )
+        except (OSError, ValueError) as e:
+            raise EngineError(f"Motor CPU falló: {e}")
+        except MemoryError:
+            raise EngineOutOfMemory("Motor CPU: out of memory")
+        if cancel_event is not None and cancel_event.is_set():
+            raise UpscaleCancelled("Tarea cancelada durante el procesamiento")
+        remaining_time(deadline)
+        upscaled.save(output_path, "PNG", compress_level=1)
+
+
+def run_process(
+    cmd: list,
+    cancel_event: Optional[threading.Event],
+    timeout: float = PROCESSING_TIMEOUT,
+    deadline: Optional[float] = None,
+    images: int = 1
+) -> Tuple[int, str]:
+    """
+    Ejecuta un proceso vigilando cancelaciones, el plazo de la petición y el
+    timeout. Si se cancela la tarea o vence el plazo, se termina el grupo de
+    procesos del hijo (incluidos los procesos que haya lanzado).
+
+    stderr se lee línea a línea mientras el proceso se ejecuta: las líneas
+    de progreso ("xx.xx%") van al informador del contexto (progress.py), las
+    de salida escrita ("... -> ... done") a su oyente de salidas y el resto
+    se retorna para los mensajes de error.
+
+    Args:
+        images: Imágenes que procesa la invocación (para el avance total)
+
+    Returns:
+        Tuple[int, str]: (código de salida, stderr sin las líneas de progreso)
+
+    Raises:
+        UpscaleCancelled: Si cancel_event se activa
+        DeadlineExceeded: Si vence el plazo antes que el timeout
+        subprocess.TimeoutExpired: Si se supera el timeout
+    """
+    allowed = remaining_time(deadline, timeout)
+    with span("engine_process") as trace_span:
+        process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+            **popen_group_kwargs()
+        )
+        if trace_span is not None:
+            trace_span.set_attribute("process.pid", process.pid)
+        limit = time.monotonic() + allowed
+
+        # El hilo lector no hereda el contexto: el informador se toma aquí
+        reporter = current_reporter()
+        progress = EngineProgress(reporter, images) if reporter is not None else None
+        listener = current_output_listener()
+        stderr_lines = []
+
+        def read_stderr():
+            for line in process.stderr:
+                percent = parse_progress(line)
+                if percent is not None:
+                    if progress is not None:
+                        progress.update(percent)
+                    continue
+                output_path = parse_output_done(line)
+                if output_path is None:
+                    stderr_lines.append(line)
+                elif listener is not None:
+                    listener(output_path)
+
+        # stderr se lee en un hilo; su fin (EOF) indica que el proceso terminó
+        reader = threading.Thread(target=read_stderr, name=f"engine-stderr-{process.pid}", daemon=True)
+        reader.start()
+
+        while True:
+            reader.join(timeout=CANCEL_POLL_INTERVAL)
+            if not reader.is_alive():
+                process.stderr.close()
+                usage = reap_process(process)
+                record_process_usage(trace_span, process, usage)
+                return process.returncode, "".join(stderr_lines)
+
+            if cancel_event is not None and cancel_event.is_set():
+                kill_process_group(process)
+                reap_process(process)
+                raise UpscaleCancelled("Tarea cancelada durante el procesamiento")
+
+            if time.monotonic() > limit:
+                kill_process_group(process)
+                reap_process(process)
+                if allowed < timeout:
+                    raise DeadlineExceeded("Plazo de la petición agotado durante el procesamiento")
+                raise subprocess.TimeoutExpired(cmd, timeout)
+
+
+def reap_process(process: subprocess.Popen):
+    """
+    Espera al proceso y retorna su uso de recursos (os.wait4), o None si no
+    está disponible (Windows, o el proceso ya se recogió con poll/wait)
+    """
+    if hasattr(os, "wait4") and process.returncode is None:
+        try:
+            _, status, usage = os.wait4(process.pid, 0)
+        except ChildProcessError:
+            process.wait()
+            return None
+        process.returncode = os.waitstatus_to_exitcode(status)
+        return usage
+    process.wait()
+    return None
+
+
+def record_process_usage(trace_span, process: subprocess.Popen, usage):
+    """Anota en el span y en las métricas la CPU y la memoria del proceso del motor"""
+    if usage is not None:
+        ENGINE_PROCESS_CPU.inc(usage.ru_utime, mode="user")
+        ENGINE_PROCESS_CPU.inc(usage.ru_stime, mode="system")
+    if trace_span is None:
+        return
+    trace_span.set_attribute("process.exit_code", process.returncode)
+    if usage is not None:
+        trace_span.set_attribute("process.cpu.user_seconds", usage.ru_utime)
+        trace_span.set_attribute("process.cpu.system_seconds", usage.ru_stime)
+        # ru_maxrss está en KB en Linux y en bytes en macOS
+        trace_span.set_attribute(
+            "process.max_rss_kb", usage.ru_maxrss // 1024 if sys.platform == "darwin" else usage.ru_maxrss
+        )
+
+
+def create_engine(backend: str, executable: Path, device_id: int) -> UpscaleEngine:
+    """
+    Crea el motor configurado. Si el modo persistente no está disponible
+    se usa el binario por subproceso como alternativa.
+    """
+    subprocess_engine = SubprocessEngine(executable, device_id)
+    if backend == "cpu":
+        return CpuEngine()
+    if backend == "persistent":
+        engine = PersistentEngine(PERSISTENT_ENGINE_IMPL, device_id, PERSISTENT_ENGINE_MAX_MODELS)
+        if engine.is_available():
+            return engine
+        logger.warning(
+            f"Motor persistente '{PERSISTENT_ENGINE_IMPL}' no disponible "
+            f"(¿falta el paquete ncnn?). Usando subproceso."
+        )
+    elif backend != "subprocess":
+        logger.warning(f"Motor desconocido '{backend}'. Usando subproceso.")
+    return subprocess_engine
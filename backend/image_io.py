@@ -0,0 +1,258 @@
+"""
+Utilidades de E/S de imágenes para el pipeline de upscale
+Evitan pasadas de codificación/decodificación innecesarias: la imagen de
+entrada se escribe tal cual si el motor ya soporta su formato y el tamaño
+del resultado se lee de la cabecera sin decodificar los píxeles.
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import struct
+import uuid
+from dataclasses import dataclass
+from io import BytesIO
+from pathlib import Path
+from typing import AsyncIterator, Optional, Tuple
+
+from PIL import Image
+
+from config import LARGE_IMAGE_MAX_SIZE, MAX_IMAGE_SIZE
+from result_cache import ResultCache
+
+# Los límites por lado se validan explícitamente; la protección de PIL contra
+# "bombas de descompresión" se alinea con el máximo de las imágenes grandes
+Image.MAX_IMAGE_PIXELS = max(Image.MAX_IMAGE_PIXELS or 0, LARGE_IMAGE_MAX_SIZE * LARGE_IMAGE_MAX_SIZE)
+
+# Formatos que Real-ESRGAN (ncnn-vulkan) lee directamente -> extensión
+PASSTHROUGH_FORMATS = {
+    "PNG": "png",
+    "JPEG": "jpg",
+    "WEBP": "webp"
+}
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Formatos y modos de las imágenes grandes (lado > MAX_IMAGE_SIZE): Pillow los
+# decodifica por bloques sobre la memoria que se le da, y large_image se la da
+# mapeada en disco. WebP, p. ej., se decodifica entero en RAM
+OUT_OF_CORE_FORMATS = ("PNG", "JPEG")
+OUT_OF_CORE_MODES = ("RGB", "RGBA", "L", "P")
+
+# Tamaño de bloque para recibir subidas sin cargarlas enteras en memoria
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Bytes del resultado que se codifican en base64 de una vez (múltiplo de 3:
+# los bloques se concatenan sin relleno intermedio)
+BASE64_CHUNK_SIZE = 3 * 1024 * 1024
+
+
+def write_input_image(image_bytes: bytes, image: Image.Image, directory: Path) -> Path:
+    """
+    Guarda la imagen de entrada para el motor.
+    Si el formato original es compatible se escriben los bytes recibidos sin
+    re-codificar; en otro caso (BMP, GIF, ...) se convierte a PNG con PIL.
+
+    Args:
+        image_bytes: Bytes originales recibidos del cliente
+        image: Imagen PIL abierta sobre esos bytes (solo se usa la cabecera)
+        directory: Directorio destino (normalmente TEMP_DIR)
+
+    Returns:
+        Path: Ruta al archivo escrito
+    """
+    extension = PASSTHROUGH_FORMATS.get(image.format)
+    if extension is not None:
+        path = directory / f"{uuid.uuid4()}.{extension}"
+        path.write_bytes(image_bytes)
+    else:
+        path = directory / f"{uuid.uuid4()}.png"
+        image.save(path, "PNG")
+    return path
+
+
+def read_image_size(path: Path) -> Tuple[int, int]:
+    """
+    Obtiene (ancho, alto) de una imagen sin decodificar sus píxeles.
+    Para PNG se lee directamente el chunk IHDR; para el resto se usa la
+    apertura perezosa de PIL, que solo procesa la cabecera.
+    """
+    with open(path, "rb") as f:
+        header = f.read(24)
+
+    if header[:8] == PNG_SIGNATURE and header[12:16] == b"IHDR":
+        return struct.unpack(">II", header[16:24])
+
+    with Image.open(path) as image:
+        return image.size
+
+
+async def save_stream(chunks: AsyncIterator[bytes], path: Path) -> str:
+    """
+    Escribe un flujo de bytes en disco por bloques calculando su hash
+
+    Args:
+        chunks: Iterador asíncrono de bloques (cuerpo de la petición o subida)
+        path: Archivo destino
+
+    Returns:
+        str: Hash SHA-256 del contenido (para la caché de resultados)
+    """
+    digest = hashlib.sha256()
+    with open(path, "wb") as f:
+        async for chunk in chunks:
+            # hashlib y la escritura liberan el GIL: en un hilo no frenan el event loop
+            await asyncio.to_thread(_hash_and_write, digest, f, chunk)
+    return digest.hexdigest()
+
+
+def _hash_and_write(digest, f, chunk: bytes):
+    digest.update(chunk)
+    f.write(chunk)
+
+
+def check_out_of_core(image: Image.Image) -> Optional[str]:
+    """
+    Comprueba que una imagen mayor que MAX_IMAGE_SIZE se pueda reescalar
+    sin decodificarla entera en memoria (solo lee la cabecera)
+
+    Returns:
+        Optional[str]: Motivo del rechazo o None si se admite
+    """
+    if max(image.size) <= MAX_IMAGE_SIZE:
+        return None
+    if image.format not in OUT_OF_CORE_FORMATS or image.mode not in OUT_OF_CORE_MODES:
+        return (
+            f"Las imágenes de más de {MAX_IMAGE_SIZE}px por lado deben ser "
+            f"{' o '.join(OUT_OF_CORE_FORMATS)} en modo {', '.join(OUT_OF_CORE_MODES)}"
+        )
+    return None
+
+
+def prepare_input_file(path: Path, max_side: int) -> Tuple[Path, Tuple[int, int]]:
+    """
+    Valida un archivo recibido y le asigna la extensión que espera el motor.
+    Los formatos no soportados por Real-ESRGAN se convierten a PNG.
+
+    Args:
+        path: Archivo subido (con cualquier extensión)
+        max_side: Tamaño máximo permitido por lado
+
+    Returns:
+        Tuple[Path, Tuple[int, int]]: (ruta final, (ancho, alto))
+
+    Raises:
+        ValueError: Si no es una imagen válida o excede max_side
+    """
+    try:
+        image = Image.open(path)
+    except Exception:
+        raise ValueError("Imagen inválida o formato no soportado")
+
+    with image:
+        size = image.size
+        if size[0] > max_side or size[1] > max_side:
+            raise ValueError(f"Imagen demasiado grande. Máximo: {max_side}px por lado")
+        error = check_out_of_core(image)
+        if error is not None:
+            raise ValueError(error)
+
+        extension = PASSTHROUGH_FORMATS.get(image.format)
+        if extension is None:
+            target = path.with_name(f"{uuid.uuid4()}.png")
+            image.save(target, "PNG")
+            path.unlink()
+            return target, size
+
+    target = path.with_suffix(f".{extension}")
+    if target != path:
+        os.replace(path, target)
+    return target, size
+
+
+@dataclass
+class DecodedPayload:
+    """Resultado de decode_json_payload: vuelve del pool sin los bytes de la imagen"""
+    params: Optional[dict]  # Campos del JSON salvo "image" (None si no es un objeto JSON)
+    has_image: bool = False  # "image" era un texto y se intentó decodificar
+    path: Optional[Path] = None
+    content_hash: str = ""
+    size: Tuple[int, int] = (0, 0)
+    image_bytes: int = 0  # Tamaño de la imagen decodificada
+    error: Optional[str] = None  # Imagen inválida o demasiado grande
+
+
+def decode_json_payload(body: bytes, directory: Path, max_side: int = LARGE_IMAGE_MAX_SIZE) -> DecodedPayload:
+    """
+    Decodifica el cuerpo JSON de /api/upscale o /api/jobs: base64, cabecera
+    con PIL, hash y escritura en 'directory' con write_input_image. Se
+    ejecuta en CodecPool; la imagen no vuelve al proceso de la API.
+
+    Los errores de la imagen se retornan en 'error' (no se lanzan) para que
+    la API valide antes los parámetros, como hacía al recibir el JSON.
+    """
+    try:
+        params = json.loads(body)
+    except ValueError:
+        return DecodedPayload(None)
+    if not isinstance(params, dict):
+        return DecodedPayload(None)
+    if not isinstance(params.get("image"), str):
+        return DecodedPayload(params)
+
+    data = params.pop("image")
+    try:
+        if data.startswith("data:image"):
+            # Remover el prefijo data:image/...;base64,
+            data = data.split(",", 1)[1]
+        image_bytes = base64.b64decode(data)
+        image = Image.open(BytesIO(image_bytes))
+    except Exception as e:
+        return DecodedPayload(params, True, error=f"Imagen inválida: {e}")
+
+    # Por encima de MAX_IMAGE_SIZE el servicio reescala la imagen por tiles
+    if image.width > max_side or image.height > max_side:
+        return DecodedPayload(
+            params, True, size=image.size, error=f"Imagen demasiado grande. Máximo: {max_side}px por lado"
+        )
+    error = check_out_of_core(image)
+    if error is not None:
+        return DecodedPayload(params, True, size=image.size, error=error)
+    path = write_input_image(image_bytes, image, directory)
+    return DecodedPayload(
+        params, True, path, ResultCache.content_hash(image_bytes), image.size, len(image_bytes)
+    )
+
+
+def write_json_response(
+    source: Path, media_type: str, fields: dict, destination: Path, newline: bool = False
+) -> int:
+    """
+    Escribe en 'destination' la respuesta JSON de /api/upscale con 'source'
+    como data URL, codificando en base64 por bloques. Se ejecuta en
+    CodecPool; la API envía el archivo sin cargarlo en memoria.
+
+    Args:
+        fields: Resto de campos de la respuesta (al menos uno)
+        newline: Terminar con salto de línea (líneas NDJSON de los lotes)
+
+    Returns:
+        int: Bytes de la imagen en base64
+    """
+    encoded = 0
+    with open(source, "rb") as src, open(destination, "wb") as out:
+        out.write(f'{{"image": "data:{media_type};base64,'.encode())
+        while True:
+            chunk = src.read(BASE64_CHUNK_SIZE)
+            if not chunk:
+                break
+            block = base64.b64encode(chunk)
+            encoded += len(block)
+            out.write(block)
+        # '{"a": 1, ...}' -> '", "a": 1, ...}'
+        out.write(b'", ' + json.dumps(fields)[1:].encode())
+        if newline:
+            out.write(b"\n")
+    return encoded
@@ -0,0 +1,340 @@
+"""
+Recolector de archivos de TEMP_DIR y OUTPUT_DIR
+Sustituye la limpieza completa al arrancar por un hilo que recorre los
+directorios por tandas de JANITOR_BATCH_SIZE entradas, sin bloquear el event
+loop ni listar todo de golpe. Mantiene un índice de los artefactos vivos
+(cada entrada de primer nivel, archivo o directorio de trabajo) con su
+tamaño y antigüedad. En cada pasada:
+
+- borra lo que supera la edad máxima
+- si el total supera la cuota, borra lo más antiguo hasta respetarla
+
+Nunca borra lo fijado (pin): los archivos de los trabajos en cola o con
+resultado pendiente de descarga y los directorios de video, lotes e
+imágenes grandes mientras se procesan. Tampoco borra lo que tenga menos
+de min_age segundos, que puede pertenecer a una petición en curso.
+"""
+
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from itertools import islice
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Pausa entre tandas de una misma pasada (cede la CPU a las peticiones)
+STEP_PAUSE = 0.05
+
+# Motivos de borrado (etiqueta de las métricas)
+REASONS = ("age", "quota")
+
+
+def _tree_stats(path: str) -> Tuple[int, float]:
+    """Bytes y mtime más reciente de un directorio y todo su contenido"""
+    total = 0
+    newest = os.stat(path, follow_symlinks=False).st_mtime
+    stack = [path]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                    newest = max(newest, stat.st_mtime)
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        total += stat.st_size
+                except OSError:
+                    # Desapareció mientras se recorría
+                    continue
+    return total, newest
+
+
+class Janitor:
+    """Índice de artefactos temporales con borrado por edad y por cuota"""
+
+    def __init__(
+        self,
+        directories: list,
+        max_age: float,
+        min_age: float,
+        quota_bytes: int,
+        batch_size: int,
+        interval: float,
+        exclude: Iterable[Path] = ()
+    ):
+        """
+        Args:
+            directories: Directorios vigilados (solo se indexa el primer nivel)
+            max_age: Segundos tras los que se borra una entrada
+            min_age: Segundos durante los que una entrada no se borra nunca
+            quota_bytes: Ocupación máxima de todos los directorios (0 = sin cuota)
+            batch_size: Entradas revisadas por tanda
+            interval: Segundos entre pasadas completas
+            exclude: Entradas que gestiona otro componente (p. ej. PREVIEW_DIR)
+        """
+        self.directories = [Path(directory) for directory in directories]
+        self.max_age = max_age
+        self.min_age = min_age
+        self.quota_bytes = quota_bytes
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self._exclude = {str(path) for path in exclude}
+
+        self._lock = threading.Lock()
+        # ruta -> (bytes, mtime)
+        self._index: dict = {}
+        self._total_bytes = 0
+        self._pins: Counter = Counter()
+        self._pin_sources: list = []
+        self._pass_hooks: list = []
+        self._source_pins: set = set()
+
+        # Pasada en curso: iterador sobre los directorios y entradas ya vistas
+        self._cursor: Optional[Iterator[os.DirEntry]] = None
+        self._seen: set = set()
+        self._pass_started = 0.0
+
+        self.reclaimed_bytes = {reason: 0 for reason in REASONS}
+        self.reclaimed_files = {reason: 0 for reason in REASONS}
+        self.passes = 0
+        self.last_pass_seconds = 0.0
+        self._over_quota = False
+
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # -- Pins ---------------------------------------------------------------
+
+    def _top_level(self, path: Path) -> Optional[str]:
+        """Entrada de primer nivel que contiene 'path' (lo que indexa el janitor)"""
+        path = Path(path)
+        for directory in self.directories:
+            try:
+                relative = path.relative_to(directory)
+            except ValueError:
+                continue
+            if relative.parts:
+                return str(directory / relative.parts[0])
+        return None
+
+    def pin(self, path: Path):
+        """Impide borrar 'path' (o la entrada de primer nivel que lo contiene)"""
+        key = self._top_level(path)
+        if key is not None:
+            with self._lock:
+                self._pins[key] += 1
+
+    def unpin(self, path: Path):
+        key = self._top_level(path)
+        if key is not None:
+            with self._lock:
+                self._pins[key] -= 1
+                if self._pins[key] <= 0:
+                    del self._pins[key]
+
+    @contextmanager
+    def pinned(self, *paths: Path):
+        """Fija las rutas durante el bloque"""
+        for path in paths:
+            self.pin(path)
+        try:
+            yield
+        finally:
+            for path in paths:
+                self.unpin(path)
+
+    def add_pin_source(self, source: Callable[[], Iterable[Path]]):
+        """Función que retorna rutas en uso; se consulta al empezar cada pasada"""
+        self._pin_sources.append(source)
+
+    def add_pass_hook(self, hook: Callable[[], None]):
+        """
+        Función que se ejecuta al terminar cada pasada, para la limpieza de
+        lo que gestiona otro componente (p. ej. las vistas previas caducadas)
+        """
+        self._pass_hooks.append(hook)
+
+    def _refresh_source_pins(self):
+        pins = set()
+        for source in self._pin_sources:
+            try:
+                for path in source():
+                    key = self._top_level(path)
+                    if key is not None:
+                        pins.add(key)
+            except Exception as e:
+                logger.warning(f"No se pudieron obtener las rutas en uso: {e}")
+                # Sin saber qué está en uso, esta pasada no borra por cuota
+                pins = None
+                break
+        with self._lock:
+            self._source_pins = pins
+
+    def _is_pinned_locked(self, key: str) -> bool:
+        return key in self._pins or self._source_pins is None or key in self._source_pins
+
+    # -- Pasadas ------------------------------------------------------------
+
+    def _entries(self) -> Iterator[os.DirEntry]:
+        for directory in self.directories:
+            try:
+                entries = os.scandir(directory)
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    if not entry.name.startswith(".") and entry.path not in self._exclude:
+                        yield entry
+
+    def step(self) -> bool:
+        """
+        Revisa una tanda de entradas
+
+        Returns:
+            bool: True si con esta tanda terminó una pasada completa
+        """
+        if self._cursor is None:
+            self._refresh_source_pins()
+            self._cursor = self._entries()
+            self._seen = set()
+            self._pass_started = time.monotonic()
+
+        now = time.time()
+        count = 0
+        for entry in islice(self._cursor, self.batch_size):
+            count += 1
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    size, mtime = _tree_stats(entry.path)
+                else:
+                    stat = entry.stat(follow_symlinks=False)
+                    size, mtime = stat.st_size, stat.st_mtime
+            except OSError:
+                continue
+
+            self._seen.add(entry.path)
+            with self._lock:
+                previous = self._index.get(entry.path)
+                self._total_bytes += size - (previous[0] if previous else 0)
+                self._index[entry.path] = (size, mtime)
+                expired = now - mtime > self.max_age and not self._is_pinned_locked(entry.path)
+            if expired:
+                self._remove(entry.path, "age")
+
+        if count == self.batch_size:
+            return False
+
+        with self._lock:
+            for key in [key for key in self._index if key not in self._seen]:
+                # Ya borrado por su petición o por otro proceso
+                self._total_bytes -= self._index.pop(key)[0]
+        self._enforce_quota()
+        for hook in self._pass_hooks:
+            try:
+                hook()
+            except Exception as e:
+                logger.warning(f"Error en la limpieza de {getattr(hook, '__qualname__', hook)}: {e}")
+        self._cursor = None
+        self.passes += 1
+        self.last_pass_seconds = time.monotonic() - self._pass_started
+        return True
+
+    def _enforce_quota(self):
+        """Borra las entradas más antiguas no fijadas hasta respetar la cuota"""
+        if self.quota_bytes <= 0:
+            return
+        with self._lock:
+            if self._total_bytes <= self.quota_bytes:
+                self._over_quota = False
+                return
+            limit = time.time() - self.min_age
+            candidates = sorted(
+                (mtime, key) for key, (_, mtime) in self._index.items()
+                if mtime < limit and not self._is_pinned_locked(key)
+            )
+
+        for _, key in candidates:
+            if self._total_bytes <= self.quota_bytes:
+                return
+            self._remove(key, "quota")
+        over_quota = self._total_bytes > self.quota_bytes
+        if over_quota and not self._over_quota:
+            # Se avisa una vez hasta que la ocupación vuelva a estar dentro de la cuota
+            logger.warning(
+                f"Archivos temporales por encima de la cuota ({self._total_bytes / (1024 * 1024):.1f} MB "
+                f"de {self.quota_bytes / (1024 * 1024):.1f} MB): el resto está en uso o es reciente"
+            )
+        self._over_quota = over_quota
+
+    def _remove(self, key: str, reason: str):
+        with self._lock:
+            entry = self._index.pop(key, None)
+            if entry is None:
+                return
+            self._total_bytes -= entry[0]
+        try:
+            if os.path.isdir(key) and not os.path.islink(key):
+                shutil.rmtree(key)
+            else:
+                os.unlink(key)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.warning(f"No se pudo eliminar {key}: {e}")
+            return
+        with self._lock:
+            self.reclaimed_bytes[reason] += entry[0]
+            self.reclaimed_files[reason] += 1
+        logger.info(f"Archivo temporal eliminado ({reason}): {key}")
+
+    def run_pass(self):
+        """Ejecuta una pasada completa de una vez (scripts y pruebas)"""
+        while not self.step():
+            pass
+
+    # -- Hilo ---------------------------------------------------------------
+
+    def start(self):
+        """Arranca el hilo de limpieza; la primera pasada empieza enseguida"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name="janitor", daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        pause = 0.0
+        while not self._stop.wait(pause):
+            try:
+                pause = self.interval if self.step() else STEP_PAUSE
+            except Exception as e:
+                logger.warning(f"Error en la limpieza de archivos temporales: {e}")
+                self._cursor = None
+                pause = self.interval
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self) -> dict:
+        """Ocupación indexada, entradas fijadas y bytes recuperados"""
+        with self._lock:
+            return {
+                "tracked_files": len(self._index),
+                "tracked_bytes": self._total_bytes,
+                "quota_bytes": self.quota_bytes,
+                "pinned": len(self._pins) + len(self._source_pins or ()),
+                "reclaimed_bytes": dict(self.reclaimed_bytes),
+                "reclaimed_files": dict(self.reclaimed_files),
+                "passes": self.passes,
+                "last_pass_seconds": self.last_pass_seconds
+            }
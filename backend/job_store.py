@@ -0,0 +1,275 @@
+"""
+Almacén de trabajos compartido entre procesos (SQLite)
+Permite ejecutar varios procesos de la API (uvicorn --workers N) sobre la
+misma máquina con una cola de trabajos y un registro de resultados comunes:
+cualquier proceso puede encolar, consultar o cancelar un trabajo, y cada
+proceso reclama trabajos pendientes cuando tiene workers libres.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Devuelve a la cola un trabajo reclamado; si ya se pidió cancelarlo se da por cancelado
+RELEASE_SET = (
+    "owner = NULL, started_at = NULL, progress = NULL, "
+    "state = CASE WHEN cancel_requested THEN 'cancelled' ELSE 'queued' END, "
+    "finished_at = CASE WHEN cancel_requested THEN :now ELSE NULL END"
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    state TEXT NOT NULL,
+    params TEXT NOT NULL,
+    input_path TEXT,
+    cache_key TEXT,
+    priority INTEGER NOT NULL DEFAULT 0,
+    client_id TEXT NOT NULL DEFAULT 'anonymous',
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    output_path TEXT,
+    error TEXT,
+    cached INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    progress TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (state, owner, priority, created_at);
+CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner, cancel_requested);
+CREATE TABLE IF NOT EXISTS processes (
+    id TEXT PRIMARY KEY,
+    pid INTEGER NOT NULL,
+    heartbeat REAL NOT NULL,
+    stats TEXT
+);
+"""
+
+
+class JobStore:
+    """Tablas de trabajos y procesos en SQLite (modo WAL, una conexión por hilo)"""
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None: autocommit; las transacciones se abren explícitamente
+            conn = sqlite3.connect(str(self.db_path), timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _row(row: Optional[sqlite3.Row]) -> Optional[dict]:
+        if row is None:
+            return None
+        data = dict(row)
+        data["params"] = json.loads(data["params"])
+        data["progress"] = json.loads(data["progress"]) if data["progress"] else None
+        return data
+
+    def insert(self, job: dict):
+        """Registra un trabajo nuevo (claves = columnas de la tabla jobs)"""
+        row = {**job, "params": json.dumps(job["params"])}
+        columns = ", ".join(row)
+        placeholders = ", ".join(f":{name}" for name in row)
+        self._conn().execute(f"INSERT INTO jobs ({columns}) VALUES ({placeholders})", row)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        return self._row(self._conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def claim(self, owner: str, kinds: tuple) -> Optional[dict]:
+        """
+        Reclama de forma atómica el trabajo pendiente más prioritario
+
+        Args:
+            owner: ID del proceso que lo ejecutará
+            kinds: Tipos de trabajo que el proceso puede aceptar ahora
+
+        Returns:
+            Optional[dict]: El trabajo reclamado o None si no hay pendientes
+        """
+        if not kinds:
+            return None
+        conn = self._conn()
+        placeholders = ", ".join("?" for _ in kinds)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                f"SELECT id FROM jobs WHERE state = 'queued' AND owner IS NULL "
+                f"AND kind IN ({placeholders}) ORDER BY priority, created_at LIMIT 1",
+                kinds
+            ).fetchone()
+            if row is not None:
+                conn.execute("UPDATE jobs SET owner = ? WHERE id = ?", (owner, row["id"]))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return self.get(row["id"]) if row is not None else None
+
+    def release(self, job_id: str):
+        """Devuelve a la cola (o cancela, si se pidió) un trabajo reclamado que no terminó"""
+        self._conn().execute(
+            f"UPDATE jobs SET {RELEASE_SET} WHERE id = :id AND state IN ('queued', 'running')",
+            {"id": job_id, "now": time.time()}
+        )
+
+    def mark_running(self, job_id: str, started_at: float):
+        self._conn().execute(
+            "UPDATE jobs SET state = 'running', started_at = ? WHERE id = ? AND state = 'queued'",
+            (started_at, job_id)
+        )
+
+    def set_progress(self, job_id: str, progress: dict):
+        self._conn().execute("UPDATE jobs SET progress = ? WHERE id = ?", (json.dumps(progress), job_id))
+
+    def finish(
+        self,
+        job_id: str,
+        state: str,
+        finished_at: float,
+        output_path: Optional[str] = None,
+        error: Optional[str] = None
+    ):
+        self._conn().execute(
+            "UPDATE jobs SET state = ?, finished_at = ?, output_path = ?, error = ? WHERE id = ?",
+            (state, finished_at, output_path, error, job_id)
+        )
+
+    def request_cancel(self, job_id: str) -> bool:
+        """
+        Cancela un trabajo: si nadie lo ha reclamado se marca cancelado al
+        instante; si no, se avisa a su proceso para que lo detenga.
+
+        Returns:
+            bool: True si quedó cancelado directamente
+        """
+        conn = self._conn()
+        cursor = conn.execute(
+            "UPDATE jobs SET state = 'cancelled', finished_at = ? "
+            "WHERE id = ? AND state = 'queued' AND owner IS NULL",
+            (time.time(), job_id)
+        )
+        if cursor.rowcount:
+            return True
+        conn.execute(
+            "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND state IN ('queued', 'running')",
+            (job_id,)
+        )
+        return False
+
+    def cancel_requests(self, owner: str) -> list:
+        """IDs de trabajos de este proceso cuya cancelación se ha pedido"""
+        rows = self._conn().execute(
+            "SELECT id FROM jobs WHERE owner = ? AND cancel_requested = 1 "
+            "AND state IN ('queued', 'running')",
+            (owner,)
+        ).fetchall()
+        return [row["id"] for row in rows]
+
+    def queue_position(self, job: dict) -> int:
+        """Trabajos sin reclamar que se atenderán antes que este"""
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND owner IS NULL "
+            "AND (priority < ? OR (priority = ? AND created_at < ?))",
+            (job["priority"], job["priority"], job["created_at"])
+        ).fetchone()[0]
+
+    def pending_count(self) -> int:
+        """Trabajos en cola que ningún proceso ha reclamado todavía"""
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND owner IS NULL"
+        ).fetchone()[0]
+
+    def heartbeat(self, owner: str, pid: int, stats: dict):
+        """Registra que el proceso sigue vivo junto con la carga de su planificador"""
+        self._conn().execute(
+            "INSERT INTO processes (id, pid, heartbeat, stats) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET heartbeat = excluded.heartbeat, stats = excluded.stats",
+            (owner, pid, time.time(), json.dumps(stats))
+        )
+
+    def remove_process(self, owner: str):
+        self._conn().execute("DELETE FROM processes WHERE id = ?", (owner,))
+
+    def processes(self, timeout: float) -> list:
+        """Procesos con latido reciente y su última carga conocida"""
+        rows = self._conn().execute(
+            "SELECT * FROM processes WHERE heartbeat >= ?", (time.time() - timeout,)
+        ).fetchall()
+        return [{**dict(row), "stats": json.loads(row["stats"] or "{}")} for row in rows]
+
+    def recover_orphans(self, timeout: float) -> int:
+        """
+        Devuelve a la cola los trabajos de procesos sin latido reciente
+        (el proceso murió sin terminarlos) y olvida esos procesos.
+        Los trabajos cuya cancelación estaba pedida quedan cancelados.
+
+        Returns:
+            int: Trabajos recuperados
+        """
+        conn = self._conn()
+        limit = time.time() - timeout
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = conn.execute(
+                f"UPDATE jobs SET {RELEASE_SET} "
+                "WHERE state IN ('queued', 'running') AND owner IS NOT NULL "
+                "AND owner NOT IN (SELECT id FROM processes WHERE heartbeat >= :limit)",
+                {"limit": limit, "now": time.time()}
+            )
+            conn.execute("DELETE FROM processes WHERE heartbeat < ?", (limit,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return cursor.rowcount
+
+    def file_references(self) -> list:
+        """ID, tipo, estado y rutas de entrada y salida de todos los trabajos registrados"""
+        return [
+            dict(row) for row in self._conn().execute(
+                "SELECT id, kind, state, input_path, output_path FROM jobs"
+            )
+        ]
+
+    def purge_expired(self, finished_before: float) -> list:
+        """
+        Elimina trabajos terminados antes del instante dado
+
+        Returns:
+            list[str]: Rutas de salida de los trabajos eliminados
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT output_path FROM jobs WHERE state NOT IN ('queued', 'running') "
+                "AND finished_at < ?",
+                (finished_before,)
+            ).fetchall()
+            conn.execute(
+                "DELETE FROM jobs WHERE state NOT IN ('queued', 'running') AND finished_at < ?",
+                (finished_before,)
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return [row["output_path"] for row in rows if row["output_path"]]
@@ -0,0 +1,714 @@
+"""
+Subsistema de trabajos asíncronos de rIA
+Permite encolar un upscale, consultar su estado y descargar el resultado
+más tarde, sin mantener abierta la conexión HTTP mientras se procesa.
+
+Con JOB_STORE=sqlite los trabajos viven en una base de datos compartida,
+de modo que varios procesos de la API reparten el trabajo entre sí y
+cualquiera de ellos responde al estado o al resultado de un trabajo.
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from enum import Enum
+from pathlib import Path
+from typing import Optional
+
+from config import (
+    JOB_DB_PATH,
+    JOB_POLL_INTERVAL,
+    JOB_RESULT_TTL,
+    JOB_STORE,
+    OUTPUT_DIR,
+    PROCESS_HEARTBEAT_TIMEOUT,
+    VIDEO_MAX_CONCURRENT
+)
+from encoder import media_type_for
+from job_store import JobStore
+from progress import get_progress_hub, reporting
+from scheduler import Priority, QueueFullError
+from upscale_service import RealESRGANService, UpscaleCancelled, get_upscale_service
+from video_pipeline import VideoPipeline
+
+logger = logging.getLogger(__name__)
+
+# Tipo MIME del resultado según el tipo de trabajo (el de una imagen
+# terminada depende del formato pedido, ver result_media_type)
+MEDIA_TYPES = {"image": "image/png", "video": "video/mp4"}
+
+
+class JobState(str, Enum):
+    """Estados posibles de un trabajo"""
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+FINISHED_STATES = (JobState.COMPLETED, JobState.FAILED, JobState.CANCELLED)
+
+
+def result_media_type(kind: str, output_path: Optional[Path]) -> str:
+    """Tipo MIME del resultado de un trabajo"""
+    if kind == "image" and output_path:
+        return media_type_for(output_path)
+    return MEDIA_TYPES[kind]
+
+
+def job_channel(job_id: str) -> str:
+    """Canal de progress.ProgressHub que avisa de los cambios de un trabajo"""
+    return f"job:{job_id}"
+
+
+@dataclass
+class Job:
+    """Trabajo de upscale registrado en el JobManager"""
+    id: str
+    params: dict
+    kind: str = "image"
+    media_type: str = "image/png"
+    input_path: Optional[Path] = None
+    cache_key: Optional[str] = None
+    state: JobState = JobState.QUEUED
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    output_path: Optional[Path] = None
+    error: Optional[str] = None
+    cached: bool = False
+    future: Optional[Future] = None
+    cancel_event: threading.Event = field(default_factory=threading.Event)
+    progress: Optional[dict] = None
+
+
+class JobManager:
+    """Registro en memoria de trabajos respaldado por los Future del servicio"""
+
+    def __init__(self, service: RealESRGANService, result_ttl: int):
+        self.service = service
+        self.result_ttl = result_ttl
+        self._jobs: dict[str, Job] = {}
+        self._lock = threading.Lock()
+        # Coordinadores de video: cada uno reparte sus bloques en el planificador
+        self._video_executor = ThreadPoolExecutor(
+            max_workers=VIDEO_MAX_CONCURRENT, thread_name_prefix="video"
+        )
+
+    def check_capacity(self):
+        """Lanza QueueFullError si no se admiten más trabajos"""
+        self.service.scheduler.check_capacity()
+
+    def submit(
+        self,
+        input_path: Path,
+        cache_key: Optional[str] = None,
+        priority: Priority = Priority.INTERACTIVE,
+        client_id: str = "anonymous",
+        **params
+    ) -> Job:
+        """
+        Encola un trabajo de upscale y retorna inmediatamente
+
+        Args:
+            input_path: Imagen de entrada ya guardada en TEMP_DIR
+            cache_key: Clave de la caché de resultados (opcional); también agrupa
+                       el trabajo con upscales idénticos en curso
+            priority: Carril del planificador (no forma parte del trabajo público)
+            client_id: Cliente para el reparto justo de workers
+            **params: Parámetros públicos del upscale (RealESRGANService.upscale)
+
+        Returns:
+            Job: Trabajo registrado en estado 'queued'
+
+        Raises:
+            QueueFullError: Si la cola del planificador está llena
+        """
+        self._purge_expired()
+
+        job = Job(id=uuid.uuid4().hex, params=params, input_path=input_path, cache_key=cache_key)
+
+        # Puede lanzar QueueFullError; en ese caso el trabajo no se registra
+        with reporting(lambda progress: self._set_progress(job, progress)):
+            job.future = self.service.upscale(
+                input_path=input_path,
+                cancel_event=job.cancel_event,
+                on_start=lambda: self._mark_running(job),
+                priority=priority,
+                client_id=client_id,
+                key=cache_key,
+                **params
+            )
+        with self._lock:
+            self._jobs[job.id] = job
+        job.future.add_done_callback(lambda future: self._on_done(job, future))
+        logger.info(f"Trabajo {job.id} encolado")
+        return job
+
+    def submit_video(self, input_path: Path, client_id: str = "anonymous", **params) -> Job:
+        """
+        Encola el reescalado de un video completo
+
+        Args:
+            input_path: Video de entrada ya guardado en TEMP_DIR
+            client_id: Cliente para el reparto justo de workers
+            **params: model, scale y tile_size para VideoPipeline
+
+        Returns:
+            Job: Trabajo registrado en estado 'queued'
+        """
+        self._purge_expired()
+
+        job = Job(
+            id=uuid.uuid4().hex,
+            params=params,
+            kind="video",
+            media_type=MEDIA_TYPES["video"],
+            input_path=input_path
+        )
+        self._start_video(job, client_id)
+        with self._lock:
+            self._jobs[job.id] = job
+        job.future.add_done_callback(lambda future: self._on_done(job, future))
+        logger.info(f"Trabajo de video {job.id} encolado")
+        return job
+
+    def _start_video(self, job: Job, client_id: str):
+        """Lanza el pipeline de video de un trabajo en el executor de video"""
+
+        def run() -> Path:
+            self._mark_running(job)
+            pipeline = VideoPipeline(
+                self.service,
+                job.input_path,
+                OUTPUT_DIR / f"{job.id}.mp4",
+                cancel_event=job.cancel_event,
+                client_id=client_id,
+                on_progress=lambda progress: self._set_progress(job, progress),
+                **job.params
+            )
+            return pipeline.run()
+
+        job.future = self._video_executor.submit(run)
+
+    def add_completed(self, output_path: Path, **params) -> Job:
+        """Registra un trabajo ya resuelto (por ejemplo, un acierto de caché)"""
+        self._purge_expired()
+
+        now = time.time()
+        job = Job(
+            id=uuid.uuid4().hex,
+            params=params,
+            state=JobState.COMPLETED,
+            started_at=now,
+            finished_at=now,
+            output_path=output_path,
+            media_type=result_media_type("image", output_path),
+            cached=True
+        )
+        with self._lock:
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Obtiene un trabajo por su ID"""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """
+        Cancela un trabajo. Si está en cola se descarta; si está en ejecución
+        se mata el proceso de Real-ESRGAN.
+
+        Returns:
+            Optional[Job]: El trabajo, o None si no existe
+        """
+        job = self.get(job_id)
+        if job is None or job.state in FINISHED_STATES:
+            return job
+
+        job.cancel_event.set()
+        if job.future is not None and job.future.cancel():
+            # Nunca llegó a ejecutarse; el callback marca el estado final
+            logger.info(f"Trabajo {job.id} cancelado en cola")
+        else:
+            logger.info(f"Cancelando trabajo {job.id} en ejecución")
+        return job
+
+    def queue_position(self, job: Job) -> Optional[int]:
+        """Posición del trabajo en la cola (0 = el siguiente en ejecutarse)"""
+        if job.state != JobState.QUEUED or job.future is None or job.kind != "image":
+            return None
+        return self.service.scheduler.queue_position(job.future)
+
+    def to_dict(self, job: Job) -> dict:
+        """Serializa el estado público de un trabajo"""
+        now = time.time()
+        queued_until = job.started_at or job.finished_at or now
+        running_until = job.finished_at or now
+        return {
+            "job_id": job.id,
+            "kind": job.kind,
+            "state": job.state.value,
+            "queue_position": self.queue_position(job),
+            "created_at": job.created_at,
+            "started_at": job.started_at,
+            "finished_at": job.finished_at,
+            "queue_time": queued_until - job.created_at,
+            "processing_time": running_until - job.started_at if job.started_at else None,
+            "cached": job.cached,
+            "error": job.error,
+            "progress": job.progress,
+            **job.params
+        }
+
+    def cluster_stats(self) -> Optional[dict]:
+        """Carga de los demás procesos de la API (None con un solo proceso)"""
+        return None
+
+    def _mark_running(self, job: Job):
+        job.state = JobState.RUNNING
+        job.started_at = time.time()
+        get_progress_hub().notify(job_channel(job.id))
+
+    def _set_progress(self, job: Job, progress: dict):
+        job.progress = progress
+        get_progress_hub().notify(job_channel(job.id))
+
+    def _on_done(self, job: Job, future: Future):
+        """Callback al terminar el Future: fija el estado y guarda en caché"""
+        job.finished_at = time.time()
+        try:
+            output_path = future.result()
+        except (CancelledError, UpscaleCancelled):
+            job.state = JobState.CANCELLED
+        except Exception as e:
+            job.state = JobState.FAILED
+            job.error = str(e)
+        else:
+            # Un error aquí se perdería en el callback y el trabajo quedaría 'running'
+            try:
+                job.output_path = self._store_result(job, output_path)
+                job.media_type = result_media_type(job.kind, job.output_path)
+                job.state = JobState.COMPLETED
+            except Exception as e:
+                logger.error(f"Error al guardar el resultado del trabajo {job.id}: {e}")
+                job.state = JobState.FAILED
+                job.error = str(e)
+
+        self._job_finished(job)
+        get_progress_hub().notify(job_channel(job.id))
+        logger.info(f"Trabajo {job.id} finalizado: {job.state.value}")
+
+    def _store_result(self, job: Job, output_path: Path) -> Path:
+        """
+        Guarda el resultado en caché si procede. Si la caché falla (p. ej.
+        disco lleno) se usa el archivo sin cachear
+
+        Raises:
+            FileNotFoundError: Si el resultado ya no existe
+        """
+        cache = self.service.cache
+        if job.cache_key is not None and cache is not None:
+            try:
+                return cache.put(job.cache_key, output_path)
+            except Exception as e:
+                logger.warning(f"No se pudo guardar en caché el trabajo {job.id}: {e}")
+        if not output_path.exists():
+            raise FileNotFoundError(f"El resultado {output_path.name} ya no existe")
+        return output_path
+
+    def _job_finished(self, job: Job):
+        """Libera los recursos de un trabajo que acaba de terminar"""
+        self._remove_file(job.input_path)
+
+    def _purge_expired(self):
+        """Olvida trabajos terminados hace más de result_ttl segundos"""
+        limit = time.time() - self.result_ttl
+        with self._lock:
+            expired = [
+                job for job in self._jobs.values()
+                if job.state in FINISHED_STATES and job.finished_at and job.finished_at < limit
+            ]
+            for job in expired:
+                del self._jobs[job.id]
+
+        for job in expired:
+            self._remove_file(job.output_path)
+
+    def live_paths(self) -> list:
+        """
+        Olvida los trabajos caducados y retorna los archivos que siguen en
+        uso: entradas pendientes, videos en curso y resultados por descargar.
+        El janitor no borra estas rutas.
+        """
+        self._purge_expired()
+        with self._lock:
+            jobs = list(self._jobs.values())
+        paths = []
+        for job in jobs:
+            paths.extend(path for path in (job.input_path, job.output_path) if path is not None)
+            if job.kind == "video" and job.state not in FINISHED_STATES:
+                paths.append(OUTPUT_DIR / f"{job.id}.mp4")
+        return paths
+
+    def _remove_file(self, file_path: Optional[Path]):
+        """Elimina un archivo salvo que pertenezca a la caché"""
+        cache = self.service.cache
+        if file_path is None or (cache is not None and cache.owns(file_path)):
+            return
+        try:
+            if file_path.exists():
+                file_path.unlink()
+        except OSError as e:
+            logger.warning(f"No se pudo eliminar {file_path}: {e}")
+
+    def shutdown(self):
+        """Cancela todos los trabajos pendientes o en ejecución"""
+        with self._lock:
+            pending = [job.id for job in self._jobs.values() if job.state not in FINISHED_STATES]
+        for job_id in pending:
+            self.cancel(job_id)
+        self._video_executor.shutdown(wait=False, cancel_futures=True)
+
+
+class SharedJobManager(JobManager):
+    """
+    Gestor de trabajos respaldado por un JobStore compartido entre procesos.
+
+    Los trabajos se insertan en la base de datos y un hilo despachador de
+    cada proceso reclama los pendientes cuando su planificador tiene workers
+    libres, así la carga se reparte entre procesos sin un broker externo.
+    self._jobs solo contiene los trabajos que ejecuta este proceso.
+    """
+
+    def __init__(self, service: RealESRGANService, result_ttl: int, store: JobStore):
+        super().__init__(service, result_ttl)
+        self.store = store
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._stop = threading.Event()
+        self._dispatcher = threading.Thread(
+            target=self._dispatch_loop, name="job-dispatcher", daemon=True
+        )
+        self._dispatcher.start()
+
+    def check_capacity(self):
+        """Lanza QueueFullError si la cola compartida está llena"""
+        pending = self.store.pending_count()
+        if pending >= self.service.scheduler.max_queue_size:
+            raise QueueFullError(self.service.scheduler.estimate_wait(pending))
+
+    def submit(
+        self,
+        input_path: Path,
+        cache_key: Optional[str] = None,
+        priority: Priority = Priority.INTERACTIVE,
+        client_id: str = "anonymous",
+        **params
+    ) -> Job:
+        """
+        Registra un trabajo de upscale en la cola compartida
+
+        Raises:
+            QueueFullError: Si la cola compartida está llena
+        """
+        self.check_capacity()
+        self._purge_expired()
+        job_id = self._insert(
+            "image", params, input_path=input_path, cache_key=cache_key,
+            priority=priority, client_id=client_id
+        )
+        logger.info(f"Trabajo {job_id} encolado")
+        return self.get(job_id)
+
+    def submit_video(self, input_path: Path, client_id: str = "anonymous", **params) -> Job:
+        """Registra un trabajo de video en la cola compartida"""
+        self._purge_expired()
+        job_id = self._insert(
+            "video", params, input_path=input_path, priority=Priority.BATCH, client_id=client_id
+        )
+        logger.info(f"Trabajo de video {job_id} encolado")
+        return self.get(job_id)
+
+    def add_completed(self, output_path: Path, **params) -> Job:
+        """Registra un trabajo ya resuelto (por ejemplo, un acierto de caché)"""
+        self._purge_expired()
+        now = time.time()
+        job_id = self._insert(
+            "image", params, state=JobState.COMPLETED, started_at=now, finished_at=now,
+            output_path=str(output_path), cached=1
+        )
+        return self.get(job_id)
+
+    def _insert(
+        self,
+        kind: str,
+        params: dict,
+        input_path: Optional[Path] = None,
+        state: JobState = JobState.QUEUED,
+        priority: Priority = Priority.INTERACTIVE,
+        **columns
+    ) -> str:
+        job_id = uuid.uuid4().hex
+        self.store.insert({
+            "id": job_id,
+            "kind": kind,
+            "state": state.value,
+            "params": params,
+            "input_path": str(input_path) if input_path else None,
+            "priority": int(priority),
+            "created_at": time.time(),
+            **columns
+        })
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Obtiene un trabajo por su ID, lo ejecute el proceso que lo ejecute"""
+        row = self.store.get(job_id)
+        if row is None:
+            return None
+        job = self._from_row(row)
+        with self._lock:
+            local = self._jobs.get(job_id)
+        if local is not None:
+            job.future = local.future
+        return job
+
+    @staticmethod
+    def _from_row(row: dict) -> Job:
+        return Job(
+            id=row["id"],
+            params=row["params"],
+            kind=row["kind"],
+            media_type=result_media_type(row["kind"], row["output_path"]),
+            input_path=Path(row["input_path"]) if row["input_path"] else None,
+            cache_key=row["cache_key"],
+            state=JobState(row["state"]),
+            created_at=row["created_at"],
+            started_at=row["started_at"],
+            finished_at=row["finished_at"],
+            output_path=Path(row["output_path"]) if row["output_path"] else None,
+            error=row["error"],
+            cached=bool(row["cached"]),
+            progress=row["progress"]
+        )
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """
+        Cancela un trabajo. Si ningún proceso lo ha reclamado se descarta al
+        momento; si no, el proceso que lo ejecuta lo detiene en cuanto ve la
+        petición (de inmediato si es este mismo proceso).
+        """
+        job = self.get(job_id)
+        if job is None or job.state in FINISHED_STATES:
+            return job
+
+        if self.store.request_cancel(job_id):
+            logger.info(f"Trabajo {job_id} cancelado en cola")
+        else:
+            self._cancel_local(job_id)
+        return self.get(job_id)
+
+    def _cancel_local(self, job_id: str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return
+        job.cancel_event.set()
+        if job.future is not None and not job.future.cancel():
+            logger.info(f"Cancelando trabajo {job_id} en ejecución")
+
+    def queue_position(self, job: Job) -> Optional[int]:
+        """Posición en la cola compartida (0 si ya lo reclamó un proceso)"""
+        if job.state != JobState.QUEUED:
+            return None
+        if job.future is not None:
+            return super().queue_position(job) or 0
+        row = self.store.get(job.id)
+        if row is None or row["owner"] is not None:
+            return 0
+        return self.store.queue_position(row)
+
+    def cluster_stats(self) -> dict:
+        """Procesos vivos, su carga y los trabajos sin reclamar"""
+        processes = self.store.processes(PROCESS_HEARTBEAT_TIMEOUT)
+        return {
+            "processes": len(processes),
+            "pending_jobs": self.store.pending_count(),
+            "workers": sum(p["stats"].get("workers", 0) for p in processes),
+            "active_workers": sum(p["stats"].get("active_workers", 0) for p in processes),
+            "queue_depth": sum(p["stats"].get("queue_depth", 0) for p in processes),
+            "members": [
+                {"id": p["id"], "pid": p["pid"], "heartbeat": p["heartbeat"], **p["stats"]}
+                for p in processes
+            ]
+        }
+
+    def _dispatch_loop(self):
+        """Latido, recuperación de trabajos huérfanos, cancelaciones y reclamo"""
+        heartbeat_interval = PROCESS_HEARTBEAT_TIMEOUT / 3
+        last_heartbeat = last_recovery = 0.0
+        while not self._stop.is_set():
+            try:
+                now = time.monotonic()
+                if now - last_heartbeat >= heartbeat_interval:
+                    self._heartbeat()
+                    last_heartbeat = now
+                if now - last_recovery >= PROCESS_HEARTBEAT_TIMEOUT:
+                    recovered = self.store.recover_orphans(PROCESS_HEARTBEAT_TIMEOUT)
+                    if recovered:
+                        logger.warning(f"{recovered} trabajos de procesos caídos devueltos a la cola")
+                    self._purge_expired()
+                    last_recovery = now
+
+                for job_id in self.store.cancel_requests(self.owner):
+                    self._cancel_local(job_id)
+                self._claim_available()
+            except Exception as e:
+                logger.warning(f"Error en el despachador de trabajos: {e}")
+            self._stop.wait(JOB_POLL_INTERVAL)
+
+    def _heartbeat(self):
+        stats = self.service.scheduler.stats()
+        with self._lock:
+            running = len(self._jobs)
+        self.store.heartbeat(self.owner, os.getpid(), {
+            "workers": stats["workers"],
+            "active_workers": stats["active_workers"],
+            "queue_depth": stats["queue_depth"],
+            "jobs": running
+        })
+
+    def _claim_available(self):
+        """Reclama trabajos pendientes mientras este proceso tenga capacidad libre"""
+        while not self._stop.is_set():
+            kinds = []
+            if self.service.scheduler.idle_workers() > 0:
+                kinds.append("image")
+            with self._lock:
+                videos = sum(1 for job in self._jobs.values() if job.kind == "video")
+            if videos < VIDEO_MAX_CONCURRENT:
+                kinds.append("video")
+
+            row = self.store.claim(self.owner, tuple(kinds))
+            if row is None:
+                return
+            self._start(row)
+
+    def _start(self, row: dict):
+        """Ejecuta en este proceso un trabajo recién reclamado"""
+        job = self._from_row(row)
+        with self._lock:
+            self._jobs[job.id] = job
+
+        if job.kind == "video":
+            self._start_video(job, row["client_id"])
+        else:
+            try:
+                with reporting(lambda progress: self._set_progress(job, progress)):
+                    job.future = self.service.upscale(
+                        input_path=job.input_path,
+                        cancel_event=job.cancel_event,
+                        on_start=lambda: self._mark_running(job),
+                        priority=Priority(row["priority"]),
+                        client_id=row["client_id"],
+                        key=job.cache_key,
+                        **job.params
+                    )
+            except QueueFullError:
+                # Otra petición ocupó el hueco: que lo reclame otro proceso
+                with self._lock:
+                    self._jobs.pop(job.id, None)
+                self.store.release(job.id)
+                return
+            except Exception as e:
+                # No se puede ejecutar (motor o formato que este proceso no tiene,
+                # entrada desaparecida): liberarlo haría que se reclamara sin fin,
+                # y dejarlo reclamado lo mantendría 'queued' para siempre
+                logger.error(f"No se pudo iniciar el trabajo {job.id}: {e}")
+                job.state = JobState.FAILED
+                job.finished_at = time.time()
+                job.error = str(e)
+                self._job_finished(job)
+                get_progress_hub().notify(job_channel(job.id))
+                return
+        job.future.add_done_callback(lambda future: self._on_done(job, future))
+        logger.info(f"Trabajo {job.id} reclamado por {self.owner}")
+
+    def _mark_running(self, job: Job):
+        super()._mark_running(job)
+        self.store.mark_running(job.id, job.started_at)
+        # Los suscriptores leen el trabajo del almacén: se les avisa tras escribirlo
+        get_progress_hub().notify(job_channel(job.id))
+
+    def _set_progress(self, job: Job, progress: dict):
+        super()._set_progress(job, progress)
+        self.store.set_progress(job.id, progress)
+        get_progress_hub().notify(job_channel(job.id))
+
+    def _job_finished(self, job: Job):
+        with self._lock:
+            self._jobs.pop(job.id, None)
+        if self._stop.is_set() and job.state == JobState.CANCELLED:
+            # Interrumpido al cerrar este proceso: otro proceso lo retomará
+            self.store.release(job.id)
+            return
+        self.store.finish(
+            job.id,
+            job.state.value,
+            job.finished_at,
+            output_path=str(job.output_path) if job.output_path else None,
+            error=job.error
+        )
+        super()._job_finished(job)
+
+    def _purge_expired(self):
+        """Elimina de la base de datos los trabajos caducados y sus resultados"""
+        for output_path in self.store.purge_expired(time.time() - self.result_ttl):
+            self._remove_file(Path(output_path))
+
+    def live_paths(self) -> list:
+        """Como JobManager.live_paths, para los trabajos de todos los procesos"""
+        self._purge_expired()
+        paths = []
+        for row in self.store.file_references():
+            paths.extend(Path(path) for path in (row["input_path"], row["output_path"]) if path)
+            if row["kind"] == "video" and row["state"] in (JobState.QUEUED.value, JobState.RUNNING.value):
+                paths.append(OUTPUT_DIR / f"{row['id']}.mp4")
+        return paths
+
+    def shutdown(self):
+        """Detiene el despachador y devuelve a la cola los trabajos de este proceso"""
+        self._stop.set()
+        self._dispatcher.join()
+        with self._lock:
+            local = list(self._jobs)
+        for job_id in local:
+            self._cancel_local(job_id)
+        self._video_executor.shutdown(wait=False, cancel_futures=True)
+        self.store.remove_process(self.owner)
+
+
+# Instancia global del gestor de trabajos
+_job_manager: Optional[JobManager] = None
+
+
+def get_job_manager() -> JobManager:
+    """Obtiene el gestor de trabajos (singleton)"""
+    global _job_manager
+    if _job_manager is None:
+        if JOB_STORE == "sqlite":
+            _job_manager = SharedJobManager(get_upscale_service(), JOB_RESULT_TTL, JobStore(JOB_DB_PATH))
+        else:
+            if JOB_STORE != "memory":
+                logger.warning(f"Almacén de trabajos desconocido '{JOB_STORE}'. Usando memoria.")
+            _job_manager = JobManager(get_upscale_service(), JOB_RESULT_TTL)
+        # El janitor no borra los archivos de los trabajos vigentes
+        _job_manager.service.janitor.add_pin_source(_job_manager.live_paths)
+    return _job_manager
@@ -0,0 +1,429 @@
+"""
+Reescalado de imágenes grandes por tiles (fuera de memoria)
+Las imágenes con algún lado mayor que MAX_IMAGE_SIZE se trocean en tiles
+solapados que se reescalan en paralelo a través del planificador. Los tiles
+se cosen, con una transición gradual en las zonas de solape, sobre un buffer
+mapeado en disco (numpy.memmap), y el PNG final se escribe por bandas de
+filas. La entrada también se decodifica directamente sobre un array en disco.
+La memoria usada depende del tamaño del tile, no del de la imagen.
+"""
+
+import logging
+import math
+import shutil
+import struct
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Optional
+
+import numpy as np
+from PIL import Image
+
+from engines import UpscaleCancelled
+from image_io import PNG_SIGNATURE, check_out_of_core
+from scheduler import QueueFullError
+
+logger = logging.getLogger(__name__)
+
+# Filas por banda al convertir la entrada y al escribir el PNG final
+ROWS_PER_BAND = 64
+
+# Modo de la imagen -> modo de la memoria en disco sobre la que Pillow la
+# decodifica (decode_rows). Pillow guarda RGB en 4 bytes por píxel (RGBX)
+DECODE_BUFFER_MODES = {"RGB": "RGBX", "RGBA": "RGBA", "L": "L", "P": "P"}
+
+# Nivel de compresión del PNG final (prioriza velocidad en imágenes enormes)
+PNG_COMPRESS_LEVEL = 3
+
+# Intervalo con el que se comprueba la cancelación mientras se espera un tile (segundos)
+CANCEL_POLL_INTERVAL = 0.2
+
+
+@dataclass
+class TileSpec:
+    """Tile de la entrada: núcleo propio y extensión con contexto"""
+    row: int
+    col: int
+    # Extensión leída de la entrada (x0, y0, x1, y1), núcleo más el contexto
+    box: tuple
+    # Fronteras con los tiles vecinos (None en el borde de la imagen)
+    left_seam: Optional[int]
+    top_seam: Optional[int]
+    right_seam: Optional[int]
+    bottom_seam: Optional[int]
+    future: Optional[Future] = None
+    input_path: Optional[Path] = None
+
+
+def split_axis(length: int, tile: int) -> list:
+    """Divide [0, length) en tramos de tamaño parecido y como mucho 'tile'"""
+    count = max(1, math.ceil(length / tile))
+    bounds = [round(i * length / count) for i in range(count + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def plan_tiles(width: int, height: int, tile: int, overlap: int) -> list:
+    """
+    Tiles en orden de barrido (filas de izquierda a derecha). Cada tile
+    añade 'overlap' píxeles de contexto por cada lado que tenga vecino.
+    """
+    tiles = []
+    for row, (y0, y1) in enumerate(split_axis(height, tile)):
+        for col, (x0, x1) in enumerate(split_axis(width, tile)):
+            tiles.append(TileSpec(
+                row=row,
+                col=col,
+                box=(max(0, x0 - overlap), max(0, y0 - overlap), min(width, x1 + overlap), min(height, y1 + overlap)),
+                left_seam=x0 if x0 > 0 else None,
+                top_seam=y0 if y0 > 0 else None,
+                right_seam=x1 if x1 < width else None,
+                bottom_seam=y1 if y1 < height else None
+            ))
+    return tiles
+
+
+def seam_ramp(start: int, length: int, seam: Optional[int], overlap: int, scale: int) -> np.ndarray:
+    """
+    Rampa de 0 a 1 a través de una costura, a lo largo de un eje (píxeles de salida)
+
+    Vale 0 hasta overlap/2 píxeles antes de la costura y 1 desde overlap/2
+    después: los píxeles junto al borde de cada tile (los peor reconstruidos,
+    sin contexto) nunca cuentan. Sin costura vale 1 en todo el eje.
+    """
+    if seam is None or overlap == 0:
+        return np.ones(length, dtype=np.float32)
+    # Centro de cada píxel de salida en coordenadas de entrada
+    centers = start + (np.arange(length, dtype=np.float32) + 0.5) / scale
+    return np.clip((centers - (seam - overlap / 2)) / overlap, 0.0, 1.0)
+
+
+def solid_span(window: np.ndarray) -> tuple:
+    """Tramo [inicio, fin) en el que la ventana vale 1"""
+    solid = np.flatnonzero(window >= 1.0)
+    if solid.size == 0:
+        return 0, 0
+    return int(solid[0]), int(solid[-1]) + 1
+
+
+def decode_rows(image: Image.Image, rows: Optional[int] = None, path: Optional[Path] = None) -> Optional[np.memmap]:
+    """
+    Decodifica una imagen abierta sin cargar. Pillow decodifica sobre la
+    memoria de la imagen si ya existe, así que se le puede dar una menor
+    (solo las primeras 'rows' filas de un PNG no entrelazado: las de debajo
+    ni se leen) o la de un numpy.memmap, con 'path'. Después image.crop lee
+    de esa memoria (sin pasar de 'rows').
+
+    Args:
+        rows: Filas necesarias (None = todas)
+        path: Decodificar sobre un array en disco (modos de DECODE_BUFFER_MODES)
+
+    Returns:
+        Optional[np.memmap]: El array en disco, o None sin 'path' o si Pillow
+            mapeó el archivo en lugar de decodificarlo
+    """
+    width, height = image.size
+    if rows is not None and rows < height and _can_stop_early(image):
+        decoder, _, offset, args = image.tile[0]
+        image.tile = [(decoder, (0, 0, width, rows), offset, args)]
+        height = rows
+    if path is None:
+        image.im = Image.core.new(image.mode, (width, height))
+        image.load()
+        return None
+
+    buffer_mode = DECODE_BUFFER_MODES[image.mode]
+    shape = (height, width, len(buffer_mode)) if len(buffer_mode) > 1 else (height, width)
+    decoded = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=shape)
+    target = Image.frombuffer(buffer_mode, (width, height), decoded, "raw", buffer_mode, 0, 1)
+    image.im = target.im
+    image.load()
+    return decoded if image.im is target.im else None
+
+
+def _can_stop_early(image: Image.Image) -> bool:
+    """PNG no entrelazado en un solo bloque: sus filas se decodifican en orden"""
+    return (
+        image.format == "PNG"
+        and len(image.tile) == 1
+        and image.tile[0][0] == "zip"
+        and not image.info.get("interlace")
+    )
+
+
+def stage_input(image: Image.Image, path: Path) -> np.ndarray:
+    """
+    Decodifica la imagen (abierta sin cargar) sobre arrays en disco y retorna
+    sus píxeles RGB o RGBA: nunca hay un buffer del tamaño de la imagen en
+    RAM (decode_rows). L y P se convierten después por bandas de filas a un
+    segundo array.
+
+    Raises:
+        ValueError: Si el formato o el modo no se pueden decodificar así
+    """
+    if image.mode not in DECODE_BUFFER_MODES:
+        raise ValueError(f"Modo de imagen no soportado: {image.mode}")
+    error = check_out_of_core(image)
+    if error is not None:
+        raise ValueError(error)
+    width, height = image.size
+    decoded_path = path.with_suffix(".decoded.npy")
+    decoded = decode_rows(image, path=decoded_path)
+
+    if image.mode in ("RGB", "RGBA") and decoded is not None:
+        decoded.flush()
+        # Pillow guarda RGB como RGBX: la vista sin X no copia nada
+        return decoded[..., :3] if image.mode == "RGB" else decoded
+
+    # Modo sin equivalente directo (o Pillow mapeó el archivo en lugar de decodificar)
+    mode = "RGBA" if "A" in image.getbands() else "RGB"
+    pixels = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=(height, width, len(mode)))
+    for y0 in range(0, height, ROWS_PER_BAND):
+        band = image.crop((0, y0, width, min(height, y0 + ROWS_PER_BAND)))
+        pixels[y0:y0 + band.height] = np.asarray(band.convert(mode))
+    pixels.flush()
+    try:
+        decoded_path.unlink()
+    except OSError:
+        # Windows no borra un archivo mapeado: se va con el directorio de trabajo
+        pass
+    return pixels
+
+
+def write_png(path: Path, pixels: np.ndarray, compress_level: int = PNG_COMPRESS_LEVEL):
+    """
+    Escribe un PNG a partir de un array (alto, ancho, canales) uint8 por
+    bandas de filas, sin tener la imagen entera en memoria. Cada fila usa el
+    filtro Up (diferencia con la fila anterior), calculado con numpy.
+    """
+    height, width, channels = pixels.shape
+    color_type = {1: 0, 3: 2, 4: 6}[channels]
+
+    def write_chunk(f, tag: bytes, data: bytes):
+        f.write(struct.pack(">I", len(data)))
+        f.write(tag)
+        f.write(data)
+        f.write(struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF))
+
+    compressor = zlib.compressobj(compress_level)
+    previous = np.zeros((1, width * channels), dtype=np.uint8)
+    with open(path, "wb") as f:
+        f.write(PNG_SIGNATURE)
+        write_chunk(f, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0))
+        for y0 in range(0, height, ROWS_PER_BAND):
+            band = np.asarray(pixels[y0:y0 + ROWS_PER_BAND]).reshape(-1, width * channels)
+            rows = np.empty((band.shape[0], 1 + width * channels), dtype=np.uint8)
+            rows[:, 0] = 2  # Filtro Up
+            # La resta en uint8 da el módulo 256 que exige el formato
+            rows[:, 1:] = band - np.concatenate((previous, band[:-1]))
+            previous = band[-1:]
+            data = compressor.compress(rows.tobytes())
+            if data:
+                write_chunk(f, b"IDAT", data)
+        write_chunk(f, b"IDAT", compressor.flush())
+        write_chunk(f, b"IEND", b"")
+
+
+class TiledUpscaler:
+    """
+    Coordina el reescalado por tiles de una imagen. No ocupa un worker del
+    planificador: solo encola tiles y cose los resultados en orden.
+    """
+
+    def __init__(
+        self,
+        submit_tile: Callable[[Path, threading.Event], Future],
+        scale: int,
+        work_dir: Path,
+        tile_size: int,
+        overlap: int,
+        max_in_flight: int,
+        cancel_event: Optional[threading.Event] = None,
+        on_tile_done: Optional[Callable[[int, int], None]] = None
+    ):
+        """
+        Args:
+            submit_tile: Encola el upscale de un archivo (con el evento que lo
+                detiene) y retorna su Future[Path]
+            scale: Factor de escala del modelo
+            work_dir: Directorio de trabajo (se elimina al terminar)
+            tile_size: Lado del núcleo de cada tile (px de entrada)
+            overlap: Contexto añadido por cada lado con vecino (px de entrada)
+            max_in_flight: Tiles encolados o en proceso a la vez (acota el disco)
+            cancel_event: Evento que detiene el proceso
+            on_tile_done: Se invoca con (tiles cosidos, total) tras coser cada tile
+        """
+        self.submit_tile = submit_tile
+        self.scale = scale
+        self.work_dir = work_dir
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.max_in_flight = max(1, max_in_flight)
+        self.cancel_event = cancel_event or threading.Event()
+        self.on_tile_done = on_tile_done
+        # Detiene los tiles en curso si la imagen se cancela o falla un tile
+        self._stop_tiles = threading.Event()
+
+    def run(self, input_path: Path, output_path: Path) -> Path:
+        """
+        Reescala input_path y escribe el PNG en output_path
+
+        Raises:
+            UpscaleCancelled: Si se activa cancel_event
+        """
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            with Image.open(input_path) as image:
+                width, height = image.size
+                source = stage_input(image, self.work_dir / "input.npy")
+            channels = source.shape[2]
+
+            tiles = plan_tiles(width, height, self.tile_size, self.overlap)
+            logger.info(
+                f"Imagen grande {width}x{height}: {len(tiles)} tiles de {self.tile_size}px "
+                f"(contexto {self.overlap}px)"
+            )
+            result = np.lib.format.open_memmap(
+                self.work_dir / "output.npy",
+                mode="w+",
+                dtype=np.uint8,
+                shape=(height * self.scale, width * self.scale, channels)
+            )
+
+            pending = deque(tiles)
+            in_flight: deque = deque()
+            stitched = 0
+            while pending or in_flight:
+                self._check_cancelled()
+                while pending and len(in_flight) < self.max_in_flight:
+                    if not self._submit(pending[0], source, wait_for=in_flight[0] if in_flight else None):
+                        break
+                    in_flight.append(pending.popleft())
+                # Se cose en orden de barrido: cada tile se mezcla con sus vecinos ya escritos
+                tile = in_flight.popleft()
+                self._stitch(tile, result, self._wait(tile))
+                stitched += 1
+                if self.on_tile_done is not None:
+                    self.on_tile_done(stitched, len(tiles))
+
+            del source
+            result.flush()
+            write_png(output_path, result)
+            del result
+            return output_path
+        except BaseException:
+            self._stop_tiles.set()
+            output_path.unlink(missing_ok=True)
+            raise
+        finally:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise UpscaleCancelled("Upscale por tiles cancelado")
+
+    def _submit(self, tile: TileSpec, source: np.ndarray, wait_for: Optional[TileSpec]) -> bool:
+        """
+        Escribe el tile a disco y lo encola. Si la cola está llena y hay
+        tiles en curso retorna False para coser antes uno de ellos.
+        """
+        if tile.input_path is None:
+            x0, y0, x1, y1 = tile.box
+            tile.input_path = self.work_dir / f"tile-{tile.row}-{tile.col}.png"
+            Image.fromarray(np.ascontiguousarray(source[y0:y1, x0:x1])).save(
+                tile.input_path, "PNG", compress_level=1
+            )
+        while True:
+            try:
+                tile.future = self.submit_tile(tile.input_path, self._stop_tiles)
+                return True
+            except QueueFullError as e:
+                if wait_for is not None:
+                    return False
+                if self.cancel_event.wait(min(max(e.retry_after, 0.5), 5.0)):
+                    self._check_cancelled()
+
+    def _wait(self, tile: TileSpec) -> Path:
+        try:
+            while True:
+                try:
+                    return tile.future.result(timeout=CANCEL_POLL_INTERVAL)
+                except TimeoutError:
+                    self._check_cancelled()
+        finally:
+            tile.input_path.unlink(missing_ok=True)
+
+    def _stitch(self, tile: TileSpec, result: np.ndarray, tile_output: Path):
+        """Copia el tile en el resultado mezclando las franjas de solape"""
+        x0, y0, x1, y1 = tile.box
+        scale = self.scale
+        with Image.open(tile_output) as image:
+            mode = "RGBA" if result.shape[2] == 4 else "RGB"
+            pixels = np.asarray(image.convert(mode) if image.mode != mode else image)
+        tile_output.unlink(missing_ok=True)
+
+        expected = ((y1 - y0) * scale, (x1 - x0) * scale)
+        if pixels.shape[:2] != expected:
+            raise RuntimeError(f"El tile {tile.row},{tile.col} mide {pixels.shape[:2]}, se esperaba {expected}")
+
+        axes = []
+        for start, length, before, after in (
+            (y0, pixels.shape[0], tile.top_seam, tile.bottom_seam),
+            (x0, pixels.shape[1], tile.left_seam, tile.right_seam)
+        ):
+            rise = seam_ramp(start, length, before, self.overlap, scale)
+            fall = 1.0 - seam_ramp(start, length, after, self.overlap, scale) if after is not None else 1.0
+            # Ventana del tile: sube en la costura de entrada y baja en la de salida
+            axes.append((rise, rise * fall))
+        (rise_y, window_y), (rise_x, window_x) = axes
+
+        target = result[y0 * scale:y1 * scale, x0 * scale:x1 * scale]
+        ya, yb = solid_span(window_y)
+        xa, xb = solid_span(window_x)
+        if ya < yb and xa < xb:
+            target[ya:yb, xa:xb] = pixels[ya:yb, xa:xb]
+        else:
+            ya = yb = xa = xb = 0
+        # Franjas de solape alrededor de la zona copiada tal cual
+        for rows, cols in (
+            (slice(0, ya), slice(None)),
+            (slice(yb, None), slice(None)),
+            (slice(ya, yb), slice(0, xa)),
+            (slice(ya, yb), slice(xb, None))
+        ):
+            self._blend(
+                target[rows, cols],
+                pixels[rows, cols],
+                rise_y[rows], window_y[rows],
+                rise_x[cols], window_x[cols]
+            )
+        self._check_cancelled()
+
+    @staticmethod
+    def _blend(
+        target: np.ndarray,
+        pixels: np.ndarray,
+        rise_y: np.ndarray,
+        window_y: np.ndarray,
+        rise_x: np.ndarray,
+        window_x: np.ndarray
+    ):
+        """
+        Mezcla el tile con lo ya cosido. Las ventanas de los tiles suman 1 en
+        cada píxel; como se cosen en orden de barrido, el peso acumulado de lo
+        ya escrito se conoce: las filas de arriba (1 - rise_y) más los tiles de
+        la izquierda en esta fila (window_y * (1 - rise_x)). El tile entra con
+        su ventana normalizada por ese total, así el resultado no depende de
+        cuándo se escribió cada vecino.
+        """
+        if target.size == 0:
+            return
+        tile_weight = window_y[:, None] * window_x[None, :]
+        done_weight = (1.0 - rise_y)[:, None] + window_y[:, None] * (1.0 - rise_x)[None, :]
+        total = done_weight + tile_weight
+        weights = np.divide(tile_weight, total, out=np.zeros_like(total), where=total > 0)[..., None]
+        mixed = target.astype(np.float32) * (1.0 - weights) + pixels.astype(np.float32) * weights
+        target[...] = np.rint(mixed).astype(np.uint8)
@@ -4,34 +4,91 @@ API para reescalado de imágenes con IA
 Ahora con procesamiento asíncrono para no bloquear el servidor.
 """
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException, BackgroundTasks, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
-from pydantic import BaseModel, Field
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
 from typing import Optional
-import base64
-from io import BytesIO
-from PIL import Image
 import logging
 from pathlib import Path
+import shutil
 import uuid
+import zipfile
 import asyncio  # Añadido para asincronía
+import json
+import math
+import re
+import threading
+import time
 
 from config import (
     API_HOST,
     API_PORT,
     API_RELOAD,
+    API_WORKERS,
     TEMP_DIR,
     OUTPUT_DIR,
+    CACHE_DIR,
     SUPPORTED_FORMATS,
-    MAX_IMAGE_SIZE
+    LARGE_IMAGE_MAX_SIZE,
+    BATCH_MAX_ITEMS,
+    JOB_STORE,
+    REQUEST_TIMEOUT,
+    MODELS,
+    PROGRESS_HEARTBEAT,
+    TRACE_LOG_FILE,
+    TRACE_LOG_MAX_MB,
+    TRACE_LOG_BACKUPS,
+    TRACE_EXCLUDE_ROUTES,
+    LOOP_LAG_INTERVAL
 )
 from upscale_service import get_upscale_service
+from engines import DeadlineExceeded
+from encoder import FORMATS, PNG, OutputFormat, available_formats, media_type_for, parse_output_format
+from scheduler import Priority, QueueFullError
+from jobs import FINISHED_STATES, JobState, get_job_manager, job_channel
+from image_io import (
+    UPLOAD_CHUNK_SIZE,
+    DecodedPayload,
+    decode_json_payload,
+    prepare_input_file,
+    read_image_size,
+    save_stream,
+    write_json_response
+)
+from preview import get_preview_store, parse_region, validate_region
+from batch import BatchRun
+from video_pipeline import ffmpeg_available
+from metrics import (
+    BYTES_RECEIVED,
+    BYTES_SENT,
+    HTTP_LATENCY,
+    HTTP_REQUESTS,
+    REGISTRY,
+    UPSCALE_REQUESTS,
+    service_collector,
+    watch_event_loop_lag
+)
+from progress import get_progress_hub, reporting
+from tracing import (
+    REQUEST_ID_PATTERN,
+    TraceLog,
+    activate,
+    current_request_id,
+    deactivate,
+    install_log_record_factory,
+    observe_stage,
+    stage,
+    start_trace
+)
+from starlette.datastructures import Headers, MutableHeaders
 
-# Configurar logging
+# Configurar logging (cada línea lleva el ID de la petición en curso)
+install_log_record_factory()
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
 )
 logger = logging.getLogger(__name__)
 
@@ -50,15 +107,232 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Estado del planificador, la caché y los directorios se lee al exportar /metrics
+REGISTRY.add_collector(service_collector(
+    get_upscale_service,
+    {"temp": TEMP_DIR, "output": OUTPUT_DIR, "cache": CACHE_DIR}
+))
 
-class UpscaleRequest(BaseModel):
-    """Modelo de solicitud para upscale"""
-    image: str = Field(..., description="Imagen en base64")
+
+class HTTPMetricsMiddleware:
+    """
+    Cuenta peticiones y latencias por ruta (plantilla, no la URL concreta).
+    Es un middleware ASGI puro: BaseHTTPMiddleware envuelve 'receive' y
+    Request.is_disconnected() dejaría de ver la desconexión del cliente.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # El router deja la ruta resuelta en el propio scope
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            HTTP_REQUESTS.inc(method=scope["method"], route=path, status=status)
+            HTTP_LATENCY.observe(time.perf_counter() - start, method=scope["method"], route=path)
+
+
+app.add_middleware(HTTPMetricsMiddleware)
+
+# Rutas cuyo progreso se publica en el canal de su X-Request-ID
+PROGRESS_ROUTE_PREFIX = "/api/upscale"
+
+
+class ProgressMiddleware:
+    """
+    Publica el progreso de los upscales síncronos (ver progress.py) en el
+    canal de su X-Request-ID: el cliente elige el ID, envía la petición con
+    esa cabecera y sigue el avance en GET /api/progress/{request_id}.
+    Va dentro de TracingMiddleware, que asigna el ID.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(PROGRESS_ROUTE_PREFIX):
+            await self.app(scope, receive, send)
+            return
+
+        hub = get_progress_hub()
+        request_id = current_request_id()
+        hub.start(request_id, {"state": "pending"})
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            with reporting(lambda progress: hub.publish(request_id, {"state": "running", **progress})):
+                await self.app(scope, receive, send_with_status)
+        finally:
+            # En las respuestas en streaming (lotes) se llega aquí al terminar de enviarlas
+            final = {"state": "completed", "percent": 100.0} if status < 400 else {"state": "failed"}
+            hub.finish(request_id, {**final, "status": status})
+
+
+app.add_middleware(ProgressMiddleware)
+
+TRACE_LOG = TraceLog(
+    Path(TRACE_LOG_FILE) if TRACE_LOG_FILE else None,
+    TRACE_LOG_MAX_MB * 1024 * 1024,
+    TRACE_LOG_BACKUPS,
+    app.version
+)
+
+
+class TracingMiddleware:
+    """
+    Asigna un ID a cada petición y abre su traza (ver tracing.py). La
+    respuesta lleva X-Request-ID y Server-Timing con el tiempo de cada
+    etapa; al terminar, la traza se escribe en TRACE_LOG_FILE.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        root = start_trace(
+            f"{scope['method']} {scope['path']}",
+            headers.get("x-request-id"),
+            headers.get("traceparent")
+        )
+        root.set_attribute("http.request.method", scope["method"])
+        root.set_attribute("url.path", scope["path"])
+        status = 500
+
+        async def send_with_trace(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                response_headers = MutableHeaders(scope=message)
+                response_headers["X-Request-ID"] = root.trace.request_id
+                response_headers["Server-Timing"] = root.trace.server_timing(root)
+            await send(message)
+
+        token = activate(root)
+        try:
+            await self.app(scope, receive, send_with_trace)
+        finally:
+            deactivate(token)
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            root.name = f"{scope['method']} {path}"
+            root.set_attribute("http.route", path)
+            root.set_attribute("http.response.status_code", status)
+            if status >= 500:
+                root.error = f"HTTP {status}"
+            root.end()
+            root.trace.add(root)
+            spans = root.trace.finish()
+            if path not in TRACE_EXCLUDE_ROUTES:
+                TRACE_LOG.write(spans)
+
+
+app.add_middleware(TracingMiddleware)
+
+
+def record_upscale(endpoint: str, model: str, scale: int, status: str):
+    """Cuenta una petición de upscale; modelos desconocidos se agrupan para acotar las etiquetas"""
+    UPSCALE_REQUESTS.inc(
+        endpoint=endpoint,
+        model=model if model in MODELS else "unknown",
+        scale=scale if scale in (1, 2, 3, 4) else "invalid",
+        status=status
+    )
+
+
+# Motores que se pueden pedir por petición
+ENGINE_PATTERN = "^(auto|cpu)$"
+# Formatos del resultado (encoder.FORMATS)
+OUTPUT_FORMAT_PATTERN = "^(png|webp|jpe?g|avif)$"
+
+
+class UpscaleParams(BaseModel):
+    """Parámetros de upscale (query string en el modo binario)"""
     scale: int = Field(2, ge=1, le=4, description="Factor de escala (1-4)")
     model: str = Field("general", description="Modelo a usar (general, anime, photo)")
     denoise_strength: int = Field(50, ge=0, le=100, description="Fuerza de denoise (0-100)")
     upscale_type: str = Field("AI Enhanced", description="Tipo de reescalado")
     tile_size: int = Field(0, ge=0, description="Tamaño de tile (0 para automático)")
+    priority: str = Field(
+        "interactive",
+        pattern="^(interactive|batch)$",
+        description="Prioridad en la cola (interactive, batch)"
+    )
+    engine: str = Field(
+        "auto",
+        pattern=ENGINE_PATTERN,
+        description="Motor (auto: el configurado, o CPU si no está disponible; cpu: LANCZOS sin GPU)"
+    )
+    format: Optional[str] = Field(
+        None,
+        pattern=OUTPUT_FORMAT_PATTERN,
+        description="Formato del resultado (png, webp, jpg, avif); por defecto el de la cabecera Accept o PNG"
+    )
+    quality: Optional[int] = Field(None, ge=1, le=100, description="Calidad de JPEG, WebP y AVIF (1-100)")
+    lossless: bool = Field(False, description="WebP sin pérdida")
+
+
+class PreviewParams(BaseModel):
+    """Vista previa rápida (solo en /api/upscale)"""
+    preview: bool = Field(False, description="Reescalar una versión reducida en el carril rápido")
+    region: Optional[str] = Field(
+        None,
+        pattern=r"^\d+,\d+,\d+,\d+$",
+        description="Región x,y,w,h en píxeles de la imagen original (solo con preview)"
+    )
+
+
+class UpscaleQuery(UpscaleParams, PreviewParams):
+    """Parámetros de /api/upscale en el modo binario (query string)"""
+
+
+class UpscaleRequest(UpscaleParams, PreviewParams):
+    """Modelo de solicitud para upscale"""
+    image: str = Field(..., description="Imagen en base64")
+
+
+# El cuerpo JSON se lee sin validar (se decodifica en CodecPool): su esquema se
+# declara a mano en la documentación de los endpoints
+UPSCALE_REQUEST_SCHEMA = UpscaleRequest.model_json_schema()
+
+
+class PromoteRequest(BaseModel):
+    """Parámetros del trabajo completo; por defecto, los de la vista previa"""
+    scale: Optional[int] = Field(None, ge=1, le=4)
+    model: Optional[str] = None
+    denoise_strength: Optional[int] = Field(None, ge=0, le=100)
+    tile_size: Optional[int] = Field(None, ge=0)
+    engine: Optional[str] = Field(None, pattern=ENGINE_PATTERN)
+    format: Optional[str] = Field(None, pattern=OUTPUT_FORMAT_PATTERN)
+    quality: Optional[int] = Field(None, ge=1, le=100)
+    lossless: Optional[bool] = None
+    priority: str = Field("interactive", pattern="^(interactive|batch)$")
 
 
 class UpscaleResponse(BaseModel):
@@ -69,6 +343,27 @@ class UpscaleResponse(BaseModel):
     width: int
     height: int
     processing_time: Optional[float] = None
+    cached: bool = False
+    engine: Optional[str] = None
+    preview_id: Optional[str] = None
+    preview_factor: Optional[float] = None
+
+
+class JobResponse(BaseModel):
+    """Estado de un trabajo asíncrono"""
+    job_id: str
+    kind: str = "image"
+    state: str
+    queue_position: Optional[int] = None
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    queue_time: float
+    processing_time: Optional[float] = None
+    cached: bool = False
+    error: Optional[str] = None
+    progress: Optional[dict] = None
+    engine: Optional[str] = None
 
 
 class ModelInfo(BaseModel):
@@ -79,6 +374,173 @@ class ModelInfo(BaseModel):
     scale: int
 
 
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request: Request, exc: QueueFullError):
+    """Responde 429 con una estimación de cuándo reintentar"""
+    retry_after = max(1, math.ceil(exc.retry_after))
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc), "retry_after": retry_after},
+        headers={"Retry-After": str(retry_after)}
+    )
+
+
+# Intervalo con el que se comprueba si el cliente sigue conectado (segundos)
+DISCONNECT_POLL_INTERVAL = 0.5
+
+# Código (convención de nginx) registrado cuando el cliente cierra la conexión
+CLIENT_CLOSED_REQUEST = 499
+
+
+class ClientDisconnected(Exception):
+    """El cliente cerró la conexión antes de recibir el resultado"""
+
+
+def request_deadline(http_request: Request) -> float:
+    """
+    Plazo de la petición (time.monotonic): REQUEST_TIMEOUT o lo que indique
+    la cabecera X-Request-Timeout (segundos), si es menor
+    """
+    timeout = REQUEST_TIMEOUT
+    header = http_request.headers.get("X-Request-Timeout")
+    if header is not None:
+        try:
+            requested = float(header)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="X-Request-Timeout debe ser un número de segundos")
+        if requested <= 0:
+            raise HTTPException(status_code=400, detail="X-Request-Timeout debe ser positivo")
+        timeout = min(timeout, requested)
+    return time.monotonic() + timeout
+
+
+async def await_upscale(
+    http_request: Request,
+    future,
+    cancel_event: threading.Event,
+    deadline: float
+):
+    """
+    Espera el resultado de una tarea sin bloquear el event loop. Si el cliente
+    se desconecta, vence el plazo o la petición se cancela, la tarea se
+    descarta de la cola o, si ya se ejecuta, se termina el proceso del motor.
+
+    Raises:
+        ClientDisconnected: Si el cliente cerró la conexión
+        DeadlineExceeded: Si vence el plazo de la petición
+    """
+    wrapped = asyncio.wrap_future(future)
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded("Plazo de la petición agotado")
+            done, _ = await asyncio.wait(
+                {wrapped}, timeout=min(DISCONNECT_POLL_INTERVAL, remaining)
+            )
+            if done:
+                return wrapped.result()
+            if await http_request.is_disconnected():
+                raise ClientDisconnected()
+    except DeadlineExceeded:
+        # En cola se descarta aquí; en ejecución el motor vence el mismo plazo
+        # (una petición agrupada solo se separa; si era la última, se detiene
+        # la ejecución compartida, que no tiene plazo propio: ver singleflight.py)
+        future.cancel()
+        wrapped.add_done_callback(_consume_result)
+        raise
+    except (ClientDisconnected, asyncio.CancelledError):
+        cancel_event.set()
+        future.cancel()
+        wrapped.add_done_callback(_consume_result)
+        raise
+
+
+def _consume_result(wrapped: asyncio.Future):
+    """Recoge el resultado de una tarea abandonada para que asyncio no lo reporte"""
+    if not wrapped.cancelled():
+        wrapped.exception()
+
+
+def request_priority(request: UpscaleParams) -> Priority:
+    """Carril del planificador para una petición síncrona"""
+    if getattr(request, "preview", False):
+        return Priority.PREVIEW
+    return Priority[request.priority.upper()]
+
+
+# Campos del cuerpo JSON que deciden el carril. Las comillas no forman parte
+# del alfabeto base64, así que no pueden aparecer dentro de la imagen
+_PREVIEW_FIELD = re.compile(rb'"preview"\s*:\s*true')
+_PRIORITY_FIELD = re.compile(rb'"priority"\s*:\s*"(interactive|batch)"')
+
+
+def peek_priority(body: bytes) -> Priority:
+    """
+    Carril de un cuerpo JSON sin parsearlo: permite rechazar con 429 antes de
+    decodificar la imagen. Si no se reconoce, el de una petición interactiva
+    (el planificador vuelve a comprobar la cola al encolar)
+    """
+    if _PREVIEW_FIELD.search(body):
+        return Priority.PREVIEW
+    match = _PRIORITY_FIELD.search(body)
+    if match:
+        return Priority[match.group(1).decode().upper()]
+    return Priority.INTERACTIVE
+
+
+def negotiate_output_format(
+    http_request: Request,
+    name: Optional[str],
+    quality: Optional[int],
+    lossless: bool,
+    size: tuple,
+    scale: int
+) -> OutputFormat:
+    """
+    Formato del resultado: el parámetro format o, si no se indica, el primer
+    tipo de la cabecera Accept que el servidor sabe codificar (PNG si ninguno)
+
+    Raises:
+        HTTPException: 400 si el formato no es válido o no admite el tamaño del resultado
+    """
+    if name is None:
+        name = "png"
+        accepted = {media_type: fmt for fmt, (_, media_type, _) in FORMATS.items() if fmt in available_formats()}
+        for media_range in http_request.headers.get("accept", "").split(","):
+            media_type = media_range.split(";")[0].strip().lower()
+            if media_type in accepted:
+                name = accepted[media_type]
+                break
+    try:
+        output_format = parse_output_format(name, quality, lossless)
+        output_format.check_size(size[0] * scale, size[1] * scale)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return output_format
+
+
+def format_params(output_format: OutputFormat) -> dict:
+    """Parámetros de RealESRGANService.upscale para un formato (serializables en JSON)"""
+    return {
+        "output_format": output_format.name,
+        "quality": output_format.quality,
+        "lossless": output_format.lossless
+    }
+
+
+def get_client_id(http_request: Request) -> str:
+    """Identifica al cliente para el reparto justo de workers"""
+    client_id = http_request.headers.get("X-Client-ID")
+    if client_id:
+        return client_id
+    return http_request.client.host if http_request.client else "anonymous"
+
+
+# Tarea que mide el retraso del event loop (se cancela al cerrar)
+_loop_lag_task: Optional[asyncio.Task] = None
+
+
 @app.on_event("startup")
 async def startup_event():
     """Evento de inicio de la aplicación"""
@@ -89,9 +551,24 @@ async def startup_event():
         service = get_upscale_service()
         logger.info("Servicio de upscale inicializado correctamente")
         
-        # Limpiar archivos temporales antiguos
-        service.cleanup_temp_files(max_age_hours=24)
-        logger.info("Archivos temporales limpiados")
+        # Calentar los modelos en segundo plano: /health/ready responde 503 hasta terminar
+        service.start_warm_up()
+        
+        # Con JOB_STORE=sqlite arranca el despachador de la cola compartida
+        get_job_manager()
+        
+        # Limpieza de temp/ y output/ en un hilo, por tandas (no retrasa el arranque).
+        # Cada pasada también elimina las vistas previas caducadas
+        service.janitor.add_pass_hook(get_preview_store().sweep)
+        service.janitor.start()
+        
+        # Procesos de decodificación de peticiones, listos antes de la primera
+        service.codec.start()
+        
+        # Retraso del event loop (ria_event_loop_lag_seconds)
+        if LOOP_LAG_INTERVAL > 0:
+            global _loop_lag_task
+            _loop_lag_task = asyncio.get_running_loop().create_task(watch_event_loop_lag(LOOP_LAG_INTERVAL))
         
     except Exception as e:
         logger.error(f"Error durante el inicio: {str(e)}")
@@ -101,6 +578,9 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     """Evento de cierre para limpiar recursos"""
+    if _loop_lag_task is not None:
+        _loop_lag_task.cancel()
+    get_job_manager().shutdown()  # Cancelar trabajos pendientes
     service = get_upscale_service()
     service.shutdown()  # Cerrar el executor de hilos
     logger.info("Servicio de upscale cerrado")
@@ -127,7 +607,9 @@ async def health_check():
             "status": "healthy",
             "version": "1.0.0",
             "models_available": len(models),
-            "models": [m["id"] for m in models]
+            "models": [m["id"] for m in models],
+            "engine": service.engine.name,
+            "engine_fallback": service.fallback
         }
     except Exception as e:
         logger.error(f"Error en health check: {str(e)}")
@@ -140,6 +622,35 @@ async def health_check():
         )
 
 
+@app.get("/health/live")
+async def liveness():
+    """Liveness: el proceso responde (no comprueba el motor ni los modelos)"""
+    return {"status": "alive"}
+
+
+@app.get("/health/ready")
+async def readiness():
+    """
+    Readiness: hay modelos disponibles y calentados, algún dispositivo sano,
+    la cola no está saturada y queda espacio en disco. Responde 503 con los
+    motivos en caso contrario, para que el balanceador no envíe tráfico a
+    una instancia fría o sin capacidad.
+    """
+    try:
+        service = get_upscale_service()
+        result = service.readiness()
+    except Exception as e:
+        return JSONResponse(status_code=503, content={"status": "not_ready", "reasons": [str(e)]})
+    
+    content = {
+        "status": "ready" if result["ready"] else "not_ready",
+        "reasons": result["reasons"],
+        "engine": service.engine.name,
+        **result["checks"]
+    }
+    return JSONResponse(status_code=200 if result["ready"] else 503, content=content)
+
+
 @app.get("/api/models", response_model=list[ModelInfo])
 async def get_available_models():
     """Retorna los modelos de IA disponibles"""
@@ -157,109 +668,304 @@ async def get_available_models():
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/api/upscale", response_model=UpscaleResponse)
+@app.post(
+    "/api/upscale",
+    response_model=UpscaleResponse,
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/json": {"schema": UPSCALE_REQUEST_SCHEMA},
+                "image/*": {
+                    "schema": {"type": "string", "format": "binary"}
+                }
+            }
+        }
+    }
+)
 async def upscale_image(
-    request: UpscaleRequest,
+    http_request: Request,
     background_tasks: BackgroundTasks
 ):
     """
     Endpoint principal para reescalar imágenes usando Real-ESRGAN (asíncrono)
+    
+    Acepta dos modos:
+    - JSON (application/json): imagen en base64, responde JSON con data URL
+    - Binario (image/*): la imagen va en el cuerpo y los parámetros en la
+      query string; responde la imagen como flujo binario con ancho, alto y
+      tiempos en cabeceras X-*. En modo JSON también se obtiene respuesta
+      binaria enviando la cabecera Accept: image/png (o image/webp, ...)
+    
+    El resultado es PNG salvo que se pida otro formato con format (o con la
+    cabecera Accept): webp, jpg o avif, con quality y, en WebP, lossless.
+    
+    Con preview=true se reescala una versión reducida de la imagen (o de la
+    región x,y,w,h) en el carril rápido. La respuesta incluye un preview_id
+    para promoverla a un trabajo completo con POST /api/previews/{id}/promote.
     """
-    import time
     start_time = time.time()
     
     temp_input_path = None
     output_path = None
+    raw_body = http_request.headers.get("content-type", "").startswith("image/")
+    request = None
+    preview_id = None
+    preview = None
+    status = "error"
     
     try:
-        logger.info(
-            f"Recibida solicitud de upscale: "
-            f"scale={request.scale}, model={request.model}"
-        )
+        deadline = request_deadline(http_request)
+        service = get_upscale_service()
         
-        # Decodificar la imagen base64
-        if request.image.startswith('data:image'):
-            # Remover el prefijo data:image/...;base64,
-            image_data = request.image.split(',')[1]
+        if raw_body:
+            request = UpscaleQuery.model_validate(dict(http_request.query_params))
+            check_model(request.model)
+            # Rechazar pronto si la cola está llena, antes de recibir la imagen
+            service.scheduler.check_capacity(request_priority(request))
+            
+            # Volcar el cuerpo a disco por bloques, sin cargarlo entero en memoria
+            upload_path = TEMP_DIR / f"{uuid.uuid4()}.upload"
+            temp_input_path = upload_path
+            with stage("temp_write"):
+                content_hash = await save_stream(http_request.stream(), upload_path)
+            BYTES_RECEIVED.inc(upload_path.stat().st_size, endpoint="upscale")
+            try:
+                with stage("decode"):
+                    temp_input_path, image_size = await service.codec.run(
+                        prepare_input_file, upload_path, LARGE_IMAGE_MAX_SIZE
+                    )
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            logger.info(f"Imagen recibida: {image_size}")
         else:
-            image_data = request.image
-        
-        image_bytes = base64.b64decode(image_data)
-        image = Image.open(BytesIO(image_bytes))
-        
-        logger.info(f"Imagen recibida: {image.size}")
-        
-        # Validar tamaño de imagen
-        if image.width > MAX_IMAGE_SIZE or image.height > MAX_IMAGE_SIZE:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Imagen demasiado grande. Máximo: {MAX_IMAGE_SIZE}px por lado"
-            )
+            # Incluye la escritura de la entrada: ambas se hacen en CodecPool
+            with stage("decode"):
+                body = await http_request.body()
+                # Rechazar pronto si la cola está llena, antes de decodificar la imagen
+                service.scheduler.check_capacity(peek_priority(body))
+                decoded = await service.codec.run(decode_json_payload, body, TEMP_DIR, LARGE_IMAGE_MAX_SIZE)
+                temp_input_path = decoded.path
+                request = validate_decoded_request(body, decoded)
+            if decoded.error is not None:
+                raise HTTPException(status_code=400, detail=decoded.error)
+            logger.info(f"Imagen recibida: {decoded.size}")
+            BYTES_RECEIVED.inc(decoded.image_bytes, endpoint="upscale")
+            content_hash = decoded.content_hash
+            image_size = decoded.size
         
-        # Guardar imagen temporal
-        temp_filename = f"{uuid.uuid4()}.png"
-        temp_input_path = TEMP_DIR / temp_filename
-        image.save(temp_input_path, "PNG")
-        
-        logger.info(f"Imagen guardada temporalmente en: {temp_input_path}")
-        
-        # Obtener servicio de upscale
-        service = get_upscale_service()
-        
-        # Convertir denoise_strength de 0-100 a 0-1
-        denoise = request.denoise_strength / 100.0
+        region = None
+        if request.preview:
+            try:
+                region = validate_region(parse_region(request.region), image_size) if request.region else None
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
         
-        # Procesar imagen con Real-ESRGAN en hilo separado (no bloqueante)
-        future = service.upscale(
-            input_path=temp_input_path,
-            scale=request.scale,
-            model=request.model,
-            denoise_strength=denoise,
-            tile_size=request.tile_size
+        engine = service.engine_name(request.engine)
+        # Las vistas previas siempre son PNG
+        output_format = PNG if request.preview else negotiate_output_format(
+            http_request, request.format, request.quality, request.lossless, image_size, request.scale
+        )
+        logger.info(
+            f"Recibida solicitud de upscale: "
+            f"scale={request.scale}, model={request.model}, engine={engine}, format={output_format.key}"
         )
         
-        # Esperar el resultado de forma asíncrona sin bloquear el event loop
-        output_path = await asyncio.wrap_future(future)
-        
-        logger.info(f"Upscale completado: {output_path}")
+        # Consultar la caché de resultados antes de lanzar Real-ESRGAN; la misma
+        # clave agrupa las peticiones idénticas en curso
+        cache_key = None
+        cached = False
+        if not request.preview:
+            cache_key = service.cache_key(
+                content_hash, request.model, request.scale, request.tile_size, engine, output_format
+            )
+        if cache_key is not None and service.cache is not None:
+            output_path = service.cache.get(cache_key)
+            cached = output_path is not None
         
-        # Leer imagen resultante
-        with Image.open(output_path) as result_img:
-            new_width, new_height = result_img.size
+        if cached:
+            logger.info(f"Resultado obtenido de caché: {output_path}")
+        else:
+            logger.info(f"Imagen guardada temporalmente en: {temp_input_path}")
+            
+            # Convertir denoise_strength de 0-100 a 0-1
+            denoise = request.denoise_strength / 100.0
+            
+            # Procesar imagen con Real-ESRGAN en hilo separado (no bloqueante)
+            cancel_event = threading.Event()
+            if request.preview:
+                future = service.preview(
+                    input_path=temp_input_path,
+                    scale=request.scale,
+                    model=request.model,
+                    region=region,
+                    tile_size=request.tile_size,
+                    cancel_event=cancel_event,
+                    client_id=get_client_id(http_request),
+                    deadline=deadline,
+                    engine=engine
+                )
+            else:
+                future = service.upscale(
+                    input_path=temp_input_path,
+                    scale=request.scale,
+                    model=request.model,
+                    denoise_strength=denoise,
+                    tile_size=request.tile_size,
+                    cancel_event=cancel_event,
+                    priority=request_priority(request),
+                    client_id=get_client_id(http_request),
+                    deadline=deadline,
+                    engine=engine,
+                    key=cache_key,
+                    **format_params(output_format)
+                )
+            
+            # Esperar el resultado sin bloquear el event loop (cancela si el cliente se va)
+            result = await await_upscale(http_request, future, cancel_event, deadline)
+            
+            if request.preview:
+                preview = result
+                output_path = preview.output_path
+                # La entrada ya decodificada se conserva para promoverla a trabajo completo
+                preview_id = get_preview_store().put(
+                    temp_input_path,
+                    content_hash,
+                    request.model_dump(include=set(UpscaleParams.model_fields))
+                )
+                temp_input_path = None
+                logger.info(f"Vista previa completada: {output_path} (id {preview_id})")
+            else:
+                output_path = result
+                logger.info(f"Upscale completado: {output_path}")
             
-            # Convertir a base64
-            buffered = BytesIO()
-            result_img.save(buffered, format="PNG")
-            img_str = base64.b64encode(buffered.getvalue()).decode()
+            # Guardar el resultado en caché (cleanup_files ya no lo borrará)
+            if cache_key is not None and service.cache is not None:
+                output_path = service.cache.put(cache_key, output_path)
+        
+        # El tamaño del resultado sale de la cabecera, sin decodificar píxeles
+        encode_start = time.perf_counter()
+        new_width, new_height = read_image_size(output_path)
         
         processing_time = time.time() - start_time
         logger.info(f"Procesamiento completado en {processing_time:.2f}s")
         
         # Programar limpieza de archivos temporales
         background_tasks.add_task(cleanup_files, temp_input_path, output_path)
+        status = "cached" if cached else "ok"
+        
+        media_type = media_type_for(output_path)
+        if raw_body or wants_binary_response(http_request):
+            # Respuesta binaria: la imagen se envía por bloques desde disco
+            BYTES_SENT.inc(output_path.stat().st_size, endpoint="upscale")
+            observe_stage("output_encode", time.perf_counter() - encode_start)
+            headers = {
+                "X-Image-Width": str(new_width),
+                "X-Image-Height": str(new_height),
+                "X-Processing-Time": f"{processing_time:.3f}",
+                "X-Cache": "HIT" if cached else "MISS",
+                "X-Engine": engine
+            }
+            if preview is not None:
+                headers["X-Preview-Id"] = preview_id
+                headers["X-Preview-Factor"] = f"{preview.factor:.4f}"
+            return FileResponse(output_path, media_type=media_type, headers=headers)
         
-        return UpscaleResponse(
+        # La imagen ya está en el formato pedido: CodecPool la pasa a base64 y
+        # escribe la respuesta en disco, que se envía por bloques
+        fields = UpscaleResponse(
             success=True,
-            image=f"data:image/png;base64,{img_str}",
             message="Imagen reescalada exitosamente",
             width=new_width,
             height=new_height,
-            processing_time=processing_time
-        )
+            processing_time=processing_time,
+            cached=cached,
+            engine=engine,
+            preview_id=preview_id,
+            preview_factor=preview.factor if preview is not None else None
+        ).model_dump(exclude={"image"})
+        response_path = OUTPUT_DIR / f"{uuid.uuid4()}.json"
+        try:
+            encoded = await service.codec.run(
+                write_json_response, output_path, media_type, fields, response_path, admit=False
+            )
+        except BaseException:
+            cleanup_files(response_path)
+            raise
+        background_tasks.add_task(cleanup_files, response_path)
+        BYTES_SENT.inc(encoded, endpoint="upscale")
+        observe_stage("output_encode", time.perf_counter() - encode_start)
         
-    except HTTPException:
-        # Re-lanzar HTTPExceptions
+        return FileResponse(response_path, media_type="application/json")
+        
+    except ValidationError as e:
+        status = "invalid"
+        cleanup_files(temp_input_path)
+        raise RequestValidationError(e.errors())
+    except QueueFullError:
+        status = "rejected"
+        cleanup_files(temp_input_path)
+        raise
+    except ClientDisconnected:
+        status = "disconnected"
+        cleanup_files(temp_input_path)
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    except asyncio.CancelledError:
+        status = "disconnected"
+        cleanup_files(temp_input_path)
+        raise
+    except DeadlineExceeded:
+        status = "timeout"
+        cleanup_files(temp_input_path)
+        raise HTTPException(status_code=504, detail="No se pudo completar antes del plazo de la petición")
+    except HTTPException as e:
+        # Re-lanzar HTTPExceptions (errores del cliente se cuentan como inválidos)
+        if e.status_code < 500:
+            status = "invalid"
+        cleanup_files(temp_input_path)
         raise
     except Exception as e:
         logger.error(f"Error en upscale: {str(e)}", exc_info=True)
         
         # Limpiar archivos en caso de error
-        if temp_input_path and temp_input_path.exists():
-            temp_input_path.unlink()
-        if output_path and output_path.exists():
-            output_path.unlink()
+        cleanup_files(temp_input_path, output_path)
         
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if request is not None:
+            record_upscale("preview" if request.preview else "upscale", request.model, request.scale, status)
+        else:
+            record_upscale("upscale", "unknown", "invalid", status)
+
+
+def wants_binary_response(http_request: Request) -> bool:
+    """Indica si el cliente pidió la imagen en binario en lugar de JSON"""
+    accept = http_request.headers.get("accept", "")
+    return accept.startswith("image/")
+
+
+def check_model(model: str):
+    """Rechaza con 400 un modelo que no existe, antes de encolar nada"""
+    if model not in MODELS:
+        raise HTTPException(status_code=400, detail=f"Modelo no válido: {model}")
+
+
+def validate_decoded_request(body: bytes, decoded: DecodedPayload) -> UpscaleRequest:
+    """
+    Valida los parámetros de un cuerpo JSON ya decodificado en CodecPool
+    (la imagen no pasa por el event loop)
+
+    Raises:
+        ValidationError: Si el JSON o sus parámetros no son válidos
+        HTTPException: 400 si falta la imagen o el modelo no existe
+    """
+    if decoded.params is None or not decoded.has_image:
+        # JSON mal formado o sin imagen: se valida entero para dar el mismo error 422
+        UpscaleRequest.model_validate_json(body)
+        raise HTTPException(status_code=400, detail="Falta la imagen en base64")
+    request = UpscaleRequest.model_validate({**decoded.params, "image": ""})
+    check_model(request.model)
+    return request
 
 
 @app.post("/api/upscale/file")
@@ -268,13 +974,21 @@ async def upscale_file(
     scale: int = 2,
     model: str = "general",
     denoise_strength: int = 50,
-    background_tasks: BackgroundTasks = None
+    priority: str = "interactive",
+    engine: str = "auto",
+    format_name: Optional[str] = Query(None, alias="format", pattern=OUTPUT_FORMAT_PATTERN),
+    quality: Optional[int] = Query(None, ge=1, le=100),
+    lossless: bool = False,
+    background_tasks: BackgroundTasks = None,
+    http_request: Request = None
 ):
     """
-    Endpoint alternativo que acepta archivos directamente (asíncrono)
+    Endpoint alternativo que acepta archivos directamente (asíncrono).
+    format, quality y lossless como en /api/upscale.
     """
     temp_input_path = None
     output_path = None
+    status = "error"
     
     try:
         # Validar formato
@@ -284,60 +998,583 @@ async def upscale_file(
                 status_code=400,
                 detail=f"Formato no soportado. Usa: {', '.join(SUPPORTED_FORMATS)}"
             )
+        # Mismas reglas que /api/upscale: solo las prioridades públicas (422)
+        try:
+            params = UpscaleParams(
+                scale=scale, model=model, denoise_strength=denoise_strength,
+                priority=priority, engine=engine
+            )
+        except ValidationError as e:
+            raise RequestValidationError(e.errors())
+        check_model(params.model)
+        deadline = request_deadline(http_request)
         
-        # Guardar archivo temporal
+        # Obtener servicio y rechazar pronto si la cola está llena
+        service = get_upscale_service()
+        service.scheduler.check_capacity()
+        engine = service.engine_name(engine)
+        
+        # Guardar archivo temporal por bloques (sin leer la subida entera)
         temp_filename = f"{uuid.uuid4()}.{file_ext}"
         temp_input_path = TEMP_DIR / temp_filename
-        
-        with open(temp_input_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
-        
+        with stage("temp_write"):
+            content_hash = await save_stream(iter_upload(file), temp_input_path)
+        BYTES_RECEIVED.inc(temp_input_path.stat().st_size, endpoint="upscale_file")
         logger.info(f"Archivo recibido: {file.filename}")
+        try:
+            image_size = read_image_size(temp_input_path)
+        except OSError as e:
+            raise HTTPException(status_code=400, detail=f"Imagen inválida: {e}")
+        output_format = negotiate_output_format(http_request, format_name, quality, lossless, image_size, scale)
         
-        # Obtener servicio y procesar
-        service = get_upscale_service()
-        denoise = denoise_strength / 100.0
-        
-        future = service.upscale(
-            input_path=temp_input_path,
-            scale=scale,
-            model=model,
-            denoise_strength=denoise
-        )
+        # Consultar la caché de resultados (la clave también agrupa las peticiones en curso)
+        cache_key = service.cache_key(content_hash, model, scale, 0, engine, output_format)
+        if service.cache is not None:
+            output_path = service.cache.get(cache_key)
         
-        # Esperar resultado asíncronamente
-        output_path = await asyncio.wrap_future(future)
+        if output_path is not None:
+            logger.info(f"Resultado obtenido de caché: {output_path}")
+            status = "cached"
+        else:
+            denoise = denoise_strength / 100.0
+            
+            cancel_event = threading.Event()
+            future = service.upscale(
+                input_path=temp_input_path,
+                scale=scale,
+                model=model,
+                denoise_strength=denoise,
+                cancel_event=cancel_event,
+                priority=Priority[params.priority.upper()],
+                client_id=get_client_id(http_request),
+                deadline=deadline,
+                engine=engine,
+                key=cache_key,
+                **format_params(output_format)
+            )
+            
+            # Esperar resultado asíncronamente (cancela si el cliente se va)
+            output_path = await await_upscale(http_request, future, cancel_event, deadline)
+            
+            if service.cache is not None:
+                output_path = service.cache.put(cache_key, output_path)
+            status = "ok"
         
         # Programar limpieza
         if background_tasks:
             background_tasks.add_task(cleanup_files, temp_input_path, output_path)
+        BYTES_SENT.inc(output_path.stat().st_size, endpoint="upscale_file")
         
         # Retornar archivo
         return FileResponse(
             output_path,
-            media_type="image/png",
-            filename=f"upscaled_{file.filename}"
+            media_type=media_type_for(output_path),
+            filename=f"upscaled_{Path(file.filename).stem}{output_path.suffix}",
+            headers={"X-Engine": engine}
         )
         
-    except HTTPException:
+    except QueueFullError:
+        status = "rejected"
+        cleanup_files(temp_input_path)
+        raise
+    except ClientDisconnected:
+        status = "disconnected"
+        cleanup_files(temp_input_path)
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    except asyncio.CancelledError:
+        status = "disconnected"
+        cleanup_files(temp_input_path)
+        raise
+    except DeadlineExceeded:
+        status = "timeout"
+        cleanup_files(temp_input_path)
+        raise HTTPException(status_code=504, detail="No se pudo completar antes del plazo de la petición")
+    except (HTTPException, RequestValidationError):
+        status = "invalid"
+        cleanup_files(temp_input_path)
         raise
     except Exception as e:
         logger.error(f"Error en upscale: {str(e)}")
         
         # Limpiar archivos en caso de error
-        if temp_input_path and temp_input_path.exists():
-            temp_input_path.unlink()
-        if output_path and output_path.exists():
-            output_path.unlink()
+        cleanup_files(temp_input_path, output_path)
         
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        record_upscale("upscale_file", model, scale, status)
+
+
+@app.post("/api/upscale/batch")
+async def upscale_batch(
+    http_request: Request,
+    files: list[UploadFile] = File(default=[], description="Imágenes a reescalar"),
+    archive: Optional[UploadFile] = File(None, description="ZIP con imágenes"),
+    scale: int = Form(2),
+    model: str = Form("general"),
+    tile_size: int = Form(0),
+    engine: str = Form("auto"),
+    items: Optional[str] = Form(
+        None,
+        description="JSON opcional: lista de {scale, model, tile_size, engine} por cada archivo de 'files'"
+    )
+):
+    """
+    Reescala muchas imágenes en una sola petición (multipart o ZIP).
+    
+    Las imágenes se agrupan por (modelo, escala, tile) y cada grupo se procesa
+    con una sola invocación del motor. La respuesta es NDJSON: una línea por
+    imagen en cuanto termina (status ok/error) y una línea final con el resumen.
+    """
+    service = get_upscale_service()
+    service.scheduler.check_capacity()
+    
+    if not files and archive is None:
+        raise HTTPException(status_code=400, detail="Envía 'files' o un 'archive' ZIP")
+    if len(files) > BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"El lote supera el máximo de {BATCH_MAX_ITEMS} imágenes"
+        )
+    
+    # Parámetros por defecto y, opcionalmente, por archivo
+    try:
+        defaults = UpscaleParams(scale=scale, model=model, tile_size=tile_size, engine=engine)
+        overrides = json.loads(items) if items else []
+        if not isinstance(overrides, list):
+            raise ValueError("'items' debe ser una lista")
+        per_file = [
+            UpscaleParams.model_validate({**defaults.model_dump(), **override})
+            for override in overrides
+        ]
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"'items' inválido: {e}")
+    
+    batch = BatchRun(service, get_client_id(http_request))
+    try:
+        for index, upload in enumerate(files):
+            params = per_file[index] if index < len(per_file) else defaults
+            path = batch.staging_dir / f"{uuid.uuid4()}.upload"
+            content_hash = await save_stream(iter_upload(upload), path)
+            await batch.add_item(
+                upload.filename or f"imagen-{index}",
+                path,
+                content_hash,
+                model=params.model,
+                scale=params.scale,
+                tile_size=params.tile_size,
+                engine=service.engine_name(params.engine)
+            )
+        
+        if archive is not None:
+            archive_path = batch.staging_dir / f"{uuid.uuid4()}.zip"
+            await save_stream(iter_upload(archive), archive_path)
+            try:
+                await batch.add_archive(
+                    archive_path,
+                    BATCH_MAX_ITEMS,
+                    model=defaults.model,
+                    scale=defaults.scale,
+                    tile_size=defaults.tile_size,
+                    engine=service.engine_name(defaults.engine)
+                )
+            except zipfile.BadZipFile:
+                raise HTTPException(status_code=400, detail="El archivo no es un ZIP válido")
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            archive_path.unlink(missing_ok=True)
+    except Exception:
+        shutil.rmtree(batch.batch_dir, ignore_errors=True)
+        raise
+    
+    logger.info(f"Lote recibido: {len(batch.items)} imágenes")
+    return StreamingResponse(batch.stream(), media_type="application/x-ndjson")
+
+
+# Cada cuánto se relee un trabajo sin avisos (posición en cola, trabajos de otros procesos)
+JOB_EVENTS_POLL_INTERVAL = 1.0
+
+# Cabeceras de las respuestas SSE (sin caché ni buffering en proxies)
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def sse_event(event: str, data: dict) -> str:
+    """Serializa un evento de Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.get("/api/progress/{request_id}")
+async def stream_progress(request_id: str):
+    """
+    Progreso de un upscale síncrono como Server-Sent Events. El cliente
+    envía POST /api/upscale (o /file, /batch) con la cabecera
+    X-Request-ID: request_id y abre este stream antes o durante la petición.
+
+    Eventos: 'progress' con {"state": "pending"|"running", "percent", ...}
+    y 'done' con {"state": "completed"|"failed", "status"} al terminar.
+    Si en REQUEST_TIMEOUT no llega ninguna petición con ese ID, 'done'
+    lleva {"state": "unknown"}.
+    """
+    if not REQUEST_ID_PATTERN.match(request_id):
+        raise HTTPException(status_code=400, detail="ID de petición no válido")
+
+    async def events():
+        give_up = time.monotonic() + REQUEST_TIMEOUT
+        seen = False
+        updates = get_progress_hub().subscribe(request_id, PROGRESS_HEARTBEAT)
+        try:
+            async for state in updates:
+                if state is None:
+                    if not seen and time.monotonic() > give_up:
+                        yield sse_event("done", {"state": "unknown"})
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                seen = True
+                final = state["state"] not in ("pending", "running")
+                yield sse_event("done" if final else "progress", state)
+        finally:
+            await updates.aclose()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+async def iter_upload(file: UploadFile):
+    """Itera una subida multipart por bloques de UPLOAD_CHUNK_SIZE"""
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+@app.post(
+    "/api/jobs",
+    response_model=JobResponse,
+    status_code=202,
+    openapi_extra={
+        "requestBody": {"required": True, "content": {"application/json": {"schema": UPSCALE_REQUEST_SCHEMA}}}
+    }
+)
+async def submit_job(http_request: Request):
+    """
+    Encola un upscale y retorna el ID del trabajo de inmediato.
+    El trabajo sigue ejecutándose aunque el cliente se desconecte.
+    El cuerpo es el de /api/upscale (UpscaleRequest).
+    """
+    service = get_upscale_service()
+    manager = get_job_manager()
+    manager.check_capacity()
+    
+    body = await http_request.body()
+    decoded = await service.codec.run(decode_json_payload, body, TEMP_DIR, LARGE_IMAGE_MAX_SIZE)
+    temp_input_path = decoded.path
+    try:
+        try:
+            request = validate_decoded_request(body, decoded)
+        except ValidationError as e:
+            raise RequestValidationError(e.errors())
+        if request.preview:
+            raise HTTPException(status_code=400, detail="Las vistas previas se piden en /api/upscale")
+        if decoded.error is not None:
+            raise HTTPException(status_code=400, detail=decoded.error)
+        
+        output_format = negotiate_output_format(
+            http_request, request.format, request.quality, request.lossless, decoded.size, request.scale
+        )
+        params = {
+            "scale": request.scale,
+            "model": request.model,
+            "denoise_strength": request.denoise_strength / 100.0,
+            "tile_size": request.tile_size,
+            "engine": service.engine_name(request.engine),
+            **format_params(output_format)
+        }
+        
+        cache_key = service.cache_key(
+            decoded.content_hash, request.model, request.scale, request.tile_size, params["engine"], output_format
+        )
+        if service.cache is not None:
+            cached_path = service.cache.get(cache_key)
+            if cached_path is not None:
+                cleanup_files(temp_input_path)
+                return manager.to_dict(manager.add_completed(cached_path, **params))
+        
+        job = manager.submit(
+            temp_input_path,
+            cache_key=cache_key,
+            priority=Priority[request.priority.upper()],
+            client_id=get_client_id(http_request),
+            **params
+        )
+    except BaseException:
+        cleanup_files(temp_input_path)
+        raise
+    return manager.to_dict(job)
+
+
+@app.post("/api/previews/{preview_id}/promote", response_model=JobResponse, status_code=202)
+async def promote_preview(
+    preview_id: str,
+    http_request: Request,
+    request: Optional[PromoteRequest] = None
+):
+    """
+    Convierte una vista previa en un trabajo completo reutilizando la
+    imagen que ya se recibió y decodificó. Una vista previa solo se puede
+    promover una vez y caduca a los PREVIEW_TTL segundos.
+    """
+    service = get_upscale_service()
+    manager = get_job_manager()
+    manager.check_capacity()
+    
+    record = get_preview_store().take(preview_id, TEMP_DIR)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Vista previa no encontrada, caducada o ya promovida")
+    
+    request = request or PromoteRequest()
+    options = {**record["params"], **request.model_dump(exclude_none=True, exclude={"priority"})}
+    if options["model"] not in MODELS:
+        cleanup_files(record["input_path"])
+        raise HTTPException(status_code=400, detail=f"Modelo no válido: {options['model']}")
+    try:
+        output_format = negotiate_output_format(
+            http_request, options.get("format"), options.get("quality"), options.get("lossless", False),
+            read_image_size(record["input_path"]), options["scale"]
+        )
+    except HTTPException:
+        cleanup_files(record["input_path"])
+        raise
+    params = {
+        "scale": options["scale"],
+        "model": options["model"],
+        "denoise_strength": options["denoise_strength"] / 100.0,
+        "tile_size": options["tile_size"],
+        "engine": service.engine_name(options.get("engine", "auto")),
+        **format_params(output_format)
+    }
+    
+    cache_key = service.cache_key(
+        record["content_hash"], params["model"], params["scale"], params["tile_size"], params["engine"],
+        output_format
+    )
+    if service.cache is not None:
+        cached_path = service.cache.get(cache_key)
+        if cached_path is not None:
+            cleanup_files(record["input_path"])
+            return manager.to_dict(manager.add_completed(cached_path, **params))
+    
+    try:
+        job = manager.submit(
+            record["input_path"],
+            cache_key=cache_key,
+            priority=Priority[request.priority.upper()],
+            client_id=get_client_id(http_request),
+            **params
+        )
+    except QueueFullError:
+        cleanup_files(record["input_path"])
+        raise
+    logger.info(f"Vista previa {preview_id} promovida al trabajo {job.id}")
+    return manager.to_dict(job)
+
+
+@app.post("/api/jobs/video", response_model=JobResponse, status_code=202)
+async def submit_video_job(
+    http_request: Request,
+    file: UploadFile = File(..., description="Video a reescalar"),
+    scale: int = Form(2),
+    model: str = Form("anime-video-2x"),
+    tile_size: int = Form(0),
+    engine: str = Form("auto")
+):
+    """
+    Encola el reescalado de un video. Los frames se decodifican, reescalan
+    y codifican por bloques en paralelo, conservando el audio original.
+    El progreso (frames/s) se consulta con GET /api/jobs/{job_id}.
+    """
+    if not ffmpeg_available():
+        raise HTTPException(status_code=503, detail="ffmpeg no está instalado en el servidor")
+    check_model(model)
+    if not 1 <= scale <= 4 or tile_size < 0:
+        raise HTTPException(status_code=400, detail="Parámetros de escala o tile no válidos")
+    if not re.match(ENGINE_PATTERN, engine):
+        raise HTTPException(status_code=400, detail="Motor no válido (auto, cpu)")
+    
+    suffix = Path(file.filename or "").suffix.lower() or ".mp4"
+    temp_input_path = TEMP_DIR / f"{uuid.uuid4()}{suffix}"
+    await save_stream(iter_upload(file), temp_input_path)
+    logger.info(f"Video recibido: {file.filename}")
+    
+    manager = get_job_manager()
+    job = manager.submit_video(
+        temp_input_path,
+        client_id=get_client_id(http_request),
+        model=model,
+        scale=scale,
+        tile_size=tile_size,
+        engine=get_upscale_service().engine_name(engine)
+    )
+    return manager.to_dict(job)
+
+
+@app.get("/api/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str):
+    """Estado, posición en cola y tiempos de un trabajo"""
+    manager = get_job_manager()
+    job = manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return manager.to_dict(job)
+
+
+@app.get("/api/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    """Descarga el resultado de un trabajo completado"""
+    job = get_job_manager().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    if job.state != JobState.COMPLETED:
+        raise HTTPException(
+            status_code=409,
+            detail=f"El trabajo no está completado (estado: {job.state.value})"
+        )
+    if job.output_path is None or not job.output_path.exists():
+        raise HTTPException(status_code=410, detail="El resultado ya no está disponible")
+    
+    return FileResponse(
+        job.output_path,
+        media_type=job.media_type,
+        filename=f"upscaled_{job.id}{job.output_path.suffix}"
+    )
+
+
+@app.get("/api/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+    """
+    Estado de un trabajo como Server-Sent Events: un evento 'status' (el
+    mismo JSON que GET /api/jobs/{job_id}) cada vez que cambian su estado,
+    su posición en cola o su progreso, y 'done' con el estado final
+    """
+    manager = get_job_manager()
+    if manager.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+
+    async def events():
+        last = None
+        idle_since = time.monotonic()
+        updates = get_progress_hub().subscribe(job_channel(job_id), JOB_EVENTS_POLL_INTERVAL)
+        try:
+            while True:
+                job = manager.get(job_id)
+                if job is None:
+                    # Caducó mientras se seguía
+                    yield sse_event("done", {"job_id": job_id, "state": "expired"})
+                    return
+                # Solo los campos públicos, como en GET /api/jobs/{job_id} (response_model)
+                data = JobResponse(**manager.to_dict(job)).model_dump()
+                if job.state in FINISHED_STATES:
+                    yield sse_event("done", data)
+                    return
+                snapshot = (data["state"], data["queue_position"], data["progress"])
+                if snapshot != last:
+                    last = snapshot
+                    idle_since = time.monotonic()
+                    yield sse_event("status", data)
+                elif time.monotonic() - idle_since >= PROGRESS_HEARTBEAT:
+                    idle_since = time.monotonic()
+                    yield ": keepalive\n\n"
+                # Despierta con cada aviso del gestor de trabajos o al vencer el intervalo
+                await updates.__anext__()
+        finally:
+            await updates.aclose()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@app.delete("/api/jobs/{job_id}", response_model=JobResponse)
+async def cancel_job(job_id: str):
+    """Cancela un trabajo en cola o en ejecución (mata el proceso de Real-ESRGAN)"""
+    manager = get_job_manager()
+    job = manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return manager.to_dict(job)
+
+
+@app.get("/api/capacity")
+async def get_capacity(
+    width: int = Query(..., ge=1, description="Ancho de la imagen de entrada"),
+    height: int = Query(..., ge=1, description="Alto de la imagen de entrada"),
+    model: str = Query("general", description="Modelo a usar"),
+    scale: int = Query(2, ge=1, le=4, description="Factor de escala"),
+    priority: str = Query("interactive", pattern="^(preview|interactive|batch)$")
+):
+    """
+    Estima, sin encolar nada, si una imagen de ese tamaño se admitiría ahora
+    y cuánto tardaría (espera en cola + proceso), para que el cliente elija
+    instancia o espere antes de enviarla
+    """
+    service = get_upscale_service()
+    try:
+        estimate = service.estimate(width, height, model, scale, Priority[priority.upper()])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    headers = {}
+    if not estimate["accepted"]:
+        headers["Retry-After"] = str(max(1, math.ceil(estimate["queue_wait"])))
+    return JSONResponse(content={"width": width, "height": height, "model": model, "scale": scale, **estimate}, headers=headers)
+
+
+@app.get("/api/queue")
+async def get_queue_stats():
+    """
+    Profundidad de la cola, workers activos y tiempos de espera de este
+    proceso; con la cola compartida incluye el agregado de todos los procesos.
+    """
+    stats = get_upscale_service().scheduler.stats()
+    cluster = get_job_manager().cluster_stats()
+    if cluster is not None:
+        stats["cluster"] = cluster
+    return stats
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Métricas en formato de texto de Prometheus"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/api/cache")
+async def get_cache_stats():
+    """Retorna aciertos, fallos y ocupación de la caché de resultados"""
+    service = get_upscale_service()
+    if service.cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **service.cache.stats()}
+
+
+@app.delete("/api/cache")
+async def clear_cache():
+    """Vacía la caché de resultados"""
+    service = get_upscale_service()
+    if service.cache is not None:
+        service.cache.clear()
+    return {"status": "ok"}
 
 
 def cleanup_files(*file_paths: Path):
-    """Limpia archivos temporales de forma asíncrona"""
+    """
+    Limpia archivos temporales de forma asíncrona.
+    Los resultados que viven en la caché se conservan.
+    """
+    cache = get_upscale_service().cache
     for file_path in file_paths:
         try:
+            if cache is not None and cache.owns(file_path):
+                continue
             if file_path and file_path.exists():
                 file_path.unlink()
                 logger.debug(f"Archivo limpiado: {file_path}")
@@ -348,12 +1585,16 @@ def cleanup_files(*file_paths: Path):
 if __name__ == "__main__":
     import uvicorn
     
-    logger.info(f"Iniciando servidor en {API_HOST}:{API_PORT}")
+    if API_WORKERS > 1 and JOB_STORE != "sqlite":
+        logger.warning("Con varios procesos usa JOB_STORE=sqlite para compartir trabajos y caché")
+    
+    logger.info(f"Iniciando servidor en {API_HOST}:{API_PORT} ({API_WORKERS} procesos)")
     uvicorn.run(
         "main:app",
         host=API_HOST,
         port=API_PORT,
-        reload=API_RELOAD,
+        reload=API_RELOAD and API_WORKERS == 1,  # uvicorn no admite reload con varios workers
+        workers=API_WORKERS,
         log_level="info",
         timeout_keep_alive=900,  # 15 minutos - evita que uvicorn cierre conexiones largas
         timeout_graceful_shutdown=30  # 30 segundos para shutdown limpio
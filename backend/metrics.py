@@ -0,0 +1,376 @@
+"""
+Métricas en formato de texto de Prometheus para rIA
+Implementación mínima sin dependencias externas: contadores e histogramas
+con etiquetas que se actualizan en memoria (coste O(1) por observación) y
+colectores que leen el estado del planificador y la caché al exportar.
+"""
+
+import asyncio
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Tuple
+
+# Límites de los histogramas de latencia (segundos)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900)
+
+# Segundos durante los que se reutiliza el tamaño calculado de un directorio
+DIRECTORY_SIZE_TTL = 15.0
+
+# Muestra exportada por un colector: (nombre, tipo, ayuda, [(etiquetas, valor)])
+MetricFamily = Tuple[str, str, str, list]
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels.items():
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{key}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    """Base de las métricas con etiquetas"""
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} espera las etiquetas {self.labelnames}, recibió {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: tuple, **extra) -> dict:
+        return {**dict(zip(self.labelnames, key)), **extra}
+
+
+class Counter(_Metric):
+    """Contador monótono"""
+
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self) -> Iterable[MetricFamily]:
+        with self._lock:
+            samples = [(self._labels(key), value) for key, value in self._values.items()]
+        yield self.name, self.type, self.documentation, samples
+
+
+class Histogram(_Metric):
+    """Histograma acumulativo con límites fijos"""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [conteos por bucket (no acumulados) + desbordamiento, suma, total]
+        self._values: dict = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Mide la duración del bloque with"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self) -> Iterable[MetricFamily]:
+        with self._lock:
+            snapshot = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+
+        samples = []
+        for key, counts, total, count in snapshot:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                samples.append((self._labels(key, le=_format_value(bound)), cumulative, "_bucket"))
+            samples.append((self._labels(key), total, "_sum"))
+            samples.append((self._labels(key), count, "_count"))
+        yield self.name, self.type, self.documentation, samples
+
+
+class MetricsRegistry:
+    """Registro de métricas y colectores; genera la exposición de texto"""
+
+    def __init__(self):
+        self._metrics: list = []
+        self._collectors: list = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], Iterable[MetricFamily]]):
+        """Registra una función que genera métricas al exportar (gauges de estado)"""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self) -> str:
+        """Exposición en formato de texto de Prometheus (versión 0.0.4)"""
+        with self._lock:
+            sources = [metric.collect for metric in self._metrics] + list(self._collectors)
+
+        lines = []
+        for source in sources:
+            for name, metric_type, documentation, samples in source():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for sample in samples:
+                    labels, value = sample[0], sample[1]
+                    suffix = sample[2] if len(sample) > 2 else ""
+                    lines.append(f"{name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class DirectorySizeCache:
+    """Tamaño de directorios calculado como mucho cada DIRECTORY_SIZE_TTL segundos"""
+
+    def __init__(self, ttl: float = DIRECTORY_SIZE_TTL):
+        self.ttl = ttl
+        self._values: dict = {}
+        self._lock = threading.Lock()
+
+    def size(self, directory: Path) -> Tuple[int, int]:
+        """
+        Returns:
+            Tuple[int, int]: (bytes, número de archivos)
+        """
+        now = time.monotonic()
+        with self._lock:
+            cached = self._values.get(directory)
+            if cached is not None and now - cached[0] < self.ttl:
+                return cached[1]
+
+        result = _directory_size(directory)
+        with self._lock:
+            self._values[directory] = (now, result)
+        return result
+
+
+def _directory_size(directory: Path) -> Tuple[int, int]:
+    total = 0
+    files = 0
+    stack = [str(directory)]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+                        files += 1
+                except OSError:
+                    # El archivo desapareció mientras se recorría
+                    continue
+    return total, files
+
+
+# Registro global y métricas del camino de upscale
+REGISTRY = MetricsRegistry()
+
+HTTP_REQUESTS = REGISTRY.counter(
+    "ria_http_requests_total", "Peticiones HTTP atendidas", ("method", "route", "status")
+)
+HTTP_LATENCY = REGISTRY.histogram(
+    "ria_http_request_duration_seconds", "Duración de las peticiones HTTP", ("method", "route")
+)
+UPSCALE_REQUESTS = REGISTRY.counter(
+    "ria_upscale_requests_total",
+    "Peticiones de upscale por endpoint, modelo, escala y resultado",
+    ("endpoint", "model", "scale", "status")
+)
+STAGE_LATENCY = REGISTRY.histogram(
+    "ria_upscale_stage_duration_seconds",
+    "Duración de cada etapa del upscale (decode, temp_write, queue_wait, engine_run, format_encode, output_encode)",
+    ("stage",)
+)
+ENGINE_SECONDS = REGISTRY.counter(
+    "ria_engine_seconds_total",
+    "Segundos de ejecución del motor por resultado (useful: resultado entregado; "
+    "cancelled, deadline y failed: trabajo desperdiciado)",
+    ("outcome",)
+)
+ENGINE_PROCESS_CPU = REGISTRY.counter(
+    "ria_engine_process_cpu_seconds_total",
+    "CPU consumida por los procesos del motor (user o system, según wait4)",
+    ("mode",)
+)
+TASKS_DROPPED = REGISTRY.counter(
+    "ria_tasks_dropped_total",
+    "Tareas descartadas sin ejecutar el motor (cliente desconectado o plazo inalcanzable)",
+    ("reason",)
+)
+COALESCED_REQUESTS = REGISTRY.counter(
+    "ria_coalesced_requests_total",
+    "Peticiones que se unieron a un upscale idéntico en curso en lugar de ejecutar el motor"
+)
+EVENT_LOOP_LAG = REGISTRY.histogram(
+    "ria_event_loop_lag_seconds",
+    "Retraso del event loop al despertar una tarea periódica (CPU ejecutado en el loop)",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
+BYTES_RECEIVED = REGISTRY.counter(
+    "ria_upscale_bytes_received_total", "Bytes de imagen recibidos", ("endpoint",)
+)
+BYTES_SENT = REGISTRY.counter(
+    "ria_upscale_bytes_sent_total", "Bytes de imagen enviados", ("endpoint",)
+)
+
+
+async def watch_event_loop_lag(interval: float):
+    """
+    Duerme 'interval' segundos en bucle y registra cuánto tarda el event loop
+    en despertarla: el tiempo que otra tarea retuvo el loop sin ceder
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - start - interval))
+
+
+def service_collector(get_service: Callable, directories: dict) -> Callable[[], Iterable[MetricFamily]]:
+    """
+    Crea un colector con el estado del planificador, la caché y el tamaño
+    de los directorios de trabajo. Se evalúa solo al exportar /metrics.
+
+    Args:
+        get_service: Función que retorna el RealESRGANService
+        directories: Nombre -> ruta de los directorios a medir
+    """
+    sizes = DirectorySizeCache()
+
+    def collect() -> Iterable[MetricFamily]:
+        service = get_service()
+        queue = service.scheduler.stats()
+        yield "ria_queue_depth", "gauge", "Tareas en espera por prioridad", [
+            ({"priority": priority}, depth) for priority, depth in queue["queue_depth_by_priority"].items()
+        ]
+        yield "ria_queue_max_size", "gauge", "Capacidad de la cola", [({}, queue["max_queue_size"])]
+        yield "ria_workers", "gauge", "Workers del planificador", [({}, queue["workers"])]
+        yield "ria_workers_active", "gauge", "Workers ejecutando una tarea", [({}, queue["active_workers"])]
+        yield "ria_scheduler_tasks_total", "counter", "Tareas del planificador por resultado", [
+            ({"result": "submitted"}, queue["submitted"]),
+            ({"result": "completed"}, queue["completed"]),
+            ({"result": "rejected"}, queue["rejected"])
+        ]
+
+        devices = queue.get("devices", [])
+        if devices:
+            yield "ria_device_healthy", "gauge", "1 si el dispositivo acepta tareas", [
+                ({"device": d["name"]}, int(d["healthy"])) for d in devices
+            ]
+            yield "ria_device_queue_depth", "gauge", "Tareas en espera por dispositivo", [
+                ({"device": d["name"]}, d["queue_depth"]) for d in devices
+            ]
+            yield "ria_device_active_workers", "gauge", "Workers ocupados por dispositivo", [
+                ({"device": d["name"]}, d["active_workers"]) for d in devices
+            ]
+            yield "ria_device_failures_total", "counter", "Fallos del motor por dispositivo", [
+                ({"device": d["name"]}, d["failures"]) for d in devices
+            ]
+
+        if service.cache is not None:
+            cache = service.cache.stats()
+            yield "ria_cache_lookups_total", "counter", "Consultas a la caché de resultados", [
+                ({"result": "hit"}, cache["hits"]),
+                ({"result": "miss"}, cache["misses"])
+            ]
+            yield "ria_cache_hit_ratio", "gauge", "Proporción de aciertos de la caché", [({}, cache["hit_rate"])]
+            yield "ria_cache_evictions_total", "counter", "Entradas expulsadas de la caché", [({}, cache["evictions"])]
+            yield "ria_cache_entries", "gauge", "Entradas en la caché", [({}, cache["entries"])]
+            yield "ria_cache_size_bytes", "gauge", "Ocupación de la caché en disco", [({}, cache["size_bytes"])]
+
+        if service.inflight is not None:
+            inflight = service.inflight.stats()
+            yield "ria_inflight_upscales", "gauge", "Upscales en curso que admiten peticiones agrupadas", [
+                ({}, inflight["inflight"])
+            ]
+            yield "ria_inflight_waiters", "gauge", "Peticiones que esperan un upscale agrupado", [
+                ({}, inflight["waiters"])
+            ]
+
+        codec = service.codec.stats()
+        yield "ria_codec_pending", "gauge", "Decodificaciones y codificaciones de peticiones pendientes", [
+            ({}, codec["pending"])
+        ]
+        yield "ria_codec_rejected_total", "counter", "Peticiones rechazadas con el pool de codificación lleno", [
+            ({}, codec["rejected"])
+        ]
+
+        janitor = service.janitor.stats()
+        yield "ria_janitor_reclaimed_bytes_total", "counter", "Bytes borrados de temp/ y output/ por el janitor", [
+            ({"reason": reason}, value) for reason, value in janitor["reclaimed_bytes"].items()
+        ]
+        yield "ria_janitor_reclaimed_files_total", "counter", "Entradas borradas de temp/ y output/ por el janitor", [
+            ({"reason": reason}, value) for reason, value in janitor["reclaimed_files"].items()
+        ]
+        yield "ria_janitor_tracked_bytes", "gauge", "Ocupación de temp/ y output/ según el índice del janitor", [
+            ({}, janitor["tracked_bytes"])
+        ]
+        yield "ria_janitor_quota_bytes", "gauge", "Cuota de temp/ y output/ (0 = sin cuota)", [({}, janitor["quota_bytes"])]
+        yield "ria_janitor_pinned", "gauge", "Entradas fijadas por trabajos en curso", [({}, janitor["pinned"])]
+        yield "ria_janitor_passes_total", "counter", "Pasadas completas del janitor", [({}, janitor["passes"])]
+        yield "ria_janitor_last_pass_seconds", "gauge", "Duración de la última pasada del janitor", [
+            ({}, janitor["last_pass_seconds"])
+        ]
+
+        measured = {name: sizes.size(path) for name, path in directories.items()}
+        yield "ria_directory_size_bytes", "gauge", "Tamaño de los directorios de trabajo", [
+            ({"directory": name}, size) for name, (size, _) in measured.items()
+        ]
+        yield "ria_directory_files", "gauge", "Archivos en los directorios de trabajo", [
+            ({"directory": name}, files) for name, (_, files) in measured.items()
+        ]
+
+    return collect
@@ -0,0 +1,212 @@
+"""
+Registro de modelos disponibles
+Valida cada modelo de config.MODELS una sola vez (archivos, cabecera del
+.param de ncnn y SHA-256) y guarda la lista de disponibles en memoria, de
+modo que /health y /api/models no tocan el disco. Un hilo vigila MODELS_DIR
+y vuelve a validar solo cuando cambia su contenido.
+
+Si MODELS_DIR contiene un manifiesto SHA256SUMS (formato de sha256sum, lo
+genera setup.py al copiar los modelos) los hashes deben coincidir; sin
+manifiesto el hash se calcula y se informa, pero no se exige.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Primera línea de todo archivo .param de ncnn
+NCNN_PARAM_MAGIC = "7767517"
+
+# Manifiesto de hashes esperados dentro de MODELS_DIR
+CHECKSUM_MANIFEST = "SHA256SUMS"
+
+
+def file_sha256(path: Path) -> str:
+    """SHA-256 de un archivo leído por bloques"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_manifest(models_dir: Path) -> dict:
+    """Lee SHA256SUMS: nombre de archivo -> hash (vacío si no existe)"""
+    try:
+        lines = (models_dir / CHECKSUM_MANIFEST).read_text().splitlines()
+    except FileNotFoundError:
+        return {}
+    expected = {}
+    for line in lines:
+        parts = line.strip().split(maxsplit=1)
+        if len(parts) == 2:
+            # sha256sum marca los archivos binarios con '*'
+            expected[parts[1].lstrip("*")] = parts[0].lower()
+    return expected
+
+
+def write_manifest(models_dir: Path, filenames: list, source_dir: Optional[Path] = None):
+    """
+    Escribe SHA256SUMS en models_dir con los archivos indicados
+
+    Args:
+        source_dir: Directorio del que se calculan los hashes (por defecto
+                    models_dir); con el de origen, una copia dañada no coincide
+    """
+    source_dir = source_dir or models_dir
+    lines = [
+        f"{file_sha256(source_dir / name)}  {name}"
+        for name in sorted(set(filenames))
+        if (source_dir / name).is_file()
+    ]
+    tmp_path = models_dir / f"{CHECKSUM_MANIFEST}.tmp"
+    tmp_path.write_text("\n".join(lines) + "\n")
+    os.replace(tmp_path, models_dir / CHECKSUM_MANIFEST)
+
+
+class ModelRegistry:
+    """Disponibilidad de los modelos, validada al arrancar y al cambiar MODELS_DIR"""
+
+    def __init__(self, models_dir: Path, models: dict, requires_files: bool = True):
+        """
+        Args:
+            models_dir: Directorio con los .bin/.param
+            models: config.MODELS
+            requires_files: False si el motor no usa los pesos (todos disponibles)
+        """
+        self.models_dir = models_dir
+        self.models = models
+        self.requires_files = requires_files
+        self._lock = threading.Lock()
+        # (ruta, tamaño, mtime) -> hash: un archivo sin cambios no se vuelve a leer
+        self._checksums: dict = {}
+        self._status: dict = {}
+        self._available: list = []
+        self._signature = None
+        self._on_change: Optional[Callable[[], None]] = None
+        self._stop = threading.Event()
+        self._watcher: Optional[threading.Thread] = None
+        self.refresh()
+
+    def _directory_signature(self) -> Optional[tuple]:
+        """Nombre, tamaño y mtime de cada archivo (un solo listado del directorio)"""
+        try:
+            with os.scandir(self.models_dir) as entries:
+                return tuple(sorted(
+                    (entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+                    for entry in entries if entry.is_file()
+                ))
+        except FileNotFoundError:
+            return None
+
+    def _checksum(self, path: Path) -> str:
+        stat = path.stat()
+        key = (str(path), stat.st_size, stat.st_mtime_ns)
+        checksum = self._checksums.get(key)
+        if checksum is None:
+            checksum = self._checksums[key] = file_sha256(path)
+        return checksum
+
+    def _validate(self, model_info: dict, expected: dict) -> dict:
+        """Estado de un modelo: {"available", "error", "sha256"}"""
+        if not self.requires_files:
+            return {"available": True, "error": None, "sha256": None}
+
+        bin_path = self.models_dir / model_info["filename"]
+        param_path = self.models_dir / model_info["param_filename"]
+        missing = [path.name for path in (bin_path, param_path) if not path.is_file()]
+        if missing:
+            return {"available": False, "error": f"Faltan: {', '.join(missing)}", "sha256": None}
+
+        try:
+            with open(param_path, encoding="utf-8", errors="replace") as f:
+                if f.readline().strip() != NCNN_PARAM_MAGIC:
+                    return {"available": False, "error": f"{param_path.name} no es un .param de ncnn", "sha256": None}
+            if bin_path.stat().st_size == 0:
+                return {"available": False, "error": f"{bin_path.name} está vacío", "sha256": None}
+
+            checksums = {path.name: self._checksum(path) for path in (bin_path, param_path)}
+        except OSError as e:
+            return {"available": False, "error": str(e), "sha256": None}
+
+        for name, checksum in checksums.items():
+            if name in expected and expected[name] != checksum:
+                return {"available": False, "error": f"SHA-256 de {name} no coincide con {CHECKSUM_MANIFEST}", "sha256": checksum}
+        return {"available": True, "error": None, "sha256": checksums[bin_path.name]}
+
+    def refresh(self) -> bool:
+        """
+        Valida de nuevo los modelos si MODELS_DIR cambió
+
+        Returns:
+            bool: True si cambió el estado de algún modelo
+        """
+        signature = self._directory_signature()
+        if signature == self._signature and self._status:
+            return False
+
+        expected = read_manifest(self.models_dir) if self.requires_files else {}
+        status = {model_id: self._validate(info, expected) for model_id, info in self.models.items()}
+        available = [
+            {
+                "id": model_id,
+                "name": info["name"],
+                "description": info["description"],
+                "scale": info["scale"]
+            }
+            for model_id, info in self.models.items()
+            if status[model_id]["available"]
+        ]
+
+        with self._lock:
+            previous = self._status
+            changed = status != previous
+            self._signature = signature
+            self._status = status
+            self._available = available
+
+        if changed:
+            for model_id, state in status.items():
+                if state["error"] is not None and previous.get(model_id) != state:
+                    logger.warning(f"Modelo '{model_id}' no disponible: {state['error']}")
+            logger.info(f"Modelos disponibles: {[m['id'] for m in available]}")
+        return changed
+
+    def available(self) -> list:
+        """Modelos disponibles (sin acceder al disco)"""
+        with self._lock:
+            return [dict(model) for model in self._available]
+
+    def status(self) -> dict:
+        """Estado de validación por modelo"""
+        with self._lock:
+            return {model_id: dict(state) for model_id, state in self._status.items()}
+
+    def start_watch(self, interval: float, on_change: Optional[Callable[[], None]] = None):
+        """
+        Revisa MODELS_DIR cada 'interval' segundos en un hilo y valida de
+        nuevo al detectar cambios; on_change se invoca tras cada cambio
+        """
+        if interval <= 0 or self._watcher is not None:
+            return
+        self._on_change = on_change
+        self._watcher = threading.Thread(
+            target=self._watch_loop, args=(interval,), name="models-watch", daemon=True
+        )
+        self._watcher.start()
+
+    def _watch_loop(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                if self.refresh() and self._on_change is not None:
+                    self._on_change()
+            except Exception as e:
+                logger.warning(f"Error revisando {self.models_dir}: {e}")
+
+    def stop_watch(self):
+        self._stop.set()
@@ -0,0 +1,282 @@
+"""
+Vista previa rápida para la interfaz
+Recorta la región pedida (o toma la imagen entera), la reduce para que el
+motor procese pocos píxeles y añade un margen de contexto que se descarta
+tras el upscale, de modo que los bordes de la región no muestren costuras.
+La entrada original se conserva un tiempo para promover la vista previa a
+un trabajo completo sin volver a subir ni decodificar la imagen.
+"""
+
+import json
+import logging
+import math
+import os
+import re
+import time
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Tuple
+
+from PIL import Image
+
+from config import MAX_IMAGE_SIZE, PREVIEW_DIR, PREVIEW_TTL
+from large_image import DECODE_BUFFER_MODES, decode_rows
+
+logger = logging.getLogger(__name__)
+
+# Los tiles del motor se redondean a múltiplos de este tamaño
+TILE_ALIGN = 32
+
+# Filas de salida por banda al reducir una región grande
+REDUCE_BAND_ROWS = 16
+
+# Los IDs de vista previa son uuid4 en hexadecimal (nunca rutas)
+PREVIEW_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+Region = Tuple[int, int, int, int]
+
+
+def parse_region(value: str) -> Region:
+    """Convierte "x,y,w,h" en una tupla de enteros"""
+    try:
+        x, y, w, h = (int(part) for part in value.split(","))
+    except ValueError:
+        raise ValueError("La región debe tener el formato x,y,w,h")
+    return x, y, w, h
+
+
+def validate_region(region: Optional[Region], size: Tuple[int, int]) -> Region:
+    """
+    Comprueba que la región cabe en la imagen
+
+    Returns:
+        Region: La región o, si es None, la imagen entera
+
+    Raises:
+        ValueError: Si la región está vacía o se sale de la imagen
+    """
+    width, height = size
+    if region is None:
+        return 0, 0, width, height
+    x, y, w, h = region
+    if w <= 0 or h <= 0 or x < 0 or y < 0 or x + w > width or y + h > height:
+        raise ValueError(f"La región {x},{y},{w},{h} queda fuera de la imagen ({width}x{height})")
+    return region
+
+
+@dataclass
+class PreviewPlan:
+    """Entrada preparada para el motor y cómo recortar su salida"""
+    input_path: Path
+    region: Region
+    # Reducción aplicada antes del motor respecto a la imagen original (<= 1)
+    factor: float
+    # Parte de la entrada del motor que corresponde a la región (sin el margen)
+    keep_box: Tuple[int, int, int, int]
+    size: Tuple[int, int]
+
+    @property
+    def tile_size(self) -> int:
+        """Tile que cubre la entrada entera: el motor no parte la vista previa"""
+        return TILE_ALIGN * math.ceil(max(self.size) / TILE_ALIGN)
+
+
+@dataclass
+class PreviewResult:
+    """Vista previa generada"""
+    output_path: Path
+    region: Region
+    factor: float
+
+
+def plan_preview(
+    input_path: Path,
+    region: Optional[Region],
+    max_side: int,
+    padding: int,
+    directory: Path
+) -> PreviewPlan:
+    """
+    Recorta y reduce la imagen para la vista previa
+
+    Args:
+        input_path: Imagen original
+        region: Región (x, y, w, h) en píxeles de la original; None = entera
+        max_side: Lado mayor de la región tras reducirla
+        padding: Margen de contexto (píxeles tras reducir) alrededor de la región
+        directory: Dónde escribir la entrada del motor
+
+    Returns:
+        PreviewPlan: Entrada del motor y caja a conservar de su salida
+    """
+    with Image.open(input_path) as image:
+        original_size = image.size
+        target = validate_region(region, original_size)
+
+        # El JPEG se decodifica ya reducido (escalado DCT) a lo justo para la región
+        ratio = max_side / max(target[2], target[3])
+        if ratio < 1:
+            image.draft("RGB", (math.ceil(original_size[0] * ratio), math.ceil(original_size[1] * ratio)))
+        drafted = image.size[0] / original_size[0]
+        x, y, w, h = (round(v * drafted) for v in target)
+        width, height = image.size
+
+        scale = min(1.0, max_side / max(w, h))
+        margin = math.ceil(padding / scale)
+        left, top = max(0, x - margin), max(0, y - margin)
+        right, bottom = min(width, x + w + margin), min(height, y + h + margin)
+        size = (max(1, round((right - left) * scale)), max(1, round((bottom - top) * scale)))
+
+        decoded_path = None
+        if image.format == "PNG":
+            # Solo se decodifican las filas hasta la región y, en imágenes
+            # enormes, sobre un array en disco en lugar de en memoria
+            if image.mode in DECODE_BUFFER_MODES and width * bottom > MAX_IMAGE_SIZE * MAX_IMAGE_SIZE:
+                decoded_path = directory / f"{uuid.uuid4()}.npy"
+            decode_rows(image, bottom, decoded_path)
+        try:
+            crop = _reduced_crop(image, (left, top, right, bottom), size)
+        finally:
+            if decoded_path is not None:
+                decoded_path.unlink(missing_ok=True)
+
+        path = directory / f"{uuid.uuid4()}.png"
+        crop.save(path, "PNG", compress_level=1)
+
+    keep_box = (
+        round((x - left) * scale),
+        round((y - top) * scale),
+        min(size[0], round((x - left + w) * scale)),
+        min(size[1], round((y - top + h) * scale))
+    )
+    return PreviewPlan(path, target, drafted * scale, keep_box, size)
+
+
+def _reduced_crop(image: Image.Image, box: Tuple[int, int, int, int], size: Tuple[int, int]) -> Image.Image:
+    """
+    Recorta 'box' y lo lleva a 'size' en RGB o RGBA. Si la caja es varias
+    veces mayor se reduce antes por bandas de filas (Image.reduce), así nunca
+    se copia entera
+    """
+    left, top, right, bottom = box
+    mode = "RGBA" if "A" in image.getbands() else "RGB"
+    factor = max(1, min((right - left) // size[0], (bottom - top) // size[1]))
+    if factor == 1:
+        crop = image.crop(box)
+        if crop.mode != mode:
+            crop = crop.convert(mode)
+    else:
+        crop = Image.new(mode, (math.ceil((right - left) / factor), math.ceil((bottom - top) / factor)))
+        step = factor * REDUCE_BAND_ROWS
+        for y0 in range(top, bottom, step):
+            band = image.crop((left, y0, right, min(bottom, y0 + step)))
+            if band.mode != mode:
+                band = band.convert(mode)
+            crop.paste(band.reduce(factor), (0, (y0 - top) // factor))
+    if size != crop.size:
+        crop = crop.resize(size, Image.Resampling.LANCZOS)
+    return crop
+
+
+def finish_preview(engine_output: Path, plan: PreviewPlan, scale: int, directory: Path) -> PreviewResult:
+    """Quita de la salida del motor el margen de contexto"""
+    left, top, right, bottom = plan.keep_box
+    with Image.open(engine_output) as image:
+        # El motor escala por 'scale'; se mide por si el modelo usa otro factor
+        ratio = image.size[0] / plan.size[0] if plan.size[0] else scale
+        box = tuple(round(v * ratio) for v in (left, top, right, bottom))
+        output_path = directory / f"{uuid.uuid4()}.png"
+        image.crop(box).save(output_path, "PNG", compress_level=1)
+    return PreviewResult(output_path, plan.region, plan.factor)
+
+
+class PreviewStore:
+    """
+    Entradas de vistas previas pendientes de promover, en disco: un JSON y la
+    imagen por vista previa. Al estar en disco cualquier proceso de la API
+    puede promoverla; el JSON se reclama con un rename atómico.
+    """
+
+    def __init__(self, directory: Path, ttl: int):
+        self.directory = directory
+        self.ttl = ttl
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def put(self, input_path: Path, content_hash: str, params: dict) -> str:
+        """
+        Guarda la entrada de una vista previa (se mueve, no se copia)
+
+        Returns:
+            str: ID para promoverla
+        """
+        preview_id = uuid.uuid4().hex
+        stored = self.directory / f"{preview_id}{input_path.suffix}"
+        os.replace(input_path, stored)
+
+        record = {
+            "input": stored.name,
+            "content_hash": content_hash,
+            "params": params,
+            "created_at": time.time()
+        }
+        tmp_path = self.directory / f"{preview_id}.json.tmp"
+        tmp_path.write_text(json.dumps(record))
+        os.replace(tmp_path, self.directory / f"{preview_id}.json")
+        return preview_id
+
+    def take(self, preview_id: str, destination: Path) -> Optional[dict]:
+        """
+        Reclama una vista previa y mueve su entrada a 'destination'
+
+        Returns:
+            Optional[dict]: {"input_path", "content_hash", "params"} o None si
+                no existe, caducó o ya se promovió
+        """
+        if not PREVIEW_ID_PATTERN.match(preview_id):
+            return None
+        claimed = self.directory / f"{preview_id}.{uuid.uuid4().hex}.claimed"
+        try:
+            os.replace(self.directory / f"{preview_id}.json", claimed)
+        except FileNotFoundError:
+            return None
+
+        try:
+            record = json.loads(claimed.read_text())
+        finally:
+            claimed.unlink(missing_ok=True)
+
+        stored = self.directory / record["input"]
+        if time.time() - record["created_at"] > self.ttl:
+            stored.unlink(missing_ok=True)
+            return None
+
+        input_path = destination / f"{uuid.uuid4()}{stored.suffix}"
+        try:
+            os.replace(stored, input_path)
+        except FileNotFoundError:
+            return None
+        return {**record, "input_path": input_path}
+
+    def sweep(self):
+        """Elimina las vistas previas caducadas (en cada pasada del janitor)"""
+        limit = time.time() - self.ttl
+        for path in self.directory.iterdir():
+            try:
+                if path.stat().st_mtime < limit:
+                    path.unlink()
+            except OSError:
+                # Otro proceso la reclamó o la borró a la vez
+                pass
+
+
+# Instancia global del almacén
+_store_instance: Optional[PreviewStore] = None
+
+
+def get_preview_store() -> PreviewStore:
+    """Obtiene el almacén de vistas previas (singleton)"""
+    global _store_instance
+    if _store_instance is None:
+        _store_instance = PreviewStore(PREVIEW_DIR, PREVIEW_TTL)
+    return _store_instance
@@ -0,0 +1,312 @@
+"""
+Progreso de los upscales en curso
+realesrgan-ncnn-vulkan escribe en stderr una línea "xx.xx%" por cada tile
+que termina. run_process (engines.py) lee stderr línea a línea y pasa el
+avance al informador del contexto actual, que fija quien encola la tarea
+con reporting(). Las tareas del planificador se ejecutan en una copia del
+contexto de quien las encoló (como las trazas), así que el avance llega sin
+pasar callbacks por toda la cadena de llamadas.
+
+El informador limita las actualizaciones a una cada PROGRESS_MIN_INTERVAL
+(salvo la del final de cada imagen): el motor puede escribir cientos de
+líneas por segundo y cada actualización despierta el event loop o escribe
+en la base de datos de trabajos.
+
+Con un directorio de entrada el motor avisa además de cada salida escrita
+(en el binario, las líneas "entrada -> salida done" de -v) a quien escuche
+con reporting_outputs(); así el lote emite cada imagen en cuanto termina.
+
+ProgressHub guarda el último estado de cada canal (una petición por su
+X-Request-ID o un trabajo) y despierta a los clientes de los endpoints SSE
+cuando cambia.
+"""
+
+import asyncio
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import AsyncIterator, Callable, Optional
+
+from config import PROGRESS_MIN_INTERVAL, PROGRESS_RETENTION
+
+logger = logging.getLogger(__name__)
+
+# Línea de progreso del binario (p. ej. "37.50%")
+PROGRESS_PATTERN = re.compile(r"^\s*(\d{1,3}(?:[.,]\d+)?)%\s*$")
+
+# Salida escrita por el binario con -v (p. ej. "in/00001.png -> out/00001.png done")
+OUTPUT_DONE_PATTERN = re.compile(r"^(.+) -> (.+) done\s*$")
+
+_reporter: ContextVar[Optional["ProgressReporter"]] = ContextVar("ria_progress_reporter", default=None)
+_output_listener: ContextVar[Optional[Callable[[Path], None]]] = ContextVar("ria_output_listener", default=None)
+
+
+def parse_progress(line: str) -> Optional[float]:
+    """Porcentaje de una línea de stderr del motor, o None si no es de progreso"""
+    match = PROGRESS_PATTERN.match(line)
+    if match is None:
+        return None
+    return min(100.0, float(match.group(1).replace(",", ".")))
+
+
+def parse_output_done(line: str) -> Optional[Path]:
+    """Salida terminada según una línea de stderr del motor, o None si no lo indica"""
+    match = OUTPUT_DONE_PATTERN.match(line)
+    if match is None:
+        return None
+    return Path(match.group(2))
+
+
+class ProgressReporter:
+    """Reenvía el avance a un callback como mucho una vez cada min_interval"""
+
+    def __init__(self, callback: Callable[[dict], None], min_interval: float = PROGRESS_MIN_INTERVAL):
+        self.callback = callback
+        self.min_interval = min_interval
+        self._last = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self, progress: dict, force: bool = False):
+        """
+        Args:
+            progress: Avance ({"percent", ...})
+            force: Reenviar aunque no haya pasado min_interval (fin de una etapa)
+        """
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last < self.min_interval:
+                return
+            self._last = now
+        try:
+            self.callback(progress)
+        except Exception as e:
+            # Lo invoca el lector de stderr del motor: un fallo aquí no debe detenerlo
+            logger.warning(f"No se pudo publicar el progreso: {e}")
+
+
+class EngineProgress:
+    """
+    Avance de una invocación del motor. Con un directorio de entrada el
+    binario procesa las imágenes una tras otra y el porcentaje vuelve a
+    empezar en cada una; se combina en un avance total.
+    """
+
+    def __init__(self, reporter: ProgressReporter, images: int = 1):
+        self.reporter = reporter
+        self.images = max(1, images)
+        self.images_done = 0
+        self._last = 0.0
+
+    def update(self, percent: float):
+        if percent < self._last:
+            # Empezó la siguiente imagen
+            self.images_done = min(self.images_done + 1, self.images - 1)
+        self._last = percent
+        self.reporter({
+            "percent": round((self.images_done + percent / 100) / self.images * 100, 2),
+            "images_done": self.images_done + (1 if percent >= 100 else 0),
+            "images": self.images
+        }, force=percent >= 100)
+
+
+class ProgressFanout:
+    """
+    Reparte el avance de una tarea entre varios informadores (peticiones
+    agrupadas en una misma ejecución, ver singleflight.py). Quien se añade
+    tarde recibe enseguida el último avance.
+    """
+
+    def __init__(self):
+        self._reporters: list = []
+        self._last: Optional[dict] = None
+        self._lock = threading.Lock()
+
+    def add(self, reporter: ProgressReporter):
+        with self._lock:
+            self._reporters.append(reporter)
+            last = self._last
+        if last is not None:
+            reporter(last, force=True)
+
+    def remove(self, reporter: ProgressReporter):
+        with self._lock:
+            if reporter in self._reporters:
+                self._reporters.remove(reporter)
+
+    def __call__(self, progress: dict, force: bool = False):
+        with self._lock:
+            self._last = progress
+            reporters = list(self._reporters)
+        for reporter in reporters:
+            # Cada informador aplica su propio min_interval
+            reporter(progress, force)
+
+
+@contextmanager
+def reporting_to(reporter: Optional[Callable[..., None]]):
+    """Como reporting(), con un informador ya creado (ProgressReporter o ProgressFanout)"""
+    token = _reporter.set(reporter)
+    try:
+        yield
+    finally:
+        _reporter.reset(token)
+
+
+def reporting(callback: Optional[Callable[[dict], None]]):
+    """
+    Envía a 'callback' el avance de las tareas encoladas dentro del bloque.
+    Con None las tareas no informan (p. ej. los tiles de una imagen grande,
+    cuyo avance se cuenta por tiles terminados).
+    """
+    return reporting_to(ProgressReporter(callback) if callback is not None else None)
+
+
+def current_reporter() -> Optional[ProgressReporter]:
+    return _reporter.get()
+
+
+@contextmanager
+def reporting_outputs(listener: Optional[Callable[[Path], None]]):
+    """
+    Envía a 'listener' cada salida que terminen de escribir los lotes
+    encolados dentro del bloque. Se llama desde el hilo del motor.
+    """
+    token = _output_listener.set(listener)
+    try:
+        yield
+    finally:
+        _output_listener.reset(token)
+
+
+def current_output_listener() -> Optional[Callable[[Path], None]]:
+    return _output_listener.get()
+
+
+class _Channel:
+    __slots__ = ("state", "version", "finished", "updated", "waiters")
+
+    def __init__(self):
+        self.state: Optional[dict] = None
+        self.version = 0
+        self.finished = False
+        self.updated = time.monotonic()
+        # (loop, asyncio.Event) de cada cliente suscrito
+        self.waiters: set = set()
+
+
+class ProgressHub:
+    """Último estado de cada canal de progreso y aviso a sus suscriptores"""
+
+    def __init__(self, retention: float = PROGRESS_RETENTION):
+        """
+        Args:
+            retention: Segundos que se conserva un canal sin cambios ni
+                       suscriptores (el cliente puede conectarse tarde)
+        """
+        self.retention = retention
+        self._channels: dict = {}
+        self._lock = threading.Lock()
+
+    def _channel_locked(self, key: str) -> _Channel:
+        channel = self._channels.get(key)
+        if channel is None:
+            now = time.monotonic()
+            for old_key in [
+                old_key for old_key, old in self._channels.items()
+                if not old.waiters and now - old.updated > self.retention
+            ]:
+                del self._channels[old_key]
+            channel = self._channels[key] = _Channel()
+        return channel
+
+    def start(self, key: str, state: dict):
+        """Abre un canal con su estado inicial (lo reabre si se reutiliza el ID)"""
+        with self._lock:
+            self._channel_locked(key).finished = False
+        self.publish(key, state)
+
+    def publish(self, key: str, state: dict, final: bool = False):
+        """
+        Actualiza el estado de un canal (desde cualquier hilo)
+
+        Args:
+            final: El canal no admite más cambios (petición o trabajo terminado)
+        """
+        with self._lock:
+            channel = self._channel_locked(key)
+            if channel.finished:
+                return
+            channel.state = dict(state)
+            channel.version += 1
+            channel.finished = final
+            channel.updated = time.monotonic()
+            waiters = list(channel.waiters)
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def notify(self, key: str):
+        """Despierta a los suscriptores sin cambiar el estado (p. ej. el trabajo cambió de estado)"""
+        with self._lock:
+            channel = self._channels.get(key)
+            waiters = list(channel.waiters) if channel is not None else []
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def finish(self, key: str, state: dict):
+        """Publica el estado final de un canal si alguien lo creó (publicó o se suscribió)"""
+        with self._lock:
+            if key not in self._channels:
+                return
+        self.publish(key, state, final=True)
+
+    async def subscribe(self, key: str, timeout: float) -> AsyncIterator[Optional[dict]]:
+        """
+        Produce el estado del canal cada vez que cambia (el actual primero,
+        si hay) y termina tras el estado final. Produce None si pasan
+        'timeout' segundos sin cambios o se llama a notify().
+        """
+        loop = asyncio.get_running_loop()
+        waiter = (loop, asyncio.Event())
+        with self._lock:
+            channel = self._channel_locked(key)
+            channel.waiters.add(waiter)
+        seen = 0
+        try:
+            while True:
+                waiter[1].clear()
+                with self._lock:
+                    version, state, finished = channel.version, channel.state, channel.finished
+                if version != seen:
+                    seen = version
+                    yield dict(state)
+                    if finished:
+                        return
+                    continue
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                with self._lock:
+                    changed = channel.version != seen
+                if not changed:
+                    yield None
+        finally:
+            with self._lock:
+                channel.waiters.discard(waiter)
+                channel.updated = time.monotonic()
+
+
+# Instancia global
+_progress_hub: Optional[ProgressHub] = None
+
+
+def get_progress_hub() -> ProgressHub:
+    """Obtiene el hub de progreso (singleton)"""
+    global _progress_hub
+    if _progress_hub is None:
+        _progress_hub = ProgressHub()
+    return _progress_hub
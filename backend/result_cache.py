@@ -0,0 +1,249 @@
+"""
+Caché de resultados direccionada por contenido
+Guarda en disco las imágenes ya reescaladas, indexadas por el hash de los
+bytes de entrada y de los parámetros de procesamiento, con límite de tamaño
+y expulsión LRU.
+
+Quien consulta o guarda un resultado recibe un enlace duro propio fuera de
+la caché, no el archivo de la caché: la expulsión solo borra el nombre de
+la caché, y una descarga en curso o un trabajo que apunta al resultado
+conservan el contenido hasta que borran su enlace.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    """Caché LRU en disco para resultados de upscale"""
+
+    def __init__(self, cache_dir: Path, max_bytes: int, link_dir: Path, shared: bool = False):
+        """
+        Args:
+            cache_dir: Directorio de la caché
+            max_bytes: Ocupación máxima en disco
+            link_dir: Directorio de los enlaces que retorna get (normalmente OUTPUT_DIR)
+            shared: Otros procesos escriben en el mismo directorio; los fallos
+                del índice en memoria se comprueban también en disco
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.link_dir = link_dir
+        self.shared = shared
+        self.cache_dir.mkdir(exist_ok=True)
+
+        self._lock = threading.Lock()
+        # key -> (ruta, tamaño en bytes), ordenado de menos a más reciente
+        self._entries: "OrderedDict[str, tuple[Path, int]]" = OrderedDict()
+        self._total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._load_index()
+
+    @staticmethod
+    def content_hash(data: bytes) -> str:
+        """Hash SHA-256 de los bytes de entrada"""
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def make_key(
+        content_hash: str,
+        model: str,
+        scale: int,
+        tile_size: int,
+        engine_version: str,
+        output_format: str = "png"
+    ) -> str:
+        """
+        Calcula la clave de caché para una imagen y sus parámetros
+
+        Args:
+            content_hash: Hash SHA-256 de los bytes originales de la imagen
+            model: ID del modelo
+            scale: Factor de escala
+            tile_size: Tamaño de tile solicitado
+            engine_version: Huella del binario de Real-ESRGAN
+            output_format: Formato del resultado (encoder.OutputFormat.key)
+
+        Returns:
+            str: Hash hexadecimal SHA-256
+        """
+        key = f"{content_hash}|{model}|{scale}|{tile_size}|{engine_version}"
+        if output_format != "png":
+            # Las claves de PNG no cambian: las entradas ya guardadas siguen valiendo
+            key += f"|{output_format}"
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _load_index(self):
+        """Reconstruye el índice a partir de los archivos existentes en disco"""
+        files = []
+        for file_path in self.cache_dir.glob("*"):
+            if file_path.name.startswith("."):
+                # Restos de un put interrumpido
+                file_path.unlink(missing_ok=True)
+            elif file_path.is_file():
+                stat = file_path.stat()
+                files.append((stat.st_mtime, file_path, stat.st_size))
+
+        # El mtime se actualiza en cada acierto, así que sirve como orden LRU
+        for _, file_path, size in sorted(files):
+            self._entries[file_path.stem] = (file_path, size)
+            self._total_bytes += size
+
+        self._evict_locked()
+        logger.info(
+            f"Caché de resultados: {len(self._entries)} entradas, "
+            f"{self._total_bytes / (1024 * 1024):.1f} MB"
+        )
+
+    def get(self, key: str) -> Optional[Path]:
+        """
+        Busca un resultado en caché
+
+        Returns:
+            Optional[Path]: Enlace al resultado en link_dir (lo borra quien lo
+                recibe) o None si no está en caché
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self.shared:
+                entry = self._adopt_locked(key)
+            if entry is None or not entry[0].exists():
+                if entry is not None:
+                    # El archivo desapareció de disco: descartar la entrada
+                    self._entries.pop(key)
+                    self._total_bytes -= entry[1]
+                self.misses += 1
+                return None
+
+            path = entry[0]
+            try:
+                # Bajo el lock: la expulsión no puede borrarlo antes de enlazarlo
+                link = _link(path, self.link_dir / f"{uuid.uuid4()}{path.suffix}")
+            except OSError:
+                self._entries.pop(key)
+                self._total_bytes -= entry[1]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        try:
+            now = time.time()
+            os.utime(path, (now, now))
+        except OSError:
+            pass
+        return link
+
+    def _adopt_locked(self, key: str) -> Optional[tuple]:
+        """Incorpora al índice un resultado que otro proceso dejó en disco"""
+        for file_path in self.cache_dir.glob(f"{key}.*"):
+            try:
+                entry = (file_path, file_path.stat().st_size)
+            except OSError:
+                continue
+            self._entries[key] = entry
+            self._total_bytes += entry[1]
+            self._evict_locked(keep=key)
+            return entry
+        return None
+
+    def put(self, key: str, source_path: Path) -> Path:
+        """
+        Guarda en la caché un resultado recién generado
+
+        Args:
+            key: Clave calculada con make_key
+            source_path: Archivo de salida generado por Real-ESRGAN
+
+        Returns:
+            Path: source_path, que sigue siendo de quien lo guardó (la caché
+                conserva su propio enlace)
+        """
+        dest_path = self.cache_dir / f"{key}{source_path.suffix}"
+        staging = _link(source_path, self.cache_dir / f".{uuid.uuid4()}{source_path.suffix}")
+        os.replace(staging, dest_path)
+        # rename() no hace nada si los dos nombres son enlaces del mismo archivo
+        # (peticiones agrupadas que guardan el mismo resultado, ver singleflight.py)
+        staging.unlink(missing_ok=True)
+        size = dest_path.stat().st_size
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._total_bytes -= previous[1]
+            self._entries[key] = (dest_path, size)
+            self._total_bytes += size
+            self._evict_locked(keep=key)
+
+        return source_path
+
+    def _evict_locked(self, keep: Optional[str] = None):
+        """Expulsa entradas LRU hasta respetar el límite (requiere el lock)"""
+        while self._total_bytes > self.max_bytes and self._entries:
+            key = next(iter(self._entries))
+            if key == keep:
+                # Nunca expulsar la entrada que se acaba de insertar
+                if len(self._entries) == 1:
+                    break
+                self._entries.move_to_end(key)
+                continue
+
+            path, size = self._entries.pop(key)
+            self._total_bytes -= size
+            self.evictions += 1
+            try:
+                path.unlink()
+            except OSError as e:
+                logger.warning(f"No se pudo eliminar entrada de caché {path}: {e}")
+
+    def owns(self, path: Path) -> bool:
+        """Indica si una ruta pertenece a la caché (no debe borrarse tras responder)"""
+        return path is not None and path.parent == self.cache_dir
+
+    def clear(self):
+        """Vacía la caché por completo"""
+        with self._lock:
+            for path, _ in self._entries.values():
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def stats(self) -> dict:
+        """Retorna contadores y ocupación de la caché"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+def _link(source: Path, target: Path) -> Path:
+    """Enlace duro de 'source' en 'target' (copia si el sistema no los admite)"""
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+    return target
@@ -0,0 +1,371 @@
+"""
+Planificador de tareas de upscale con cola acotada y prioridades
+Sustituye al ThreadPoolExecutor sin límite: rechaza trabajo cuando la cola
+está llena, atiende primero las peticiones interactivas y reparte los
+workers de forma equitativa entre clientes. Las vistas previas tienen un
+carril rápido con cola y workers propios.
+"""
+
+import contextvars
+import logging
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, Callable, Optional
+
+from metrics import TASKS_DROPPED
+from tracing import observe_stage
+
+logger = logging.getLogger(__name__)
+
+# Tiempo de ejecución asumido antes de tener mediciones reales (segundos)
+DEFAULT_RUN_TIME_ESTIMATE = 10.0
+# Peso de la última medición en la media móvil exponencial
+EMA_ALPHA = 0.2
+# Número de esperas recientes usadas para los percentiles
+WAIT_WINDOW = 200
+
+
+class Priority(IntEnum):
+    """Clases de prioridad (menor valor = se atiende antes)"""
+    PREVIEW = -1  # Carril rápido: cola propia y workers reservados
+    INTERACTIVE = 0
+    BATCH = 1
+
+
+class QueueFullError(Exception):
+    """La cola está llena; el cliente debe reintentar más tarde"""
+
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(
+            f"Cola de procesamiento llena. Reintenta en {math.ceil(retry_after)}s"
+        )
+
+
+@dataclass
+class _Task:
+    fn: Callable
+    args: tuple
+    kwargs: dict
+    future: Future
+    priority: Priority
+    client_id: str
+    enqueued_at: float = field(default_factory=time.monotonic)
+    # Contexto de quien encoló la tarea (traza de la petición); la tarea se ejecuta en él
+    context: contextvars.Context = field(default_factory=contextvars.copy_context)
+
+
+class _FairQueue:
+    """Cola round-robin por cliente dentro de una clase de prioridad"""
+
+    def __init__(self):
+        self.by_client: dict[str, deque] = {}
+        self.turns: deque = deque()
+
+    def __len__(self) -> int:
+        return sum(len(tasks) for tasks in self.by_client.values())
+
+    def push(self, task: _Task):
+        tasks = self.by_client.get(task.client_id)
+        if tasks is None:
+            tasks = self.by_client[task.client_id] = deque()
+            self.turns.append(task.client_id)
+        tasks.append(task)
+
+    def remove(self, task: _Task) -> bool:
+        """Quita una tarea concreta de la cola; False si ya no estaba"""
+        tasks = self.by_client.get(task.client_id)
+        if tasks is None:
+            return False
+        try:
+            tasks.remove(task)
+        except ValueError:
+            return False
+        if not tasks:
+            del self.by_client[task.client_id]
+            self.turns.remove(task.client_id)
+        return True
+
+    def pop(self) -> Optional[_Task]:
+        if not self.turns:
+            return None
+        client_id = self.turns.popleft()
+        tasks = self.by_client[client_id]
+        task = tasks.popleft()
+        if tasks:
+            # El cliente vuelve al final de la ronda
+            self.turns.append(client_id)
+        else:
+            del self.by_client[client_id]
+        return task
+
+    def tasks(self):
+        for tasks in self.by_client.values():
+            yield from tasks
+
+
+class PriorityScheduler:
+    """Pool de workers con cola acotada, prioridades y reparto justo"""
+
+    def __init__(
+        self,
+        max_workers: int,
+        max_queue_size: int,
+        preview_workers: int = 0,
+        preview_queue_size: int = 0
+    ):
+        """
+        Args:
+            max_workers: Workers que atienden todas las clases de prioridad
+            max_queue_size: Tareas en espera (sin contar vistas previas)
+            preview_workers: Workers adicionales que solo atienden vistas previas
+            preview_queue_size: Vistas previas en espera (0 = max_queue_size)
+        """
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.preview_workers = preview_workers
+        self.preview_queue_size = preview_queue_size or max_queue_size
+
+        self._queues = {priority: _FairQueue() for priority in Priority}
+        # Las vistas previas se cuentan aparte: no ocupan la cola ni las
+        # estimaciones del trabajo normal
+        self._queued = 0
+        self._running = 0
+        self._queued_preview = 0
+        self._running_preview = 0
+        self._shutdown = False
+        self._cond = threading.Condition()
+
+        # Métricas
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self._avg_run_time = DEFAULT_RUN_TIME_ESTIMATE
+        self._avg_wait_time = 0.0
+        self._recent_waits: deque = deque(maxlen=WAIT_WINDOW)
+
+        self._workers = [
+            threading.Thread(
+                target=self._worker_loop, args=(tuple(Priority),), name=f"upscale-worker-{i}", daemon=True
+            )
+            for i in range(max_workers)
+        ] + [
+            threading.Thread(
+                target=self._worker_loop, args=((Priority.PREVIEW,),), name=f"preview-worker-{i}", daemon=True
+            )
+            for i in range(preview_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def estimate_wait(self, extra: int = 0) -> float:
+        """Estimación del tiempo hasta que una tarea nueva empiece (segundos)"""
+        with self._cond:
+            return self._estimate_wait_locked(extra)
+
+    def _estimate_wait_locked(self, extra: int = 0) -> float:
+        pending = self._queued + self._running + extra
+        return pending * self._avg_run_time / self.max_workers
+
+    def _full_locked(self, priority: Priority) -> bool:
+        if priority == Priority.PREVIEW:
+            return self._queued_preview >= self.preview_queue_size
+        return self._queued >= self.max_queue_size
+
+    def has_capacity(self, priority: Priority = Priority.INTERACTIVE) -> bool:
+        """Indica si la cola admite otra tarea (sin contar un rechazo)"""
+        with self._cond:
+            return not self._shutdown and not self._full_locked(priority)
+
+    def idle_workers(self) -> int:
+        """Workers que quedarían libres tras atender las tareas ya encoladas"""
+        with self._cond:
+            return max(0, self.max_workers - self._running - self._queued)
+
+    def check_capacity(self, priority: Priority = Priority.INTERACTIVE):
+        """
+        Lanza QueueFullError si la cola está llena.
+        Permite rechazar una petición antes de decodificar su imagen.
+        """
+        with self._cond:
+            if self._full_locked(priority):
+                self.rejected += 1
+                raise QueueFullError(self._estimate_wait_locked())
+
+    def submit(
+        self,
+        fn: Callable,
+        *args: Any,
+        priority: Priority = Priority.INTERACTIVE,
+        client_id: str = "anonymous",
+        **kwargs: Any
+    ) -> Future:
+        """
+        Encola una tarea
+
+        Args:
+            fn: Función a ejecutar en un worker
+            priority: Clase de prioridad de la tarea
+            client_id: Identificador del cliente para el reparto justo
+
+        Returns:
+            Future: Se resuelve con el valor retornado por fn
+
+        Raises:
+            QueueFullError: Si la cola ha alcanzado max_queue_size
+        """
+        future: Future = Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("El planificador está cerrado")
+            priority = Priority(priority)
+            if self._full_locked(priority):
+                self.rejected += 1
+                raise QueueFullError(self._estimate_wait_locked())
+
+            task = _Task(fn, args, kwargs, future, priority, client_id)
+            self._queues[task.priority].push(task)
+            self._count_queued_locked(task, 1)
+            self.submitted += 1
+            # Hay workers que solo atienden algunas clases: despertar a todos
+            self._cond.notify_all()
+        future.add_done_callback(lambda done: self._discard_if_cancelled(task, done))
+        return future
+
+    def _discard_if_cancelled(self, task: _Task, future: Future):
+        """Libera el hueco en cola de una tarea cancelada antes de ejecutarse"""
+        if not future.cancelled():
+            return
+        with self._cond:
+            if self._queues[task.priority].remove(task):
+                self._count_queued_locked(task, -1)
+                TASKS_DROPPED.inc(reason="cancelled")
+
+    def queue_position(self, future: Future) -> Optional[int]:
+        """Número aproximado de tareas que se ejecutarán antes que esta"""
+        with self._cond:
+            for priority in Priority:
+                for task in self._queues[priority].tasks():
+                    if task.future is future:
+                        return self._position_locked(task)
+        return None
+
+    def _position_locked(self, target: _Task) -> int:
+        ahead = 0
+        for priority in Priority:
+            for task in self._queues[priority].tasks():
+                if task is target:
+                    continue
+                if priority < target.priority or (
+                    priority == target.priority and task.enqueued_at < target.enqueued_at
+                ):
+                    ahead += 1
+        return ahead
+
+    def _count_queued_locked(self, task: _Task, delta: int):
+        if task.priority == Priority.PREVIEW:
+            self._queued_preview += delta
+        else:
+            self._queued += delta
+
+    def _count_running_locked(self, task: _Task, delta: int):
+        if task.priority == Priority.PREVIEW:
+            self._running_preview += delta
+        else:
+            self._running += delta
+
+    def _next_task_locked(self, lanes: tuple) -> Optional[_Task]:
+        for priority in lanes:
+            task = self._queues[priority].pop()
+            if task is not None:
+                self._count_queued_locked(task, -1)
+                return task
+        return None
+
+    def _worker_loop(self, lanes: tuple):
+        """Atiende las clases de prioridad de 'lanes', en ese orden"""
+        while True:
+            with self._cond:
+                task = self._next_task_locked(lanes)
+                while task is None:
+                    if self._shutdown:
+                        return
+                    self._cond.wait()
+                    task = self._next_task_locked(lanes)
+
+                if not task.future.set_running_or_notify_cancel():
+                    # Cancelada mientras esperaba en cola
+                    continue
+
+                wait_time = time.monotonic() - task.enqueued_at
+                self._recent_waits.append(wait_time)
+                self._avg_wait_time += EMA_ALPHA * (wait_time - self._avg_wait_time)
+                self._count_running_locked(task, 1)
+
+            task.context.run(observe_stage, "queue_wait", wait_time)
+            start = time.monotonic()
+            try:
+                result = task.context.run(task.fn, *task.args, **task.kwargs)
+            except BaseException as e:
+                task.future.set_exception(e)
+            else:
+                task.future.set_result(result)
+            finally:
+                run_time = time.monotonic() - start
+                with self._cond:
+                    self._count_running_locked(task, -1)
+                    self.completed += 1
+                    if task.priority != Priority.PREVIEW:
+                        # Las vistas previas no deben abaratar la estimación de espera
+                        self._avg_run_time += EMA_ALPHA * (run_time - self._avg_run_time)
+
+    def stats(self) -> dict:
+        """Profundidad de cola, workers activos y tiempos de espera"""
+        with self._cond:
+            waits = sorted(self._recent_waits)
+            return {
+                "workers": self.max_workers,
+                "active_workers": self._running,
+                "preview_workers": self.preview_workers,
+                "active_preview_workers": self._running_preview,
+                "queue_depth": self._queued,
+                "queue_depth_by_priority": {
+                    priority.name.lower(): len(self._queues[priority]) for priority in Priority
+                },
+                "max_queue_size": self.max_queue_size,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "avg_wait_time": self._avg_wait_time,
+                "p95_wait_time": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+                "max_wait_time": waits[-1] if waits else 0.0,
+                "avg_run_time": self._avg_run_time,
+                "estimated_wait": self._estimate_wait_locked()
+            }
+
+    def shutdown(self, wait: bool = True):
+        """Detiene los workers; las tareas aún en cola se cancelan"""
+        cancelled = []
+        with self._cond:
+            self._shutdown = True
+            for priority in Priority:
+                task = self._queues[priority].pop()
+                while task is not None:
+                    cancelled.append(task.future)
+                    task = self._queues[priority].pop()
+            self._queued = 0
+            self._queued_preview = 0
+            self._cond.notify_all()
+        # Fuera del lock: los callbacks de los Future (p. ej. DevicePool) toman
+        # sus propios locks, que a su vez encolan aquí con ellos tomados
+        for future in cancelled:
+            future.cancel()
+
+        if wait:
+            for worker in self._workers:
+                worker.join()
@@ -17,6 +17,7 @@ from config import (
     REALESRGAN_EXECUTABLE,
     MODELS
 )
+from model_registry import CHECKSUM_MANIFEST, write_manifest
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -202,6 +203,14 @@ def download_models():
     
     if models_found:
         logger.info(f"✓ Modelos copiados exitosamente: {', '.join(models_found)}")
+        
+        # Hashes de los originales: el backend comprueba las copias al arrancar
+        write_manifest(MODELS_DIR, [
+            filename
+            for model_id in models_found
+            for filename in (MODELS[model_id]["filename"], MODELS[model_id]["param_filename"])
+        ], source_dir=models_subdir)
+        logger.info(f"✓ Hashes SHA-256 guardados en {MODELS_DIR / CHECKSUM_MANIFEST}")
         return True
     else:
         logger.error(
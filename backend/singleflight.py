@@ -0,0 +1,238 @@
+"""
+Agrupación de upscales idénticos en curso (single-flight)
+Dos peticiones con la misma imagen y los mismos parámetros (la clave de la
+caché de resultados) que llegan mientras la primera sigue en cola o en el
+motor comparten una única ejecución en lugar de ocupar dos veces un
+dispositivo. La caché solo ayuda cuando la primera ya terminó.
+
+Cada petición recibe su propio CoalescedFuture:
+
+- Cancelarlo (cliente desconectado, plazo vencido, trabajo cancelado) solo
+  lo separa del grupo; la ejecución compartida se cancela cuando se va la
+  última petición que la esperaba.
+- La ejecución trabaja sobre un enlace duro de la entrada de la primera
+  petición, así que esta puede borrar su archivo sin afectar a las demás.
+- Al terminar, cada petición recibe su propio archivo de resultado (el
+  original o un enlace duro): el cleanup_files de una no borra el de otra.
+"""
+
+import logging
+import os
+import shutil
+import threading
+import uuid
+from concurrent.futures import Future, InvalidStateError
+from pathlib import Path
+from typing import Callable, Optional
+
+from metrics import COALESCED_REQUESTS
+from progress import ProgressFanout, current_reporter, reporting_to
+
+logger = logging.getLogger(__name__)
+
+
+def _link(path: Path) -> Path:
+    """Enlace duro de 'path' en su mismo directorio (copia si el sistema no los admite)"""
+    target = path.with_name(f"{uuid.uuid4()}{path.suffix}")
+    try:
+        os.link(path, target)
+    except OSError:
+        shutil.copyfile(path, target)
+    return target
+
+
+class _Flight:
+    """Ejecución compartida y peticiones que la esperan"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.waiters: list = []
+        # Lo activa la última petición que se va: detiene el motor
+        self.cancel_event = threading.Event()
+        self.progress = ProgressFanout()
+        self.upstream: Optional[Future] = None
+        self.input_path: Optional[Path] = None
+        self.started = False
+        # Ya no admite peticiones nuevas (terminó o se canceló)
+        self.closed = False
+
+
+class CoalescedFuture(Future):
+    """
+    Resultado de una petición dentro de un grupo. 'upstream' es el Future
+    de la ejecución compartida (DevicePool.queue_position lo usa).
+    """
+
+    def __init__(self, flight: _Flight, group: "SingleFlight", on_start, reporter):
+        super().__init__()
+        self._flight = flight
+        self._group = group
+        self.on_start = on_start
+        self.reporter = reporter
+
+    @property
+    def upstream(self) -> Optional[Future]:
+        return self._flight.upstream
+
+    def cancel(self) -> bool:
+        return self._group._cancel(self._flight, self)
+
+    def _detach(self) -> bool:
+        return super().cancel()
+
+
+class SingleFlight:
+    """Registro de ejecuciones en curso por clave"""
+
+    def __init__(self):
+        self._flights: dict = {}
+        self._lock = threading.Lock()
+
+    def join(
+        self,
+        key: str,
+        input_path: Path,
+        start: Callable[[Path, threading.Event, Callable[[], None]], Future],
+        on_start: Optional[Callable[[], None]] = None
+    ) -> CoalescedFuture:
+        """
+        Se une a la ejecución en curso con la misma clave o lanza una nueva
+
+        Args:
+            key: Clave de la imagen y los parámetros (RealESRGANService.cache_key)
+            input_path: Entrada de esta petición (la ejecución usa un enlace)
+            start: Encola la ejecución: recibe la entrada compartida, el evento
+                   que la cancela y el callback de inicio; retorna su Future
+            on_start: Callback de esta petición cuando la ejecución empieza
+
+        Raises:
+            Lo que lance 'start' (p. ej. QueueFullError)
+        """
+        reporter = current_reporter()
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and not flight.closed:
+                waiter = CoalescedFuture(flight, self, on_start, reporter)
+                flight.waiters.append(waiter)
+                started = flight.started
+                if reporter is not None:
+                    flight.progress.add(reporter)
+                COALESCED_REQUESTS.inc()
+                logger.info(f"Petición agrupada con un upscale en curso ({len(flight.waiters)} en espera)")
+            else:
+                flight = self._flights[key] = _Flight(key)
+                waiter = CoalescedFuture(flight, self, on_start, reporter)
+                flight.waiters.append(waiter)
+                started = None
+                if reporter is not None:
+                    flight.progress.add(reporter)
+
+        if started is not None:
+            if started and on_start is not None:
+                on_start()
+            return waiter
+
+        try:
+            flight.input_path = _link(input_path)
+            with reporting_to(flight.progress):
+                upstream = start(flight.input_path, flight.cancel_event, lambda: self._started(flight))
+        except BaseException as e:
+            # Quien se unió mientras tanto recibe el mismo error
+            with self._lock:
+                flight.closed = True
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                others = [w for w in flight.waiters if w is not waiter]
+            if flight.input_path is not None:
+                flight.input_path.unlink(missing_ok=True)
+            for other in others:
+                if other.set_running_or_notify_cancel():
+                    other.set_exception(e)
+            raise
+        flight.upstream = upstream
+        upstream.add_done_callback(lambda done: self._finish(flight, done))
+        return waiter
+
+    def _started(self, flight: _Flight):
+        with self._lock:
+            flight.started = True
+            waiters = list(flight.waiters)
+        for waiter in waiters:
+            if waiter.on_start is not None:
+                waiter.on_start()
+
+    def _cancel(self, flight: _Flight, waiter: CoalescedFuture) -> bool:
+        """
+        Separa una petición del grupo. Si era la última, cancela la ejecución:
+        en cola se descarta (True); en el motor la detiene cancel_event y la
+        petición recibe UpscaleCancelled al terminar (False), como sin agrupar.
+        """
+        with self._lock:
+            if waiter.done():
+                return waiter.cancelled()
+            if waiter not in flight.waiters:
+                return False
+            if len(flight.waiters) > 1:
+                flight.waiters.remove(waiter)
+                if waiter.reporter is not None:
+                    flight.progress.remove(waiter.reporter)
+                return waiter._detach()
+            # Última petición: nadie más puede unirse a una ejecución cancelada
+            flight.closed = True
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        flight.cancel_event.set()
+        if flight.upstream is not None:
+            flight.upstream.cancel()
+        return waiter.cancelled()
+
+    def _finish(self, flight: _Flight, done: Future):
+        with self._lock:
+            flight.closed = True
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            waiters = list(flight.waiters)
+        flight.input_path.unlink(missing_ok=True)
+
+        if done.cancelled():
+            for waiter in waiters:
+                waiter._detach()
+            return
+        error = done.exception()
+        if error is not None:
+            for waiter in waiters:
+                if waiter.set_running_or_notify_cancel():
+                    waiter.set_exception(error)
+            return
+
+        output_path = Path(done.result())
+        waiters = [waiter for waiter in waiters if waiter.set_running_or_notify_cancel()]
+        if not waiters:
+            # Todas se fueron mientras terminaba
+            output_path.unlink(missing_ok=True)
+            return
+        # Cada petición recibe su archivo; los enlaces se crean antes de
+        # resolver ninguna, que puede mover el suyo a la caché enseguida
+        results = [output_path]
+        try:
+            for _ in waiters[1:]:
+                results.append(_link(output_path))
+        except OSError as e:
+            for path in results:
+                path.unlink(missing_ok=True)
+            for waiter in waiters:
+                waiter.set_exception(e)
+            return
+        for waiter, result in zip(waiters, results):
+            try:
+                waiter.set_result(result)
+            except InvalidStateError:
+                result.unlink(missing_ok=True)
+
+    def stats(self) -> dict:
+        """Ejecuciones en curso y peticiones que las esperan"""
+        with self._lock:
+            return {
+                "inflight": len(self._flights),
+                "waiters": sum(len(flight.waiters) for flight in self._flights.values())
+            }
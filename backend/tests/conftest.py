@@ -0,0 +1,6 @@
+"""Configuración de pytest: los módulos del backend se importan por nombre"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
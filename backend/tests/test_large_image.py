@@ -0,0 +1,168 @@
+"""
+Reescalado por tiles de imágenes grandes
+Reescala imágenes pequeñas de una pasada y por tiles (con tiles diminutos
+para forzar muchas costuras) y compara ambos resultados, en especial en las
+franjas de las costuras. El "motor" es un redimensionado bicúbico de PIL,
+cuyo alcance es menor que el solape: el resultado cosido debe coincidir con
+la referencia. También comprueba el escritor de PNG por bandas y la
+decodificación de la entrada sobre disco.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import image_io
+import preview
+from large_image import TiledUpscaler, plan_tiles, stage_input, write_png
+
+SCALE = 4
+
+# (ancho, alto, modo, tile, contexto): tamaños impares y tiles que no dividen la imagen
+CASES = [
+    (300, 200, "RGB", 64, 16),
+    (257, 131, "RGB", 48, 8),
+    (180, 180, "RGBA", 64, 16),
+    (96, 400, "RGB", 40, 12)
+]
+
+# Diferencia máxima admitida con el motor de referencia (redondeo de la mezcla)
+REFERENCE_TOLERANCE = 1
+
+
+def make_image(width: int, height: int, mode: str) -> Image.Image:
+    """Ruido con degradados: detalle fino en todas partes, sin zonas planas"""
+    rng = np.random.default_rng(width * 1000 + height)
+    y, x = np.mgrid[0:height, 0:width]
+    channels = len(mode)
+    pixels = np.stack([(x * (c + 1) + y * 2) % 256 for c in range(channels)], axis=-1).astype(np.int16)
+    pixels += rng.integers(-40, 40, size=pixels.shape)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), mode)
+
+
+def seam_mask(width: int, height: int, tile: int, overlap: int, scale: int) -> np.ndarray:
+    """Píxeles de salida a menos de 'overlap' píxeles de entrada de una costura"""
+    mask = np.zeros((height * scale, width * scale), dtype=bool)
+    for spec in plan_tiles(width, height, tile, overlap):
+        if spec.left_seam is not None:
+            x = spec.left_seam * scale
+            mask[:, max(0, x - overlap * scale):x + overlap * scale] = True
+        if spec.top_seam is not None:
+            y = spec.top_seam * scale
+            mask[max(0, y - overlap * scale):y + overlap * scale, :] = True
+    return mask
+
+
+class ResizeEngine:
+    """Motor de referencia: redimensionado bicúbico (alcance de 2 píxeles)"""
+
+    def __init__(self, scale: int):
+        self.scale = scale
+        self.executor = ThreadPoolExecutor(max_workers=4)
+
+    def upscale(self, input_path: Path, output_path: Path) -> Path:
+        with Image.open(input_path) as image:
+            image.resize((image.width * self.scale, image.height * self.scale), Image.Resampling.BICUBIC).save(output_path)
+        return output_path
+
+    def submit(self, input_path: Path, stop: threading.Event):
+        return self.executor.submit(self.upscale, input_path, input_path.with_suffix(".out.png"))
+
+
+@pytest.fixture
+def engine():
+    engine = ResizeEngine(SCALE)
+    yield engine
+    engine.executor.shutdown()
+
+
+@pytest.fixture
+def out_of_core_everywhere(monkeypatch):
+    """Trata cualquier imagen como grande (aplica las restricciones de formato)"""
+    monkeypatch.setattr(image_io, "MAX_IMAGE_SIZE", 0)
+    monkeypatch.setattr(preview, "MAX_IMAGE_SIZE", 0)
+
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA"])
+def test_png_writer_roundtrip(tmp_path, mode):
+    pixels = np.asarray(make_image(203, 150, mode))
+    path = tmp_path / "writer.png"
+    write_png(path, pixels)
+    with Image.open(path) as image:
+        assert image.mode == mode
+        assert np.array_equal(np.asarray(image), pixels)
+
+
+@pytest.mark.parametrize("case", CASES, ids=lambda case: f"{case[0]}x{case[1]}-{case[2]}")
+def test_tiled_matches_single_pass(tmp_path, engine, case):
+    width, height, mode, tile, overlap = case
+    source = tmp_path / "source.png"
+    make_image(width, height, mode).save(source)
+
+    reference_path = engine.upscale(source, tmp_path / "reference.png")
+    tiled_path = tmp_path / "tiled.png"
+    TiledUpscaler(
+        engine.submit, SCALE, tmp_path / "tiles", tile, overlap, max_in_flight=4
+    ).run(source, tiled_path)
+
+    with Image.open(reference_path) as image:
+        reference = np.asarray(image.convert(mode)).astype(np.int16)
+    with Image.open(tiled_path) as image:
+        tiled = np.asarray(image.convert(mode)).astype(np.int16)
+    assert tiled.shape == reference.shape
+
+    diff = np.abs(reference - tiled).max(axis=-1)
+    seams = seam_mask(width, height, tile, overlap, SCALE)
+    assert int(diff[seams].max()) <= REFERENCE_TOLERANCE
+    assert int(diff[~seams].max()) <= REFERENCE_TOLERANCE
+    # El directorio de trabajo (arrays en disco, tiles) se elimina al terminar
+    assert not (tmp_path / "tiles").exists()
+
+
+@pytest.mark.parametrize(
+    "image_format, mode",
+    [("PNG", "RGB"), ("PNG", "RGBA"), ("PNG", "L"), ("PNG", "P"), ("JPEG", "RGB"), ("JPEG", "L")]
+)
+def test_stage_input_decodes_to_disk(tmp_path, out_of_core_everywhere, image_format, mode):
+    path = tmp_path / f"source.{image_format.lower()}"
+    make_image(53, 37, "RGB").convert(mode).save(path, image_format)
+
+    with Image.open(path) as image:
+        staged = stage_input(image, tmp_path / "input.npy")
+    with Image.open(path) as image:
+        expected = np.asarray(image.convert("RGBA" if mode == "RGBA" else "RGB"))
+
+    assert isinstance(staged, np.memmap)
+    assert np.array_equal(np.asarray(staged), expected)
+
+
+def test_stage_input_rejects_formats_decoded_in_memory(tmp_path, out_of_core_everywhere):
+    path = tmp_path / "source.webp"
+    make_image(53, 37, "RGB").save(path, "WEBP")
+    with Image.open(path) as image, pytest.raises(ValueError):
+        stage_input(image, tmp_path / "input.npy")
+
+
+def test_large_inputs_are_checked_on_arrival(tmp_path, out_of_core_everywhere):
+    path = tmp_path / "source.upload"
+    make_image(53, 37, "RGB").save(path, "WEBP")
+    with pytest.raises(ValueError):
+        image_io.prepare_input_file(path, 1000)
+
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "L"])
+def test_preview_region_decodes_only_needed_rows(tmp_path, out_of_core_everywhere, mode):
+    path = tmp_path / "source.png"
+    make_image(300, 200, "RGB").convert(mode).save(path, "PNG")
+
+    plan = preview.plan_preview(path, (40, 30, 60, 30), 512, 8, tmp_path)
+    with Image.open(path) as image:
+        expected = np.asarray(image.convert("RGBA" if mode == "RGBA" else "RGB").crop((32, 22, 108, 68)))
+
+    with Image.open(plan.input_path) as result:
+        assert np.array_equal(np.asarray(result), expected)
+    assert not list(tmp_path.glob("*.npy"))
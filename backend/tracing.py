@@ -0,0 +1,280 @@
+"""
+Trazas por petición
+Cada petición HTTP recibe un ID (X-Request-ID del cliente si es válido, o
+uno nuevo) y una traza con un span por etapa: decode, temp_write,
+queue_wait, engine_run, el proceso del motor (con su CPU y memoria según
+wait4), format_encode (si el resultado se re-codifica) y output_encode. El
+ID y los tiempos vuelven en las cabeceras X-Request-ID y Server-Timing, y el
+ID aparece en cada línea de log.
+
+Las tareas que se ejecutan en los hilos del planificador heredan la traza:
+PriorityScheduler ejecuta cada tarea en una copia del contexto (contextvars)
+de quien la encoló.
+
+Al terminar la petición, la traza se escribe como una línea OTLP/JSON (el
+formato del exportador 'file' del OpenTelemetry Collector) en
+TRACE_LOG_FILE, que el receptor 'otlpjsonfile' puede importar después.
+"""
+
+import json
+import logging
+import re
+import secrets
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+from typing import Iterator, Optional
+
+from metrics import STAGE_LATENCY
+
+SERVICE_NAME = "ria-backend"
+SCOPE_NAME = "ria.tracing"
+
+# Tipos de span y códigos de estado de OTLP
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+STATUS_CODE_ERROR = 2
+
+# ID de petición aceptado del cliente; si no, se genera uno
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+# Cabecera traceparent de W3C Trace Context (versión 00)
+TRACEPARENT_PATTERN = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+TRACE_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("ria_current_span", default=None)
+
+
+class Span:
+    """Intervalo con nombre dentro de una traza"""
+
+    __slots__ = ("trace", "name", "span_id", "parent_id", "kind", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str],
+                 kind: int = SPAN_KIND_INTERNAL, start_ns: Optional[int] = None):
+        self.trace = trace
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start_ns = start_ns if start_ns is not None else time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes: dict = {}
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def end(self, end_ns: Optional[int] = None):
+        self.end_ns = end_ns if end_ns is not None else time.time_ns()
+
+    @property
+    def duration_ms(self) -> float:
+        end_ns = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end_ns - self.start_ns) / 1e6
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns if self.end_ns is not None else time.time_ns()),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in self.attributes.items()],
+            "status": {"code": STATUS_CODE_ERROR, "message": self.error} if self.error else {}
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class Trace:
+    """Spans de una petición; se pueden añadir desde varios hilos"""
+
+    def __init__(self, request_id: str, trace_id: str):
+        self.request_id = request_id
+        self.trace_id = trace_id
+        self._spans: list = []
+        self._lock = threading.Lock()
+        self._finished = False
+
+    def add(self, span: Span):
+        """Guarda un span terminado; los que llegan tras cerrar la traza se descartan"""
+        with self._lock:
+            if not self._finished:
+                self._spans.append(span)
+
+    def finish(self) -> list:
+        """Cierra la traza y retorna sus spans"""
+        with self._lock:
+            self._finished = True
+            return list(self._spans)
+
+    def server_timing(self, root: Span) -> str:
+        """
+        Valor de la cabecera Server-Timing: duración total de cada etapa
+        (sumando sus spans, p. ej. los reintentos o los tiles) y de la petición
+        """
+        with self._lock:
+            spans = list(self._spans)
+        totals: dict = {}
+        for span in spans:
+            if span is not root:
+                totals[span.name] = totals.get(span.name, 0.0) + span.duration_ms
+        totals["total"] = root.duration_ms
+        return ", ".join(f"{name};dur={duration:.1f}" for name, duration in totals.items())
+
+
+def _otlp_value(value) -> dict:
+    """Valor de un atributo en la codificación JSON de OTLP (int64 como texto)"""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def start_trace(name: str, request_id: Optional[str] = None, traceparent: Optional[str] = None) -> Span:
+    """
+    Crea la traza de una petición y retorna su span raíz (sin activarlo)
+
+    Args:
+        name: Nombre del span raíz (p. ej. "POST /api/upscale")
+        request_id: X-Request-ID del cliente; se ignora si no es válido
+        traceparent: Cabecera traceparent; si es válida la traza continúa la del cliente
+    """
+    if not request_id or not REQUEST_ID_PATTERN.match(request_id):
+        request_id = uuid.uuid4().hex
+
+    parent_id = None
+    match = TRACEPARENT_PATTERN.match(traceparent or "")
+    if match and match.group(1) != "0" * 32:
+        trace_id, parent_id = match.groups()
+    elif TRACE_ID_PATTERN.match(request_id):
+        # Los IDs generados sirven también como trace ID: se buscan igual en el log
+        trace_id = request_id
+    else:
+        trace_id = secrets.token_hex(16)
+
+    root = Span(Trace(request_id, trace_id), name, parent_id, kind=SPAN_KIND_SERVER)
+    root.set_attribute("ria.request_id", request_id)
+    return root
+
+
+def activate(span: Span):
+    """Hace de 'span' el actual; retorna el token para deactivate()"""
+    return _current_span.set(span)
+
+
+def deactivate(token):
+    _current_span.reset(token)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def current_request_id() -> Optional[str]:
+    span = _current_span.get()
+    return span.trace.request_id if span is not None else None
+
+
+@contextmanager
+def span(name: str) -> Iterator[Optional[Span]]:
+    """
+    Registra un span hijo del actual durante el bloque. Fuera de una
+    petición no hace nada y produce None.
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(parent.trace, name, parent.span_id)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.error = type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        child.end()
+        parent.trace.add(child)
+
+
+def record_span(name: str, seconds: float, **attributes):
+    """Registra un span ya transcurrido que termina ahora"""
+    parent = _current_span.get()
+    if parent is None:
+        return
+    end_ns = time.time_ns()
+    child = Span(parent.trace, name, parent.span_id, start_ns=end_ns - int(seconds * 1e9))
+    child.attributes.update(attributes)
+    child.end(end_ns)
+    parent.trace.add(child)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[Optional[Span]]:
+    """Etapa del upscale: observa ria_upscale_stage_duration_seconds y registra un span"""
+    with STAGE_LATENCY.time(stage=name), span(name) as current:
+        yield current
+
+
+def observe_stage(name: str, seconds: float):
+    """Como stage() para una etapa ya medida (p. ej. la espera en cola)"""
+    STAGE_LATENCY.observe(seconds, stage=name)
+    record_span(name, seconds)
+
+
+def install_log_record_factory():
+    """Añade 'request_id' a cada registro de log ('-' fuera de una petición)"""
+    factory = logging.getLogRecordFactory()
+
+    def record_factory(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        record.request_id = current_request_id() or "-"
+        return record
+
+    logging.setLogRecordFactory(record_factory)
+
+
+class TraceLog:
+    """Escribe cada traza como una línea OTLP/JSON en un archivo con rotación"""
+
+    def __init__(self, path: Optional[Path], max_bytes: int, backups: int, service_version: str = ""):
+        """
+        Args:
+            path: Archivo de destino (None desactiva el log de trazas)
+            max_bytes: Tamaño a partir del cual se rota el archivo
+            backups: Archivos rotados que se conservan
+        """
+        self._logger: Optional[logging.Logger] = None
+        self._resource = {"attributes": [
+            {"key": "service.name", "value": {"stringValue": SERVICE_NAME}},
+            {"key": "service.version", "value": {"stringValue": service_version}}
+        ]}
+        if path is None:
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self._logger = logging.getLogger(SCOPE_NAME)
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        self._logger.addHandler(handler)
+
+    def write(self, spans: list):
+        if self._logger is None or not spans:
+            return
+        self._logger.info(json.dumps({"resourceSpans": [{
+            "resource": self._resource,
+            "scopeSpans": [{"scope": {"name": SCOPE_NAME}, "spans": [span.to_otlp() for span in spans]}]
+        }]}, separators=(",", ":")))
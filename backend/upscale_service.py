@@ -1,42 +1,389 @@
 """
 Servicio de reescalado usando Real-ESRGAN con Vulkan
-Maneja el procesamiento de imágenes a través del binario de Real-ESRGAN
+Maneja el procesamiento de imágenes a través de un motor de inferencia
+intercambiable (binario por subproceso, workers persistentes o CPU). Si el
+motor configurado no está disponible se usa el motor CPU como alternativa.
 Ahora usa un hilo independiente para no bloquear la interfaz de usuario.
 """
 
+import contextvars
 import subprocess
 import platform
 import logging
+import threading
+import time
+import json
+import os
+import shutil
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Callable, Optional, Tuple
 import uuid
 from PIL import Image
-from concurrent.futures import ThreadPoolExecutor, Future
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from config import (
     BINARIES_DIR,
     MODELS_DIR,
     TEMP_DIR,
     OUTPUT_DIR,
+    CACHE_DIR,
     MODELS,
     REALESRGAN_EXECUTABLE,
+    REALESRGAN_BINARY,
+    ENGINE_BACKEND,
+    ENGINE_FALLBACK,
+    PERSISTENT_ENGINE_IMPL,
     PROCESSING_TIMEOUT,
     MAX_IMAGE_SIZE,
-    VULKAN_DEVICE_ID
+    VULKAN_DEVICES,
+    DEVICE_MAX_FAILURES,
+    DEVICE_RETRY_AFTER,
+    RESULT_CACHE_ENABLED,
+    JOB_STORE,
+    RESULT_CACHE_MAX_MB,
+    JANITOR_INTERVAL,
+    JANITOR_BATCH_SIZE,
+    JANITOR_MAX_AGE_HOURS,
+    JANITOR_QUOTA_MB,
+    JANITOR_MIN_AGE,
+    PREVIEW_DIR,
+    MAX_WORKERS,
+    MAX_QUEUE_SIZE,
+    TILE_AUTO_TUNE,
+    GPU_MEMORY_MB,
+    TILE_MEMORY_FRACTION,
+    TILE_TUNING_FILE,
+    PREVIEW_MAX_SIDE,
+    PREVIEW_PADDING,
+    PREVIEW_WORKERS,
+    PREVIEW_QUEUE_SIZE,
+    LARGE_IMAGE_MAX_SIZE,
+    LARGE_IMAGE_TILE_SIZE,
+    LARGE_IMAGE_TILE_OVERLAP,
+    LARGE_IMAGE_TILES_IN_FLIGHT,
+    LARGE_IMAGE_MAX_CONCURRENT,
+    LARGE_IMAGE_QUEUE_SIZE,
+    WARMUP_ENABLED,
+    MODELS_WATCH_INTERVAL,
+    READY_QUEUE_SATURATION,
+    MIN_FREE_DISK_MB,
+    ENCODER_WORKERS,
+    COALESCE_ENABLED,
+    CODEC_WORKERS,
+    CODEC_QUEUE_SIZE
 )
+from codec_pool import CodecPool
+from devices import CPU_DEVICE_ID, Device, DevicePool, discover_devices
+from encoder import PNG, ImageEncoder, OutputFormat, parse_output_format
+from engines import (
+    CpuEngine,
+    DeadlineExceeded,
+    EngineOutOfMemory,
+    UpscaleCancelled,
+    UpscaleEngine,
+    create_engine
+)
+from image_io import read_image_size
+from janitor import Janitor
+from large_image import TiledUpscaler
+from metrics import ENGINE_SECONDS
+from model_registry import ModelRegistry
+from preview import PreviewResult, Region, finish_preview, plan_preview
+from progress import current_reporter, reporting
+from result_cache import ResultCache
+from scheduler import Priority, QueueFullError
+from singleflight import SingleFlight
+from tracing import stage
 
 logger = logging.getLogger(__name__)
 
+# Tamaños de tile que prueba el auto-tuner, de mayor a menor
+TILE_CANDIDATES = (512, 384, 256, 192, 128, 96, 64, 32)
+
+# Tile con el que se reintenta un OOM cuando el motor eligió el tamaño (tile_size=0)
+TILE_OOM_FALLBACK = 192
+
+# Memoria aproximada por píxel de tile (bytes) según la arquitectura del modelo.
+# Calibrado con la heurística del propio realesrgan-ncnn-vulkan (tile 200 con ~2 GB).
+TILE_BYTES_PER_PIXEL = {
+    "realesrgan-x4plus": 40_000,
+    "realesrgan-x4plus-anime": 40_000,
+    "realesr-animevideov3": 10_000  # Red compacta (SRVGGNet)
+}
+
+# Segundos durante los que se reutiliza la medición de memoria libre
+MEMORY_PROBE_TTL = 10.0
+
+# Lado de la imagen con la que se calienta cada modelo
+WARMUP_IMAGE_SIZE = 32
+
+
+class TileAutoTuner:
+    """
+    Elige el tamaño de tile a partir de las dimensiones de la imagen, la
+    escala del modelo y la memoria disponible. Recuerda los tiempos por
+    (modelo, tamaño de imagen) y el tile más pequeño que agotó la memoria,
+    y persiste ese historial en disco entre ejecuciones.
+    """
+    
+    def __init__(self, stats_path: Path, memory_mb: int = 0, memory_fraction: float = 0.7):
+        self.stats_path = stats_path
+        self.memory_mb = memory_mb
+        self.memory_fraction = memory_fraction
+        self._lock = threading.Lock()
+        # dispositivo -> (instante de la medición, MB libres)
+        self._memory_probes: dict = {}
+        # "dispositivo|modelo|bucket" -> {"tiles": {tile: {"seconds_per_mp", "runs"}}, "oom_tile": int}
+        self._stats: dict = {}
+        # Cambios pendientes de escribir; flush() serializa las escrituras con _save_lock
+        self._dirty = False
+        self._save_lock = threading.Lock()
+        self._load()
+    
+    def _load(self):
+        try:
+            self._stats = json.loads(self.stats_path.read_text())
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"No se pudo leer el historial de tiles {self.stats_path}: {e}")
+    
+    def flush(self):
+        """
+        Escritura atómica del historial si cambió desde la última. Se llama en
+        cada pasada del janitor y al cerrar el servicio, no en cada ejecución
+        """
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                data = json.dumps(self._stats, indent=2)
+                self._dirty = False
+            tmp_path = self.stats_path.with_suffix(f".{os.getpid()}.tmp")
+            try:
+                tmp_path.write_text(data)
+                os.replace(tmp_path, self.stats_path)
+            except OSError as e:
+                logger.warning(f"No se pudo guardar el historial de tiles: {e}")
+                with self._lock:
+                    self._dirty = True
+    
+    @staticmethod
+    def _stats_key(device_id: int, model: str, size: Tuple[int, int]) -> str:
+        """Agrupa las imágenes por dispositivo y potencia de dos de su lado mayor"""
+        bucket = 256
+        while bucket < max(size):
+            bucket *= 2
+        return f"{device_id}|{model}|{bucket}"
+    
+    @staticmethod
+    def smaller(tile_size: int) -> Optional[int]:
+        """Siguiente tile a probar tras un OOM (None si ya es el mínimo)"""
+        if tile_size == 0:
+            return TILE_OOM_FALLBACK
+        return next((tile for tile in TILE_CANDIDATES if tile < tile_size), None)
+    
+    def available_memory_mb(self, device_id: int) -> Optional[int]:
+        """
+        Memoria libre para el motor: GPU_MEMORY_MB si está fijado, la VRAM
+        libre según nvidia-smi o, en su defecto, la RAM disponible del host
+        (GPUs integradas y ejecución en CPU comparten esa memoria)
+        """
+        if self.memory_mb > 0:
+            return self.memory_mb
+        
+        with self._lock:
+            measured_at, value = self._memory_probes.get(device_id, (0.0, None))
+        if time.monotonic() - measured_at < MEMORY_PROBE_TTL:
+            return value
+        
+        value = None
+        nvidia_smi = shutil.which("nvidia-smi") if device_id != CPU_DEVICE_ID else None
+        if nvidia_smi:
+            try:
+                result = subprocess.run(
+                    [nvidia_smi, "--query-gpu=memory.free", "--format=csv,noheader,nounits",
+                     "-i", str(device_id)],
+                    capture_output=True, text=True, timeout=5
+                )
+                if result.returncode == 0:
+                    value = int(result.stdout.strip().splitlines()[0])
+            except (OSError, ValueError, IndexError, subprocess.TimeoutExpired):
+                pass
+        
+        if value is None:
+            try:
+                with open("/proc/meminfo") as f:
+                    for line in f:
+                        if line.startswith("MemAvailable:"):
+                            value = int(line.split()[1]) // 1024
+                            break
+            except OSError:
+                pass
+        
+        with self._lock:
+            self._memory_probes[device_id] = (time.monotonic(), value)
+        return value
+    
+    def memory_limit(self, model: str, scale: int, device_id: int) -> int:
+        """Mayor tile candidato que cabe en la memoria disponible del dispositivo"""
+        memory_mb = self.available_memory_mb(device_id)
+        if memory_mb is None:
+            return TILE_OOM_FALLBACK
+        
+        # Activaciones de la red más el buffer de salida (3 canales float por píxel reescalado)
+        bytes_per_pixel = TILE_BYTES_PER_PIXEL.get(MODELS[model]["name"], 40_000) + 12 * scale * scale
+        budget = memory_mb * 1024 * 1024 * self.memory_fraction
+        fitting = int((budget / bytes_per_pixel) ** 0.5)
+        return next((tile for tile in TILE_CANDIDATES if tile <= fitting), TILE_CANDIDATES[-1])
+    
+    def choose(self, model: str, scale: int, size: Tuple[int, int], device_id: int) -> int:
+        """
+        Elige el tile para una imagen (o el lado mayor de un lote)
+        
+        Returns:
+            int: Tamaño de tile (uno de TILE_CANDIDATES)
+        """
+        limit = self.memory_limit(model, scale, device_id)
+        with self._lock:
+            stats = self._stats.get(self._stats_key(device_id, model, size), {})
+            oom_tile = stats.get("oom_tile")
+            if oom_tile:
+                limit = min(limit, self.smaller(oom_tile) or TILE_CANDIDATES[-1])
+            
+            # Un tile mayor que la imagen no aporta nada
+            covering = [tile for tile in TILE_CANDIDATES if tile >= max(size)]
+            if covering:
+                limit = min(limit, covering[-1])
+            
+            # Primero se prueba el mayor tile posible; después gana el más rápido medido
+            timings = {
+                int(tile): entry["seconds_per_mp"]
+                for tile, entry in stats.get("tiles", {}).items()
+                if int(tile) <= limit
+            }
+            if limit in timings:
+                return min(timings, key=timings.get)
+            return limit
+    
+    def record_run(
+        self,
+        model: str,
+        size: Tuple[int, int],
+        tile_size: int,
+        elapsed: float,
+        pixels: int,
+        device_id: int
+    ):
+        """Registra la duración de una ejecución correcta (media móvil por megapíxel)"""
+        if tile_size <= 0 or pixels <= 0:
+            return
+        seconds_per_mp = elapsed / (pixels / 1_000_000)
+        with self._lock:
+            stats = self._stats.setdefault(self._stats_key(device_id, model, size), {})
+            entry = stats.setdefault("tiles", {}).setdefault(
+                str(tile_size), {"seconds_per_mp": seconds_per_mp, "runs": 0}
+            )
+            entry["seconds_per_mp"] = 0.7 * entry["seconds_per_mp"] + 0.3 * seconds_per_mp
+            entry["runs"] += 1
+            self._dirty = True
+    
+    def record_oom(self, model: str, size: Tuple[int, int], tile_size: int, device_id: int):
+        """Recuerda el menor tile que agotó la memoria para ese tamaño de imagen"""
+        if tile_size <= 0:
+            return
+        with self._lock:
+            stats = self._stats.setdefault(self._stats_key(device_id, model, size), {})
+            stats["oom_tile"] = min(stats.get("oom_tile") or tile_size, tile_size)
+            stats.get("tiles", {}).pop(str(tile_size), None)
+            self._dirty = True
+        # Los OOM son raros y caros de repetir: se guardan en el momento
+        self.flush()
+    
+    def stats(self) -> dict:
+        """Historial de tiempos y límites por dispositivo, modelo y tamaño"""
+        with self._lock:
+            return {
+                "available_memory_mb": {
+                    str(device_id): value for device_id, (_, value) in self._memory_probes.items()
+                },
+                "history": json.loads(json.dumps(self._stats))
+            }
+
 
 class RealESRGANService:
     """Servicio para procesar imágenes con Real-ESRGAN"""
     
-    def __init__(self, max_workers: int = 2):
+    def __init__(self, max_workers: int = MAX_WORKERS, max_queue_size: int = MAX_QUEUE_SIZE):
         self.system = self._detect_system()
         self.executable = self._get_executable_path()
+        # Un motor por dispositivo; el primero sirve para verificar el setup y versionar la caché
+        self.device_ids = discover_devices(VULKAN_DEVICES, ENGINE_BACKEND, PERSISTENT_ENGINE_IMPL)
+        engines = {
+            device_id: create_engine(ENGINE_BACKEND, self.executable, device_id)
+            for device_id in self.device_ids
+        }
+        self.engine: UpscaleEngine = engines[self.device_ids[0]]
+        # Motor CPU: para las peticiones que lo eligen y como alternativa al configurado
+        self.cpu_engine = CpuEngine()
+        self.fallback = not self.engine.is_available() and ENGINE_FALLBACK == CpuEngine.name
+        if self.fallback:
+            logger.warning(
+                f"Motor '{self.engine.name}' no disponible ({self.executable}); "
+                f"usando el motor CPU (LANCZOS, sin IA)"
+            )
+            self.device_ids = [CPU_DEVICE_ID]
+            engines = {CPU_DEVICE_ID: self.cpu_engine}
+            self.engine = self.cpu_engine
+        # Modelos validados una vez; se revisan solo si cambia MODELS_DIR
+        self.models = ModelRegistry(MODELS_DIR, MODELS, self.engine.requires_model_files)
         self._verify_setup()
-        # Executor para hilos independientes
-        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Cola acotada y prioridades por dispositivo; las tareas van al que terminaría antes
+        self.scheduler = DevicePool(
+            engines, max_workers, max_queue_size, DEVICE_MAX_FAILURES, DEVICE_RETRY_AFTER,
+            PREVIEW_WORKERS, PREVIEW_QUEUE_SIZE
+        )
+        logger.info(f"Dispositivos de cómputo: {self.device_ids}")
+        # Caché de resultados en disco (None si está desactivada)
+        self.cache: Optional[ResultCache] = None
+        if RESULT_CACHE_ENABLED:
+            # Con la cola compartida otros procesos escriben en el mismo directorio
+            self.cache = ResultCache(
+                CACHE_DIR, RESULT_CACHE_MAX_MB * 1024 * 1024, OUTPUT_DIR, shared=JOB_STORE == "sqlite"
+            )
+        # Limpieza de temp/ y output/ por tandas (se arranca con start_janitor)
+        self.janitor = Janitor(
+            [TEMP_DIR, OUTPUT_DIR],
+            max_age=JANITOR_MAX_AGE_HOURS * 3600,
+            min_age=JANITOR_MIN_AGE,
+            quota_bytes=JANITOR_QUOTA_MB * 1024 * 1024,
+            batch_size=JANITOR_BATCH_SIZE,
+            interval=JANITOR_INTERVAL,
+            exclude=[PREVIEW_DIR]  # Las vistas previas caducan en PreviewStore
+        )
+        # Re-codificación de los resultados a formatos que el motor no escribe
+        self.encoder = ImageEncoder(ENCODER_WORKERS)
+        # Decodificación de las peticiones y codificación de las respuestas (fuera del event loop)
+        self.codec = CodecPool(CODEC_WORKERS, CODEC_QUEUE_SIZE)
+        # Upscales idénticos en curso (None si la agrupación está desactivada)
+        self.inflight: Optional[SingleFlight] = SingleFlight() if COALESCE_ENABLED else None
+        # Coordinadores de imágenes grandes: reparten sus tiles en el planificador
+        self._large_executor = ThreadPoolExecutor(
+            max_workers=LARGE_IMAGE_MAX_CONCURRENT, thread_name_prefix="large-image"
+        )
+        # Imágenes grandes en curso o en espera (la cola del executor no tiene límite)
+        self._large_pending = 0
+        self._large_lock = threading.Lock()
+        # Auto-tuner de tiles (None: se respeta el tile automático del motor)
+        self.tile_tuner: Optional[TileAutoTuner] = None
+        if TILE_AUTO_TUNE:
+            self.tile_tuner = TileAutoTuner(TILE_TUNING_FILE, GPU_MEMORY_MB, TILE_MEMORY_FRACTION)
+            self.janitor.add_pass_hook(self.tile_tuner.flush)
+        # Calentamiento: (dispositivo, modelo) -> {"seconds", "sha256", "error"}
+        self.warmup_done = threading.Event()
+        self._warm: dict = {}
+        self._warm_lock = threading.Lock()
+        self.models.start_watch(MODELS_WATCH_INTERVAL, self.start_warm_up)
     
     def _detect_system(self) -> str:
         """Detecta el sistema operativo"""
@@ -50,32 +397,79 @@ class RealESRGANService:
     
     def _get_executable_path(self) -> Path:
         """Obtiene la ruta al ejecutable de Real-ESRGAN"""
+        if REALESRGAN_BINARY:
+            return Path(REALESRGAN_BINARY)
         exe_name = REALESRGAN_EXECUTABLE[self.system]
         exe_path = BINARIES_DIR / exe_name
         return exe_path
     
     def _verify_setup(self):
-        """Verifica que el ejecutable y modelos estén disponibles"""
-        if not self.executable.exists():
+        """Verifica que el motor y los modelos estén disponibles"""
+        if not self.engine.is_available():
             raise FileNotFoundError(
                 f"Ejecutable de Real-ESRGAN no encontrado en: {self.executable}\n"
                 f"Ejecuta setup.py para descargar el binario."
             )
         
-        # Verificar que al menos un modelo esté disponible
-        model_found = False
-        for model_info in MODELS.values():
-            model_path = MODELS_DIR / model_info["filename"]
-            if model_path.exists():
-                model_found = True
-                break
-        
-        if not model_found:
+        if not self.models.available():
             logger.warning(
                 "No se encontraron modelos descargados. "
                 "Ejecuta setup.py para descargar los modelos."
             )
     
+    def resolve_engine(self, name: str = "auto") -> UpscaleEngine:
+        """
+        Motor que atiende una petición
+        
+        Args:
+            name: "auto" (el configurado o su alternativa), "cpu" o el nombre
+                  del motor configurado
+        
+        Raises:
+            ValueError: Si el motor no existe en este servidor
+        """
+        if name in ("auto", self.engine.name):
+            return self.engine
+        if name == CpuEngine.name:
+            return self.cpu_engine
+        raise ValueError(f"Motor '{name}' no disponible")
+    
+    def engine_name(self, name: str = "auto") -> str:
+        """Nombre del motor que atiende las peticiones con engine=name"""
+        return self.resolve_engine(name).name
+    
+    def _device_engine(self, device: Device, engine: str) -> UpscaleEngine:
+        """Motor del dispositivo, salvo que la petición pida otro"""
+        resolved = self.resolve_engine(engine)
+        return device.engine if resolved is self.engine else resolved
+    
+    def cache_key(
+        self,
+        content_hash: str,
+        model: str,
+        scale: int,
+        tile_size: int,
+        engine: str = "auto",
+        output_format: OutputFormat = PNG
+    ) -> str:
+        """
+        Clave de caché para una imagen de entrada y parámetros de upscale
+        
+        Args:
+            content_hash: Hash SHA-256 de los bytes originales (ResultCache.content_hash)
+            model: ID del modelo
+            scale: Factor de escala
+            tile_size: Tamaño de tile
+            engine: Motor pedido (ver resolve_engine)
+            output_format: Formato del resultado
+        
+        Returns:
+            str: Clave SHA-256 que incluye la versión del motor
+        """
+        return ResultCache.make_key(
+            content_hash, model, scale, tile_size, self.resolve_engine(engine).version(), output_format.key
+        )
+    
     def _validate_image(self, image_path: Path) -> Tuple[int, int]:
         """
         Valida que la imagen sea procesable
@@ -97,6 +491,69 @@ class RealESRGANService:
         except Exception as e:
             raise ValueError(f"Error al validar imagen: {str(e)}")
     
+    def _run_with_tile_retry(
+        self,
+        run: Callable[[int], None],
+        model: str,
+        scale: int,
+        size: Tuple[int, int],
+        pixels: int,
+        tile_size: int,
+        device_id: int
+    ) -> int:
+        """
+        Ejecuta el motor con el tile solicitado (o el elegido por el auto-tuner
+        si es 0) y, ante un fallo por falta de memoria, reintenta con tiles
+        cada vez más pequeños.
+        
+        Args:
+            run: Invoca el motor con un tamaño de tile
+            size: Lado mayor (ancho, alto) de las imágenes a procesar
+            pixels: Píxeles totales de entrada (para registrar tiempos)
+            tile_size: Tile solicitado (0 para automático)
+            device_id: Dispositivo en el que se ejecuta
+        
+        Returns:
+            int: Tile con el que terminó la ejecución
+        """
+        tuner = self.tile_tuner
+        if tile_size == 0 and tuner is not None:
+            tile_size = tuner.choose(model, scale, size, device_id)
+            logger.info(f"Tile elegido automáticamente: {tile_size}")
+        
+        while True:
+            start = time.monotonic()
+            # Cada segundo de motor cuenta como útil o como desperdiciado según el resultado
+            outcome = "failed"
+            try:
+                with stage("engine_run") as span:
+                    if span is not None:
+                        span.set_attribute("ria.device", device_id)
+                        span.set_attribute("ria.tile_size", tile_size)
+                    run(tile_size)
+                outcome = "useful"
+            except DeadlineExceeded:
+                outcome = "deadline"
+                raise
+            except UpscaleCancelled:
+                outcome = "cancelled"
+                raise
+            except EngineOutOfMemory:
+                if tuner is not None:
+                    tuner.record_oom(model, size, tile_size, device_id)
+                smaller = TileAutoTuner.smaller(tile_size)
+                if smaller is None:
+                    raise
+                logger.warning(f"Memoria agotada con tile {tile_size or 'auto'}; reintentando con {smaller}")
+                tile_size = smaller
+                continue
+            finally:
+                ENGINE_SECONDS.inc(time.monotonic() - start, outcome=outcome)
+            
+            if tuner is not None:
+                tuner.record_run(model, size, tile_size, time.monotonic() - start, pixels, device_id)
+            return tile_size
+    
     def _upscale_task(
         self,
         input_path: Path,
@@ -104,12 +561,29 @@ class RealESRGANService:
         model: str,
         denoise_strength: float,
         tile_size: int,
-        face_enhance: bool
+        face_enhance: bool,
+        cancel_event: Optional[threading.Event] = None,
+        on_start: Optional[Callable[[], None]] = None,
+        deadline: Optional[float] = None,
+        engine: str = "auto",
+        extension: str = "png",
+        device: Optional[Device] = None
     ) -> Path:
         """
         Tarea interna de upscale ejecutada en hilo separado.
         Maneja la lógica de procesamiento sin bloquear.
+        'extension' es el formato que escribe el motor (uno de sus native_formats).
+        'device' lo asigna el DevicePool al sacar la tarea de la cola.
         """
+        if cancel_event is not None and cancel_event.is_set():
+            raise UpscaleCancelled("Tarea cancelada antes de iniciar")
+        if on_start is not None:
+            on_start()
+        
+        # Generar nombre único para el archivo de salida
+        output_filename = f"{uuid.uuid4()}.{extension}"
+        output_path = OUTPUT_DIR / output_filename
+        
         try:
             # Validar imagen de entrada
             original_width, original_height = self._validate_image(input_path)
@@ -119,48 +593,21 @@ class RealESRGANService:
             if model not in MODELS:
                 raise ValueError(f"Modelo '{model}' no disponible")
             
-            model_info = MODELS[model]
-            model_name = model_info["name"]
-            
-            # Generar nombre único para el archivo de salida
-            output_filename = f"{uuid.uuid4()}.png"
-            output_path = OUTPUT_DIR / output_filename
-            
-            # Construir comando para Real-ESRGAN
-            cmd = [
-                str(self.executable),
-                "-i", str(input_path),
-                "-o", str(output_path),
-                "-n", model_name,
-                "-s", str(scale),
-                "-g", str(VULKAN_DEVICE_ID),  # GPU ID
-                "-f", "png"  # Formato de salida
-            ]
-            
-            # Añadir parámetros opcionales
-            if tile_size > 0:
-                cmd.extend(["-t", str(tile_size)])
-            
-            # NOTA: El binario ncnn-vulkan de Real-ESRGAN NO soporta el parámetro -d (denoise)
-            # El denoise está integrado en cada modelo y no se puede ajustar en runtime
-            # El parámetro denoise_strength se ignora para el binario ncnn-vulkan
-            
-            logger.info(f"Ejecutando comando: {' '.join(cmd)}")
-            
-            # Ejecutar Real-ESRGAN
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=PROCESSING_TIMEOUT,
-                check=False
+            # NOTA: El parámetro denoise_strength se ignora: el denoise está
+            # integrado en cada modelo y no se puede ajustar en runtime
+            runner = self._device_engine(device, engine)
+            self._run_with_tile_retry(
+                lambda tile: runner.run(
+                    input_path, output_path, model, scale, tile, cancel_event, deadline
+                ),
+                model,
+                scale,
+                (original_width, original_height),
+                original_width * original_height,
+                tile_size,
+                device.id
             )
             
-            # Verificar resultado
-            if result.returncode != 0:
-                logger.error(f"Error de Real-ESRGAN: {result.stderr}")
-                raise RuntimeError(f"Real-ESRGAN falló: {result.stderr}")
-            
             # Verificar que el archivo de salida existe
             if not output_path.exists():
                 raise RuntimeError("Archivo de salida no generado")
@@ -171,6 +618,14 @@ class RealESRGANService:
         except subprocess.TimeoutExpired:
             logger.error("Timeout al procesar imagen")
             raise RuntimeError(f"Procesamiento excedió {PROCESSING_TIMEOUT}s")
+        except DeadlineExceeded:
+            logger.info(f"Upscale abandonado por plazo agotado: {input_path}")
+            output_path.unlink(missing_ok=True)
+            raise
+        except UpscaleCancelled:
+            logger.info(f"Upscale cancelado: {input_path}")
+            output_path.unlink(missing_ok=True)
+            raise
         except Exception as e:
             logger.error(f"Error en upscale: {str(e)}")
             raise
@@ -182,7 +637,17 @@ class RealESRGANService:
         model: str = "general",
         denoise_strength: float = 0.5,
         tile_size: int = 0,
-        face_enhance: bool = False
+        face_enhance: bool = False,
+        cancel_event: Optional[threading.Event] = None,
+        on_start: Optional[Callable[[], None]] = None,
+        priority: Priority = Priority.INTERACTIVE,
+        client_id: str = "anonymous",
+        deadline: Optional[float] = None,
+        engine: str = "auto",
+        output_format: str = "png",
+        quality: Optional[int] = None,
+        lossless: bool = False,
+        key: Optional[str] = None
     ) -> Future[Path]:
         """
         Reescala una imagen usando Real-ESRGAN en un hilo independiente
@@ -194,44 +659,486 @@ class RealESRGANService:
             denoise_strength: Fuerza de denoise (0.0 a 1.0, -1 para desactivar)
             tile_size: Tamaño de tile para procesamiento (0 para automático)
             face_enhance: Habilitar mejora de rostros (requiere GFPGAN)
+            cancel_event: Evento que, al activarse, mata el proceso de Real-ESRGAN
+            on_start: Callback invocado cuando la tarea sale de la cola y empieza
+            priority: Prioridad (INTERACTIVE para la UI, BATCH para procesos masivos)
+            client_id: Identificador del cliente para repartir los workers
+            deadline: Instante (time.monotonic) en que el cliente deja de esperar;
+                      la tarea se descarta o se interrumpe con DeadlineExceeded
+            engine: Motor a usar ("auto" para el configurado, "cpu")
+            output_format: Formato del resultado (png, webp, jpg, avif)
+            quality: Calidad de los formatos con pérdida (por defecto OUTPUT_QUALITY)
+            lossless: WebP sin pérdida
+            key: Clave de la imagen y los parámetros (cache_key). Las peticiones
+                 con la misma clave en curso comparten una ejecución
+                 (singleflight.py); cancelar una no detiene la de las demás.
         
         Returns:
             Future[Path]: Objeto Future que se resuelve con la ruta al archivo de salida.
                           Usa future.result() para obtener el Path cuando esté listo.
+        
+        Raises:
+            QueueFullError: Si la cola del planificador está llena
+            ValueError: Si el motor o el formato pedidos no son válidos
+        """
+        runner = self.resolve_engine(engine)
+        fmt = parse_output_format(output_format, quality, lossless)
+        if key is None or self.inflight is None:
+            return self._submit_upscale(
+                input_path, scale, model, denoise_strength, tile_size, face_enhance, cancel_event,
+                on_start, priority, client_id, deadline, engine, runner, fmt
+            )
+        
+        def start(shared_input: Path, shared_cancel: threading.Event, started: Callable[[], None]) -> Future:
+            # Sin plazo propio: cada petición vence el suyo en await_upscale y
+            # la ejecución se cancela cuando se va la última
+            self.janitor.pin(shared_input)
+            try:
+                future = self._submit_upscale(
+                    shared_input, scale, model, denoise_strength, tile_size, face_enhance, shared_cancel,
+                    started, priority, client_id, None, engine, runner, fmt
+                )
+            except BaseException:
+                self.janitor.unpin(shared_input)
+                raise
+            future.add_done_callback(lambda _: self.janitor.unpin(shared_input))
+            return future
+        
+        return self.inflight.join(key, input_path, start, on_start)
+    
+    def _submit_upscale(
+        self,
+        input_path: Path,
+        scale: int,
+        model: str,
+        denoise_strength: float,
+        tile_size: int,
+        face_enhance: bool,
+        cancel_event: Optional[threading.Event],
+        on_start: Optional[Callable[[], None]],
+        priority: Priority,
+        client_id: str,
+        deadline: Optional[float],
+        engine: str,
+        runner: UpscaleEngine,
+        fmt: OutputFormat
+    ) -> Future[Path]:
+        """Encola un upscale ya validado (upscale agrupa antes las peticiones idénticas)"""
+        # Las imágenes mayores que MAX_IMAGE_SIZE se reescalan por tiles
+        if self._is_large(input_path):
+            self._admit_large()
+            # copy_context: los tiles encolados desde ese hilo siguen en la traza de la petición
+            future = self._large_executor.submit(
+                contextvars.copy_context().run,
+                self._upscale_large_task,
+                input_path,
+                scale,
+                model,
+                tile_size,
+                cancel_event,
+                on_start,
+                priority,
+                client_id,
+                deadline,
+                engine
+            )
+            future.add_done_callback(self._release_large)
+            # El resultado cosido es PNG
+            native = fmt == PNG
+        else:
+            # Si el motor escribe el formato pedido no hace falta re-codificar
+            native = fmt.key in runner.native_formats
+            # Enviar la tarea al dispositivo menos cargado (se ejecuta en un hilo separado)
+            future = self.scheduler.submit(
+                self._upscale_task,
+                input_path,
+                scale,
+                model,
+                denoise_strength,
+                tile_size,
+                face_enhance,
+                cancel_event,
+                on_start,
+                deadline,
+                engine,
+                fmt.extension if native else "png",
+                priority=priority,
+                client_id=client_id,
+                cost=self._estimate_cost([input_path], scale),
+                deadline=deadline
+            )
+        if native:
+            return future
+        return self.encoder.chain(future, fmt)
+    
+    def _admit_large(self):
+        """
+        Reserva un hueco para una imagen grande: como la cola del
+        planificador, la de sus coordinadores rechaza con 429 al llenarse
+
+        Raises:
+            QueueFullError: Si hay LARGE_IMAGE_MAX_CONCURRENT imágenes en curso
+                y LARGE_IMAGE_QUEUE_SIZE en espera
+        """
+        with self._large_lock:
+            if self._large_pending >= LARGE_IMAGE_MAX_CONCURRENT + LARGE_IMAGE_QUEUE_SIZE:
+                # Cada imagen grande ocupa el planificador con sus tiles
+                raise QueueFullError(self.scheduler.estimate_wait(self._large_pending))
+            self._large_pending += 1
+
+    def _release_large(self, _future: Future):
+        with self._large_lock:
+            self._large_pending -= 1
+
+    @staticmethod
+    def _is_large(input_path: Path) -> bool:
+        """Indica si la imagen supera lo que el motor procesa de una vez"""
+        try:
+            return max(read_image_size(input_path)) > MAX_IMAGE_SIZE
+        except OSError:
+            # Se valida al ejecutar
+            return False
+    
+    def _upscale_large_task(
+        self,
+        input_path: Path,
+        scale: int,
+        model: str,
+        tile_size: int,
+        cancel_event: Optional[threading.Event],
+        on_start: Optional[Callable[[], None]],
+        priority: Priority,
+        client_id: str,
+        deadline: Optional[float],
+        engine: str
+    ) -> Path:
+        """
+        Coordinador de una imagen grande: trocea la entrada, encola cada tile
+        como un upscale normal y cose los resultados en un buffer en disco
+        """
+        if cancel_event is not None and cancel_event.is_set():
+            raise UpscaleCancelled("Tarea cancelada antes de iniciar")
+        if deadline is not None and time.monotonic() >= deadline:
+            raise DeadlineExceeded("Plazo de la petición agotado")
+        width, height = read_image_size(input_path)
+        if max(width, height) > LARGE_IMAGE_MAX_SIZE:
+            raise ValueError(
+                f"Imagen demasiado grande: {width}x{height}. "
+                f"Máximo permitido: {LARGE_IMAGE_MAX_SIZE}px por lado"
+            )
+        if model not in MODELS:
+            raise ValueError(f"Modelo '{model}' no disponible")
+        if on_start is not None:
+            on_start()
+        
+        tiles_dir = TEMP_DIR / f"large-{uuid.uuid4()}"
+        # El avance se cuenta por tiles cosidos, no por el de cada tile en el motor
+        reporter = current_reporter()
+        tiler = TiledUpscaler(
+            lambda path, stop: self.upscale(
+                path,
+                scale,
+                model,
+                tile_size=tile_size,
+                cancel_event=stop,
+                priority=priority,
+                client_id=client_id,
+                deadline=deadline,
+                engine=engine
+            ),
+            scale,
+            tiles_dir,
+            # Cada tile con su contexto debe caber en lo que el motor procesa de una vez
+            min(LARGE_IMAGE_TILE_SIZE, MAX_IMAGE_SIZE - 2 * LARGE_IMAGE_TILE_OVERLAP),
+            LARGE_IMAGE_TILE_OVERLAP,
+            LARGE_IMAGE_TILES_IN_FLIGHT,
+            cancel_event,
+            on_tile_done=(
+                lambda done, total: reporter(
+                    {"percent": round(100 * done / total, 2), "tiles_done": done, "tiles": total},
+                    force=done == total
+                )
+            ) if reporter is not None else None
+        )
+        output_path = OUTPUT_DIR / f"{uuid.uuid4()}.png"
+        start = time.monotonic()
+        with self.janitor.pinned(input_path, tiles_dir, output_path), reporting(None):
+            tiler.run(input_path, output_path)
+        logger.info(f"Imagen grande reescalada en {time.monotonic() - start:.1f}s: {output_path}")
+        return output_path
+    
+    def _preview_task(
+        self,
+        input_path: Path,
+        scale: int,
+        model: str,
+        region: Optional[Region],
+        tile_size: int,
+        cancel_event: Optional[threading.Event] = None,
+        deadline: Optional[float] = None,
+        engine: str = "auto",
+        device: Optional[Device] = None
+    ) -> PreviewResult:
+        """Tarea interna de vista previa: recorta, reescala y quita el margen"""
+        if cancel_event is not None and cancel_event.is_set():
+            raise UpscaleCancelled("Vista previa cancelada antes de iniciar")
+        if model not in MODELS:
+            raise ValueError(f"Modelo '{model}' no disponible")
+        
+        plan = plan_preview(input_path, region, PREVIEW_MAX_SIDE, PREVIEW_PADDING, TEMP_DIR)
+        engine_output = OUTPUT_DIR / f"{uuid.uuid4()}.png"
+        runner = self._device_engine(device, engine)
+        try:
+            # Un solo tile cubre la entrada (sin costuras internas) salvo que falte memoria
+            self._run_with_tile_retry(
+                lambda tile: runner.run(
+                    plan.input_path, engine_output, model, scale, tile, cancel_event, deadline
+                ),
+                model,
+                scale,
+                plan.size,
+                plan.size[0] * plan.size[1],
+                tile_size or plan.tile_size,
+                device.id
+            )
+            if not engine_output.exists():
+                raise RuntimeError("Archivo de salida no generado")
+            return finish_preview(engine_output, plan, scale, OUTPUT_DIR)
+        except subprocess.TimeoutExpired:
+            raise RuntimeError(f"Procesamiento excedió {PROCESSING_TIMEOUT}s")
+        finally:
+            plan.input_path.unlink(missing_ok=True)
+            engine_output.unlink(missing_ok=True)
+    
+    def preview(
+        self,
+        input_path: Path,
+        scale: int = 2,
+        model: str = "general",
+        region: Optional[Region] = None,
+        tile_size: int = 0,
+        cancel_event: Optional[threading.Event] = None,
+        client_id: str = "anonymous",
+        deadline: Optional[float] = None,
+        engine: str = "auto"
+    ) -> Future[PreviewResult]:
+        """
+        Vista previa rápida: reescala una versión reducida de la imagen o de
+        una región, en el carril de vistas previas del planificador
+        
+        Args:
+            input_path: Imagen original
+            scale: Factor de escala
+            model: Modelo a usar
+            region: Región (x, y, w, h) en píxeles de la original; None = entera
+            tile_size: Tamaño de tile (0: un tile que cubre la vista previa)
+            cancel_event: Evento que, al activarse, mata el proceso del motor
+            client_id: Identificador del cliente para repartir los workers
+            deadline: Instante (time.monotonic) en que el cliente deja de esperar
+            engine: Motor a usar ("auto" para el configurado, "cpu")
+        
+        Returns:
+            Future[PreviewResult]: Se resuelve con la vista previa ya recortada
+        
+        Raises:
+            QueueFullError: Si la cola de vistas previas está llena
+            ValueError: Si el motor pedido no existe
         """
-        # Enviar la tarea al executor en un hilo separado
-        future = self.executor.submit(
-            self._upscale_task,
+        self.resolve_engine(engine)
+        side = PREVIEW_MAX_SIDE + 2 * PREVIEW_PADDING
+        return self.scheduler.submit(
+            self._preview_task,
             input_path,
             scale,
             model,
-            denoise_strength,
+            region,
             tile_size,
-            face_enhance
+            cancel_event,
+            deadline,
+            engine,
+            priority=Priority.PREVIEW,
+            client_id=client_id,
+            cost=side * side * scale * scale / 1_000_000,
+            deadline=deadline
         )
-        return future
     
-    def cleanup_temp_files(self, max_age_hours: int = 24):
+    def _upscale_batch_task(
+        self,
+        input_dir: Path,
+        output_dir: Path,
+        scale: int,
+        model: str,
+        tile_size: int,
+        cancel_event: Optional[threading.Event] = None,
+        engine: str = "auto",
+        device: Optional[Device] = None
+    ) -> Path:
+        """Tarea interna de upscale por lotes ejecutada en hilo separado"""
+        if cancel_event is not None and cancel_event.is_set():
+            raise UpscaleCancelled("Lote cancelado antes de iniciar")
+        if model not in MODELS:
+            raise ValueError(f"Modelo '{model}' no disponible")
+        
+        output_dir.mkdir(parents=True, exist_ok=True)
+        
+        # El tile se elige para la imagen más grande del lote
+        sizes = [read_image_size(path) for path in input_dir.iterdir()]
+        largest = (max((w for w, _ in sizes), default=0), max((h for _, h in sizes), default=0))
+        pixels = sum(w * h for w, h in sizes)
+        runner = self._device_engine(device, engine)
+        try:
+            self._run_with_tile_retry(
+                lambda tile: runner.run_batch(input_dir, output_dir, model, scale, tile, cancel_event),
+                model,
+                scale,
+                largest,
+                pixels,
+                tile_size,
+                device.id
+            )
+        except subprocess.TimeoutExpired:
+            logger.error(f"Timeout al procesar lote: {input_dir}")
+            raise RuntimeError("Procesamiento del lote excedió el tiempo máximo")
+        return output_dir
+    
+    def upscale_batch(
+        self,
+        input_dir: Path,
+        output_dir: Path,
+        scale: int = 2,
+        model: str = "general",
+        tile_size: int = 0,
+        cancel_event: Optional[threading.Event] = None,
+        priority: Priority = Priority.BATCH,
+        client_id: str = "anonymous",
+        engine: str = "auto"
+    ) -> Future[Path]:
         """
-        Limpia archivos temporales antiguos
+        Reescala todas las imágenes de un directorio con una sola invocación del motor
         
         Args:
-            max_age_hours: Edad máxima en horas antes de eliminar
+            input_dir: Directorio con las imágenes de entrada
+            output_dir: Directorio donde se escribe <nombre>.png por cada entrada
+            scale: Factor de escala
+            model: Modelo a usar
+            tile_size: Tamaño de tile (0 para automático)
+            cancel_event: Evento que, al activarse, mata el proceso del motor
+            priority: Prioridad en el planificador (BATCH por defecto)
+            client_id: Identificador del cliente para repartir los workers
+            engine: Motor a usar ("auto" para el configurado, "cpu")
+        
+        Returns:
+            Future[Path]: Se resuelve con output_dir cuando termina el lote.
+                          Si falla, las salidas ya escritas siguen en output_dir.
+        
+        Raises:
+            QueueFullError: Si la cola del planificador está llena
+            ValueError: Si el motor pedido no existe
         """
-        import time
-        current_time = time.time()
-        max_age_seconds = max_age_hours * 3600
+        self.resolve_engine(engine)
+        return self.scheduler.submit(
+            self._upscale_batch_task,
+            input_dir,
+            output_dir,
+            scale,
+            model,
+            tile_size,
+            cancel_event,
+            engine,
+            priority=priority,
+            client_id=client_id,
+            cost=self._estimate_cost(list(input_dir.iterdir()), scale)
+        )
+    
+    @staticmethod
+    def _estimate_cost(paths: list, scale: int) -> float:
+        """Coste relativo de una tarea: megapíxeles de salida (leídos de la cabecera)"""
+        pixels = 0
+        for path in paths:
+            try:
+                width, height = read_image_size(path)
+            except OSError:
+                # Se valida al ejecutar; aquí basta una estimación
+                width, height = 1024, 1024
+            pixels += width * height
+        return max(pixels * scale * scale / 1_000_000, 0.01)
+    
+    def estimate(
+        self,
+        width: int,
+        height: int,
+        model: str,
+        scale: int,
+        priority: Priority = Priority.INTERACTIVE
+    ) -> dict:
+        """
+        Estimación de espera y proceso para una imagen, sin encolarla
         
-        for directory in [TEMP_DIR, OUTPUT_DIR]:
-            for file_path in directory.glob("*"):
-                if file_path.is_file():
-                    file_age = current_time - file_path.stat().st_mtime
-                    if file_age > max_age_seconds:
-                        try:
-                            file_path.unlink()
-                            logger.info(f"Archivo temporal eliminado: {file_path}")
-                        except Exception as e:
-                            logger.warning(f"No se pudo eliminar {file_path}: {e}")
+        Returns:
+            dict: La estimación de DevicePool.estimate más el coste de la tarea
+        
+        Raises:
+            ValueError: Si el modelo no existe o la imagen supera LARGE_IMAGE_MAX_SIZE
+        """
+        if model not in MODELS:
+            raise ValueError(f"Modelo '{model}' no disponible")
+        if max(width, height) > LARGE_IMAGE_MAX_SIZE:
+            raise ValueError(
+                f"Imagen demasiado grande: {width}x{height}. "
+                f"Máximo permitido: {LARGE_IMAGE_MAX_SIZE}px por lado"
+            )
+        if priority == Priority.PREVIEW:
+            # Igual que preview(): la entrada se reduce a PREVIEW_MAX_SIDE
+            side = PREVIEW_MAX_SIDE + 2 * PREVIEW_PADDING
+            cost = side * side * scale * scale / 1_000_000
+        else:
+            cost = max(width * height * scale * scale / 1_000_000, 0.01)
+        return {**self.scheduler.estimate(cost, priority), "cost": cost}
+    
+    def readiness(self) -> dict:
+        """
+        Comprueba si la instancia debe recibir tráfico: modelos disponibles y
+        calentados, algún dispositivo sano, cola sin saturar y disco libre
+        
+        Returns:
+            dict: {"ready", "reasons", "checks"}
+        """
+        reasons = []
+        checks: dict = {}
+        
+        models = self.get_available_models()
+        checks["models"] = [m["id"] for m in models]
+        if not models:
+            reasons.append("No hay modelos disponibles")
+        
+        checks["warmup"] = self.warmup_state()
+        if not self.warmup_done.is_set():
+            reasons.append("Calentamiento de modelos en curso")
+        
+        stats = self.scheduler.stats()
+        healthy = [d["name"] for d in stats["devices"] if d["healthy"]]
+        checks["devices"] = {"healthy": healthy, "total": len(stats["devices"])}
+        if not healthy:
+            reasons.append("Ningún dispositivo de cómputo disponible")
+        
+        saturation = stats["queue_depth"] / stats["max_queue_size"] if stats["max_queue_size"] else 1.0
+        checks["queue"] = {
+            "depth": stats["queue_depth"],
+            "max": stats["max_queue_size"],
+            "saturation": round(saturation, 3),
+            "estimated_wait": stats["estimated_wait"]
+        }
+        if saturation >= READY_QUEUE_SATURATION or not self.scheduler.has_capacity():
+            reasons.append(f"Cola saturada ({stats['queue_depth']}/{stats['max_queue_size']})")
+        
+        checks["disk_free_mb"] = {}
+        for name, directory in (("temp", TEMP_DIR), ("output", OUTPUT_DIR)):
+            free_mb = shutil.disk_usage(directory).free // (1024 * 1024)
+            checks["disk_free_mb"][name] = free_mb
+            if free_mb < MIN_FREE_DISK_MB:
+                reasons.append(f"Poco espacio libre en {directory} ({free_mb} MB)")
+        
+        return {"ready": not reasons, "reasons": reasons, "checks": checks}
     
     def get_available_models(self) -> list:
         """
@@ -240,25 +1147,88 @@ class RealESRGANService:
         Returns:
             list: Lista de modelos disponibles con su información
         """
-        available = []
-        
-        for model_id, model_info in MODELS.items():
-            model_path = MODELS_DIR / model_info["filename"]
-            param_path = MODELS_DIR / model_info["param_filename"]
-            
-            if model_path.exists() and param_path.exists():
-                available.append({
-                    "id": model_id,
-                    "name": model_info["name"],
-                    "description": model_info["description"],
-                    "scale": model_info["scale"]
-                })
-        
-        return available
+        # Validados al arrancar y al cambiar MODELS_DIR: no se accede al disco.
+        # El motor CPU no usa los pesos: con él todos los modelos están disponibles
+        return self.models.available()
+    
+    def _warm_task(self, input_path: Path, model: str, device: Optional[Device] = None) -> float:
+        """Inferencia mínima con un modelo en un dispositivo; devuelve los segundos"""
+        output_path = OUTPUT_DIR / f"warmup-{uuid.uuid4()}.png"
+        start = time.monotonic()
+        try:
+            device.engine.run(input_path, output_path, model, MODELS[model]["scale"], 0)
+        finally:
+            output_path.unlink(missing_ok=True)
+        return time.monotonic() - start
+    
+    def warm_up(self):
+        """
+        Ejecuta una inferencia mínima por modelo disponible y dispositivo, para
+        que la primera petición real no pague la carga del modelo ni la
+        inicialización de Vulkan. Solo calienta los pares que aún no lo están
+        o cuyo modelo cambió. Al terminar se activa warmup_done.
+        """
+        with self._warm_lock:
+            input_path = TEMP_DIR / f"warmup-{uuid.uuid4()}.png"
+            Image.new("RGB", (WARMUP_IMAGE_SIZE, WARMUP_IMAGE_SIZE), (128, 128, 128)).save(input_path)
+            pending = []
+            try:
+                status = self.models.status()
+                for device in self.scheduler.devices:
+                    for model, state in status.items():
+                        key = (device.id, model)
+                        warm = self._warm.get(key)
+                        if not state["available"] or (warm is not None and warm["sha256"] == state["sha256"]):
+                            continue
+                        try:
+                            future = self.scheduler.submit_to(
+                                device, self._warm_task, input_path, model,
+                                priority=Priority.BATCH, cost=0
+                            )
+                        except QueueFullError:
+                            logger.warning(f"Cola llena: se omite el calentamiento de {model} en {device.name}")
+                            continue
+                        pending.append((key, state["sha256"], future))
+                
+                for (device_id, model), checksum, future in pending:
+                    try:
+                        seconds = future.result()
+                        self._warm[(device_id, model)] = {"seconds": seconds, "sha256": checksum, "error": None}
+                        logger.info(f"Modelo '{model}' calentado en el dispositivo {device_id} ({seconds:.2f}s)")
+                    except Exception as e:
+                        self._warm[(device_id, model)] = {"seconds": None, "sha256": checksum, "error": str(e)}
+                        logger.warning(f"Fallo al calentar '{model}' en el dispositivo {device_id}: {e}")
+            finally:
+                input_path.unlink(missing_ok=True)
+                self.warmup_done.set()
+    
+    def start_warm_up(self):
+        """Lanza el calentamiento en segundo plano (o lo da por hecho si está desactivado)"""
+        if not WARMUP_ENABLED:
+            self.warmup_done.set()
+            return
+        threading.Thread(target=self.warm_up, name="warmup", daemon=True).start()
+    
+    def warmup_state(self) -> dict:
+        """Estado del calentamiento por modelo y dispositivo"""
+        models: dict = {}
+        for (device_id, model), warm in sorted(self._warm.items()):
+            models.setdefault(model, {})[str(device_id)] = {
+                "seconds": round(warm["seconds"], 3) if warm["seconds"] is not None else None,
+                "error": warm["error"]
+            }
+        return {"enabled": WARMUP_ENABLED, "done": self.warmup_done.is_set(), "models": models}
     
     def shutdown(self):
-        """Cierra el executor de hilos (llamar al salir de la app)"""
-        self.executor.shutdown(wait=True)
+        """Cierra el planificador de hilos y el motor (llamar al salir de la app)"""
+        self.models.stop_watch()
+        self.janitor.stop()
+        self._large_executor.shutdown(wait=False, cancel_futures=True)
+        self.encoder.shutdown()
+        self.codec.shutdown()
+        self.scheduler.shutdown(wait=True)  # También cierra el motor de cada dispositivo
+        if self.tile_tuner is not None:
+            self.tile_tuner.flush()
 
 
 # Instancia global del servicio
@@ -55,7 +55,8 @@ def check_dependencies():
         'fastapi': 'FastAPI',
         'uvicorn': 'Uvicorn',
         'PIL': 'Pillow',
-        'pydantic': 'Pydantic'
+        'pydantic': 'Pydantic',
+        'numpy': 'NumPy'
     }
     
     all_ok = True
@@ -0,0 +1,410 @@
+"""
+Pipeline de reescalado de video para rIA
+Decodifica los frames con ffmpeg, los reescala por bloques a través de
+RealESRGANService y los vuelve a codificar conservando el audio original.
+
+Las tres etapas (decodificar -> reescalar -> codificar) se solapan en hilos
+separados y el número de bloques presentes en disco está acotado por
+VIDEO_MAX_CHUNKS_ON_DISK, así que el uso de disco no depende de la duración.
+"""
+
+import json
+import logging
+import queue
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass
+from fractions import Fraction
+from pathlib import Path
+from typing import Callable, Optional
+
+from PIL import Image
+
+from config import (
+    FFMPEG_BINARY,
+    FFPROBE_BINARY,
+    MAX_IMAGE_SIZE,
+    TEMP_DIR,
+    VIDEO_CHUNK_FRAMES,
+    VIDEO_CRF,
+    VIDEO_MAX_CHUNKS_ON_DISK
+)
+from engines import UpscaleCancelled
+from scheduler import Priority, QueueFullError
+from upscale_service import RealESRGANService
+
+logger = logging.getLogger(__name__)
+
+# Intervalo de sondeo para detectar cancelaciones y errores entre etapas (segundos)
+PIPELINE_POLL_INTERVAL = 0.2
+
+
+class VideoPipelineError(RuntimeError):
+    """Fallo en alguna etapa del pipeline de video"""
+
+
+def ffmpeg_available() -> bool:
+    """Indica si ffmpeg y ffprobe están instalados"""
+    return shutil.which(FFMPEG_BINARY) is not None and shutil.which(FFPROBE_BINARY) is not None
+
+
+def probe_video(path: Path) -> dict:
+    """
+    Obtiene dimensiones, fps, número de frames y presencia de audio
+
+    Returns:
+        dict: width, height, fps (Fraction), frames (estimado) y has_audio
+    """
+    result = subprocess.run(
+        [
+            FFPROBE_BINARY, "-v", "error",
+            "-show_entries", "stream=codec_type,width,height,r_frame_rate,nb_frames",
+            "-show_entries", "format=duration",
+            "-of", "json", str(path)
+        ],
+        capture_output=True,
+        text=True,
+        check=False
+    )
+    if result.returncode != 0:
+        raise VideoPipelineError(f"No se pudo leer el video: {result.stderr.strip()}")
+
+    info = json.loads(result.stdout)
+    streams = info.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), None)
+    if video is None:
+        raise VideoPipelineError("El archivo no contiene una pista de video")
+
+    fps = Fraction(video.get("r_frame_rate", "0/1"))
+    frames = int(video.get("nb_frames") or 0)
+    if not frames:
+        duration = float(info.get("format", {}).get("duration") or 0)
+        frames = int(duration * fps) if fps else 0
+
+    return {
+        "width": int(video["width"]),
+        "height": int(video["height"]),
+        "fps": fps,
+        "frames": frames,
+        "has_audio": any(s.get("codec_type") == "audio" for s in streams)
+    }
+
+
+@dataclass
+class _Chunk:
+    """Bloque de frames consecutivos que se reescala con una invocación del motor"""
+    index: int
+    directory: Path
+    frame_count: int = 0
+    future: Optional[object] = None
+
+    @property
+    def input_dir(self) -> Path:
+        return self.directory / "in"
+
+    @property
+    def output_dir(self) -> Path:
+        return self.directory / "out"
+
+
+class VideoPipeline:
+    """Reescala un video completo con decodificación, upscale y codificación solapados"""
+
+    def __init__(
+        self,
+        service: RealESRGANService,
+        input_path: Path,
+        output_path: Path,
+        model: str,
+        scale: int,
+        tile_size: int = 0,
+        cancel_event: Optional[threading.Event] = None,
+        client_id: str = "anonymous",
+        on_progress: Optional[Callable[[dict], None]] = None,
+        engine: str = "auto"
+    ):
+        self.service = service
+        self.input_path = input_path
+        self.output_path = output_path
+        self.model = model
+        self.scale = scale
+        self.tile_size = tile_size
+        self.engine = engine
+        self.cancel_event = cancel_event or threading.Event()
+        self.client_id = client_id
+        self.on_progress = on_progress
+
+        self.work_dir = TEMP_DIR / f"video-{uuid.uuid4()}"
+        # Plazas de bloques en disco: acotan el espacio usado por el pipeline
+        self._slots = threading.Semaphore(VIDEO_MAX_CHUNKS_ON_DISK)
+        self._decoded: queue.Queue = queue.Queue()
+        self._upscaled: queue.Queue = queue.Queue()
+        self._abort = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._processes: list = []
+
+        self.total_frames = 0
+        self.frames_done = 0
+        self._start_time = 0.0
+
+    def run(self) -> Path:
+        """
+        Ejecuta el pipeline completo
+
+        Returns:
+            Path: Ruta al video reescalado
+
+        Raises:
+            UpscaleCancelled: Si se canceló el trabajo
+            VideoPipelineError: Si falló alguna etapa
+        """
+        info = probe_video(self.input_path)
+        if info["width"] > MAX_IMAGE_SIZE or info["height"] > MAX_IMAGE_SIZE:
+            raise VideoPipelineError(
+                f"Video demasiado grande. Máximo: {MAX_IMAGE_SIZE}px por lado"
+            )
+
+        self.total_frames = info["frames"]
+        self._start_time = time.time()
+        self.work_dir.mkdir(parents=True)
+        logger.info(
+            f"Video {info['width']}x{info['height']} @ {float(info['fps']):.2f} fps, "
+            f"~{self.total_frames} frames"
+        )
+
+        decoder = threading.Thread(target=self._guard, args=(self._decode, info), daemon=True)
+        encoder = threading.Thread(target=self._guard, args=(self._encode, info), daemon=True)
+        decoder.start()
+        encoder.start()
+
+        self.service.janitor.pin(self.work_dir)
+        self.service.janitor.pin(self.output_path)
+        try:
+            self._upscale_stage()
+            encoder.join()
+            self._check_failed()
+            return self.output_path
+        except BaseException:
+            self._stop()
+            self.output_path.unlink(missing_ok=True)
+            raise
+        finally:
+            self._abort.set()
+            decoder.join(timeout=5)
+            encoder.join(timeout=5)
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+            self.service.janitor.unpin(self.work_dir)
+            self.service.janitor.unpin(self.output_path)
+
+    def _guard(self, target: Callable, *args):
+        """Ejecuta una etapa en su hilo y registra el primer error"""
+        try:
+            target(*args)
+        except BaseException as e:
+            if self._error is None:
+                self._error = e
+            self._abort.set()
+
+    def _check_failed(self):
+        if self.cancel_event.is_set():
+            raise UpscaleCancelled("Video cancelado")
+        if self._error is not None:
+            if isinstance(self._error, (UpscaleCancelled, VideoPipelineError)):
+                raise self._error
+            raise VideoPipelineError(str(self._error)) from self._error
+
+    def _stop(self):
+        """Detiene todas las etapas y mata los procesos de ffmpeg"""
+        self._abort.set()
+        self.cancel_event.set()
+        for process in self._processes:
+            if process.poll() is None:
+                process.kill()
+
+    def _wait_slot(self):
+        while not self._slots.acquire(timeout=PIPELINE_POLL_INTERVAL):
+            if self._abort.is_set():
+                raise UpscaleCancelled("Pipeline detenido")
+
+    def _decode(self, info: dict):
+        """Etapa 1: ffmpeg -> frames RGB -> bloques de PNG en disco"""
+        width, height = info["width"], info["height"]
+        frame_bytes = width * height * 3
+        with open(self.work_dir / "decode.log", "wb") as log:
+            process = subprocess.Popen(
+                [
+                    FFMPEG_BINARY, "-v", "error", "-i", str(self.input_path),
+                    "-f", "rawvideo", "-pix_fmt", "rgb24", "-"
+                ],
+                stdout=subprocess.PIPE,
+                stderr=log
+            )
+        self._processes.append(process)
+
+        frame_index = 0
+        chunk_index = 0
+        end_of_stream = False
+        while not end_of_stream and not self._abort.is_set():
+            self._wait_slot()
+            chunk = _Chunk(chunk_index, self.work_dir / f"chunk-{chunk_index:05d}")
+            chunk.input_dir.mkdir(parents=True)
+
+            while chunk.frame_count < VIDEO_CHUNK_FRAMES:
+                data = process.stdout.read(frame_bytes)
+                if len(data) < frame_bytes:
+                    end_of_stream = True
+                    break
+                frame = Image.frombytes("RGB", (width, height), data)
+                # Compresión mínima: el PNG solo vive hasta que el motor lo lee
+                frame.save(chunk.input_dir / f"{frame_index:08d}.png", compress_level=1)
+                frame_index += 1
+                chunk.frame_count += 1
+
+            if chunk.frame_count:
+                self._decoded.put(chunk)
+                chunk_index += 1
+            else:
+                shutil.rmtree(chunk.directory, ignore_errors=True)
+                self._slots.release()
+
+        process.wait()
+        if process.returncode not in (0, None) and not self._abort.is_set():
+            log_text = (self.work_dir / "decode.log").read_text(errors="replace")
+            raise VideoPipelineError(f"ffmpeg falló al decodificar: {log_text.strip()}")
+        self._decoded.put(None)
+
+    def _submit_chunk(self, chunk: _Chunk):
+        """Envía un bloque al planificador, esperando si la cola está llena"""
+        while True:
+            try:
+                chunk.future = self.service.upscale_batch(
+                    chunk.input_dir,
+                    chunk.output_dir,
+                    scale=self.scale,
+                    model=self.model,
+                    tile_size=self.tile_size,
+                    cancel_event=self.cancel_event,
+                    priority=Priority.BATCH,
+                    client_id=self.client_id,
+                    engine=self.engine
+                )
+                return
+            except QueueFullError as e:
+                if self._abort.wait(min(max(e.retry_after, 1.0), 10.0)):
+                    raise UpscaleCancelled("Pipeline detenido")
+
+    def _upscale_stage(self):
+        """Etapa 2: reescala los bloques y los entrega en orden al codificador"""
+        in_flight: deque = deque()
+        decoding = True
+
+        while decoding or in_flight:
+            if self.cancel_event.is_set() or self._error is not None:
+                self._check_failed()
+
+            # Entregar en orden los bloques ya reescalados
+            while in_flight and in_flight[0].future.done():
+                chunk = in_flight.popleft()
+                error = chunk.future.exception()
+                if error is not None:
+                    raise error
+                shutil.rmtree(chunk.input_dir, ignore_errors=True)
+                self._upscaled.put(chunk)
+
+            if not decoding:
+                time.sleep(PIPELINE_POLL_INTERVAL)
+                continue
+
+            try:
+                chunk = self._decoded.get(timeout=PIPELINE_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if chunk is None:
+                decoding = False
+                continue
+
+            self._submit_chunk(chunk)
+            in_flight.append(chunk)
+
+        self._upscaled.put(None)
+
+    def _encode(self, info: dict):
+        """Etapa 3: frames reescalados -> ffmpeg (con el audio original)"""
+        process = None
+        log_path = self.work_dir / "encode.log"
+
+        while True:
+            try:
+                chunk = self._upscaled.get(timeout=PIPELINE_POLL_INTERVAL)
+            except queue.Empty:
+                if self._abort.is_set():
+                    return
+                continue
+            if chunk is None:
+                break
+
+            frames = sorted(chunk.output_dir.glob("*.png"))
+            if len(frames) != chunk.frame_count:
+                raise VideoPipelineError(
+                    f"El bloque {chunk.index} generó {len(frames)} de {chunk.frame_count} frames"
+                )
+
+            for frame_path in frames:
+                with Image.open(frame_path) as frame:
+                    frame = frame.convert("RGB")
+                if process is None:
+                    process = self._start_encoder(info, frame.size, log_path)
+                process.stdin.write(frame.tobytes())
+                self.frames_done += 1
+
+            shutil.rmtree(chunk.directory, ignore_errors=True)
+            self._slots.release()
+            self._report_progress()
+
+        if process is None:
+            raise VideoPipelineError("El video no contiene frames")
+
+        process.stdin.close()
+        process.wait()
+        if process.returncode != 0:
+            log_text = log_path.read_text(errors="replace")
+            raise VideoPipelineError(f"ffmpeg falló al codificar: {log_text.strip()}")
+
+    def _start_encoder(self, info: dict, size: tuple, log_path: Path) -> subprocess.Popen:
+        width, height = size
+        cmd = [
+            FFMPEG_BINARY, "-v", "error", "-y",
+            "-f", "rawvideo", "-pix_fmt", "rgb24",
+            "-s", f"{width}x{height}",
+            "-r", str(info["fps"]),
+            "-i", "-",
+            "-i", str(self.input_path),
+            "-map", "0:v", "-map", "1:a?",
+            # yuv420p exige dimensiones pares
+            "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+            "-c:v", "libx264", "-crf", str(VIDEO_CRF), "-pix_fmt", "yuv420p",
+            "-c:a", "copy",
+            str(self.output_path)
+        ]
+        with open(log_path, "wb") as log:
+            process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=log)
+        self._processes.append(process)
+        return process
+
+    def _report_progress(self):
+        if self.on_progress is None:
+            return
+        elapsed = time.time() - self._start_time
+        # El total es una estimación (duración x fps) si el contenedor no lo indica
+        total = max(self.total_frames, self.frames_done)
+        self.on_progress({
+            "frames_done": self.frames_done,
+            "total_frames": total,
+            "percent": 100.0 * self.frames_done / total if total else None,
+            "fps": self.frames_done / elapsed if elapsed > 0 else 0.0,
+            "elapsed": elapsed
+        })
@@ -20,11 +20,70 @@ export async function checkBackendHealth() {
   }
 }
 
+/**
+ * Genera un ID para la cabecera X-Request-ID (también identifica el canal de progreso)
+ */
+function createRequestId() {
+  if (window.crypto && window.crypto.randomUUID) {
+    return window.crypto.randomUUID().replace(/-/g, '');
+  }
+  return `${Date.now().toString(16)}${Math.random().toString(16).slice(2)}`;
+}
+
+/**
+ * Sigue el progreso de un upscale síncrono enviado con X-Request-ID
+ * 
+ * El backend publica el avance real del motor (porcentaje de tiles) por
+ * Server-Sent Events en /api/progress/{requestId}.
+ * 
+ * @param {string} requestId - Valor enviado en la cabecera X-Request-ID
+ * @param {Function} onProgress - Recibe {state, percent, ...} en cada actualización
+ * @returns {Function} - Cierra la conexión
+ */
+export function subscribeUpscaleProgress(requestId, onProgress) {
+  const source = new EventSource(`${API_BASE_URL}/api/progress/${requestId}`);
+  const handle = (event) => onProgress(JSON.parse(event.data));
+
+  source.addEventListener('progress', handle);
+  source.addEventListener('done', (event) => {
+    handle(event);
+    // Sin cerrar, EventSource se reconectaría al terminar el stream
+    source.close();
+  });
+  return () => source.close();
+}
+
+/**
+ * Sigue el estado de un trabajo por Server-Sent Events (/api/jobs/{id}/events)
+ * 
+ * @param {string} jobId - ID del trabajo
+ * @param {Function} onStatus - Recibe el estado del trabajo en cada cambio
+ * @returns {Promise<object>} - Estado final del trabajo
+ */
+export function watchJob(jobId, onStatus) {
+  return new Promise((resolve, reject) => {
+    const source = new EventSource(`${API_BASE_URL}/api/jobs/${jobId}/events`);
+
+    source.addEventListener('status', (event) => {
+      if (onStatus) onStatus(JSON.parse(event.data));
+    });
+    source.addEventListener('done', (event) => {
+      source.close();
+      resolve(JSON.parse(event.data));
+    });
+    source.onerror = () => {
+      source.close();
+      reject(new Error('Se perdió la conexión con el stream de eventos del trabajo'));
+    };
+  });
+}
+
 /**
  * Reescala una imagen usando el backend de IA
  * 
  * @param {string} imageBase64 - Imagen en formato base64
- * @param {object} options - Opciones de reescalado
+ * @param {object} options - Opciones de reescalado (+ onProgress para el avance real;
+ *                           format y quality para pedir webp o jpg en lugar de PNG)
  * @returns {Promise<object>} - Resultado con la imagen reescalada
  */
 export async function upscaleImageWithBackend(imageBase64, options = {}) {
@@ -32,9 +91,19 @@ export async function upscaleImageWithBackend(imageBase64, options = {}) {
     scale = 2,
     model = 'general',
     denoiseStrength = 50,
-    upscaleType = 'AI Enhanced'
+    upscaleType = 'AI Enhanced',
+    format,
+    quality,
+    onProgress
   } = options;
 
+  const requestId = createRequestId();
+  const unsubscribe = onProgress
+    ? subscribeUpscaleProgress(requestId, (update) => {
+        if (update.percent !== undefined) onProgress(update.percent, update);
+      })
+    : null;
+
   try {
     // Crear AbortController para timeout personalizado
     // 900000ms = 15 minutos (ajustable según necesidad)
@@ -45,6 +114,7 @@ export async function upscaleImageWithBackend(imageBase64, options = {}) {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
+        'X-Request-ID': requestId,
       },
       signal: controller.signal,
       body: JSON.stringify({
@@ -52,7 +122,9 @@ export async function upscaleImageWithBackend(imageBase64, options = {}) {
         scale,
         model,
         denoise_strength: denoiseStrength,
-        upscale_type: upscaleType
+        upscale_type: upscaleType,
+        format,
+        quality
       })
     });
 
@@ -81,9 +153,179 @@ export async function upscaleImageWithBackend(imageBase64, options = {}) {
     }
     console.error('Error al llamar al backend:', error);
     throw error;
+  } finally {
+    if (unsubscribe) unsubscribe();
   }
 }
 
+/**
+ * Reescala una imagen enviándola en binario (sin base64)
+ * 
+ * El backend devuelve la imagen (PNG, o el format pedido) directamente y el
+ * tamaño en cabeceras, evitando el 33% extra de base64 y los JSON gigantes.
+ * 
+ * @param {Blob} imageBlob - Imagen (File o Blob con tipo image/*)
+ * @param {object} options - Opciones de reescalado
+ * @returns {Promise<object>} - Resultado con la imagen reescalada (object URL)
+ */
+export async function upscaleImageBinary(imageBlob, options = {}) {
+  const {
+    scale = 2,
+    model = 'general',
+    denoiseStrength = 50,
+    tileSize = 0,
+    format,
+    quality
+  } = options;
+
+  const params = new URLSearchParams({
+    scale: String(scale),
+    model,
+    denoise_strength: String(denoiseStrength),
+    tile_size: String(tileSize)
+  });
+  if (format) params.set('format', format);
+  if (quality) params.set('quality', String(quality));
+
+  const response = await fetch(`${API_BASE_URL}/api/upscale?${params}`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': imageBlob.type || 'image/png',
+    },
+    body: imageBlob
+  });
+
+  if (!response.ok) {
+    throw new Error(`Error del servidor: ${response.status}`);
+  }
+
+  const blob = await response.blob();
+  return {
+    success: true,
+    image: URL.createObjectURL(blob),
+    width: Number(response.headers.get('X-Image-Width')),
+    height: Number(response.headers.get('X-Image-Height')),
+    processingTime: Number(response.headers.get('X-Processing-Time'))
+  };
+}
+
+/**
+ * Encola un reescalado como trabajo asíncrono y retorna su estado inicial
+ * 
+ * @param {string} imageBase64 - Imagen en formato base64
+ * @param {object} options - Opciones de reescalado
+ * @returns {Promise<object>} - Estado del trabajo (incluye job_id)
+ */
+export async function submitUpscaleJob(imageBase64, options = {}) {
+  const {
+    scale = 2,
+    model = 'general',
+    denoiseStrength = 50,
+    upscaleType = 'AI Enhanced',
+    format,
+    quality
+  } = options;
+
+  const response = await fetch(`${API_BASE_URL}/api/jobs`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify({
+      image: imageBase64,
+      scale,
+      model,
+      denoise_strength: denoiseStrength,
+      upscale_type: upscaleType,
+      format,
+      quality
+    })
+  });
+
+  if (!response.ok) {
+    throw new Error(`Error del servidor: ${response.status}`);
+  }
+
+  return await response.json();
+}
+
+/**
+ * Consulta el estado de un trabajo (cola, tiempos, errores)
+ */
+export async function getJobStatus(jobId) {
+  const response = await fetch(`${API_BASE_URL}/api/jobs/${jobId}`);
+
+  if (!response.ok) {
+    throw new Error(`Error del servidor: ${response.status}`);
+  }
+
+  return await response.json();
+}
+
+/**
+ * Cancela un trabajo en cola o en ejecución
+ */
+export async function cancelUpscaleJob(jobId) {
+  const response = await fetch(`${API_BASE_URL}/api/jobs/${jobId}`, {
+    method: 'DELETE'
+  });
+
+  if (!response.ok) {
+    throw new Error(`Error del servidor: ${response.status}`);
+  }
+
+  return await response.json();
+}
+
+/**
+ * Reescala una imagen mediante la API de trabajos: encola, sigue el estado
+ * (por Server-Sent Events, o consultándolo periódicamente si el stream
+ * falla) y descarga el resultado al terminar.
+ * 
+ * @param {string} imageBase64 - Imagen en formato base64
+ * @param {object} options - Opciones de reescalado (+ pollInterval, onStatus)
+ * @returns {Promise<object>} - Resultado con la imagen reescalada (object URL)
+ */
+export async function upscaleImageWithJob(imageBase64, options = {}) {
+  const { pollInterval = 1000, onStatus } = options;
+
+  let job = await submitUpscaleJob(imageBase64, options);
+
+  if ((job.state === 'queued' || job.state === 'running') && window.EventSource) {
+    if (onStatus) onStatus(job);
+    try {
+      job = await watchJob(job.job_id, onStatus);
+    } catch (error) {
+      console.warn('Stream de eventos no disponible, consultando el estado:', error);
+    }
+  }
+
+  while (job.state === 'queued' || job.state === 'running') {
+    if (onStatus) onStatus(job);
+    await new Promise((resolve) => setTimeout(resolve, pollInterval));
+    job = await getJobStatus(job.job_id);
+  }
+
+  if (onStatus) onStatus(job);
+
+  if (job.state !== 'completed') {
+    throw new Error(job.error || `El trabajo terminó en estado: ${job.state}`);
+  }
+
+  const response = await fetch(`${API_BASE_URL}/api/jobs/${job.job_id}/result`);
+  if (!response.ok) {
+    throw new Error(`Error del servidor: ${response.status}`);
+  }
+
+  const blob = await response.blob();
+  return {
+    success: true,
+    image: URL.createObjectURL(blob),
+    jobId: job.job_id,
+    processingTime: job.processing_time
+  };
+}
+
 /**
  * Obtiene los modelos de IA disponibles
  */
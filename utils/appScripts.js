@@ -77,9 +77,11 @@ export const upscaleImage = async (
       console.log("✅ Backend disponible, procesando con Real-ESRGAN...");
       console.log(`📊 Parámetros: modelo="${model}", escala=${scale}x, denoise=${denoiseStrength}%, tipo="${upscaleType}"`);
       
-      // Simular progreso mientras procesa el backend
+      // El backend publica el avance real del motor; mientras no llegue
+      // (p. ej. a través de Electron) se simula como antes
+      let realProgress = false;
       const progressInterval = setInterval(() => {
-        setProgress(prev => Math.min(prev + 5, 90));
+        if (!realProgress) setProgress(prev => Math.min(prev + 5, 90));
       }, 500);
       
       try {
@@ -89,7 +91,12 @@ export const upscaleImage = async (
           scale,
           model,
           denoiseStrength,
-          upscaleType
+          upscaleType,
+          onProgress: (percent) => {
+            realProgress = true;
+            // El 100% se muestra al recibir la imagen
+            setProgress(Math.min(Math.round(percent), 99));
+          }
         });
         
         clearInterval(progressInterval);